@@ -0,0 +1,91 @@
+"""Stand-ins for InfluxDB that count and validate the lines they receive."""
+import asyncio
+import gzip
+import json
+
+from aiohttp import web
+
+from influxproxy.ingestion import LINE
+
+
+class LineCounter:
+    """Counts received lines, checking each one's structure."""
+
+    def __init__(self):
+        self.lines = 0
+        self.invalid = 0
+        self.payloads = 0
+
+    def count(self, data):
+        self.payloads += 1
+        for line in data.splitlines():
+            if not line:
+                continue
+            self.lines += 1
+            if LINE.match(line) is None:
+                self.invalid += 1
+
+    def as_dict(self):
+        return {
+            'payloads': self.payloads,
+            'lines': self.lines,
+            'invalid_lines': self.invalid,
+        }
+
+
+class FakeUDPBackend(asyncio.DatagramProtocol):
+    """Listens for line protocol datagrams, as InfluxDB's UDP service."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.counter = LineCounter()
+        self.transport = None
+        self.port = None
+
+    async def start(self):
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: self, local_addr=('127.0.0.1', 0))
+        self.port = self.transport.get_extra_info('sockname')[1]
+
+    def stop(self):
+        self.transport.close()
+
+    def datagram_received(self, data, address):
+        self.counter.count(data)
+
+
+class FakeHTTPBackend:
+    """Answers InfluxDB's /write and /query endpoints, counting lines."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.counter = LineCounter()
+        self.app = web.Application(loop=loop)
+        self.app.router.add_route('POST', '/write', self.write)
+        self.app.router.add_route('*', '/query', self.query)
+        self.handler = None
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.handler = self.app.make_handler(access_log=None)
+        self.server = await self.loop.create_server(
+            self.handler, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.handler.finish_connections()
+
+    async def write(self, request):
+        body = await request.read()
+        if request.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        self.counter.count(body)
+        return web.Response(status=204)
+
+    async def query(self, request):
+        return web.Response(
+            body=json.dumps({'results': [{'statement_id': 0}]}).encode(),
+            content_type='application/json')
@@ -0,0 +1,91 @@
+"""Compares ingestion throughput of compressed and uncompressed bodies.
+
+Batches of beacon points are posted through the ``send_metric`` handler as
+JSON and NDJSON, plain and gzipped, with an in-memory backend standing in
+for InfluxDB, so the cost of inflating a body can be weighed against the
+bytes it saves on the wire.
+
+Run with::
+
+    APP_SETTINGS_YAML=testing.yaml python -m benchmarks.compression
+"""
+import asyncio
+import gzip
+import json
+import logging
+from unittest.mock import patch
+
+from aiohttp import web
+
+from benchmarks.encoder import beacon_points
+from benchmarks.stages import Stages, measure_async, write_nowhere
+from influxproxy.app import send_metric
+from influxproxy.drivers import InfluxDriver
+
+
+BATCH_SIZES = (10, 100, 1000)
+OPERATIONS = 50000
+FORMATS = (
+    ('json', 'application/json'),
+    ('ndjson', 'application/x-ndjson'),
+)
+
+
+def encode_body(points, format_name):
+    if format_name == 'json':
+        return json.dumps(points).encode('utf-8')
+    return b''.join(
+        json.dumps(point).encode('utf-8') + b'\n' for point in points)
+
+
+def post_rate(stages, body, number):
+    """Returns the time per post of a body, as the stages' headers say.
+
+    The batcher is drained after every post, as the backend writes nowhere
+    and would otherwise let its queue fill up with the larger batches.
+    """
+    batcher = stages.app['batcher']
+
+    async def send():
+        try:
+            await send_metric(stages.make_request(body))
+        except web.HTTPNoContent:
+            pass
+        await batcher.drain()
+
+    return measure_async(stages.loop, send, number)
+
+
+def main():
+    # Keeps the per-request log lines off the terminal, and out of timings.
+    logging.getLogger('influxdb.app').setLevel(logging.WARNING)
+    loop = asyncio.new_event_loop()
+    stages = Stages(loop)
+    print('{:>7} {:>6} {:>10} {:>10} {:>12} {:>12} {:>8}'.format(
+        'format', 'points', 'plain B', 'gzip B', 'plain pts/s', 'gzip pts/s',
+        'change'))
+    try:
+        with patch.object(InfluxDriver, 'write_lines', write_nowhere):
+            for format_name, content_type in FORMATS:
+                stages.headers['Content-Type'] = content_type
+                for size in BATCH_SIZES:
+                    body = encode_body(beacon_points(size), format_name)
+                    compressed = gzip.compress(body)
+                    number = max(10, OPERATIONS // size // 10)
+                    stages.headers.pop('Content-Encoding', None)
+                    plain = post_rate(stages, body, number)
+                    stages.headers['Content-Encoding'] = 'gzip'
+                    inflated = post_rate(stages, compressed, number)
+                    print(
+                        '{:>7} {:>6} {:>10,} {:>10,} {:>12,.0f} {:>12,.0f} '
+                        '{:>+7.1f}%'.format(
+                            format_name, size, len(body), len(compressed),
+                            size / plain, size / inflated,
+                            (plain / inflated - 1) * 100))
+    finally:
+        stages.close()
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Compares the line protocol encoder with influxdb-python's make_lines.
+
+Run with::
+
+    python -m benchmarks.encoder
+"""
+import timeit
+
+from influxdb.line_protocol import make_lines
+
+from influxproxy.encoder import LineEncoder
+
+
+ROUNDS = 5
+BATCH_SIZES = (1, 10, 100)
+
+
+def beacon_points(count):
+    return [
+        {
+            'measurement': 'page_load',
+            'time': '2016-09-01T12:00:{:02d}.123Z'.format(i % 60),
+            'tags': {
+                'browser': 'chrome',
+                'country': 'uk',
+                'page': '/surveys/{}'.format(i % 5),
+            },
+            'fields': {
+                'duration': 1234.5 + i,
+                'resources': i,
+                'connection': '4g',
+            },
+        }
+        for i in range(count)
+    ]
+
+
+def measure(func, number):
+    return min(timeit.repeat(func, number=number, repeat=ROUNDS)) / number
+
+
+def main():
+    encoder = LineEncoder()
+    print('{:>6} {:>14} {:>14} {:>8}'.format(
+        'points', 'make_lines/s', 'encoder/s', 'speedup'))
+    for size in BATCH_SIZES:
+        points = beacon_points(size)
+        number = max(1, 20000 // size)
+        baseline = measure(
+            lambda: make_lines({'points': points}).encode('utf-8'), number)
+        current = measure(lambda: encoder.encode(points), number)
+        print('{:>6} {:>14,.0f} {:>14,.0f} {:>7.1f}x'.format(
+            size, size / baseline, size / current, baseline / current))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,345 @@
+"""Drives the proxy with a mix of preflights and metric posts.
+
+The proxy runs in its own process, under gunicorn or aiohttp's runner, with
+a configuration pointing it at stand-in InfluxDB backends that listen here:
+one over UDP and one over HTTP, each with a database of its own. Clients
+send preflights and posts of varying sizes, as JSON or line protocol, to
+either database, until the run is over; the backends then get a moment to
+receive what the proxy had batched.
+
+Reports requests per second, latency percentiles, points delivered per
+second and the share of accepted points that never reached a backend, and
+saves them as JSON so runs can be compared between releases.
+
+Run with::
+
+    APP_SETTINGS_YAML=testing.yaml python -m benchmarks.load \\
+        --server gunicorn --workers 4 --concurrency 50 --duration 30
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+import yaml
+
+from benchmarks.backends import FakeHTTPBackend, FakeUDPBackend
+from benchmarks.encoder import beacon_points
+from influxproxy.encoder import LineEncoder
+
+
+PUBLIC_KEY = 'load-test-key'
+ORIGIN = 'https://load.example.com'
+DATABASES = ('load_udp', 'load_http')
+BATCH_MIX = ((1, 60), (10, 30), (100, 10))
+CONTENT_TYPES = ('application/json', 'text/plain')
+STARTUP_TIMEOUT = 30
+SETTLE_TIMEOUT = 10
+SERVE_AIOHTTP = """
+import asyncio, sys
+from aiohttp import web
+from influxproxy.main import app
+web.run_app(app(asyncio.get_event_loop()), host='127.0.0.1',
+            port=int(sys.argv[1]), shutdown_timeout=5)
+"""
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def proxy_config(udp_port, http_port):
+    database = {'public_key': PUBLIC_KEY, 'allow_from': '*'}
+    return {
+        'debug': False,
+        'preflight_expiration': 600,
+        'backend': {
+            'host': '127.0.0.1',
+            'port': http_port,
+            'udp_port': udp_port,
+            'username': 'root',
+            'password': 'root',
+        },
+        'databases': {
+            'load_udp': dict(database, udp_port=udp_port),
+            'load_http': dict(database, transport='http'),
+        },
+    }
+
+
+def build_payloads():
+    """Encodes the payloads upfront, keyed by content type and size."""
+    encoder = LineEncoder()
+    payloads = {}
+    for size, _ in BATCH_MIX:
+        points = beacon_points(size)
+        payloads['application/json', size] = json.dumps(points).encode()
+        payloads['text/plain', size] = encoder.encode(points)
+    return payloads
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Proxy:
+    """Runs the proxy in a child process, against a generated config."""
+
+    def __init__(self, server, workers, config, log):
+        self.server = server
+        self.workers = workers
+        self.log = log
+        self.port = free_port()
+        self.config_file = tempfile.NamedTemporaryFile(
+            'w', suffix='.yaml', delete=False)
+        yaml.safe_dump(config, self.config_file)
+        self.config_file.close()
+        self.process = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.port)
+
+    def start(self):
+        env = dict(
+            os.environ, APP_SETTINGS_YAML=self.config_file.name,
+            HOST='127.0.0.1', PORT=str(self.port))
+        if self.server == 'gunicorn':
+            command = [
+                sys.executable, '-m', 'gunicorn',
+                '-c', 'python:influxproxy.gunicorn',
+                '--workers', str(self.workers), '--log-level', 'warning',
+                'influxproxy.main:app']
+        else:
+            command = [sys.executable, '-c', SERVE_AIOHTTP, str(self.port)]
+        with open(self.log, 'w') as log:
+            self.process = subprocess.Popen(
+                command, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    async def wait_ready(self, session):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError('Proxy exited with {}, see {}'.format(
+                    self.process.returncode, self.log))
+            try:
+                response = await session.get(self.url + '/ping')
+                await response.release()
+                if response.status == 200:
+                    return
+            except (aiohttp.errors.ClientError, OSError):
+                pass
+            await asyncio.sleep(0.1)
+        raise RuntimeError('Proxy not ready after {}s'.format(
+            STARTUP_TIMEOUT))
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            self.process.wait()
+        os.unlink(self.config_file.name)
+
+
+class LoadRun:
+    """Sends a seeded mix of requests from concurrent clients."""
+
+    def __init__(self, url, session, payloads, args):
+        self.url = url
+        self.session = session
+        self.payloads = payloads
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.sizes = [
+            size for size, weight in BATCH_MIX for _ in range(weight)]
+        self.latencies = {'preflight': [], 'post': []}
+        self.statuses = {}
+        self.points_sent = 0
+        self.points_accepted = 0
+        self.errors = 0
+
+    def next_request(self):
+        database = self.random.choice(DATABASES)
+        url = '{}/metric/{}/{}'.format(self.url, database, PUBLIC_KEY)
+        if self.random.random() < self.args.preflight_ratio:
+            return 'preflight', url, None, 0
+        size = self.random.choice(self.sizes)
+        content_type = self.random.choice(CONTENT_TYPES)
+        return 'post', url, (content_type, size), size
+
+    async def client(self, deadline):
+        loop = asyncio.get_event_loop()
+        while loop.time() < deadline:
+            kind, url, payload, size = self.next_request()
+            started_at = loop.time()
+            try:
+                if kind == 'preflight':
+                    response = await self.session.options(url, headers={
+                        'Origin': ORIGIN,
+                        'Access-Control-Request-Method': 'POST',
+                    })
+                else:
+                    self.points_sent += size
+                    response = await self.session.post(
+                        url, data=self.payloads[payload], headers={
+                            'Origin': ORIGIN,
+                            'Content-Type': payload[0],
+                        })
+                await response.release()
+            except (aiohttp.errors.ClientError, OSError):
+                self.errors += 1
+                continue
+            self.latencies[kind].append(loop.time() - started_at)
+            self.statuses[response.status] = (
+                self.statuses.get(response.status, 0) + 1)
+            if kind == 'post' and response.status == 204:
+                self.points_accepted += size
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        started_at = loop.time()
+        deadline = started_at + self.args.duration
+        await asyncio.gather(*[
+            self.client(deadline) for _ in range(self.args.concurrency)])
+        return loop.time() - started_at
+
+
+async def settle(backends, expected):
+    """Waits until the backends received all points, or stopped receiving."""
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + SETTLE_TIMEOUT
+    last = None
+    while loop.time() < deadline:
+        received = sum(backend.counter.lines for backend in backends)
+        if received >= expected or received == last:
+            return
+        last = received
+        await asyncio.sleep(1)
+
+
+async def benchmark(args):
+    loop = asyncio.get_event_loop()
+    udp, http = FakeUDPBackend(loop), FakeHTTPBackend(loop)
+    await udp.start()
+    await http.start()
+    proxy = Proxy(
+        args.server, args.workers, proxy_config(udp.port, http.port),
+        args.proxy_log)
+    proxy.start()
+    session = aiohttp.ClientSession(
+        loop=loop, connector=aiohttp.TCPConnector(loop=loop))
+    try:
+        await proxy.wait_ready(session)
+        load = LoadRun(proxy.url, session, build_payloads(), args)
+        elapsed = await load.run()
+        await settle([udp, http], load.points_accepted)
+    finally:
+        session.close()
+        proxy.stop()
+        udp.stop()
+        await http.stop()
+    return report(args, load, elapsed, [udp, http])
+
+
+def report(args, load, elapsed, backends):
+    udp, http = backends
+    latencies = load.latencies['preflight'] + load.latencies['post']
+    delivered = udp.counter.lines + http.counter.lines
+    accepted = load.points_accepted
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'settings': {
+            'server': args.server,
+            'workers': args.workers,
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'preflight_ratio': args.preflight_ratio,
+            'seed': args.seed,
+        },
+        'elapsed': elapsed,
+        'requests': {
+            'total': len(latencies),
+            'errors': load.errors,
+            'per_second': len(latencies) / elapsed,
+            'statuses': {
+                str(status): count
+                for status, count in sorted(load.statuses.items())},
+        },
+        'latency_ms': {
+            kind: {
+                'p50': percentile(values, 0.5) * 1000,
+                'p99': percentile(values, 0.99) * 1000,
+            }
+            for kind, values in [
+                ('all', latencies),
+                ('preflight', load.latencies['preflight']),
+                ('post', load.latencies['post']),
+            ] if values
+        },
+        'points': {
+            'sent': load.points_sent,
+            'accepted': accepted,
+            'delivered': delivered,
+            'per_second': delivered / elapsed,
+            'loss_rate': 1 - delivered / accepted if accepted else 0.0,
+        },
+        'backends': {
+            'udp': udp.counter.as_dict(),
+            'http': http.counter.as_dict(),
+        },
+    }
+
+
+def print_summary(results):
+    requests = results['requests']
+    points = results['points']
+    print('{:>20} {:>12,.0f}'.format('requests/s', requests['per_second']))
+    for kind, latency in sorted(results['latency_ms'].items()):
+        print('{:>20} {:>12.2f}'.format(kind + ' p50 ms', latency['p50']))
+        print('{:>20} {:>12.2f}'.format(kind + ' p99 ms', latency['p99']))
+    print('{:>20} {:>12,.0f}'.format(
+        'points/s delivered', points['per_second']))
+    print('{:>20} {:>11.3f}%'.format('loss', points['loss_rate'] * 100))
+    print('{:>20} {:>12}'.format('statuses', json.dumps(requests['statuses'])))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--server', choices=('gunicorn', 'aiohttp'), default='gunicorn')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--preflight-ratio', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='load-results.json')
+    parser.add_argument('--proxy-log', default='load-proxy.log')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(benchmark(args))
+    print_summary(results)
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    print('Saved to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Compares point validation with and without a compiled schema.
+
+The baseline is the mandatory keys check that every point goes through;
+the schema check runs on top of it.
+
+Run with::
+
+    python -m benchmarks.schemas
+"""
+from benchmarks.encoder import beacon_points, measure
+from influxproxy.drivers import validate_points
+from influxproxy.encoder import LineEncoder
+from influxproxy.ingestion import validate_lines
+from influxproxy.schemas import Schema
+
+
+BATCH_SIZES = (1, 10, 100)
+SCHEMA = Schema.compile({
+    'max_string_length': 256,
+    'measurements': {
+        'page_load': {
+            'tags': ['browser', 'country', 'page'],
+            'fields': {
+                'duration': 'float',
+                'resources': 'integer',
+                'connection': 'string',
+            },
+        },
+    },
+})
+
+
+def check_points(points):
+    SCHEMA.validate_points(validate_points(points))
+
+
+def report(name, size, baseline, current):
+    print('{:>12} {:>6} {:>14,.0f} {:>14,.0f} {:>7.2f}x'.format(
+        name, size, size / baseline, size / current, current / baseline))
+
+
+def main():
+    encoder = LineEncoder()
+    print('{:>12} {:>6} {:>14} {:>14} {:>8}'.format(
+        'format', 'points', 'baseline/s', 'schema/s', 'cost'))
+    for size in BATCH_SIZES:
+        points = beacon_points(size)
+        number = max(1, 50000 // size)
+        baseline = measure(lambda: validate_points(points), number)
+        current = measure(lambda: check_points(points), number)
+        report('json', size, baseline, current)
+
+        data = encoder.encode(points)
+        baseline = measure(lambda: validate_lines(data), number)
+        current = measure(lambda: validate_lines(data, SCHEMA), number)
+        report('line', size, baseline, current)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""Times each stage a metric post goes through, against a stored baseline.
+
+Stages are timed on their own, with single points and batches of beacon
+points, then all together through the ``send_metric`` handler, with an
+in-memory backend standing in for InfluxDB. Results are compared against
+the baseline file if there is one, and saved as the new baseline when
+asked, so a change can be checked for regressions before it is made.
+
+Run with::
+
+    APP_SETTINGS_YAML=testing.yaml python -m benchmarks.stages [--save]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from unittest.mock import patch
+
+from aiohttp import web
+from aiohttp.streams import StreamReader
+from aiohttp.test_utils import make_mocked_request
+from multidict import CIMultiDict
+
+from benchmarks.encoder import ROUNDS, beacon_points, measure
+from influxproxy.app import RequestUser, create_app, send_metric
+from influxproxy.configuration import config
+from influxproxy.drivers import InfluxDriver, validate_points
+from influxproxy.encoder import LineEncoder
+
+
+BATCH_SIZES = (1, 10, 100)
+DATABASE = 'testing'
+ORIGIN = 'https://app.example.com'
+DEFAULT_BASELINE = 'stages-baseline.json'
+OPERATIONS = 20000
+STAGES = (
+    ('validate_points', BATCH_SIZES),
+    ('decode_json', BATCH_SIZES),
+    ('encode_lines', BATCH_SIZES),
+    ('setup_user', (1,)),
+    ('send_metric', BATCH_SIZES),
+)
+
+
+async def write_nowhere(self, database, chunks):
+    pass
+
+
+class LocalTransport:
+    """Just enough of a transport for a request, cheaper than a mock."""
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+def measure_async(loop, coroutine_function, number):
+    """Returns the best time per call of a coroutine function."""
+    async def run():
+        for _ in range(number):
+            await coroutine_function()
+    timings = []
+    for _ in range(ROUNDS):
+        started_at = time.perf_counter()
+        loop.run_until_complete(run())
+        timings.append(time.perf_counter() - started_at)
+    return min(timings) / number
+
+
+class Stages:
+    """Sets up the application once, and times each stage on its own."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.app = create_app(loop)
+        self.encoder = LineEncoder()
+        self.transport = LocalTransport()
+        self.path = '/metric/{}/{}'.format(
+            DATABASE, config['databases'][DATABASE]['public_key'])
+        self.headers = CIMultiDict({
+            'Origin': ORIGIN, 'Content-Type': 'application/json'})
+        self.match_info = loop.run_until_complete(
+            self.app.router.resolve(self.make_request()))
+
+    def make_request(self, body=b''):
+        payload = StreamReader(loop=self.loop)
+        payload.feed_data(body)
+        payload.feed_eof()
+        request = make_mocked_request(
+            'POST', self.path, self.headers, app=self.app, reader=None,
+            writer=None, transport=self.transport, payload=payload)
+        request._match_info = getattr(self, 'match_info', None)
+        return request
+
+    def validate_points(self, points, number):
+        return measure(lambda: validate_points(points), number)
+
+    def decode_json(self, points, number):
+        body = json.dumps(points).encode('utf-8')
+        return measure(lambda: json.loads(body.decode('utf-8')), number)
+
+    def encode_lines(self, points, number):
+        return measure(lambda: self.encoder.encode(points), number)
+
+    def setup_user(self, points, number):
+        request = self.make_request()
+        return measure(lambda: RequestUser(request).setup(), number)
+
+    def send_metric(self, points, number):
+        body = json.dumps(points).encode('utf-8')
+
+        async def send():
+            try:
+                await send_metric(self.make_request(body))
+            except web.HTTPNoContent:
+                pass
+
+        with patch.object(InfluxDriver, 'write_lines', write_nowhere):
+            timing = measure_async(self.loop, send, number)
+            self.loop.run_until_complete(self.app['batcher'].drain())
+        return timing
+
+    def run(self):
+        """Returns the time per operation of every stage, by batch size."""
+        results = {}
+        for name, sizes in STAGES:
+            stage = getattr(self, name)
+            results[name] = {}
+            for size in sizes:
+                number = max(10, OPERATIONS // size)
+                if name == 'send_metric':
+                    number //= 10
+                results[name][str(size)] = stage(beacon_points(size), number)
+        return results
+
+    def close(self):
+        self.loop.run_until_complete(self.app.shutdown())
+
+
+def compare(results, baseline):
+    print('{:>16} {:>6} {:>12} {:>12} {:>8}'.format(
+        'stage', 'points', 'baseline us', 'current us', 'change'))
+    for name, sizes in STAGES:
+        for size in map(str, sizes):
+            current = results[name][size]
+            previous = baseline.get(name, {}).get(size)
+            if previous is None:
+                print('{:>16} {:>6} {:>12} {:>12.2f} {:>8}'.format(
+                    name, size, '-', current * 1e6, '-'))
+                continue
+            print('{:>16} {:>6} {:>12.2f} {:>12.2f} {:>+7.1f}%'.format(
+                name, size, previous * 1e6, current * 1e6,
+                (current / previous - 1) * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument(
+        '--save', action='store_true',
+        help='save the results as the new baseline')
+    args = parser.parse_args()
+
+    # Keeps the per-request log lines off the terminal, and out of timings.
+    logging.getLogger('influxdb.app').setLevel(logging.WARNING)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    loop = asyncio.new_event_loop()
+    stages = Stages(loop)
+    try:
+        results = stages.run()
+    finally:
+        stages.close()
+        loop.close()
+
+    compare(results, baseline)
+    if args.save:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        print('Saved baseline to {}'.format(args.baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Compares how long a worker takes to be ready with and without preloading.
+
+Each worker is forked from this process, like gunicorn does, and timed
+until it has built its application. Without preloading the worker imports
+the app and parses the config itself; with preloading it only builds the
+application. Creating the databases in the backend is left out, since it
+needs a running InfluxDB, but it would add a round trip per database to
+every worker that isn't preloaded.
+
+Run with::
+
+    APP_SETTINGS_YAML=testing.yaml python -m benchmarks.startup
+"""
+import asyncio
+import importlib
+import os
+import time
+
+
+WORKERS = 20
+APP_MODULES = ('influxproxy.configuration', 'influxproxy.app')
+
+
+def build_app():
+    from influxproxy.app import create_app
+    loop = asyncio.new_event_loop()
+    create_app(loop)
+    loop.close()
+
+
+def time_workers(count):
+    """Returns the mean time it takes a forked worker to build the app."""
+    total = 0
+    for _ in range(count):
+        start = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                build_app()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        total += time.perf_counter() - start
+    return total / count
+
+
+def main():
+    cold = time_workers(WORKERS)
+    for name in APP_MODULES:
+        importlib.import_module(name)
+    preloaded = time_workers(WORKERS)
+
+    print('{:>12} {:>12}'.format('mode', 'ms/worker'))
+    print('{:>12} {:>12.1f}'.format('cold', cold * 1000))
+    print('{:>12} {:>12.1f}'.format('preloaded', preloaded * 1000))
+    print('{:>12} {:>11.1f}x'.format('speedup', cold / preloaded))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import hmac
+import re
+from collections import namedtuple
+
+
+ALL_ORIGINS = '*'
+MAX_CACHED_PREFLIGHTS = 1000
+
+
+class OriginMatcher:
+    """Tells which origins may use a database, and what to allow them.
+
+    Plain origins are kept in a frozenset; patterns with ``*`` wildcards,
+    such as ``https://*.example.com``, are joined into one regex.
+    """
+
+    __slots__ = ('allow_all', 'origins', 'pattern')
+
+    def __init__(self, allow_from):
+        if isinstance(allow_from, str):
+            allow_from = [allow_from]
+        allow_from = [str(origin) for origin in allow_from or ()]
+        self.allow_all = ALL_ORIGINS in allow_from
+        self.origins = frozenset(
+            origin for origin in allow_from if '*' not in origin)
+        wildcards = [
+            '.*'.join(re.escape(part) for part in origin.split('*'))
+            for origin in allow_from
+            if '*' in origin and origin != ALL_ORIGINS]
+        self.pattern = re.compile(
+            '(?:{})$'.format('|'.join(wildcards))) if wildcards else None
+
+    def allowed_to(self, origin):
+        """Returns the Access-Control-Allow-Origin value, or None."""
+        if self.allow_all:
+            return ALL_ORIGINS
+        if origin in self.origins:
+            return origin
+        if self.pattern is not None and self.pattern.match(origin):
+            return origin
+        return None
+
+
+def build_preflight_headers(allowed_to, max_age):
+    return {
+        'Access-Control-Allow-Methods': 'POST',
+        'Access-Control-Allow-Headers': 'Content-Type, Content-Encoding',
+        'Access-Control-Allow-Origin': allowed_to,
+        'Access-Control-Max-Age': str(max_age),
+        'Content-Type': 'text/plain',
+    }
+
+
+_DatabaseAccess = namedtuple('_DatabaseAccess', [
+    'name', 'config', 'public_key', 'matcher', 'schema', 'max_age',
+    'preflights'])
+
+
+class DatabaseAccess(_DatabaseAccess):
+    """Everything needed to authorize requests to one database.
+
+    Built once per configuration. Preflight headers are prebuilt for the
+    wildcard and for each plain origin; origins matching a pattern get
+    theirs built on first use.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def compile(cls, name, db_config, max_age, schema=None):
+        matcher = OriginMatcher(db_config['allow_from'])
+        allowed = [ALL_ORIGINS] if matcher.allow_all else matcher.origins
+        preflights = {
+            origin: build_preflight_headers(origin, max_age)
+            for origin in allowed}
+        return cls(
+            name, db_config, str(db_config['public_key']).encode('utf-8'),
+            matcher, schema, max_age, preflights)
+
+    def check_key(self, public_key):
+        """Compares the public key in constant time."""
+        return hmac.compare_digest(
+            self.public_key, public_key.encode('utf-8'))
+
+    def allowed_to(self, origin):
+        return self.matcher.allowed_to(origin)
+
+    def preflight_headers(self, allowed_to):
+        try:
+            return self.preflights[allowed_to]
+        except KeyError:
+            if len(self.preflights) >= MAX_CACHED_PREFLIGHTS:
+                self._forget_pattern_preflights()
+            headers = build_preflight_headers(allowed_to, self.max_age)
+            self.preflights[allowed_to] = headers
+            return headers
+
+    def _forget_pattern_preflights(self):
+        for origin in list(self.preflights):
+            if origin not in self.matcher.origins:
+                del self.preflights[origin]
+
+
+def compile_access(config, schemas):
+    """Compiles the access rules of every configured database."""
+    max_age = config['preflight_expiration']
+    return {
+        name: DatabaseAccess.compile(
+            name, db_config, max_age, schemas.get(name))
+        for name, db_config in config['databases'].items()}
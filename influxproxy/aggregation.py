@@ -0,0 +1,295 @@
+import logging
+import math
+import time
+
+from influxproxy.batching import QueueFullError
+from influxproxy.encoder import PRECISIONS, escape_key
+from influxproxy.ingestion import HASH, MEASUREMENT, SERIES, parse_line
+from influxproxy.schemas import TAG
+
+
+DEFAULT_WINDOW = 10
+DEFAULT_MAX_SERIES = 10000
+DEFAULT_WORKER_TAG = 'worker'
+INTEGER = ord('i')
+UNSIGNED = ord('u')
+QUOTE = ord('"')
+
+
+logger = logging.getLogger('influxproxy.aggregation')
+
+
+def parse_number(value):
+    """Returns a field value as a number, or None if it isn't one."""
+    if value[-1] == INTEGER:
+        return int(value[:-1])
+    if value[-1] == UNSIGNED or value[0] == QUOTE:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def encode_number(number):
+    if type(number) is int:
+        return b'%di' % number
+    if not math.isfinite(number):
+        return None
+    return repr(number).encode('ascii')
+
+
+class FieldStats:
+    """Running sum, count, min, max and last value of one field.
+
+    Fields that aren't always numbers only keep their count and last value.
+    """
+
+    __slots__ = ('sum', 'count', 'min', 'max', 'last')
+
+    def __init__(self, value, number):
+        self.count = 1
+        self.last = value
+        self.sum = self.min = self.max = number
+
+    def add(self, value, number):
+        self.count += 1
+        self.last = value
+        if number is None or self.sum is None:
+            self.sum = None
+            return
+        self.sum += number
+        if number < self.min:
+            self.min = number
+        if number > self.max:
+            self.max = number
+
+    def encode(self, key):
+        parts = [key + b'_count=%di' % self.count]
+        if self.sum is not None:
+            for suffix, number in ((b'_sum', self.sum), (b'_min', self.min),
+                                   (b'_max', self.max)):
+                encoded = encode_number(number)
+                if encoded is not None:
+                    parts.append(key + suffix + b'=' + encoded)
+        parts.append(key + b'_last=' + self.last)
+        return b','.join(parts)
+
+
+class AggregationWindow:
+    """Reduces the points of a database to one point per series and window.
+
+    Points of the given ``measurements``, or of all of them by default, are
+    folded into one set of ``FieldStats`` per series as they arrive, so
+    memory grows with the number of series rather than of points. Every
+    ``window`` seconds, aligned on the clock, each series is written as a
+    single point, timed at the start of the window, with ``<field>_sum``,
+    ``_count``, ``_min``, ``_max`` and ``_last`` fields. Points of series
+    beyond the first ``max_series`` in a window are passed through as they
+    are.
+
+    Every worker aggregates its own points, so the aggregates carry a
+    ``tag``, a ``(key, value)`` pair telling them apart, rather than
+    overwriting each other. It's put in order among the tags of each series,
+    in place of any tag with the same key.
+    """
+
+    def __init__(self, database, batcher, loop, window=DEFAULT_WINDOW,
+                 measurements=None, max_series=DEFAULT_MAX_SERIES, tag=None,
+                 metrics=None):
+        self.database = database
+        self.batcher = batcher
+        self.loop = loop
+        self.window = window
+        self.measurements = (
+            None if measurements is None else
+            {escape_key(name).encode('utf-8') for name in measurements})
+        self.max_series = max_series
+        self.tag = tag
+        self.metrics = metrics
+        self.series = {}
+        self.aggregates = {}
+        self.started_at = None
+        self.driver = None
+        self.db_config = None
+        self._timer = None
+
+    @classmethod
+    def from_config(cls, database, batcher, loop, db_config, worker=None,
+                    metrics=None):
+        aggregate = db_config['aggregate']
+        tag = None
+        if worker is not None:
+            tag = (
+                escape_key(aggregate.get('worker_tag', DEFAULT_WORKER_TAG))
+                .encode('utf-8'),
+                str(worker).encode('utf-8'))
+        return cls(
+            database, batcher, loop,
+            window=aggregate.get('window', DEFAULT_WINDOW),
+            measurements=aggregate.get('measurements'),
+            max_series=aggregate.get('max_series', DEFAULT_MAX_SERIES),
+            tag=tag, metrics=metrics)
+
+    def split(self, chunks):
+        """Sorts ``(data, count)`` chunks into lines to aggregate and others.
+
+        Returns the lines to aggregate, and the chunks of the points to be
+        written as they are.
+        """
+        lines = []
+        remaining = []
+        for data, count in chunks:
+            kept = []
+            for line in data.split(b'\n'):
+                line = line.rstrip(b'\r')
+                if not line or line[0] == HASH:
+                    continue
+                if self._takes(line):
+                    lines.append(line)
+                else:
+                    kept.append(line)
+            if len(kept) == count:
+                remaining.append((data, count))
+            elif kept:
+                kept.append(b'')
+                remaining.append((b'\n'.join(kept), len(kept) - 1))
+        return lines, remaining
+
+    def _takes(self, line):
+        if self.measurements is not None and (
+                MEASUREMENT.match(line).group() not in self.measurements):
+            return False
+        return (len(self.series) < self.max_series or
+                SERIES.match(line).group() in self.series)
+
+    def add(self, driver, lines, db_config):
+        """Folds lines into the accumulators of their series."""
+        if not lines:
+            return
+        self.driver = driver
+        self.db_config = db_config
+        if self.started_at is None:
+            now = time.time()
+            self.started_at = now - now % self.window
+            self._timer = self.loop.call_later(
+                self.started_at + self.window - now, self.flush)
+        for line in lines:
+            key, fields = parse_line(line)
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = self._aggregate(key)
+            for field_key, value in fields:
+                number = parse_number(value)
+                stats = series.get(field_key)
+                if stats is None:
+                    series[field_key] = FieldStats(value, number)
+                else:
+                    stats.add(value, number)
+        if self.metrics is not None:
+            self.metrics.count_points(self.database, 'aggregated', len(lines))
+
+    def _aggregate(self, key):
+        """Returns the stats of the aggregate a series is folded into."""
+        if self.tag is not None:
+            key = self._tagged(key)
+        aggregate = self.aggregates.get(key)
+        if aggregate is None:
+            aggregate = self.aggregates[key] = {}
+        return aggregate
+
+    def _tagged(self, key):
+        measurement = MEASUREMENT.match(key).group()
+        tag_key = self.tag[0]
+        tags = [
+            match.groups()
+            for match in TAG.finditer(key, len(measurement))
+            if match.group(1) != tag_key]
+        tags.append(self.tag)
+        tags.sort()
+        return measurement + b''.join(
+            b',' + name + b'=' + value for name, value in tags)
+
+    def flush(self):
+        """Writes a point per series aggregated, and starts a new window."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.series = {}
+        aggregates, self.aggregates = self.aggregates, {}
+        started_at, self.started_at = self.started_at, None
+        if not aggregates:
+            return
+        divisor = PRECISIONS[self.db_config.get('precision') or 'n']
+        timestamp = b' %d' % (int(started_at * 1000000000) // divisor)
+        lines = []
+        for key, fields in aggregates.items():
+            lines.append(key + b' ' + b','.join(
+                stats.encode(field_key)
+                for field_key, stats in sorted(fields.items())) + timestamp)
+        lines.append(b'')
+        try:
+            self.batcher.add(
+                self.database, self.driver, b'\n'.join(lines), len(aggregates),
+                self.db_config)
+        except QueueFullError:
+            if self.metrics is not None:
+                self.metrics.count_points(
+                    self.database, 'dropped', len(aggregates))
+            logger.warning(
+                'Dropped %d aggregated points for %s',
+                len(aggregates), self.database)
+
+
+class Aggregator:
+    """Aggregates points for the databases that opt in to it.
+
+    A database opts in with an ``aggregate`` section in its configuration,
+    and gets an ``AggregationWindow`` of its own. When a reload changes
+    the section, the window is flushed and replaced by one built from the
+    new section.
+    """
+
+    def __init__(self, loop, batcher, worker=None, metrics=None):
+        self.loop = loop
+        self.batcher = batcher
+        self.worker = worker
+        self.metrics = metrics
+        self.windows = {}
+        self.configs = {}
+
+    def split(self, database, chunks, db_config):
+        """Returns the lines to aggregate, and the chunks left as they are.
+
+        Nothing is aggregated until the lines are added, so that a request
+        refused in between leaves no trace.
+        """
+        window = self._window(database, db_config)
+        if window is None:
+            return [], chunks
+        return window.split(chunks)
+
+    def add(self, database, driver, lines, db_config):
+        window = self._window(database, db_config)
+        if window is not None:
+            window.add(driver, lines, db_config)
+
+    def _window(self, database, db_config):
+        aggregate = db_config.get('aggregate')
+        if not aggregate:
+            return None
+        window = self.windows.get(database)
+        old_aggregate = self.configs.get(database)
+        if window is None or (aggregate is not old_aggregate and
+                              aggregate != old_aggregate):
+            if window is not None:
+                window.flush()
+            window = self.windows[database] = AggregationWindow.from_config(
+                database, self.batcher, self.loop, db_config, self.worker,
+                self.metrics)
+        self.configs[database] = aggregate
+        return window
+
+    def flush(self):
+        for window in self.windows.values():
+            window.flush()
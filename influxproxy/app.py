@@ -1,18 +1,41 @@
 #!/usr/bin/env python
 
+import asyncio
+import hmac
 import logging
 import os
+import time
 from uuid import uuid4
 
 import aiohttp_jinja2
 import jinja2
 from aiohttp import web
 
-from influxproxy.configuration import DEBUG, PORT, PROJECT_ROOT, config
-from influxproxy.drivers import InfluxDriver, MalformedDataError
+from influxproxy.aggregation import Aggregator
+from influxproxy.batching import Batcher, QueueFullError
+from influxproxy.cardinality import CardinalityGuards
+from influxproxy import configuration
+from influxproxy.configuration import DEBUG, PORT, PROJECT_ROOT
+from influxproxy.drivers import DriverRegistry, MalformedDataError
+from influxproxy.ingestion import (
+    DEFAULT_MAX_BODY_SIZE,
+    BodyTooLargeError,
+    read_metrics,
+)
+from influxproxy.logs import should_log
+from influxproxy.metrics import (
+    CONTENT_TYPE as METRICS_CONTENT_TYPE,
+    ROUTES as TIMED_ROUTES,
+    StatsReporter,
+    get_recorder,
+)
+from influxproxy.ratelimit import RateLimitedError, get_limiter
+from influxproxy.reloading import DEFAULT_RELOAD_INTERVAL, ConfigReloader
+from influxproxy.schemas import SchemaError
 
 
 MANUAL_TEST_HOST = os.environ.get('HOST', 'localhost')
+DRAIN_TIMEOUT = 20
 
 
 logger = logging.getLogger('influxdb.app')
@@ -25,6 +48,7 @@ class RequestUser:
         self.request = request
         self.database = request.match_info.get('database')
         self.public_key = request.match_info.get('public_key')
+        self.access = None
         self.config = None
         self.origin = None
         self.allowed_to = None
@@ -35,32 +59,76 @@ class RequestUser:
         self.setup_origin()
 
     def setup_origin(self):
-        self.origin = self.allowed_to = self.request.headers['Origin']
-        allow_from = self.config['allow_from']
-        if allow_from == '*':
-            self.allowed_to = '*'
-        elif self.origin not in allow_from:
+        self.origin = self.request.headers['Origin']
+        self.allowed_to = self.access.allowed_to(self.origin)
+        if self.allowed_to is None:
             raise web.HTTPForbidden(reason='Origin not allowed')
 
     def setup_public_key(self):
-        if self.public_key != self.config['public_key']:
+        if not self.access.check_key(self.public_key):
             raise web.HTTPUnauthorized(reason=self.BAD)
 
     def setup_config(self):
         try:
-            self.config = config['databases'][self.database]
+            self.access = configuration.settings.access[self.database]
         except KeyError:
             raise web.HTTPUnauthorized(reason=self.BAD)
+        self.config = self.access.config
 
 
 def create_app(loop):
-    app = web.Application(logger=logger, loop=loop, debug=DEBUG)
+    config = configuration.settings.config
+    app = web.Application(
+        logger=logger, loop=loop, debug=DEBUG,
+        middlewares=[log_requests, time_requests])
+    app['metrics'] = get_recorder(config['databases'])
+    app['drivers'] = DriverRegistry(app.loop)
+    spill_directory = config.get('spill_directory')
+    if spill_directory is not None and not app['metrics'].owner:
+        # Its slot is another worker's, and so would be the directory.
+        logger.warning('No free metrics slot, not spilling to disk')
+        spill_directory = None
+    if spill_directory is not None:
+        # Each worker spills on its own, and picks up after the worker it
+        # replaces, taking over its slot.
+        spill_directory = os.path.join(
+            spill_directory, str(app['metrics'].slot))
+    app['batcher'] = Batcher(
+        app.loop, max_pending_bytes=config.get('max_pending_bytes'),
+        metrics=app['metrics'], spill_directory=spill_directory)
+    app['aggregator'] = Aggregator(
+        app.loop, app['batcher'], worker=app['metrics'].slot,
+        metrics=app['metrics'])
+    app['rate_limiter'] = get_limiter(config)
+    app['cardinality'] = CardinalityGuards(app.loop, metrics=app['metrics'])
+    app['stats'] = StatsReporter(
+        app['metrics'], app['batcher'], app['drivers'], app.loop,
+        influxdb=config.get('metrics', {}).get('influxdb'))
+    app['stats'].start()
+    app['reloader'] = ConfigReloader(
+        app.loop,
+        interval=config.get('reload_interval', DEFAULT_RELOAD_INTERVAL))
+    app['reloader'].start()
+    app.on_shutdown.append(stop_reloader)
+    app.on_shutdown.append(stop_stats)
+    app.on_shutdown.append(flush_aggregator)
+    app.on_shutdown.append(drain_batcher)
+    app.on_shutdown.append(close_drivers)
 
     metric_path = r'/metric/{database}/{public_key:.+}'
-    app.router.add_route('GET', '/ping', ping)
-    app.router.add_route('OPTIONS', metric_path, preflight_metric)
-    app.router.add_route('POST', metric_path, send_metric)
-    app.router.add_route('GET', '/manual-test', manual_test)
+    app.router.add_route('GET', '/ping', ping, name='ping')
+    app.router.add_route(
+        'OPTIONS', metric_path, preflight_metric, name='preflight_metric')
+    app.router.add_route(
+        'POST', metric_path, send_metric, name='send_metric')
+    app.router.add_route('GET', '/metrics', metrics, name='metrics')
+    app.router.add_route(
+        'GET', '/admin/cardinality', cardinality, name='cardinality')
+    app.router.add_route(
+        'GET', '/admin/cardinality/{database}', cardinality,
+        name='database_cardinality')
+    app.router.add_route(
+        'GET', '/manual-test', manual_test, name='manual_test')
     app.router.add_static('/static', PROJECT_ROOT / 'influxproxy' / 'static')
     aiohttp_jinja2.setup(
         app, loader=jinja2.FileSystemLoader(
@@ -69,6 +137,97 @@ def create_app(loop):
     return app
 
 
+def get_request_id(request):
+    """Returns the id of a request, made up the first time it's needed."""
+    request_id = request.get('request_id')
+    if request_id is None:
+        request_id = request['request_id'] = uuid4().hex
+    return request_id
+
+
+async def log_requests(app, handler):
+    """Logs requests that failed, and a sample of the others.
+
+    Requests to each route are sampled at the rate given for it in the
+    ``sample_rates`` of the ``logging`` settings, all of them by default.
+    """
+    async def logged(request):
+        started_at = app.loop.time()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            route = request.match_info.route.name
+            rates = configuration.settings.config.get(
+                'logging', {}).get('sample_rates', {})
+            if should_log(route, status, rates):
+                level = (
+                    logging.ERROR if status >= 500 else
+                    logging.WARNING if status >= 400 else logging.INFO)
+                # Named routes keep public keys in paths out of the logs.
+                logger.log(
+                    level, '%s %s %d', request.method, route or request.path,
+                    status,
+                    extra={
+                        'request_id': get_request_id(request),
+                        'database': request.match_info.get('database'),
+                        'route': route,
+                        'status': status,
+                        'duration': round(app.loop.time() - started_at, 6),
+                    })
+    return logged
+
+
+async def time_requests(app, handler):
+    async def timed(request):
+        started_at = app.loop.time()
+        try:
+            return await handler(request)
+        finally:
+            route = request.match_info.route.name
+            if route in TIMED_ROUTES:
+                app['metrics'].observe_request(
+                    route, request.match_info.get('database'),
+                    app.loop.time() - started_at)
+    return timed
+
+
+async def stop_reloader(app):
+    app['reloader'].stop()
+
+
+async def stop_stats(app):
+    app['stats'].stop()
+
+
+async def flush_aggregator(app):
+    app['aggregator'].flush()
+
+
+async def drain_batcher(app):
+    batcher = app['batcher']
+    config = configuration.settings.config
+    try:
+        await asyncio.wait_for(
+            batcher.drain(), config.get('drain_timeout', DRAIN_TIMEOUT),
+            loop=app.loop)
+    except asyncio.TimeoutError:
+        logger.warning(
+            'Gave up draining, %d bytes left unwritten',
+            batcher.pending_bytes)
+    finally:
+        batcher.close()
+
+
+async def close_drivers(app):
+    app['drivers'].close()
+
+
 def ensure_headers(request, expected_headers):
     for header in expected_headers:
         if header not in request.headers:
@@ -76,63 +235,156 @@ def ensure_headers(request, expected_headers):
                 reason='{} header is missing'.format(header))
 
 
+def setup_user(user, metrics):
+    try:
+        user.setup()
+    except web.HTTPUnauthorized:
+        metrics.reject_request(user.database, 'unauthorized')
+        raise
+    except web.HTTPForbidden:
+        metrics.reject_request(user.database, 'forbidden')
+        raise
+
+
+def reject(metrics, user, reason, count=0):
+    metrics.reject_request(user.database, reason)
+    if count:
+        metrics.count_points(user.database, reason, count)
+
+
+def shed_load(error, error_class=web.HTTPTooManyRequests, allowed_to=None):
+    headers = {'Retry-After': str(error.retry_after)}
+    if allowed_to is not None:
+        headers['Access-Control-Allow-Origin'] = allowed_to
+        headers['Access-Control-Expose-Headers'] = 'Retry-After'
+    return error_class(reason=str(error), headers=headers)
+
+
 async def ping(request):
-    logger.info('ping')
     return web.Response(body=b'pong')
 
 
 async def preflight_metric(request):
-    logger.info('preflight_metric')
     ensure_headers(request, ['Origin', 'Access-Control-Request-Method'])
 
     user = RequestUser(request)
-    user.setup()
+    setup_user(user, request.app['metrics'])
 
     method = request.headers['Access-Control-Request-Method']
 
     if method != 'POST':
         raise web.HTTPMethodNotAllowed(method, ['POST'])
 
-    return web.Response(headers={
-        'Access-Control-Allow-Methods': 'POST',
-        'Access-Control-Allow-Headers': 'Content-Type',
-        'Access-Control-Allow-Origin': user.allowed_to,
-        'Access-Control-Max-Age': str(config['preflight_expiration']),
-        'Content-Type': 'text/plain',
-    })
+    return web.Response(
+        headers=user.access.preflight_headers(user.allowed_to))
 
 
 async def send_metric(request):
-    logger.info('send_metric')
     ensure_headers(request, ['Origin'])
 
+    metrics = request.app['metrics']
     user = RequestUser(request)
-    user.setup()
-
-    request_id = uuid4()
+    limiter = request.app['rate_limiter']
+    try:
+        limiter.check_request(user.database)
+    except RateLimitedError as e:
+        reject(metrics, user, 'rate_limited')
+        raise shed_load(e)
+    setup_user(user, metrics)
 
-    points = await request.json()
+    count = 0
 
     try:
-        driver = InfluxDriver(udp_port=user.config['udp_port'])
-        driver.write(user.database, points)
+        driver = await request.app['drivers'].get(user.config)
+        now = None
+        if user.config.get('stamp_time', False):
+            now = int(time.time() * 1000000000)
+        chunks, precision = await read_metrics(
+            request, driver, user.access.schema, now,
+            user.config.get('max_body_size', DEFAULT_MAX_BODY_SIZE))
+        count = sum(chunk_count for _, chunk_count in chunks)
+        limiter.check_points(user.database, count)
+        chunks, rejected = request.app['cardinality'].check(
+            user.database, chunks, user.config)
+        count -= rejected
+        aggregator = request.app['aggregator']
+        lines, chunks = aggregator.split(user.database, chunks, user.config)
+        request.app['batcher'].add_all(
+            user.database, driver, chunks, user.config, precision)
+        aggregator.add(user.database, driver, lines, user.config)
+    except BodyTooLargeError as e:
+        reject(metrics, user, 'too_large')
+        raise web.HTTPRequestEntityTooLarge(reason=str(e))
     except MalformedDataError as e:
+        reject(metrics, user, 'malformed')
+        raise web.HTTPBadRequest(reason=str(e))
+    except SchemaError as e:
+        reject(metrics, user, 'schema')
         raise web.HTTPBadRequest(reason=str(e))
-    except Exception as e:
-        logger.error('Metric for request %s failed', request_id)
-        logger.exception(e)
+    except RateLimitedError as e:
+        reject(metrics, user, 'rate_limited', count)
+        raise shed_load(e, allowed_to=user.allowed_to)
+    except QueueFullError as e:
+        if e.overloaded:
+            reject(metrics, user, 'overloaded', count)
+            error_class = web.HTTPServiceUnavailable
+        else:
+            reject(metrics, user, 'queue_full', count)
+            error_class = web.HTTPTooManyRequests
+        raise shed_load(e, error_class, user.allowed_to)
+    except Exception:
+        reject(metrics, user, 'error')
+        request_id = get_request_id(request)
+        logger.exception(
+            'Metric for request %s failed', request_id, extra={
+                'request_id': request_id, 'database': user.database})
         reason = (
             'Internal Server Error. Please provide this ID to the system '
             'administrators: {}').format(request_id)
         raise web.HTTPInternalServerError(reason=reason)
 
+    metrics.count_points(user.database, 'accepted', count)
     raise web.HTTPNoContent(headers={
         'Access-Control-Allow-Origin': user.allowed_to,
     })
 
 
+async def metrics(request):
+    """Returns this worker's metrics to an admin, in Prometheus format."""
+    ensure_admin(request)
+    request.app['stats'].collect()
+    return web.Response(
+        body=request.app['metrics'].render().encode('utf-8'),
+        headers={'Content-Type': METRICS_CONTENT_TYPE})
+
+
+def ensure_admin(request):
+    """Lets through requests bearing the configured ``admin_token``.
+
+    Without a token configured, admin routes are off altogether.
+    """
+    token = configuration.settings.config.get('admin_token')
+    if not token:
+        raise web.HTTPNotFound()
+    expected = 'Bearer {}'.format(token).encode('utf-8')
+    given = request.headers.get('Authorization', '').encode('utf-8')
+    if not hmac.compare_digest(given, expected):
+        raise web.HTTPUnauthorized(headers={'WWW-Authenticate': 'Bearer'})
+
+
+async def cardinality(request):
+    """Returns this worker's estimates of the series of guarded databases."""
+    ensure_admin(request)
+    estimates = request.app['cardinality'].estimates(
+        request.match_info.get('database'))
+    if estimates is None:
+        raise web.HTTPNotFound()
+    return web.json_response(estimates)
+
+
 @aiohttp_jinja2.template('manual-test.html')
 async def manual_test(request):
+    config = configuration.settings.config
     if not config['manual_test_page']:
         raise web.HTTPNotFound()
 
@@ -0,0 +1,503 @@
+import asyncio
+import logging
+import os
+from collections import deque
+
+from influxproxy.cluster import ClusterDriver
+from influxproxy.dedup import DEFAULT_DEDUP_KEYS, Deduplicator
+from influxproxy.spill import (
+    DEFAULT_REPLAY_RATE,
+    DEFAULT_REPLAY_RETRY,
+    DEFAULT_SEGMENT_BYTES,
+    DEFAULT_SPILL_BYTES,
+    Replayer,
+    SpillQueue,
+)
+
+
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_BATCH_BYTES = 1024 * 1024
+DEFAULT_BATCH_LINGER = 0.1
+DEFAULT_QUEUE_POINTS = 100000
+DEFAULT_QUEUE_BYTES = 16 * 1024 * 1024
+DEFAULT_MAX_WRITES = 4
+DEFAULT_RETRY_AFTER = 1
+REJECT_NEWEST = 'reject_newest'
+DROP_OLDEST = 'drop_oldest'
+QUEUE_POLICIES = (REJECT_NEWEST, DROP_OLDEST)
+
+
+logger = logging.getLogger('influxproxy.batching')
+
+
+class QueueFullError(Exception):
+    """Raised when points can't be taken without going over budget.
+
+    ``overloaded`` tells whether the whole proxy is over budget, rather
+    than only the database.
+    """
+
+    def __init__(self, database, retry_after, overloaded=False):
+        super().__init__('Queue for {} is full'.format(database))
+        self.database = database
+        self.retry_after = retry_after
+        self.overloaded = overloaded
+
+
+class BatchBuffer:
+    """Encoded points waiting to be written to a database.
+
+    The buffer is flushed as soon as it holds ``max_points`` points or
+    ``max_bytes`` bytes, or ``linger`` seconds after it stopped being empty,
+    whichever comes first. Flushed batches wait in a queue until one of the
+    ``max_writes`` write slots is free.
+
+    Everything not written yet counts against a budget of ``queue_points``
+    points and ``queue_bytes`` bytes. Once that is used up, new points are
+    refused, or with the ``drop_oldest`` policy make room by dropping the
+    oldest ones that aren't being written yet.
+
+    With a ``dedup`` ``Deduplicator``, the points of each batch that share
+    their series and timestamp are merged before it's written.
+
+    Points can come in a precision of their own, rather than the driver's;
+    a batch only ever holds points of one precision, so it's flushed early
+    when points in another one are added.
+
+    With a ``spill`` ``SpillQueue``, batches that fail to be written are
+    spilled to disk rather than lost, as are points that don't fit in the
+    budget: the newest, or with the ``drop_oldest`` policy the oldest. They
+    are replayed at ``replay_rate`` bytes per second, the first time
+    ``replay_retry`` seconds after being spilled.
+    """
+
+    def __init__(self, database, driver, loop, max_points=DEFAULT_BATCH_SIZE,
+                 max_bytes=DEFAULT_BATCH_BYTES, linger=DEFAULT_BATCH_LINGER,
+                 queue_points=DEFAULT_QUEUE_POINTS,
+                 queue_bytes=DEFAULT_QUEUE_BYTES, policy=REJECT_NEWEST,
+                 max_writes=DEFAULT_MAX_WRITES,
+                 retry_after=DEFAULT_RETRY_AFTER, dedup=None, spill=None,
+                 replay_rate=DEFAULT_REPLAY_RATE,
+                 replay_retry=DEFAULT_REPLAY_RETRY, replayer=None,
+                 metrics=None):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError('Unknown queue policy: {!r}'.format(policy))
+        self.database = database
+        self.driver = driver
+        self.loop = loop
+        self.max_points = max_points
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self.queue_points = queue_points
+        self.queue_bytes = queue_bytes
+        self.policy = policy
+        self.max_writes = max_writes
+        self.retry_after = retry_after
+        self.dedup = dedup
+        self.spill = spill
+        self.metrics = metrics
+        self.chunks = []
+        self.counts = []
+        self.size = 0
+        self.count = 0
+        self.precision = None
+        self.queue = deque()
+        self.pending_points = 0
+        self.pending_bytes = 0
+        self.dropped_points = 0
+        self.deduplicated_points = 0
+        self.spilled_points = 0
+        self._timer = None
+        self._writes = set()
+        self.replayer = replayer
+        if spill is not None:
+            if replayer is None:
+                self.replayer = Replayer(
+                    spill, driver, loop, replay_rate, replay_retry)
+            if spill:
+                # Left over by an earlier process.
+                self.replayer.start(replay_retry)
+
+    @classmethod
+    def from_config(cls, database, driver, loop, db_config, metrics=None,
+                    spill_directory=None, spills=None):
+        """Builds a buffer with the settings of a database.
+
+        ``spills`` maps spill directories to the ``(SpillQueue, Replayer)``
+        of the buffer last built for each. A buffer built for the same
+        directory takes them over, replaying with its own driver, so that
+        the buffer it replaces can still spill while it's drained.
+        """
+        dedup = None
+        if db_config.get('dedup', False):
+            dedup = Deduplicator(
+                db_config.get('dedup_keys', DEFAULT_DEDUP_KEYS))
+        spill = replayer = None
+        if spill_directory is not None and db_config.get('spill', False):
+            spill, replayer = (spills or {}).get(
+                spill_directory, (None, None))
+            max_bytes = db_config.get('spill_bytes', DEFAULT_SPILL_BYTES)
+            segment_bytes = db_config.get(
+                'spill_segment_bytes', DEFAULT_SEGMENT_BYTES)
+            if spill is None:
+                spill = SpillQueue(
+                    spill_directory, database, max_bytes=max_bytes,
+                    segment_bytes=segment_bytes, metrics=metrics)
+            else:
+                spill.max_bytes = max_bytes
+                spill.segment_bytes = segment_bytes
+                replayer.driver = driver
+                replayer.rate = db_config.get(
+                    'replay_rate', DEFAULT_REPLAY_RATE)
+                replayer.retry_after = db_config.get(
+                    'replay_retry', DEFAULT_REPLAY_RETRY)
+        buffer = cls(
+            database, driver, loop,
+            max_points=db_config.get('batch_size', DEFAULT_BATCH_SIZE),
+            max_bytes=db_config.get('batch_bytes', DEFAULT_BATCH_BYTES),
+            linger=db_config.get('batch_linger', DEFAULT_BATCH_LINGER),
+            queue_points=db_config.get('queue_points', DEFAULT_QUEUE_POINTS),
+            queue_bytes=db_config.get('queue_bytes', DEFAULT_QUEUE_BYTES),
+            policy=db_config.get('queue_policy', REJECT_NEWEST),
+            max_writes=db_config.get('max_writes', DEFAULT_MAX_WRITES),
+            retry_after=db_config.get('retry_after', DEFAULT_RETRY_AFTER),
+            dedup=dedup, spill=spill,
+            replay_rate=db_config.get('replay_rate', DEFAULT_REPLAY_RATE),
+            replay_retry=db_config.get('replay_retry', DEFAULT_REPLAY_RETRY),
+            replayer=replayer, metrics=metrics)
+        if spills is not None and spill is not None:
+            spills[spill_directory] = (spill, buffer.replayer)
+        return buffer
+
+    def route(self, driver, chunks):
+        """Returns the buffers the chunks go to, with their chunks."""
+        return [(self, chunks)]
+
+    def check(self, size, count):
+        """Raises an error if points can't be admitted.
+
+        Nothing is dropped or spilled, so that points going to several
+        buffers can be refused before any of them makes room.
+        """
+        if self._fits(size, count) or self.spill is not None:
+            return
+        if self.policy == DROP_OLDEST and self._fits_once_dropped(
+                size, count):
+            return
+        raise QueueFullError(self.database, self.retry_after)
+
+    def admit(self, size, count):
+        """Makes room for points about to be added, or raises an error.
+
+        Returns whether the points can be added, rather than spilled.
+        """
+        self.check(size, count)
+        if not self._fits(size, count) and self.policy == DROP_OLDEST:
+            self._drop_oldest(size, count)
+        return self._fits(size, count)
+
+    def _fits(self, size, count):
+        return (self.pending_points + count <= self.queue_points and
+                self.pending_bytes + size <= self.queue_bytes)
+
+    def _fits_once_dropped(self, size, count):
+        """Tells whether points fit once all that isn't being written goes."""
+        points = self.count + sum(batch[1] for batch in self.queue)
+        size -= self.size + sum(batch[2] for batch in self.queue)
+        return self._fits(size, count - points)
+
+    def _drop_oldest(self, size, count):
+        batches = []
+        while self.queue and not self._fits(size, count):
+            chunks, batch_count, batch_size, precision = self.queue.popleft()
+            self._release(batch_size, batch_count)
+            batches.append((chunks, batch_count, precision))
+        while self.chunks and not self._fits(size, count):
+            data = self.chunks.pop(0)
+            chunk_count = self.counts.pop(0)
+            self.size -= len(data)
+            self.count -= chunk_count
+            self._release(len(data), chunk_count)
+            batches.append(([data], chunk_count, self.precision))
+        if self.spill is not None:
+            for chunks, batch_count, precision in batches:
+                self._spill(chunks, batch_count, precision)
+            return
+        dropped = sum(batch_count for _, batch_count, _ in batches)
+        self.dropped_points += dropped
+        if self.metrics is not None:
+            self.metrics.count_points(self.database, 'dropped', dropped)
+        logger.warning(
+            'Dropped %d queued points for %s', dropped, self.database)
+
+    def _release(self, size, count):
+        self.pending_bytes -= size
+        self.pending_points -= count
+
+    def spill_all(self, chunks, precision=None):
+        """Spills ``(data, count)`` chunks that weren't admitted."""
+        self._spill(
+            [data for data, _ in chunks],
+            sum(count for _, count in chunks), precision)
+
+    def _spill(self, chunks, count, precision=None):
+        if self.spill.append(b''.join(chunks), count, precision):
+            self.spilled_points += count
+            outcome = 'spilled'
+        else:
+            self.dropped_points += count
+            outcome = 'dropped'
+            logger.warning(
+                'Dropped %d points for %s, too many to spill',
+                count, self.database)
+        if self.metrics is not None:
+            self.metrics.count_points(self.database, outcome, count)
+        self.replayer.start(self.replayer.retry_after)
+
+    def add(self, data, count, precision=None):
+        if self.chunks and precision != self.precision:
+            self.flush()
+        self.precision = precision
+        self.chunks.append(data)
+        self.counts.append(count)
+        self.size += len(data)
+        self.count += count
+        self.pending_bytes += len(data)
+        self.pending_points += count
+        if self.count >= self.max_points or self.size >= self.max_bytes:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self.loop.call_later(self.linger, self.flush)
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.chunks:
+            self.queue.append(
+                (self.chunks, self.count, self.size, self.precision))
+            self.chunks, self.counts = [], []
+            self.size, self.count = 0, 0
+        self._start_writes()
+
+    def _start_writes(self):
+        while self.queue and len(self._writes) < self.max_writes:
+            chunks, count, size, precision = self.queue.popleft()
+            task = asyncio.ensure_future(
+                self._write(chunks, count, size, precision), loop=self.loop)
+            self._writes.add(task)
+            task.add_done_callback(self._write_done)
+
+    def _write_done(self, task):
+        self._writes.discard(task)
+        self._start_writes()
+
+    async def _write(self, chunks, count, size, precision=None):
+        started_at = self.loop.time()
+        failed = False
+        try:
+            if self.dedup is not None:
+                chunks = self._deduplicate(chunks)
+            if precision is None:
+                await self.driver.write_lines(self.database, chunks)
+            else:
+                await self.driver.write_lines(
+                    self.database, chunks, precision)
+        except Exception:
+            failed = True
+            logger.exception(
+                'Failed to write %d points to %s', count, self.database)
+            if self.spill is not None:
+                self._spill(chunks, count, precision)
+        finally:
+            self._release(size, count)
+            if self.metrics is not None:
+                self.metrics.observe_write(
+                    self.database, self.loop.time() - started_at, failed)
+
+    def _deduplicate(self, chunks):
+        chunks, saved = self.dedup.collapse(chunks)
+        if saved:
+            self.deduplicated_points += saved
+            if self.metrics is not None:
+                self.metrics.count_points(
+                    self.database, 'deduplicated', saved)
+        return chunks
+
+    async def drain(self):
+        self.flush()
+        while self._writes:
+            await asyncio.wait(list(self._writes), loop=self.loop)
+
+    def close(self):
+        """Stops replaying, leaving what's spilled for the next process."""
+        if self.spill is not None:
+            self.replayer.stop()
+            self.spill.close()
+
+
+class ShardedBuffer:
+    """The buffers of a database whose points are split between nodes.
+
+    Each node gets a ``BatchBuffer`` of its own, with the database's
+    settings, so that a slow or failing node only holds up its own points.
+    """
+
+    def __init__(self, database, loop, db_config, metrics=None,
+                 spill_directory=None, spills=None):
+        self.database = database
+        self.loop = loop
+        self.db_config = db_config
+        self.metrics = metrics
+        self.spill_directory = spill_directory
+        self.spills = spills
+        self.buffers = {}
+
+    @property
+    def pending_points(self):
+        return sum(
+            buffer.pending_points for buffer in self.buffers.values())
+
+    @property
+    def pending_bytes(self):
+        return sum(
+            buffer.pending_bytes for buffer in self.buffers.values())
+
+    def route(self, driver, chunks):
+        """Returns the buffers of the nodes the chunks go to, with theirs."""
+        routed = []
+        for node_driver, node_chunks in driver.route(chunks):
+            buffer = self.buffers.get(node_driver)
+            if buffer is None:
+                spill_directory = None
+                if self.spill_directory is not None:
+                    spill_directory = os.path.join(
+                        self.spill_directory,
+                        node_driver.node.name.replace(':', '-'))
+                buffer = self.buffers[node_driver] = BatchBuffer.from_config(
+                    self.database, node_driver, self.loop, self.db_config,
+                    self.metrics, spill_directory, self.spills)
+            routed.append((buffer, node_chunks))
+        return routed
+
+    async def drain(self):
+        for buffer in list(self.buffers.values()):
+            await buffer.drain()
+
+    def close(self):
+        for buffer in self.buffers.values():
+            buffer.close()
+
+
+class Batcher:
+    """Groups points from many requests into one buffer per database.
+
+    The points of a database written to a cluster are split between its
+    nodes, each with a buffer of its own.
+
+    With ``max_pending_bytes``, points are refused once the buffers of all
+    databases together hold that many bytes not written yet.
+
+    Databases configured to ``spill`` do so under ``spill_directory``, in a
+    directory of their own.
+
+    When the driver or the settings of a database change, on reload, its
+    buffer is replaced by a new one, and the old one is drained in the
+    background, writing what it holds as it was configured to.
+    """
+
+    def __init__(self, loop, max_pending_bytes=None,
+                 retry_after=DEFAULT_RETRY_AFTER, metrics=None,
+                 spill_directory=None):
+        self.loop = loop
+        self.max_pending_bytes = max_pending_bytes
+        self.retry_after = retry_after
+        self.metrics = metrics
+        self.spill_directory = spill_directory
+        self.buffers = {}
+        self.configs = {}
+        self.spills = {}
+        self.retired = {}
+
+    @property
+    def pending_bytes(self):
+        return sum(
+            buffer.pending_bytes for buffer in self.buffers.values()) + sum(
+            buffer.pending_bytes for buffer in self.retired.values())
+
+    def add(self, database, driver, data, count, db_config):
+        self.add_all(database, driver, [(data, count)], db_config)
+
+    def add_all(self, database, driver, chunks, db_config, precision=None):
+        """Adds ``(data, count)`` chunks, all of them or none.
+
+        The chunks are in ``precision`` if given, or in the driver's.
+        """
+        buffer = self.buffers.get(database)
+        if buffer is None or self._reconfigured(database, driver, db_config):
+            buffer = self._create_buffer(database, driver, db_config)
+        routed = buffer.route(driver, chunks)
+        sizes = [
+            sum(len(data) for data, _ in buffer_chunks)
+            for _, buffer_chunks in routed]
+        if (self.max_pending_bytes is not None and
+                self.pending_bytes + sum(sizes) > self.max_pending_bytes):
+            raise QueueFullError(database, self.retry_after, overloaded=True)
+        counts = [
+            sum(count for _, count in target_chunks)
+            for _, target_chunks in routed]
+        for (target, _), size, count in zip(routed, sizes, counts):
+            target.check(size, count)
+        admitted = [
+            target.admit(size, count)
+            for (target, _), size, count in zip(routed, sizes, counts)]
+        for (target, target_chunks), fits in zip(routed, admitted):
+            if not fits:
+                target.spill_all(target_chunks, precision)
+                continue
+            for data, count in target_chunks:
+                target.add(data, count, precision)
+
+    def _reconfigured(self, database, driver, db_config):
+        old_driver, old_config = self.configs[database]
+        if driver is not old_driver:
+            return True
+        if db_config is not old_config:
+            if db_config != old_config:
+                return True
+            self.configs[database] = driver, db_config
+        return False
+
+    def _create_buffer(self, database, driver, db_config):
+        old = self.buffers.get(database)
+        if old is not None:
+            task = asyncio.ensure_future(old.drain(), loop=self.loop)
+            self.retired[task] = old
+            task.add_done_callback(self.retired.pop)
+        spill_directory = None
+        if self.spill_directory is not None:
+            spill_directory = os.path.join(self.spill_directory, database)
+        if isinstance(driver, ClusterDriver):
+            buffer = ShardedBuffer(
+                database, self.loop, db_config, self.metrics,
+                spill_directory, self.spills)
+        else:
+            buffer = BatchBuffer.from_config(
+                database, driver, self.loop, db_config, self.metrics,
+                spill_directory, self.spills)
+        self.buffers[database] = buffer
+        self.configs[database] = driver, db_config
+        return buffer
+
+    async def drain(self):
+        for buffer in list(self.buffers.values()):
+            await buffer.drain()
+        if self.retired:
+            await asyncio.wait(list(self.retired), loop=self.loop)
+
+    def close(self):
+        for buffer in self.buffers.values():
+            buffer.close()
+        for spill, replayer in self.spills.values():
+            replayer.stop()
+            spill.close()
@@ -0,0 +1,326 @@
+import logging
+import math
+import zlib
+
+from influxproxy.ingestion import HASH, MEASUREMENT, SERIES
+from influxproxy.schemas import TAG
+
+
+DEFAULT_WINDOW = 3600
+DEFAULT_PRECISION = 10
+DEFAULT_BUCKETS = 100
+DEFAULT_MAX_SKETCHES = 1000
+REJECT = 'reject'
+DROP_TAG = 'drop_tag'
+BUCKET = 'bucket'
+ACTIONS = (REJECT, DROP_TAG, BUCKET)
+HASH_MASK = (1 << 64) - 1
+
+
+logger = logging.getLogger('influxproxy.cardinality')
+
+
+class HyperLogLog:
+    """Estimates how many distinct 64 bit hashes were added.
+
+    Takes ``2 ** precision`` bytes, for a standard error of about
+    ``1.04 / sqrt(2 ** precision)``, 3% with the default precision. The sum
+    the estimate is computed from is kept up to date as registers change,
+    so estimating takes constant time; it's kept as an integer, scaled by
+    ``2 ** 64``, so that it doesn't lose precision as it shrinks.
+    """
+
+    __slots__ = ('precision', 'registers', '_sum', '_zeros')
+
+    def __init__(self, precision=DEFAULT_PRECISION):
+        if not 4 <= precision <= 16:
+            raise ValueError(
+                'Precision should be from 4 to 16, not {}'.format(precision))
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+        self._sum = len(self.registers) << 64
+        self._zeros = len(self.registers)
+
+    @property
+    def empty(self):
+        return self._zeros == len(self.registers)
+
+    def add(self, hashed):
+        index = hashed & (len(self.registers) - 1)
+        rank = 65 - self.precision - (hashed >> self.precision).bit_length()
+        old = self.registers[index]
+        if rank > old:
+            self.registers[index] = rank
+            self._sum += (1 << (64 - rank)) - (1 << (64 - old))
+            if not old:
+                self._zeros -= 1
+
+    def estimate(self):
+        size = len(self.registers)
+        if size >= 128:
+            alpha = 0.7213 / (1 + 1.079 / size)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[size]
+        estimate = alpha * size * size / (self._sum / 2.0 ** 64)
+        if estimate <= 2.5 * size and self._zeros:
+            # Linear counting is more accurate for small cardinalities.
+            return size * math.log(size / self._zeros)
+        return estimate
+
+
+class WindowedSketch:
+    """Estimates the distinct values seen over the last window or two.
+
+    Values go to the sketch of the current window, and to one that also
+    holds the previous window's; on rotation, the current sketch becomes
+    that one, so estimates always cover between one and two windows.
+    """
+
+    __slots__ = ('current', 'combined')
+
+    def __init__(self, precision=DEFAULT_PRECISION):
+        self.current = HyperLogLog(precision)
+        self.combined = HyperLogLog(precision)
+
+    def add(self, value):
+        hashed = hash(value) & HASH_MASK
+        self.current.add(hashed)
+        self.combined.add(hashed)
+
+    def estimate(self):
+        return self.combined.estimate()
+
+    def rotate(self):
+        """Starts a new window, returning whether the last one saw values."""
+        self.combined = self.current
+        self.current = HyperLogLog(self.combined.precision)
+        return not self.combined.empty
+
+
+class CardinalityGuard:
+    """Keeps the series of a database's measurements from exploding.
+
+    Distinct series are estimated per measurement, and distinct values per
+    tag of each measurement, over a sliding ``window`` of seconds. Points
+    with a tag past ``max_tag_values`` values, or of a measurement past
+    ``max_series`` series, where the tag with the most values is blamed,
+    are rejected, have that tag dropped, or have its values hashed into
+    ``buckets`` values, depending on ``action``. Points are counted as
+    they come, before the action, so it lasts as long as the values keep
+    coming.
+
+    At most ``max_sketches`` sketches are kept; the series of measurements
+    and tags past them are left alone. Sketches that saw nothing for a
+    whole window are forgotten.
+    """
+
+    def __init__(self, database, loop, window=DEFAULT_WINDOW, max_series=None,
+                 max_tag_values=None, action=REJECT, buckets=DEFAULT_BUCKETS,
+                 precision=DEFAULT_PRECISION,
+                 max_sketches=DEFAULT_MAX_SKETCHES, metrics=None):
+        if action not in ACTIONS:
+            raise ValueError('Unknown cardinality action: {!r}'.format(action))
+        self.database = database
+        self.loop = loop
+        self.window = window
+        self.max_series = max_series
+        self.max_tag_values = max_tag_values
+        self.action = action
+        self.buckets = buckets
+        self.precision = precision
+        self.max_sketches = max_sketches
+        self.metrics = metrics
+        self.series = {}
+        self.tag_values = {}
+        self.limited = set()
+        self.rotate_at = loop.time() + window
+
+    @classmethod
+    def from_config(cls, database, loop, db_config, metrics=None):
+        cardinality = db_config['cardinality']
+        return cls(
+            database, loop,
+            window=cardinality.get('window', DEFAULT_WINDOW),
+            max_series=cardinality.get('max_series'),
+            max_tag_values=cardinality.get('max_tag_values'),
+            action=cardinality.get('action', REJECT),
+            buckets=cardinality.get('buckets', DEFAULT_BUCKETS),
+            precision=cardinality.get('precision', DEFAULT_PRECISION),
+            max_sketches=cardinality.get(
+                'max_sketches', DEFAULT_MAX_SKETCHES),
+            metrics=metrics)
+
+    @property
+    def sketches(self):
+        return len(self.series) + len(self.tag_values)
+
+    def check(self, chunks):
+        """Applies the action to ``(data, count)`` chunks.
+
+        Returns the chunks, those without points acted on as they are, and
+        the number of points rejected.
+        """
+        if self.loop.time() >= self.rotate_at:
+            self.rotate()
+        checked = []
+        rejected = retagged = 0
+        for data, count in chunks:
+            kept = []
+            changed = False
+            for line in data.split(b'\n'):
+                if not line or line[0] == HASH:
+                    continue
+                guarded = self._guard(line)
+                if guarded is not line:
+                    changed = True
+                    if guarded is None:
+                        continue
+                    retagged += 1
+                kept.append(guarded)
+            if not changed:
+                checked.append((data, count))
+                continue
+            rejected += count - len(kept)
+            if kept:
+                kept.append(b'')
+                checked.append((b'\n'.join(kept), len(kept) - 1))
+        if self.metrics is not None:
+            if rejected:
+                self.metrics.count_points(
+                    self.database, 'over_cardinality', rejected)
+            if retagged:
+                self.metrics.count_points(
+                    self.database, 'retagged', retagged)
+        return checked, rejected
+
+    def _guard(self, line):
+        series = SERIES.match(line).group()
+        measurement = MEASUREMENT.match(series).group()
+        series_sketch = self._sketch(self.series, measurement)
+        if series_sketch is None:
+            return line
+        series_sketch.add(series)
+        tags = [
+            match.groups()
+            for match in TAG.finditer(series, len(measurement))]
+        over = self._over(measurement, series_sketch, tags)
+        if not over:
+            return line
+        for key in over:
+            self._warn(measurement, key)
+        if self.action == REJECT:
+            return None
+        parts = [measurement]
+        for key, value in tags:
+            if key not in over:
+                parts.append(b',' + key + b'=' + value)
+            elif self.action == BUCKET:
+                parts.append(b',%s=bucket-%d' % (
+                    key, zlib.crc32(value) % self.buckets))
+        return b''.join(parts) + line[len(series):]
+
+    def _over(self, measurement, series_sketch, tags):
+        """Counts the values of tags, returning the keys of those over."""
+        over = set()
+        top_key, top_values = None, 0
+        for key, value in tags:
+            sketch = self._sketch(self.tag_values, (measurement, key))
+            if sketch is None:
+                continue
+            sketch.add(value)
+            values = round(sketch.estimate())
+            if (self.max_tag_values is not None and
+                    values > self.max_tag_values):
+                over.add(key)
+            if values > top_values:
+                top_key, top_values = key, values
+        if (not over and top_key is not None and
+                self.max_series is not None and
+                round(series_sketch.estimate()) > self.max_series):
+            over.add(top_key)
+        return over
+
+    def _sketch(self, sketches, key):
+        sketch = sketches.get(key)
+        if sketch is None and self.sketches < self.max_sketches:
+            sketch = sketches[key] = WindowedSketch(self.precision)
+        return sketch
+
+    def _warn(self, measurement, key):
+        if (measurement, key) not in self.limited:
+            self.limited.add((measurement, key))
+            logger.warning(
+                'Cardinality of %s is too high, applying %s to its %s tag',
+                measurement.decode('utf-8', 'replace'), self.action,
+                key.decode('utf-8', 'replace'))
+
+    def rotate(self):
+        """Starts a new window, forgetting sketches that saw nothing."""
+        self.rotate_at = self.loop.time() + self.window
+        self.limited.clear()
+        for sketches in (self.series, self.tag_values):
+            for key, sketch in list(sketches.items()):
+                if not sketch.rotate():
+                    del sketches[key]
+
+    def estimates(self):
+        """Returns the estimated series and tag values of each measurement."""
+        measurements = {}
+        for measurement, sketch in self.series.items():
+            measurements[measurement.decode('utf-8', 'replace')] = {
+                'series': round(sketch.estimate()),
+                'tags': {},
+            }
+        for (measurement, key), sketch in self.tag_values.items():
+            tags = measurements[measurement.decode('utf-8', 'replace')][
+                'tags']
+            tags[key.decode('utf-8', 'replace')] = {
+                'values': round(sketch.estimate()),
+                'limited': (measurement, key) in self.limited,
+            }
+        return {
+            'window': self.window,
+            'max_series': self.max_series,
+            'max_tag_values': self.max_tag_values,
+            'action': self.action,
+            'measurements': measurements,
+        }
+
+
+class CardinalityGuards:
+    """Guards the cardinality of the databases that opt in to it.
+
+    A database opts in with a ``cardinality`` section in its configuration,
+    and gets a ``CardinalityGuard`` of its own, built anew when a reload
+    changes the section. Every worker keeps its own sketches, of the
+    points it takes.
+    """
+
+    def __init__(self, loop, metrics=None):
+        self.loop = loop
+        self.metrics = metrics
+        self.guards = {}
+        self.configs = {}
+
+    def check(self, database, chunks, db_config):
+        """Returns the chunks guarded, and the number of points rejected."""
+        cardinality = db_config.get('cardinality')
+        if not cardinality:
+            return chunks, 0
+        guard = self.guards.get(database)
+        old_cardinality = self.configs.get(database)
+        if guard is None or (cardinality is not old_cardinality and
+                             cardinality != old_cardinality):
+            guard = self.guards[database] = CardinalityGuard.from_config(
+                database, self.loop, db_config, self.metrics)
+        self.configs[database] = cardinality
+        return guard.check(chunks)
+
+    def estimates(self, database=None):
+        """Returns the estimates of every database, or of one."""
+        if database is not None:
+            guard = self.guards.get(database)
+            return None if guard is None else guard.estimates()
+        return {
+            database: guard.estimates()
+            for database, guard in self.guards.items()}
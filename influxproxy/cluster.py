@@ -0,0 +1,278 @@
+import asyncio
+import hashlib
+import logging
+import re
+from bisect import bisect
+
+import aiohttp
+
+
+DEFAULT_VIRTUAL_NODES = 160
+DEFAULT_REPLICATION = 1
+DEFAULT_MAX_FAILURES = 3
+DEFAULT_DOWN_FOR = 10
+DEFAULT_CHECK_INTERVAL = 5
+CHECK_TIMEOUT = 2
+MAX_CACHED_SERIES = 100000
+HASH = ord('#')
+SERIES = re.compile(rb'(?:[^ \\]|\\.)+')
+SERIES_PART = re.compile(rb'(?:[^,\\]|\\.)+')
+
+
+logger = logging.getLogger('influxproxy.cluster')
+
+
+def ring_hash(key):
+    """Hashes bytes the same way in every process, unlike ``hash``."""
+    return int.from_bytes(hashlib.md5(key).digest()[:8], 'big')
+
+
+def series_key(line):
+    """Returns the series of a line: its measurement and sorted tags."""
+    parts = SERIES_PART.findall(SERIES.match(line).group())
+    if len(parts) > 2:
+        parts[1:] = sorted(parts[1:])
+    return b','.join(parts)
+
+
+def node_configs(backend_conf):
+    """Returns the backend configuration of each node.
+
+    A backend without a ``cluster`` section is a single node; the nodes of
+    a cluster take the settings they don't give from the backend.
+    """
+    cluster = backend_conf.get('cluster')
+    if not cluster:
+        return [backend_conf]
+    defaults = {
+        key: value for key, value in backend_conf.items()
+        if key != 'cluster'}
+    return [dict(defaults, **node) for node in cluster['nodes']]
+
+
+class ClusterNode:
+    """A backend of a cluster, and whether it's taking writes.
+
+    A node is marked down once ``max_failures`` writes or health checks in
+    a row failed, and left out of routing for ``down_for`` seconds. It's
+    then tried again, and marked down again on its next failure, unless it
+    succeeds first.
+    """
+
+    def __init__(self, host, port, loop, max_failures=DEFAULT_MAX_FAILURES,
+                 down_for=DEFAULT_DOWN_FOR):
+        self.host = host
+        self.port = port
+        self.name = '{}:{}'.format(host, port)
+        self.loop = loop
+        self.max_failures = max_failures
+        self.down_for = down_for
+        self.failures = 0
+        self.down_until = None
+
+    @property
+    def ping_url(self):
+        return 'http://{}:{}/ping'.format(self.host, self.port)
+
+    @property
+    def up(self):
+        return self.down_until is None or self.loop.time() >= self.down_until
+
+    def succeeded(self):
+        if self.down_until is not None:
+            logger.info('Node %s is back up', self.name)
+        self.failures = 0
+        self.down_until = None
+
+    def failed(self):
+        self.failures += 1
+        if self.failures >= self.max_failures and self.up:
+            self.down_until = self.loop.time() + self.down_for
+            logger.warning(
+                'Node %s is down after %d failures, failing over for %ss',
+                self.name, self.failures, self.down_for)
+
+
+class HashRing:
+    """Places each node at ``virtual_nodes`` points of a ring of hashes.
+
+    A series prefers the nodes met walking the ring from its own hash, so
+    adding or removing a node only moves the series of the arcs it takes
+    or gives back, and the many points per node keep those arcs even.
+    """
+
+    def __init__(self, names, virtual_nodes=DEFAULT_VIRTUAL_NODES):
+        points = sorted(
+            (ring_hash('{}#{}'.format(name, index).encode('utf-8')), name)
+            for name in names for index in range(virtual_nodes))
+        self.hashes = [point for point, _ in points]
+        self.names = [name for _, name in points]
+        self.size = len(set(self.names))
+
+    def preference(self, key):
+        """Returns the names of all nodes, in the order ``key`` prefers."""
+        index = bisect(self.hashes, ring_hash(key))
+        count = len(self.names)
+        names = []
+        while len(names) < self.size:
+            name = self.names[index % count]
+            if name not in names:
+                names.append(name)
+            index += 1
+        return names
+
+
+class Cluster:
+    """Routes each series to ``replication`` nodes of a cluster.
+
+    A series goes to the first nodes up in the order the ring prefers for
+    it, so the series of a node that's down fail over to the next nodes,
+    and come back once it's up. When no node is up, series go to their
+    preferred nodes anyway, rather than nowhere.
+
+    Nodes are also checked every ``check_interval`` seconds through their
+    /ping endpoint, as writes over UDP never tell whether a node is up.
+    """
+
+    def __init__(self, nodes, loop, virtual_nodes=DEFAULT_VIRTUAL_NODES,
+                 replication=DEFAULT_REPLICATION,
+                 check_interval=DEFAULT_CHECK_INTERVAL):
+        self.nodes = nodes
+        self.loop = loop
+        self.ring = HashRing([node.name for node in nodes], virtual_nodes)
+        self.replication = min(replication, len(nodes))
+        self.check_interval = check_interval
+        self._nodes_by_name = {node.name: node for node in nodes}
+        self._preferences = {}
+        self._checker = None
+
+    @classmethod
+    def from_config(cls, backend_conf, loop):
+        cluster = backend_conf['cluster']
+        nodes = [
+            ClusterNode(
+                node_conf['host'], node_conf['port'], loop,
+                max_failures=cluster.get(
+                    'max_failures', DEFAULT_MAX_FAILURES),
+                down_for=cluster.get('down_for', DEFAULT_DOWN_FOR))
+            for node_conf in node_configs(backend_conf)]
+        return cls(
+            nodes, loop,
+            virtual_nodes=cluster.get('virtual_nodes', DEFAULT_VIRTUAL_NODES),
+            replication=cluster.get('replication', DEFAULT_REPLICATION),
+            check_interval=cluster.get(
+                'check_interval', DEFAULT_CHECK_INTERVAL))
+
+    def nodes_for(self, series):
+        """Returns the nodes a series is written to."""
+        preference = self._preferences.get(series)
+        if preference is None:
+            if len(self._preferences) >= MAX_CACHED_SERIES:
+                self._preferences.clear()
+            preference = self._preferences[series] = [
+                self._nodes_by_name[name]
+                for name in self.ring.preference(series)]
+        nodes = [node for node in preference if node.up][:self.replication]
+        return nodes or preference[:self.replication]
+
+    def start_checks(self, session):
+        if self._checker is None:
+            self._checker = asyncio.ensure_future(
+                self._check_periodically(session), loop=self.loop)
+
+    async def _check_periodically(self, session):
+        while True:
+            await asyncio.sleep(self.check_interval, loop=self.loop)
+            await self.check(session)
+
+    async def check(self, session):
+        """Pings every node, updating whether it's up."""
+        await asyncio.gather(
+            *[self._check_node(session, node) for node in self.nodes],
+            loop=self.loop)
+
+    async def _check_node(self, session, node):
+        try:
+            response = await asyncio.wait_for(
+                session.get(node.ping_url), CHECK_TIMEOUT, loop=self.loop)
+            await response.release()
+            healthy = response.status < 300
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+            healthy = False
+        if healthy:
+            node.succeeded()
+        else:
+            node.failed()
+
+    def close(self):
+        if self._checker is not None:
+            self._checker.cancel()
+            self._checker = None
+
+
+class NodeDriver:
+    """The driver of a node, telling the node how its writes went.
+
+    Only ``acknowledged`` writes, as over HTTP, tell that a node is up;
+    writes over UDP succeed whether anything is listening or not.
+    """
+
+    def __init__(self, node, driver, acknowledged=False):
+        self.node = node
+        self.driver = driver
+        self.acknowledged = acknowledged
+
+    async def write_lines(self, database, chunks, precision=None):
+        try:
+            await self.driver.write_lines(database, chunks, precision)
+        except Exception:
+            self.node.failed()
+            raise
+        if self.acknowledged:
+            self.node.succeeded()
+
+
+class ClusterDriver:
+    """Encodes points for a database, and splits them between its nodes.
+
+    Points are encoded by the driver of the first node, as the drivers of
+    all nodes share the database's settings, and the lines are then routed
+    by series to the ``NodeDriver`` of each of their nodes.
+    """
+
+    def __init__(self, cluster, drivers, acknowledged=False):
+        self.cluster = cluster
+        self.driver = drivers[0]
+        self.precision = self.driver.precision
+        self.adaptive_precision = self.driver.adaptive_precision
+        self.node_drivers = {
+            node: NodeDriver(node, driver, acknowledged)
+            for node, driver in zip(cluster.nodes, drivers)}
+
+    def encode(self, points, precision=None):
+        return self.driver.encode(points, precision)
+
+    def route(self, chunks):
+        """Splits ``(data, count)`` chunks between nodes, by series.
+
+        Returns a ``(node driver, chunks)`` pair for each node written to.
+        """
+        nodes_for = self.cluster.nodes_for
+        lines = {}
+        for data, _ in chunks:
+            for line in data.split(b'\n'):
+                if not line or line[0] == HASH:
+                    continue
+                for node in nodes_for(series_key(line)):
+                    node_lines = lines.get(node)
+                    if node_lines is None:
+                        node_lines = lines[node] = []
+                    node_lines.append(line)
+        routed = []
+        for node in self.cluster.nodes:
+            node_lines = lines.get(node)
+            if node_lines is not None:
+                node_lines.append(b'')
+                routed.append((self.node_drivers[node], [
+                    (b'\n'.join(node_lines), len(node_lines) - 1)]))
+        return routed
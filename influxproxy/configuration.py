@@ -1,13 +1,107 @@
 import logging
 import os
+from collections import namedtuple
 from pathlib import Path
 
 import yaml
 
+from influxproxy.access import compile_access
+from influxproxy.logs import FORMATS, HANDLERS, setup_logging
+from influxproxy.schemas import compile_schemas
+
+
+SETTINGS_PATH = os.environ['APP_SETTINGS_YAML']
+
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('influxproxy')
-config = yaml.load(open(os.environ['APP_SETTINGS_YAML']))
+
+
+class InvalidConfigError(ValueError):
+    """Raised when the configuration can't be used."""
+
+
+def validate_config(config):
+    """Checks the parts of the configuration every request relies on."""
+    if not isinstance(config, dict):
+        raise InvalidConfigError('The configuration should be a mapping')
+    for key in ('backend', 'databases', 'preflight_expiration'):
+        if key not in config:
+            raise InvalidConfigError('Missing {!r}'.format(key))
+    for key in ('host', 'port'):
+        if key not in config['backend']:
+            raise InvalidConfigError('Missing backend {!r}'.format(key))
+    if not isinstance(config['databases'], dict):
+        raise InvalidConfigError('The databases should be a mapping')
+    for name, db_config in config['databases'].items():
+        if not isinstance(db_config, dict):
+            raise InvalidConfigError(
+                'Database {!r} should be a mapping'.format(name))
+        if not isinstance(db_config.get('public_key'), str):
+            raise InvalidConfigError(
+                'Database {!r} has no public key'.format(name))
+        if 'allow_from' not in db_config:
+            raise InvalidConfigError(
+                'Database {!r} allows no origin'.format(name))
+    if not isinstance(config.get('admin_token') or '', str):
+        raise InvalidConfigError('The admin token should be a string')
+    validate_logging(config.get('logging', {}))
+
+
+def validate_logging(log_config):
+    if log_config.get('handler', HANDLERS[0]) not in HANDLERS:
+        raise InvalidConfigError(
+            'The logging handler should be one of {}'.format(HANDLERS))
+    if log_config.get('format', FORMATS[0]) not in FORMATS:
+        raise InvalidConfigError(
+            'The logging format should be one of {}'.format(FORMATS))
+
+
+class Settings(namedtuple('Settings', [
+        'config', 'schemas', 'access', 'mtime'])):
+    """A configuration, validated and compiled, never changed once built.
+
+    Reloading builds new settings and swaps them in as a whole, so readers
+    always see one consistent configuration.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def load(cls, path):
+        mtime = os.stat(path).st_mtime
+        with open(path) as settings_file:
+            config = yaml.load(settings_file)
+        return cls.compile(config, mtime)
+
+    @classmethod
+    def compile(cls, config, mtime=None):
+        validate_config(config)
+        schemas = compile_schemas(config['databases'])
+        return cls(config, schemas, compile_access(config, schemas), mtime)
+
+    @property
+    def databases(self):
+        return frozenset(self.config['databases'])
+
+
+settings = Settings.load(SETTINGS_PATH)
+# As loaded at startup; ``settings`` holds the current configuration.
+config = settings.config
+schemas = settings.schemas
+access = settings.access
+# Reloading only swaps in the sampling rates of requests, read as they come.
+setup_logging(config.get('logging', {}))
+
+
+def reload_settings(path=SETTINGS_PATH):
+    """Loads the configuration again, and swaps it in if it's valid.
+
+    Returns the new settings, or raises if they're invalid, in which case
+    the current ones are kept.
+    """
+    global settings
+    settings = Settings.load(path)
+    return settings
 
 
 PORT = int(os.environ.get('PORT', None) or config.get('port', 8765))
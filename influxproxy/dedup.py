@@ -0,0 +1,78 @@
+import re
+from collections import OrderedDict
+
+from influxproxy.ingestion import HASH, SERIES, parse_line
+
+
+DEFAULT_DEDUP_KEYS = 10000
+TIMESTAMP = re.compile(rb'-?\d+$')
+
+
+def merge_lines(old, new):
+    """Merges two lines of the same point, the fields of ``new`` winning."""
+    key, old_fields = parse_line(old)
+    _, new_fields = parse_line(new)
+    fields = OrderedDict(old_fields)
+    fields.update(new_fields)
+    return b''.join([
+        key, b' ',
+        b','.join(name + b'=' + value for name, value in fields.items()),
+        new[new.rfind(b' '):]])
+
+
+class Deduplicator:
+    """Collapses the points of a batch that share their series and time.
+
+    InfluxDB stores a single point per series and timestamp, merging the
+    fields written to it, the last write winning; duplicates are merged the
+    same way before they are written, so that each point is sent once.
+
+    Points are looked up by a hash of their series key and timestamp, and
+    only the ``max_keys`` most recently seen are remembered, so a batch
+    takes bounded memory whatever its size. Points without a timestamp are
+    timed by the backend, and left alone.
+    """
+
+    def __init__(self, max_keys=DEFAULT_DEDUP_KEYS):
+        self.max_keys = max_keys
+
+    def collapse(self, chunks):
+        """Returns the chunks with duplicates merged, and how many were.
+
+        Chunks without duplicates are returned as they are.
+        """
+        lines = []
+        seen = OrderedDict()
+        saved = 0
+        for data in chunks:
+            for line in data.split(b'\n'):
+                line = line.rstrip(b'\r')
+                if not line or line[0] == HASH:
+                    continue
+                point = self._point(line)
+                if point is None:
+                    lines.append(line)
+                    continue
+                key = hash(point)
+                index = seen.get(key)
+                if index is not None and self._point(lines[index]) == point:
+                    lines[index] = merge_lines(lines[index], line)
+                    saved += 1
+                else:
+                    seen[key] = len(lines)
+                    lines.append(line)
+                seen.move_to_end(key)
+                if len(seen) > self.max_keys:
+                    seen.popitem(last=False)
+        if not saved:
+            return chunks, 0
+        lines.append(b'')
+        return [b'\n'.join(lines)], saved
+
+    def _point(self, line):
+        series_end = SERIES.match(line).end()
+        time_start = line.rfind(b' ') + 1
+        if time_start <= series_end + 1 or not TIMESTAMP.match(
+                line, time_start):
+            return None
+        return line[:series_end], line[time_start:]
@@ -1,12 +1,26 @@
+import asyncio
 import logging
 import socket
 
-from influxdb import InfluxDBClient
+from aiohttp import BasicAuth
 
-from influxproxy.configuration import config
+from influxproxy import configuration
+from influxproxy.cluster import Cluster, ClusterDriver, node_configs
+from influxproxy.encoder import EncodingError, LineEncoder
+from influxproxy.http import (
+    DEFAULT_POOL_SIZE,
+    DEFAULT_RETRIES,
+    DEFAULT_WRITE_TIMEOUT,
+    HTTPWriter,
+    create_session,
+)
+from influxproxy.udp import DEFAULT_PAYLOAD_SIZE, UDPEndpoint, UDPWriter
 
 
 MANDATORY_FIELDS = ('measurement', 'time', 'fields')
+# Mandatory when missing times are stamped by the proxy.
+STAMPED_FIELDS = ('measurement', 'fields')
+DNS_TTL = 60
 
 
 logger = logging.getLogger('influxproxy.drivers')
@@ -16,37 +30,271 @@ class MalformedDataError(ValueError):
     """Raised when the data is malformed."""
 
 
+def validate_points(points, mandatory=MANDATORY_FIELDS):
+    """Returns the points as a list, raising if any of them is malformed."""
+    if not isinstance(points, list):
+        points = [points]
+    try:
+        for point in points:
+            _validate_point(point, mandatory)
+    except Exception as e:
+        raise MalformedDataError(str(e))
+    return points
+
+
+def _validate_point(point, mandatory):
+    if not all(field in point for field in mandatory):
+        raise ValueError('Point %s should contain these fields: %s',
+                         point, mandatory)
+
+
 class InfluxDriver:
-    def __init__(self, udp_port=None):
-        backend_conf = config['backend']
-        host = socket.gethostbyname(backend_conf['host'])
+    """Encodes points and writes them to the backend.
 
+    With ``adaptive_precision``, which takes a writer that can be told the
+    precision of each write, points can be written in the coarsest
+    precision their times allow, rather than in ``precision``.
+    """
+
+    def __init__(self, udp_port=None, host=None, writer=None,
+                 precision=None, adaptive_precision=False):
         if udp_port is None:
-            udp_port = backend_conf['udp_port']
+            udp_port = configuration.settings.config['backend']['udp_port']
+
+        self.host = host
+        self.udp_port = udp_port
+        self.writer = writer
+        self.precision = precision
+        self.adaptive_precision = adaptive_precision
+        self.encoder = LineEncoder(precision=precision)
+
+    def encode(self, points, precision=None):
+        try:
+            return self.encoder.encode(points, precision)
+        except EncodingError as e:
+            raise MalformedDataError(str(e))
+
+    async def write_lines(self, database, chunks, precision=None):
+        if precision is None:
+            await self.writer.write(database, chunks)
+        else:
+            await self.writer.write(database, chunks, precision)
+
+
+class HostResolver:
+    """Resolves a hostname without blocking the event loop.
 
-        self.client = InfluxDBClient(
-            host, backend_conf['port'],
-            backend_conf['username'], backend_conf['password'],
-            use_udp=True, udp_port=udp_port)
+    The address is cached for ``ttl`` seconds and, once first resolved, kept
+    fresh by a background task, so requests don't wait on DNS. Once resolved,
+    the address is kept for another ``ttl`` whenever the host can't be
+    resolved again, so that a DNS outage doesn't stop writes.
+    """
 
-    def create_databases(self):
-        for db in sorted(config['databases']):
-            self.client.create_database(db)
+    def __init__(self, host, loop, ttl=DNS_TTL):
+        self.host = host
+        self.loop = loop
+        self.ttl = ttl
+        self.address = None
+        self.expires_at = 0
+        self._refresher = None
 
-    def write(self, database, points):
-        if not isinstance(points, list):
-            points = [points]
-        self._validate_points(points)
-        self.client.write_points(points, database=database)
+    async def resolve(self):
+        if self.address is None or self.loop.time() >= self.expires_at:
+            await self.refresh()
+        if self._refresher is None:
+            self._refresher = asyncio.ensure_future(
+                self._refresh_periodically(), loop=self.loop)
+        return self.address
 
-    def _validate_points(self, points):
+    async def refresh(self):
+        """Resolves the host again, keeping the last address if that fails.
+
+        Raises only if the host has never been resolved.
+        """
         try:
-            for point in points:
-                self._validate_point(point)
-        except Exception as e:
-            raise MalformedDataError(str(e))
+            infos = await self.loop.getaddrinfo(
+                self.host, None, family=socket.AF_INET,
+                type=socket.SOCK_DGRAM)
+        except OSError as e:
+            if self.address is None:
+                raise
+            logger.warning(
+                'Could not resolve %s, keeping %s: %s',
+                self.host, self.address, e)
+        else:
+            self.address = infos[0][4][0]
+        self.expires_at = self.loop.time() + self.ttl
+
+    async def _refresh_periodically(self):
+        while True:
+            await asyncio.sleep(self.ttl / 2, loop=self.loop)
+            await self.refresh()
+
+    def close(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
+
+
+class DriverRegistry:
+    """Keeps drivers alive for the life of the app.
+
+    Drivers are keyed by backend and by the settings that change what they
+    send, and drivers writing to the same destination share its transport: a
+    single UDP endpoint per host and port, and a single pool of keep-alive
+    HTTP connections for the /write endpoints. The backend is read from
+    the current configuration on every call, so that drivers for a new one
+    are created once the configuration is reloaded.
+
+    A backend with a ``cluster`` section gets a ``ClusterDriver`` per
+    database settings, over a driver per node, and its nodes are checked
+    in the background.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.resolvers = {}
+        self.drivers = {}
+        self.cluster_drivers = {}
+        self.endpoints = {}
+        self.session = None
+        self.cluster = None
+        self._use_backend(configuration.settings.config['backend'])
+
+    @property
+    def resolver(self):
+        """The resolver of the backend's host."""
+        return self._get_resolver(self.backend_conf['host'])
+
+    def _get_resolver(self, host):
+        resolver = self.resolvers.get(host)
+        if resolver is None:
+            resolver = self.resolvers[host] = HostResolver(host, self.loop)
+        return resolver
+
+    async def get(self, db_config):
+        backend_conf = configuration.settings.config['backend']
+        if backend_conf is not self.backend_conf:
+            self._use_backend(backend_conf)
+        if self.cluster is not None:
+            return await self._get_cluster_driver(db_config)
+        return await self._get_node_driver(db_config, self.backend_conf)
+
+    async def _get_cluster_driver(self, db_config):
+        drivers = [
+            await self._get_node_driver(db_config, node_conf)
+            for node_conf in node_configs(self.backend_conf)]
+        key = tuple(drivers)
+        driver = self.cluster_drivers.get(key)
+        if driver is None:
+            driver = self.cluster_drivers[key] = ClusterDriver(
+                self.cluster, drivers,
+                acknowledged=db_config.get('transport', 'udp') == 'http')
+            self.cluster.start_checks(self._get_session())
+        return driver
+
+    async def _get_node_driver(self, db_config, backend_conf):
+        if db_config.get('transport', 'udp') == 'http':
+            return await self._get_http_driver(db_config, backend_conf)
+        return await self._get_udp_driver(db_config, backend_conf)
+
+    async def _get_udp_driver(self, db_config, backend_conf):
+        host = backend_conf['host']
+        udp_port = db_config.get('udp_port', backend_conf['udp_port'])
+        payload_size = db_config.get(
+            'udp_payload_size', DEFAULT_PAYLOAD_SIZE)
+        precision = db_config.get('precision')
+        endpoint = await self._get_endpoint(host, udp_port)
+        key = ('udp', host, udp_port, payload_size, precision)
+        driver = self.drivers.get(key)
+        if driver is None:
+            driver = self.drivers[key] = InfluxDriver(
+                udp_port=udp_port, host=endpoint.address[0],
+                writer=UDPWriter(endpoint, payload_size=payload_size),
+                precision=precision)
+        else:
+            driver.writer.endpoint = endpoint
+        return driver
+
+    async def _get_endpoint(self, host, udp_port):
+        address = (await self._get_resolver(host).resolve(), udp_port)
+        key = (host, udp_port)
+        while True:
+            creating = self.endpoints.get(key)
+            if creating is None:
+                creating = self.endpoints[key] = asyncio.ensure_future(
+                    UDPEndpoint.create(address, self.loop), loop=self.loop)
+            try:
+                endpoint = await creating
+            except Exception:
+                if self.endpoints.get(key) is creating:
+                    del self.endpoints[key]
+                raise
+            if endpoint.address == address:
+                return endpoint
+            if self.endpoints.get(key) is creating:
+                del self.endpoints[key]
+                endpoint.close()
+
+    async def _get_http_driver(self, db_config, backend_conf):
+        host = backend_conf['host']
+        port = backend_conf['port']
+        precision = db_config.get('precision')
+        gzip = db_config.get('gzip', False)
+        retries = db_config.get('retries', DEFAULT_RETRIES)
+        write_timeout = db_config.get('write_timeout', DEFAULT_WRITE_TIMEOUT)
+        address = await self._get_resolver(host).resolve()
+        url = 'http://{}:{}/write'.format(address, port)
+        key = ('http', host, port, precision, gzip, retries, write_timeout)
+        driver = self.drivers.get(key)
+        if driver is None:
+            writer = HTTPWriter(
+                self._get_session(), url, self.loop,
+                auth=BasicAuth(
+                    backend_conf['username'], backend_conf['password']),
+                precision=precision, gzip=gzip, retries=retries,
+                write_timeout=write_timeout)
+            driver = self.drivers[key] = InfluxDriver(
+                host=address, writer=writer, precision=precision,
+                adaptive_precision=precision is None)
+        else:
+            driver.writer.url = url
+        return driver
+
+    def _use_backend(self, backend_conf):
+        self.backend_conf = backend_conf
+        hosts = {node_conf['host'] for node_conf in node_configs(backend_conf)}
+        for host in list(self.resolvers):
+            if host not in hosts:
+                self.resolvers.pop(host).close()
+        if self.cluster is not None:
+            self.cluster.close()
+            self.cluster = None
+        self.cluster_drivers.clear()
+        if backend_conf.get('cluster'):
+            self.cluster = Cluster.from_config(backend_conf, self.loop)
+
+    def _get_session(self):
+        if self.session is None:
+            self.session = create_session(
+                self.loop, pool_size=self.backend_conf.get(
+                    'http_pool_size', DEFAULT_POOL_SIZE))
+        return self.session
 
-    def _validate_point(self, point):
-        if not all(field in point for field in MANDATORY_FIELDS):
-            raise ValueError('Point %s should contain these fields: %s',
-                             point, MANDATORY_FIELDS)
+    def close(self):
+        for resolver in self.resolvers.values():
+            resolver.close()
+        self.resolvers.clear()
+        if self.cluster is not None:
+            self.cluster.close()
+        for creating in self.endpoints.values():
+            if creating.done():
+                creating.result().close()
+            else:
+                creating.cancel()
+        self.endpoints.clear()
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+        self.drivers.clear()
+        self.cluster_drivers.clear()
@@ -0,0 +1,240 @@
+import math
+import re
+from calendar import timegm
+from datetime import datetime, timezone
+
+from dateutil.parser import parse as parse_date
+
+
+MAX_CACHED_PREFIXES = 10000
+PRECISIONS = {
+    'n': 1,
+    'u': 1000,
+    'ms': 1000000,
+    's': 1000000000,
+    'm': 60 * 1000000000,
+    'h': 3600 * 1000000000,
+}
+# Precisions clients can send times in, by the name they give them.
+PRECISION_PARAMS = {'s': 's', 'ms': 'ms', 'us': 'u', 'ns': 'n'}
+PRECISIONS_BY_DIVISOR = {
+    PRECISIONS[name]: name for name in PRECISION_PARAMS.values()}
+
+KEY_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    ' ': '\\ ',
+    ',': '\\,',
+    '=': '\\=',
+})
+STRING_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '"': '\\"',
+    '\n': '\\n',
+})
+ISO_TIME = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,9}))?'
+    r'(Z|[+-]\d\d:?\d\d)?$')
+
+
+class EncodingError(ValueError):
+    """Raised when a point can't be represented in line protocol."""
+
+
+def escape_key(key):
+    """Escapes a measurement, key or tag value for line protocol.
+
+    Line breaks can't be escaped there, and would end the line, so they're
+    refused.
+    """
+    key = str(key)
+    if '\n' in key or '\r' in key:
+        raise EncodingError('Line break in {!r}'.format(key))
+    return key.translate(KEY_ESCAPES)
+
+
+def encode_value(value):
+    value_type = type(value)
+    if value_type is float:
+        if not math.isfinite(value):
+            raise EncodingError('Unsupported field value: {!r}'.format(value))
+        return repr(value)
+    if value_type is int:
+        return '{}i'.format(value)
+    if value_type is str:
+        if value == '':
+            return None
+        return '"{}"'.format(value.translate(STRING_ESCAPES))
+    if value_type is bool:
+        return 'True' if value else 'False'
+    if value is None:
+        return None
+    raise EncodingError('Unsupported field value: {!r}'.format(value))
+
+
+def to_nanoseconds(timestamp):
+    """Converts a point time to integer nanoseconds since the epoch.
+
+    Integers are taken as already being in nanoseconds; ISO 8601 strings and
+    datetimes without a timezone are taken as UTC.
+    """
+    if type(timestamp) is int:
+        return timestamp
+    if isinstance(timestamp, str):
+        match = ISO_TIME.match(timestamp)
+        if match is None:
+            try:
+                timestamp = parse_date(timestamp)
+            except (ValueError, OverflowError):
+                raise EncodingError('Invalid time: {!r}'.format(timestamp))
+        else:
+            return _iso_to_nanoseconds(match)
+    if isinstance(timestamp, datetime):
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(timezone.utc)
+        seconds = timegm(timestamp.utctimetuple())
+        return seconds * 1000000000 + timestamp.microsecond * 1000
+    raise EncodingError('Invalid time: {!r}'.format(timestamp))
+
+
+def normalize_times(points, precision=None, now=None):
+    """Sets the time of every point to integer nanoseconds, in one pass.
+
+    Integer times are taken in ``precision``, nanoseconds by default, and
+    points without a time get ``now``, if given. Returns the coarsest of
+    the s, ms, u and n precisions that all the times can be written in.
+    """
+    multiplier = PRECISIONS[precision or 'n']
+    divisor = PRECISIONS['s']
+    for point in points:
+        timestamp = point.get('time')
+        if type(timestamp) is int:
+            timestamp *= multiplier
+        elif timestamp is None and now is not None:
+            timestamp = now
+        else:
+            timestamp = to_nanoseconds(timestamp)
+        point['time'] = timestamp
+        while timestamp % divisor:
+            divisor //= 1000
+    return PRECISIONS_BY_DIVISOR[divisor]
+
+
+def _iso_to_nanoseconds(match):
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    try:
+        date = datetime(
+            int(year), int(month), int(day),
+            int(hour), int(minute), int(second))
+    except ValueError:
+        raise EncodingError('Invalid time: {!r}'.format(match.string))
+    seconds = timegm(date.utctimetuple())
+    if offset is not None and offset != 'Z':
+        sign = -1 if offset[0] == '-' else 1
+        offset = offset[1:].replace(':', '')
+        seconds -= sign * (int(offset[:2]) * 3600 + int(offset[2:]) * 60)
+    nanoseconds = seconds * 1000000000
+    if fraction is not None:
+        nanoseconds += int(fraction.ljust(9, '0'))
+    return nanoseconds
+
+
+class LineEncoder:
+    """Encodes points into InfluxDB line protocol.
+
+    Keys are escaped through prebuilt translation tables, and the
+    "measurement,tag=value" prefix of each series is cached, so repeated
+    series are only escaped and sorted once. Timestamps are written in the
+    given precision, nanoseconds by default.
+    """
+
+    def __init__(self, precision=None,
+                 max_cached_prefixes=MAX_CACHED_PREFIXES):
+        self.precision = precision
+        self._divisor = PRECISIONS[precision or 'n']
+        self.max_cached_prefixes = max_cached_prefixes
+        self._prefixes = {}
+        self._field_keys = {}
+        self._buffer = []
+
+    def encode(self, points, precision=None):
+        """Returns the points as line protocol bytes, one line per point.
+
+        Times are written in ``precision`` if given, rather than in the
+        encoder's own.
+        """
+        divisor = self._divisor if precision is None else PRECISIONS[precision]
+        lines = self._buffer
+        try:
+            for point in points:
+                lines.append(self.encode_line(point, divisor))
+            lines.append('')
+            return '\n'.join(lines).encode('utf-8')
+        finally:
+            lines.clear()
+
+    def encode_line(self, point, divisor=None):
+        prefix = self.series_prefix(point['measurement'], point.get('tags'))
+        fields = self.encode_fields(point['fields'])
+        if 'time' in point:
+            return '{} {} {}'.format(
+                prefix, fields,
+                to_nanoseconds(point['time']) // (divisor or self._divisor))
+        return '{} {}'.format(prefix, fields)
+
+    def series_prefix(self, measurement, tags):
+        try:
+            items = tuple(tags.items()) if tags else ()
+            for tag_key, value in items:
+                if type(tag_key) is not str or type(value) is not str:
+                    # Tags that compare equal, like True and 1, encode
+                    # differently, so their types are part of the key.
+                    items = tuple(
+                        (tag_key, type(tag_key), value, type(value))
+                        for tag_key, value in items)
+                    break
+            key = (measurement, items)
+            return self._prefixes[key]
+        except KeyError:
+            prefix = self._build_prefix(measurement, tags)
+            if len(self._prefixes) >= self.max_cached_prefixes:
+                self._prefixes.clear()
+            self._prefixes[key] = prefix
+            return prefix
+        except (TypeError, AttributeError):
+            return self._build_prefix(measurement, tags)
+
+    def _build_prefix(self, measurement, tags):
+        if not isinstance(measurement, str) or measurement == '':
+            raise EncodingError('Invalid measurement: {!r}'.format(
+                measurement))
+        parts = [escape_key(measurement)]
+        if tags:
+            if not isinstance(tags, dict):
+                raise EncodingError('Invalid tags: {!r}'.format(tags))
+            for key in sorted(tags):
+                value = tags[key]
+                if key == '' or value is None or value == '':
+                    continue
+                parts.append(
+                    '{}={}'.format(escape_key(key), escape_key(value)))
+        return ','.join(parts)
+
+    def encode_fields(self, fields):
+        if not isinstance(fields, dict):
+            raise EncodingError('Invalid fields: {!r}'.format(fields))
+        field_keys = self._field_keys
+        encoded = []
+        for key in sorted(fields):
+            value = encode_value(fields[key])
+            if value is None or key == '':
+                continue
+            escaped = field_keys.get(key)
+            if escaped is None:
+                escaped = escape_key(key)
+                if len(field_keys) >= self.max_cached_prefixes:
+                    field_keys.clear()
+                field_keys[key] = escaped
+            encoded.append('{}={}'.format(escaped, value))
+        if not encoded:
+            raise EncodingError('Point has no valid fields')
+        return ','.join(encoded)
@@ -1,5 +1,14 @@
+import logging
 import multiprocessing
 import os
+import signal
+import time
+
+from influxproxy import configuration
+from influxproxy.logs import restart_logging
+from influxproxy.metrics import claim_slot, create_shared_metrics, use_slot
+from influxproxy.provisioning import DEPLOYMENT_ENV
+from influxproxy.ratelimit import create_shared_limiter
 
 
 HOST = os.environ.get('HOST', '0.0.0.0')
@@ -8,8 +17,49 @@ PORT = os.environ.get('PORT', 8765)
 
 bind = '{}:{}'.format(HOST, PORT)
 workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = 'aiohttp.worker.GunicornWebWorker'
-max_requests = 100
-max_requests_jitter = 50
+worker_class = 'influxproxy.worker.ProxyWorker'
 reload = bool(os.environ.get('RELOAD', False))
+# Preloaded workers would keep running the code loaded by the master.
+preload_app = not reload
+graceful_timeout = 30
 capture_output = True
+
+
+logger = logging.getLogger('influxproxy.gunicorn')
+
+
+def reload_config(server):
+    """Reloads the configuration in every process, keeping the workers.
+
+    Stands in for gunicorn's own handling of SIGHUP, which would replace
+    the workers, dropping what they have buffered.
+    """
+    try:
+        configuration.reload_settings()
+    except Exception:
+        logger.exception('Keeping the current configuration')
+    server.kill_workers(signal.SIGHUP)
+
+
+def on_starting(server):
+    # Created in the master, so that every worker shares the same buckets.
+    create_shared_limiter(configuration.config)
+    # Room for the workers being replaced while their successors start.
+    create_shared_metrics(
+        configuration.config['databases'], server.cfg.workers * 2)
+    server.handle_hup = lambda: reload_config(server)
+    # The workers provision the databases once per start of the master.
+    os.environ.setdefault(
+        DEPLOYMENT_ENV, '{}-{}'.format(os.getpid(), int(time.time())))
+
+
+def pre_fork(server, worker):
+    worker.metrics_slot = claim_slot(
+        getattr(other, 'metrics_slot', None)
+        for other in server.WORKERS.values())
+
+
+def post_fork(server, worker):
+    use_slot(worker.metrics_slot)
+    # The master's logging thread isn't running in the worker.
+    restart_logging()
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import random
+import zlib
+
+import aiohttp
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_DELAY = 0.1
+DEFAULT_WRITE_TIMEOUT = 10
+MAX_RETRY_DELAY = 5
+GZIP_LEVEL = 1
+
+
+logger = logging.getLogger('influxproxy.http')
+
+
+class BackendError(Exception):
+    """Raised when the backend refuses a write."""
+
+
+def create_session(loop, pool_size=DEFAULT_POOL_SIZE):
+    """Creates a session whose keep-alive connections are bounded."""
+    connector = aiohttp.TCPConnector(limit=pool_size, loop=loop)
+    return aiohttp.ClientSession(connector=connector, loop=loop)
+
+
+def gzip_chunks(chunks, level=GZIP_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    parts = [compressor.compress(chunk) for chunk in chunks]
+    parts.append(compressor.flush())
+    return b''.join(parts)
+
+
+class HTTPWriter:
+    """Writes line protocol to the backend's /write endpoint.
+
+    Failed writes are retried with jittered exponential backoff, unless the
+    backend refused them as invalid; so are writes the backend doesn't
+    answer within ``write_timeout`` seconds. Each write can be given its
+    own precision, overriding ``precision``.
+    """
+
+    def __init__(self, session, url, loop, auth=None, precision=None,
+                 gzip=False, retries=DEFAULT_RETRIES,
+                 retry_delay=DEFAULT_RETRY_DELAY,
+                 write_timeout=DEFAULT_WRITE_TIMEOUT):
+        self.session = session
+        self.url = url
+        self.loop = loop
+        self.auth = auth
+        self.precision = precision
+        self.gzip = gzip
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.write_timeout = write_timeout
+
+    async def write(self, database, chunks, precision=None):
+        params = {'db': database}
+        precision = precision or self.precision
+        if precision is not None:
+            params['precision'] = precision
+        headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if self.gzip:
+            body = gzip_chunks(chunks)
+            headers['Content-Encoding'] = 'gzip'
+        else:
+            body = b''.join(chunks)
+
+        attempt = 0
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._post(params, headers, body), self.write_timeout,
+                    loop=self.loop)
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError,
+                    OSError) as e:
+                if attempt >= self.retries:
+                    raise
+                logger.warning('Retrying write to %s: %s', database, e)
+            await asyncio.sleep(self.backoff(attempt), loop=self.loop)
+            attempt += 1
+
+    def backoff(self, attempt):
+        delay = min(MAX_RETRY_DELAY, self.retry_delay * 2 ** attempt)
+        return random.uniform(0, delay)
+
+    async def _post(self, params, headers, body):
+        response = await self.session.post(
+            self.url, params=params, data=body, headers=headers,
+            auth=self.auth)
+        try:
+            if response.status < 300:
+                return
+            error = '{} {}'.format(response.status, await response.text())
+        finally:
+            await response.release()
+        if response.status >= 500:
+            raise aiohttp.ClientResponseError('Backend failed: ' + error)
+        raise BackendError('Backend refused write: ' + error)
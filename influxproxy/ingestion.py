@@ -0,0 +1,378 @@
+import json
+import re
+import zlib
+from collections import deque
+
+from influxproxy.drivers import (
+    MANDATORY_FIELDS,
+    STAMPED_FIELDS,
+    MalformedDataError,
+    validate_points,
+)
+from influxproxy.encoder import (
+    PRECISION_PARAMS,
+    PRECISIONS,
+    EncodingError,
+    normalize_times,
+)
+
+
+LINE_PROTOCOL = 'text/plain'
+NDJSON = 'application/x-ndjson'
+NDJSON_CHUNK_SIZE = 500
+LINE_PROTOCOL_CHUNK_SIZE = 256 * 1024
+DEFAULT_MAX_BODY_SIZE = 10 * 1024 * 1024
+READ_SIZE = 64 * 1024
+DECOMPRESSED_CHUNK_SIZE = 256 * 1024
+IDENTITY = 'identity'
+# zlib window bits for each content encoding, telling their headers apart.
+CONTENT_ENCODINGS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'x-gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+CR = ord('\r')
+HASH = ord('#')
+COMMA = ord(',')
+
+_KEY = rb'(?:[^,= \\\n]|\\.)[^,= \\\n]*(?:\\.[^,= \\\n]*)*'
+_VALUE = (
+    rb'(?:-?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?'
+    rb'|-?\d+i|\d+u'
+    rb'|[tT]|true|True|TRUE|[fF]|false|False|FALSE'
+    rb'|"[^"\\\n]*(?:\\.[^"\\\n]*)*")')
+LINE = re.compile(
+    rb'(?:[^, \\\n#]|\\.)[^, \\\n]*(?:\\.[^, \\\n]*)*'
+    rb'(?:,' + _KEY + rb'=' + _KEY + rb')*'
+    rb' ' + _KEY + rb'=' + _VALUE +
+    rb'(?:,' + _KEY + rb'=' + _VALUE + rb')*'
+    rb'(?: -?\d+)?$')
+SERIES = re.compile(rb'(?:[^ \\]|\\.)+')
+MEASUREMENT = re.compile(rb'(?:[^, \\]|\\.)+')
+FIELD = re.compile(
+    rb'((?:[^,= \\]|\\.)+)=("(?:[^"\\]|\\.)*"|[^, ]+)')
+LINE_TIME = re.compile(rb' (-?\d+)(\r?)$', re.MULTILINE)
+
+
+class BodyTooLargeError(ValueError):
+    """Raised when a request body is larger than its database allows."""
+
+
+class RequestBody:
+    """Reads a request body in chunks, decompressing it as it goes.
+
+    Bodies sent with a gzip or deflate ``Content-Encoding`` are inflated a
+    bounded chunk at a time, and reading stops as soon as ``max_size``
+    bytes have come out, compressed or not, so a small body that inflates
+    to gigabytes is refused before it takes any memory.
+    """
+
+    def __init__(self, request, max_size=DEFAULT_MAX_BODY_SIZE):
+        self.content = request.content
+        self.max_size = max_size
+        self.size = 0
+        self.encoding = request.headers.get(
+            'Content-Encoding', IDENTITY).strip().lower()
+        self.decompressor = None
+        if self.encoding != IDENTITY:
+            try:
+                wbits = CONTENT_ENCODINGS[self.encoding]
+            except KeyError:
+                raise MalformedDataError(
+                    'Unsupported content encoding: {!r}'.format(
+                        self.encoding))
+            self.decompressor = zlib.decompressobj(wbits)
+        if request.content_length is not None:
+            self._check_size(request.content_length)
+        self._tail = b''
+        self._partial = b''
+        self._lines = deque()
+
+    def _check_size(self, size):
+        if size > self.max_size:
+            raise BodyTooLargeError(
+                'Body is larger than {} bytes'.format(self.max_size))
+
+    async def read_chunk(self):
+        """Returns the next chunk of the body, or an empty one at its end."""
+        while True:
+            data = self._tail or await self.content.read(READ_SIZE)
+            if self.decompressor is None:
+                self.size += len(data)
+                self._check_size(self.size)
+                return data
+            if not data:
+                if not self.decompressor.eof:
+                    raise MalformedDataError(
+                        'Truncated {} body'.format(self.encoding))
+                return b''
+            try:
+                chunk = self.decompressor.decompress(data, min(
+                    self.max_size - self.size + 1, DECOMPRESSED_CHUNK_SIZE))
+            except zlib.error:
+                raise MalformedDataError(
+                    'Invalid {} body'.format(self.encoding))
+            if self.decompressor.unused_data:
+                raise MalformedDataError(
+                    'Trailing data after {} body'.format(self.encoding))
+            self._tail = self.decompressor.unconsumed_tail
+            if chunk:
+                self.size += len(chunk)
+                self._check_size(self.size)
+                return chunk
+
+    async def read(self):
+        """Returns the whole body."""
+        chunks = []
+        while True:
+            chunk = await self.read_chunk()
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    async def read_line(self):
+        """Returns the next line of the body, without its end.
+
+        Returns None past the last line.
+        """
+        while not self._lines:
+            chunk = await self.read_chunk()
+            if not chunk:
+                line, self._partial = self._partial, b''
+                return line or None
+            lines = (self._partial + chunk).split(b'\n')
+            self._partial = lines.pop()
+            self._lines.extend(lines)
+        return self._lines.popleft()
+
+
+def check_line(data, start, end, number, schema=None):
+    """Checks a line of line protocol data, from ``start`` to ``end``.
+
+    Returns where the point on the line ends, before any carriage return,
+    or None for blank lines and comments.
+    """
+    if end > start and data[end - 1] == CR:
+        end -= 1
+    if end == start or data[start] == HASH:
+        return None
+    if LINE.match(data, start, end) is None:
+        raise MalformedDataError('Invalid line {}: {!r}'.format(
+            number, data[start:end][:100]))
+    if schema is not None:
+        schema.validate_line(data, start, end)
+    return end
+
+
+def validate_lines(data, schema=None):
+    """Checks the structure of line protocol data, line by line.
+
+    Lines are matched in place, without being split or decoded, so the data
+    can be forwarded as is. Blank lines and comments are skipped, and the
+    remaining lines are checked against ``schema`` if given. Returns the
+    number of points in the data.
+    """
+    count = 0
+    number = 0
+    start, end = 0, len(data)
+    while start < end:
+        stop = data.find(b'\n', start)
+        if stop < 0:
+            stop = end
+        number += 1
+        if check_line(data, start, stop, number, schema) is not None:
+            count += 1
+        start = stop + 1
+    return count
+
+
+def parse_line(line):
+    """Returns the series key and the ``(key, value)`` fields of a line.
+
+    The line is expected to be valid line protocol; its timestamp, if any,
+    is left out.
+    """
+    series = SERIES.match(line)
+    position = series.end() + 1
+    fields = []
+    while True:
+        field = FIELD.match(line, position)
+        fields.append(field.groups())
+        position = field.end()
+        if position >= len(line) or line[position] != COMMA:
+            return series.group(), fields
+        position += 1
+
+
+def parse_precision(request):
+    """Returns the precision of the request's times, if it gives one."""
+    precision = request.GET.get('precision')
+    if precision is None:
+        return None
+    try:
+        return PRECISION_PARAMS[precision]
+    except KeyError:
+        raise MalformedDataError('Invalid precision: {!r}'.format(precision))
+
+
+def rescale_times(data, precision, target):
+    """Rewrites the times of line protocol data into another precision."""
+    multiplier = PRECISIONS[precision]
+    divisor = PRECISIONS[target]
+
+    def rescale(match):
+        return b' %d%s' % (
+            int(match.group(1)) * multiplier // divisor, match.group(2))
+
+    return LINE_TIME.sub(rescale, data)
+
+
+def encode_points(points, driver, schema=None, precision=None, now=None,
+                  adapt=False):
+    """Validates decoded points and encodes them as line protocol.
+
+    Integer times are taken in ``precision``, and points without a time get
+    ``now``, if given. With ``adapt``, the points are written in the
+    coarsest precision their times allow. Returns the data, the number of
+    points, and the precision they're written in, None for the driver's.
+    """
+    points = validate_points(
+        points, MANDATORY_FIELDS if now is None else STAMPED_FIELDS)
+    if schema is not None:
+        schema.validate_points(points)
+    written = None
+    if precision is not None or now is not None or adapt:
+        try:
+            coarsest = normalize_times(points, precision, now)
+        except EncodingError as e:
+            raise MalformedDataError(str(e))
+        if adapt:
+            written = coarsest
+    return driver.encode(points, written), len(points), written
+
+
+async def read_line_protocol(body, schema=None,
+                             chunk_size=LINE_PROTOCOL_CHUNK_SIZE):
+    """Reads a line protocol body as chunks of checked lines.
+
+    Lines are checked one at a time as the body is read and decompressed,
+    and gathered into chunks of about ``chunk_size`` bytes, ending in line
+    feeds only, and leaving blank lines and comments out. Returns the
+    chunks as ``(data, count)`` pairs.
+    """
+    chunks, lines, size, number = [], [], 0, 0
+    while True:
+        line = await body.read_line()
+        if line is None:
+            break
+        number += 1
+        end = check_line(line, 0, len(line), number, schema)
+        if end is None:
+            continue
+        # Backends would take a carriage return as part of the line.
+        if end < len(line):
+            line = line[:end]
+        lines.append(line)
+        size += end + 1
+        if size >= chunk_size:
+            chunks.append((b'\n'.join(lines) + b'\n', len(lines)))
+            lines, size = [], 0
+    if lines:
+        chunks.append((b'\n'.join(lines) + b'\n', len(lines)))
+    return chunks
+
+
+def decode_record(line, number):
+    """Decodes one NDJSON record, returning None for blank lines."""
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        point = json.loads(line.decode('utf-8'))
+    except ValueError:
+        raise MalformedDataError('Invalid JSON on line {}'.format(number))
+    if not isinstance(point, dict):
+        raise MalformedDataError('Line {} is not a point'.format(number))
+    return point
+
+
+async def read_ndjson(body, driver, schema=None,
+                      chunk_size=NDJSON_CHUNK_SIZE, precision=None, now=None):
+    """Reads an NDJSON body as line protocol chunks.
+
+    Records are decoded one at a time as the body is read and decompressed,
+    without the whole of it ever being held in memory, and encoded every
+    ``chunk_size`` points, so only their encoded form is kept around. The
+    chunks are written in the driver's precision, as the points to come
+    aren't known yet. Returns the chunks as ``(data, count)`` pairs.
+    """
+    chunks, points, number = [], [], 0
+
+    def encode():
+        data, count, _ = encode_points(points, driver, schema, precision, now)
+        chunks.append((data, count))
+
+    while True:
+        line = await body.read_line()
+        if line is None:
+            break
+        number += 1
+        point = decode_record(line, number)
+        if point is None:
+            continue
+        points.append(point)
+        if len(points) >= chunk_size:
+            encode()
+            points = []
+    if points:
+        encode()
+    return chunks
+
+
+async def read_json(body, driver, schema=None, precision=None, now=None):
+    """Reads a JSON point or list of points as a line protocol chunk.
+
+    Returns the chunks, and the precision they're written in.
+    """
+    data = await body.read()
+    try:
+        points = json.loads(data.decode('utf-8'))
+    except ValueError:
+        raise MalformedDataError('Invalid JSON')
+    data, count, written = encode_points(
+        points, driver, schema, precision, now, driver.adaptive_precision)
+    return [(data, count)], written
+
+
+async def read_metrics(request, driver, schema=None, now=None,
+                       max_size=DEFAULT_MAX_BODY_SIZE):
+    """Reads the metrics in a request body, according to its content type.
+
+    The body is decompressed according to its content encoding, and refused
+    past ``max_size`` bytes. Points are checked against ``schema`` if given,
+    times are read in the precision the request gives, if any, and points
+    without a time get ``now``, if given. Returns a list of
+    ``(data, count)`` pairs, each holding line protocol bytes and the number
+    of points in them, and the precision they're written in, None for the
+    driver's.
+    """
+    precision = parse_precision(request)
+    body = RequestBody(request, max_size)
+    content_type = request.content_type
+    if content_type == LINE_PROTOCOL:
+        chunks = await read_line_protocol(body, schema)
+        if not chunks:
+            return [], None
+        if precision is None or driver.adaptive_precision:
+            return chunks, precision
+        target = driver.precision or 'n'
+        if precision != target:
+            chunks = [
+                (rescale_times(data, precision, target), count)
+                for data, count in chunks]
+        return chunks, None
+    if content_type == NDJSON:
+        chunks = await read_ndjson(
+            body, driver, schema, precision=precision, now=now)
+        return chunks, None
+    return await read_json(body, driver, schema, precision, now)
@@ -0,0 +1,151 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+
+HANDLERS = ('queue', 'stream')
+FORMATS = ('json', 'text')
+DEFAULT_HANDLER = 'queue'
+DEFAULT_FORMAT = 'json'
+DEFAULT_LEVEL = 'INFO'
+DEFAULT_MAX_QUEUED_RECORDS = 10000
+# Load shedding answers every request over the limits with these, so they
+# are sampled like successes rather than flooding the logs under load.
+SHED_STATUSES = frozenset([429, 503])
+RECORD_FIELDS = ('request_id', 'database', 'route', 'status', 'duration')
+
+
+_handler = None
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as JSON objects, each on a single line.
+
+    The request fields given as ``extra`` to the logging call are included
+    when present, as is the traceback of an exception.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': '{}.{:03d}Z'.format(
+                time.strftime('%Y-%m-%dT%H:%M:%S',
+                              time.gmtime(record.created)),
+                int(record.msecs)),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in RECORD_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str, separators=(',', ':'))
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Queues records for a listener thread, dropping them when it lags.
+
+    Records are queued as they are, formatting left to the listener, but
+    for their message and traceback, which refer to objects that may have
+    changed by then. A full queue counts the record as ``dropped`` rather
+    than blocking the event loop.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(log_config, stream=None):
+    """Sends the records of every logger to ``stream``, stderr by default.
+
+    With the ``queue`` handler, records are written by a thread, so that a
+    slow log pipe never blocks the event loop; the ``stream`` handler
+    writes them as they come, as ``logging.basicConfig`` does. Records are
+    formatted as JSON, or as text in the format of ``basicConfig``.
+
+    Returns the handler added to the root logger, replacing any previously
+    added by this function.
+    """
+    global _handler, _listener
+    stop_logging()
+    stream_handler = logging.StreamHandler(stream or sys.stderr)
+    if log_config.get('format', DEFAULT_FORMAT) == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root = logging.getLogger()
+    if _handler is not None:
+        root.removeHandler(_handler)
+    if log_config.get('handler', DEFAULT_HANDLER) == 'queue':
+        _handler = DroppingQueueHandler(queue.Queue(log_config.get(
+            'max_queued_records', DEFAULT_MAX_QUEUED_RECORDS)))
+        _listener = QueueListener(_handler.queue, stream_handler)
+        _listener.start()
+    else:
+        _handler = stream_handler
+    root.addHandler(_handler)
+    root.setLevel(log_config.get('level', DEFAULT_LEVEL))
+    return _handler
+
+
+def restart_logging():
+    """Starts the listener thread again, in a forked process.
+
+    Threads don't survive a fork, and the queue may have been locked by
+    the parent's listener when it happened, so a new one is used.
+    """
+    global _listener
+    if _listener is None:
+        return
+    _handler.queue = queue.Queue(_handler.queue.maxsize)
+    _listener = QueueListener(_handler.queue, *_listener.handlers)
+    _listener.start()
+
+
+def stop_logging():
+    """Writes the records still queued, and stops the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def should_log(route, status, rates):
+    """Tells whether to log a request to ``route`` answered with ``status``.
+
+    Failures are always logged, other requests at the rate of their route
+    in ``rates``, all of them by default.
+    """
+    if status >= 400 and status not in SHED_STATUSES:
+        return True
+    rate = rates.get(route, 1)
+    return rate >= 1 or random.random() < rate
+
+
+atexit.register(stop_logging)
@@ -1,7 +1,14 @@
 from influxproxy.app import create_app
-from influxproxy.drivers import InfluxDriver
+from influxproxy.provisioning import start_provisioning
 
 
-driver = InfluxDriver()
-driver.create_databases()
-app = create_app(loop=None)
+def app(loop):
+    """Creates the application on a worker's event loop.
+
+    The databases are provisioned in the background, while the worker
+    already serves requests. Everything else in here runs once, in the
+    gunicorn master, when the app is preloaded.
+    """
+    application = create_app(loop)
+    start_provisioning(application)
+    return application
@@ -0,0 +1,388 @@
+import asyncio
+import logging
+import mmap
+import socket
+import time
+from bisect import bisect_left
+from itertools import product
+
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+OTHER = 'other'
+ROUTES = ('send_metric', 'preflight_metric')
+REJECT_REASONS = (
+    'unauthorized', 'forbidden', 'malformed', 'too_large', 'schema',
+    'rate_limited', 'queue_full', 'overloaded', 'error')
+POINT_OUTCOMES = (
+    'accepted', 'aggregated', 'deduplicated', 'rate_limited', 'queue_full',
+    'overloaded', 'dropped', 'spilled', 'over_cardinality', 'retagged')
+SPILL_OUTCOMES = ('spilled', 'replayed', 'evicted')
+COLLECT_INTERVAL = 5
+DEFAULT_EMIT_INTERVAL = 10
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LABEL_ESCAPES = str.maketrans({'\\': '\\\\', '"': '\\"', '\n': '\\n'})
+
+
+logger = logging.getLogger('influxproxy.metrics')
+
+_table = None
+_slot = None
+
+
+class Family:
+    """A metric and the offsets of each of its label combinations.
+
+    Counters and gauges take one value per combination; histograms take
+    one per bucket, plus one for observations past the last bucket and one
+    for their sum.
+    """
+
+    def __init__(self, name, kind, help, labelnames, label_values=((),),
+                 buckets=None):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labelnames = labelnames
+        self.label_values = list(label_values)
+        self.buckets = buckets
+        self.width = 1 if buckets is None else len(buckets) + 2
+        self.offsets = {}
+
+    def place(self, offset):
+        for labels in self.label_values:
+            self.offsets[labels] = offset
+            offset += self.width
+        return offset
+
+
+class Layout:
+    """Where each metric lives in a worker's block of values.
+
+    Label values are all known upfront, databases missing from the
+    configuration being counted as "other", so the layout is the same in
+    every worker.
+    """
+
+    def __init__(self, databases):
+        self.databases = frozenset(databases)
+        databases = sorted(self.databases) + [OTHER]
+        self.families = [
+            Family('influxproxy_request_duration_seconds', HISTOGRAM,
+                   'Time taken to answer metric requests.',
+                   ('route', 'database'), product(ROUTES, databases),
+                   DEFAULT_BUCKETS),
+            Family('influxproxy_rejected_requests_total', COUNTER,
+                   'Metric requests refused, by reason.',
+                   ('database', 'reason'),
+                   product(databases, REJECT_REASONS)),
+            Family('influxproxy_points_total', COUNTER,
+                   'Points received, by what became of them.',
+                   ('database', 'outcome'),
+                   product(databases, POINT_OUTCOMES)),
+            Family('influxproxy_backend_write_duration_seconds', HISTOGRAM,
+                   'Time taken to write batches to the backend.',
+                   ('database',), product(databases), DEFAULT_BUCKETS),
+            Family('influxproxy_backend_write_errors_total', COUNTER,
+                   'Batches that failed to be written to the backend.',
+                   ('database',), product(databases)),
+            Family('influxproxy_queue_points', GAUGE,
+                   'Points waiting to be written to the backend.',
+                   ('database',), product(databases)),
+            Family('influxproxy_queue_bytes', GAUGE,
+                   'Bytes waiting to be written to the backend.',
+                   ('database',), product(databases)),
+            Family('influxproxy_spill_bytes_total', COUNTER,
+                   'Bytes of points spilled to disk, by what became of them.',
+                   ('database', 'outcome'),
+                   product(databases, SPILL_OUTCOMES)),
+            Family('influxproxy_udp_bytes_total', COUNTER,
+                   'Bytes sent to the backend over UDP.', ()),
+            Family('influxproxy_udp_datagrams_total', COUNTER,
+                   'Datagrams sent to the backend over UDP.', ()),
+        ]
+        self.size = 0
+        for family in self.families:
+            self.size = family.place(self.size)
+        self.by_name = {family.name: family for family in self.families}
+
+    def database(self, database):
+        return database if database in self.databases else OTHER
+
+
+class MetricsTable:
+    """Blocks of metric values, one per worker, in shared memory.
+
+    Created before gunicorn forks its workers, each of them then only ever
+    writes to its own block, so no locking is needed; readers add up the
+    blocks of all workers.
+    """
+
+    def __init__(self, layout, slots):
+        self.layout = layout
+        self.slots = slots
+        self.memory = mmap.mmap(-1, max(1, layout.size * slots) * 8)
+        self.values = memoryview(self.memory).cast('d')
+
+    def slot(self, index):
+        size = self.layout.size
+        return self.values[index * size:(index + 1) * size]
+
+    def totals(self):
+        size = self.layout.size
+        totals = [0.0] * size
+        values = self.values
+        for start in range(0, size * self.slots, size):
+            for index in range(size):
+                totals[index] += values[start + index]
+        return totals
+
+
+class Recorder:
+    """Records the metrics of one worker.
+
+    A worker that found no free slot in the shared table records in one of
+    its own, and isn't ``owner`` of the slot it reports.
+    """
+
+    def __init__(self, table, slot, owner=True):
+        self.table = table
+        self.slot = slot
+        self.owner = owner
+        self.layout = layout = table.layout
+        self.values = table.slot(slot)
+        families = layout.by_name
+        self.requests = families['influxproxy_request_duration_seconds']
+        self.rejections = families['influxproxy_rejected_requests_total']
+        self.points = families['influxproxy_points_total']
+        self.writes = families['influxproxy_backend_write_duration_seconds']
+        self.write_errors = families['influxproxy_backend_write_errors_total']
+        self.queue_points = families['influxproxy_queue_points']
+        self.queue_bytes = families['influxproxy_queue_bytes']
+        self.spill_bytes = families['influxproxy_spill_bytes_total']
+        self.udp_bytes = families['influxproxy_udp_bytes_total']
+        self.udp_datagrams = families['influxproxy_udp_datagrams_total']
+
+    def _observe(self, family, labels, seconds):
+        offset = family.offsets[labels]
+        values = self.values
+        values[offset + bisect_left(family.buckets, seconds)] += 1
+        values[offset + family.width - 1] += seconds
+
+    def observe_request(self, route, database, seconds):
+        self._observe(
+            self.requests, (route, self.layout.database(database)), seconds)
+
+    def reject_request(self, database, reason):
+        labels = (self.layout.database(database), reason)
+        self.values[self.rejections.offsets[labels]] += 1
+
+    def count_points(self, database, outcome, count):
+        labels = (self.layout.database(database), outcome)
+        self.values[self.points.offsets[labels]] += count
+
+    def observe_write(self, database, seconds, failed=False):
+        labels = (self.layout.database(database),)
+        self._observe(self.writes, labels, seconds)
+        if failed:
+            self.values[self.write_errors.offsets[labels]] += 1
+
+    def set_queue(self, database, points, size):
+        labels = (self.layout.database(database),)
+        self.values[self.queue_points.offsets[labels]] = points
+        self.values[self.queue_bytes.offsets[labels]] = size
+
+    def count_spill(self, database, outcome, size):
+        labels = (self.layout.database(database), outcome)
+        self.values[self.spill_bytes.offsets[labels]] += size
+
+    def add_udp(self, size, datagrams):
+        self.values[self.udp_bytes.offsets[()]] += size
+        self.values[self.udp_datagrams.offsets[()]] += datagrams
+
+    def render(self):
+        """Renders the metrics of all workers in Prometheus text format."""
+        return render(self.layout, self.table.totals())
+
+    def as_points(self, tags, timestamp):
+        """Returns this worker's own metrics as InfluxDB points."""
+        return as_points(self.layout, self.values, tags, timestamp)
+
+
+def _format_labels(labelnames, labels, extra=()):
+    pairs = list(zip(labelnames, labels)) + list(extra)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).translate(LABEL_ESCAPES))
+        for name, value in pairs))
+
+
+def _format_number(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def render(layout, values):
+    lines = []
+    for family in layout.families:
+        lines.append('# HELP {} {}'.format(family.name, family.help))
+        lines.append('# TYPE {} {}'.format(family.name, family.kind))
+        for labels, offset in family.offsets.items():
+            if family.kind != HISTOGRAM:
+                lines.append('{}{} {}'.format(
+                    family.name, _format_labels(family.labelnames, labels),
+                    _format_number(values[offset])))
+                continue
+            count = 0
+            bounds = [_format_number(b) for b in family.buckets] + ['+Inf']
+            for index, bound in enumerate(bounds):
+                count += values[offset + index]
+                lines.append('{}_bucket{} {}'.format(
+                    family.name,
+                    _format_labels(family.labelnames, labels, [('le', bound)]),
+                    _format_number(count)))
+            label_text = _format_labels(family.labelnames, labels)
+            lines.append('{}_sum{} {}'.format(
+                family.name, label_text,
+                _format_number(values[offset + family.width - 1])))
+            lines.append('{}_count{} {}'.format(
+                family.name, label_text, _format_number(count)))
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def as_points(layout, values, tags, timestamp):
+    points = []
+    for family in layout.families:
+        for labels, offset in family.offsets.items():
+            if family.kind == HISTOGRAM:
+                count = sum(values[offset:offset + family.width - 1])
+                if not count:
+                    continue
+                fields = {
+                    'count': int(count),
+                    'sum': float(values[offset + family.width - 1]),
+                }
+            elif family.kind == COUNTER:
+                if not values[offset]:
+                    continue
+                fields = {'value': int(values[offset])}
+            else:
+                fields = {'value': float(values[offset])}
+            point_tags = dict(tags)
+            point_tags.update(zip(family.labelnames, labels))
+            points.append({
+                'measurement': family.name,
+                'time': timestamp,
+                'tags': point_tags,
+                'fields': fields,
+            })
+    return points
+
+
+def create_shared_metrics(databases, slots):
+    """Creates the table that processes forked from now on will share."""
+    global _table
+    _table = MetricsTable(Layout(databases), slots)
+    return _table
+
+
+def claim_slot(taken):
+    """Returns a slot of the shared table that isn't ``taken``, or None."""
+    if _table is None:
+        return None
+    free = set(range(_table.slots)) - set(taken)
+    return min(free) if free else None
+
+
+def use_slot(slot):
+    """Makes this process record its metrics in a slot of the shared table.
+
+    Slots are reused as workers are replaced, and not reset, so that
+    counters never go backwards once added up.
+    """
+    global _slot
+    _slot = slot
+
+
+def get_recorder(databases):
+    """Returns a recorder into the shared table, or one for this process."""
+    if _table is not None and _slot is not None:
+        return Recorder(_table, _slot)
+    return Recorder(
+        MetricsTable(Layout(databases), 1), 0, owner=_table is None)
+
+
+class StatsReporter:
+    """Keeps the metrics of a worker's queues and UDP writers current.
+
+    With an ``influxdb`` section in the ``metrics`` configuration, the
+    worker's metrics are also written as points to the database it names,
+    every ``interval`` seconds, through the same batching as any other
+    points; the rest of the section configures that database's driver.
+    """
+
+    def __init__(self, recorder, batcher, drivers, loop, influxdb=None):
+        self.recorder = recorder
+        self.batcher = batcher
+        self.drivers = drivers
+        self.loop = loop
+        self.influxdb = influxdb
+        self.tags = {'host': socket.gethostname(), 'worker': recorder.slot}
+        self._udp_seen = {}
+        self._handles = {}
+        self._emitting = None
+
+    def start(self):
+        self._schedule('collect', COLLECT_INTERVAL, self.collect)
+        if self.influxdb is not None:
+            interval = self.influxdb.get('interval', DEFAULT_EMIT_INTERVAL)
+            self._schedule('emit', interval, self._emit)
+
+    def _schedule(self, name, interval, callback):
+        def run():
+            callback()
+            self._handles[name] = self.loop.call_later(interval, run)
+        self._handles[name] = self.loop.call_later(interval, run)
+
+    def stop(self):
+        for handle in self._handles.values():
+            handle.cancel()
+        self._handles.clear()
+
+    def collect(self):
+        for database, buffer in self.batcher.buffers.items():
+            self.recorder.set_queue(
+                database, buffer.pending_points, buffer.pending_bytes)
+        for driver in list(self.drivers.drivers.values()):
+            stats = getattr(driver.writer, 'stats', None)
+            if stats is None:
+                continue
+            seen_bytes, seen_datagrams = self._udp_seen.get(
+                driver.writer, (0, 0))
+            self.recorder.add_udp(
+                stats.bytes - seen_bytes, stats.datagrams - seen_datagrams)
+            self._udp_seen[driver.writer] = (stats.bytes, stats.datagrams)
+
+    def _emit(self):
+        if self._emitting is None or self._emitting.done():
+            self._emitting = asyncio.ensure_future(
+                self.emit(), loop=self.loop)
+
+    async def emit(self):
+        self.collect()
+        database = self.influxdb['database']
+        points = self.recorder.as_points(
+            self.tags, int(time.time()) * 1000000000)
+        try:
+            driver = await self.drivers.get(self.influxdb)
+            self.batcher.add(
+                database, driver, driver.encode(points), len(points),
+                self.influxdb)
+        except Exception:
+            logger.exception('Failed to emit stats to %s', database)
@@ -0,0 +1,202 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import tempfile
+
+import aiohttp
+
+from influxproxy import configuration
+from influxproxy.cluster import node_configs
+
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_TIMEOUT = 10
+LOCK_POLL_INTERVAL = 0.1
+DEPLOYMENT_ENV = 'INFLUXPROXY_DEPLOYMENT'
+DEFAULT_MARKER = os.path.join(
+    tempfile.gettempdir(), 'influxproxy-databases.json')
+
+
+logger = logging.getLogger('influxproxy.provisioning')
+
+
+def configured_databases(config):
+    """Returns the databases the configuration writes to."""
+    databases = set(config['databases'])
+    stats = config.get('metrics', {}).get('influxdb')
+    if stats is not None:
+        databases.add(stats['database'])
+    return databases
+
+
+def deployment_id():
+    """Identifies the processes started together, e.g. by one gunicorn."""
+    return os.environ.get(DEPLOYMENT_ENV) or str(os.getpid())
+
+
+class DatabaseProvisioner:
+    """Creates databases in the backend, once per deployment.
+
+    Workers take turns through a lock file, and record the databases they
+    provisioned in a marker file next to it, so each database is only
+    looked at by the first worker that needs it. The existing databases are
+    listed with a single query, and the missing ones created at most
+    ``concurrency`` at a time.
+    """
+
+    def __init__(self, loop, backend_conf, marker=DEFAULT_MARKER,
+                 concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT):
+        self.loop = loop
+        self.url = 'http://{}:{}/query'.format(
+            backend_conf['host'], backend_conf['port'])
+        self.auth = aiohttp.BasicAuth(
+            backend_conf['username'], backend_conf['password'])
+        self.marker = marker
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    @classmethod
+    def from_config(cls, loop, config, backend_conf=None):
+        """Builds a provisioner for the backend, or the given node of it.
+
+        Each node of a cluster gets a marker of its own.
+        """
+        provisioning = config.get('provisioning', {})
+        marker = provisioning.get('marker', DEFAULT_MARKER)
+        if backend_conf is None:
+            backend_conf = config['backend']
+        elif backend_conf is not config['backend']:
+            marker = '{}.{}-{}'.format(
+                marker, backend_conf['host'], backend_conf['port'])
+        return cls(
+            loop, backend_conf, marker=marker,
+            concurrency=provisioning.get('concurrency', DEFAULT_CONCURRENCY),
+            timeout=provisioning.get('timeout', DEFAULT_TIMEOUT))
+
+    async def provision(self, databases):
+        """Creates the databases missing from the backend.
+
+        Returns the databases created, logging rather than raising errors.
+        """
+        with open(self.marker + '.lock', 'a') as lock_file:
+            await self._lock(lock_file)
+            try:
+                return await self._provision(set(databases))
+            except Exception:
+                logger.exception('Failed to provision %s', sorted(databases))
+                return []
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    async def _lock(self, lock_file):
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                await asyncio.sleep(LOCK_POLL_INTERVAL, loop=self.loop)
+
+    async def _provision(self, databases):
+        provisioned = self.read_marker()
+        missing = databases - provisioned
+        if not missing:
+            return []
+        session = aiohttp.ClientSession(loop=self.loop)
+        try:
+            existing = await self.show_databases(session)
+            created = await self.create_databases(
+                session, sorted(missing - existing))
+        finally:
+            session.close()
+        self.write_marker(provisioned | (missing & existing) | set(created))
+        return created
+
+    async def show_databases(self, session):
+        results = await self._query(session, 'GET', 'SHOW DATABASES')
+        series = results[0].get('series', [{}])[0]
+        return {row[0] for row in series.get('values', [])}
+
+    async def create_databases(self, session, databases):
+        semaphore = asyncio.Semaphore(self.concurrency, loop=self.loop)
+
+        async def create(database):
+            async with semaphore:
+                await self._query(
+                    session, 'POST', 'CREATE DATABASE "{}"'.format(
+                        database.replace('"', '\\"')))
+            logger.info('Created database %s', database)
+
+        outcomes = await asyncio.gather(
+            *[create(database) for database in databases],
+            loop=self.loop, return_exceptions=True)
+        created = []
+        for database, outcome in zip(databases, outcomes):
+            if isinstance(outcome, Exception):
+                logger.error(
+                    'Failed to create database %s: %s', database, outcome)
+            else:
+                created.append(database)
+        return created
+
+    async def _query(self, session, method, query):
+        response = await asyncio.wait_for(
+            session.request(
+                method, self.url, params={'q': query}, auth=self.auth),
+            self.timeout, loop=self.loop)
+        try:
+            if response.status >= 300:
+                raise aiohttp.ClientResponseError('{} {}'.format(
+                    response.status, await response.text()))
+            return (await response.json())['results']
+        finally:
+            await response.release()
+
+    def read_marker(self):
+        try:
+            with open(self.marker) as marker:
+                content = json.load(marker)
+        except (OSError, ValueError):
+            return set()
+        if content.get('deployment') != deployment_id() or (
+                content.get('url') != self.url):
+            return set()
+        return set(content['databases'])
+
+    def write_marker(self, databases):
+        content = {
+            'deployment': deployment_id(),
+            'url': self.url,
+            'databases': sorted(databases),
+        }
+        with open(self.marker + '.tmp', 'w') as marker:
+            json.dump(content, marker)
+        os.replace(self.marker + '.tmp', self.marker)
+
+
+def provision(loop, databases=None):
+    """Provisions the databases in the background, returning the task.
+
+    Defaults to every database of the current configuration, and provisions
+    them on every node of a cluster.
+    """
+    config = configuration.settings.config
+    if databases is None:
+        databases = configured_databases(config)
+    provisioners = [
+        DatabaseProvisioner.from_config(loop, config, backend_conf)
+        for backend_conf in node_configs(config['backend'])]
+    return asyncio.ensure_future(asyncio.gather(
+        *[provisioner.provision(databases) for provisioner in provisioners],
+        loop=loop), loop=loop)
+
+
+def start_provisioning(app):
+    """Provisions the configured databases while the app serves requests."""
+    app['provisioning'] = provision(app.loop)
+    app.on_shutdown.append(stop_provisioning)
+
+
+async def stop_provisioning(app):
+    app['provisioning'].cancel()
@@ -0,0 +1,204 @@
+import logging
+import math
+import mmap
+import multiprocessing
+import os
+import struct
+import time
+
+
+DEFAULT_BURST = 1
+LOCK_ATTEMPTS = 100
+# Locks can't be shared once workers are forked, so spares are created
+# upfront, each replacing the lock a worker died holding.
+LOCKS = 32
+BUCKET = struct.Struct('dd')
+# Which of the locks is in use, and which process holds it; 0 while nobody
+# does.
+HOLDER = struct.Struct('qq')
+
+
+logger = logging.getLogger('influxproxy.ratelimit')
+
+_shared = None
+
+
+class RateLimitedError(Exception):
+    """Raised when a database went over one of its rate limits."""
+
+    def __init__(self, database, retry_after):
+        super().__init__('Rate limit exceeded for {}'.format(database))
+        self.database = database
+        self.retry_after = retry_after
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class TokenBuckets:
+    """Token buckets kept in an anonymous shared memory map.
+
+    Each bucket is a pair of doubles, the tokens left and when they were last
+    counted. Created before gunicorn forks its workers, the map and its lock
+    are inherited by all of them, so they all draw from the same buckets.
+
+    The lock is never waited for, so that the event loop never blocks on
+    it, and the limits are skipped while it's busy. Its holder is recorded
+    in the map, and when it died holding the lock, the lock is replaced by
+    the next one of ``LOCKS``.
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.memory = mmap.mmap(
+            -1, HOLDER.size + max(1, count) * BUCKET.size)
+        self.locks = [multiprocessing.Lock() for _ in range(LOCKS)]
+        self.recovery_lock = multiprocessing.Lock()
+
+    def reset(self, index, tokens):
+        BUCKET.pack_into(
+            self.memory, HOLDER.size + index * BUCKET.size, tokens,
+            time.monotonic())
+
+    def take(self, index, cost, rate, capacity):
+        """Takes ``cost`` tokens from a bucket.
+
+        A bucket may go into debt for requests costing more than it can
+        ever hold, as long as it's full. Returns how many seconds to wait
+        before trying again, or 0 if the tokens were taken.
+        """
+        lock = self._acquire()
+        if lock is None:
+            return 0
+        try:
+            offset = HOLDER.size + index * BUCKET.size
+            tokens, updated_at = BUCKET.unpack_from(self.memory, offset)
+            now = time.monotonic()
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            if tokens < min(cost, capacity):
+                BUCKET.pack_into(self.memory, offset, tokens, now)
+                return (min(cost, capacity) - tokens) / rate
+            BUCKET.pack_into(self.memory, offset, tokens - cost, now)
+            return 0
+        finally:
+            HOLDER.pack_into(self.memory, 0, lock, 0)
+            self.locks[lock].release()
+
+    def _acquire(self):
+        """Returns the index of the lock it acquired, or None."""
+        for _ in range(LOCK_ATTEMPTS):
+            lock, _ = HOLDER.unpack_from(self.memory, 0)
+            if self.locks[lock].acquire(False):
+                HOLDER.pack_into(self.memory, 0, lock, os.getpid())
+                return lock
+        lock = self._replace_lock()
+        if lock is not None:
+            return lock
+        logger.error('Rate limits are not enforced, their lock is busy')
+        return None
+
+    def _replace_lock(self):
+        """Moves on to the next lock if the holder of this one died.
+
+        The next lock is acquired and returned, or None if the holder is
+        alive, or another worker is replacing the lock.
+        """
+        if not self.recovery_lock.acquire(False):
+            return None
+        try:
+            lock, pid = HOLDER.unpack_from(self.memory, 0)
+            if not pid or is_alive(pid):
+                return None
+            if lock + 1 == LOCKS:
+                logger.error(
+                    'No rate limit lock left to replace the one process %d '
+                    'died holding', pid)
+                return None
+            lock += 1
+            # Never used before, so it's free.
+            self.locks[lock].acquire(False)
+            HOLDER.pack_into(self.memory, 0, lock, os.getpid())
+            logger.error(
+                'Replaced the rate limit lock process %d died holding', pid)
+            return lock
+        finally:
+            self.recovery_lock.release()
+
+
+class Limit:
+    __slots__ = ('index', 'rate', 'capacity')
+
+    def __init__(self, index, rate, burst):
+        self.index = index
+        self.rate = rate
+        self.capacity = rate * burst
+
+
+class RateLimiter:
+    """Rate limits in requests and points per second for each database.
+
+    Configured through a ``rate_limit`` section with ``requests_per_second``
+    and ``points_per_second`` in the database config; ``burst`` is how many
+    seconds worth of either can be taken at once.
+    """
+
+    def __init__(self, limits):
+        self.requests = {}
+        self.points = {}
+        self.buckets = TokenBuckets(len(limits))
+        for index, (database, kind, rate, burst) in enumerate(limits):
+            limit = Limit(index, rate, burst)
+            getattr(self, kind)[database] = limit
+            self.buckets.reset(index, limit.capacity)
+
+    @classmethod
+    def from_config(cls, config):
+        limits = []
+        for database, db_config in config['databases'].items():
+            rate_limit = db_config.get('rate_limit') or {}
+            burst = rate_limit.get('burst', DEFAULT_BURST)
+            for kind in ('requests', 'points'):
+                rate = rate_limit.get('{}_per_second'.format(kind))
+                if rate is not None:
+                    if rate <= 0 or burst <= 0:
+                        raise ValueError(
+                            'Invalid rate limit for {}'.format(database))
+                    limits.append((database, kind, rate, burst))
+        return cls(limits)
+
+    def check_request(self, database):
+        limit = self.requests.get(database)
+        if limit is not None:
+            self._take(database, limit, 1)
+
+    def check_points(self, database, count):
+        limit = self.points.get(database)
+        if limit is not None:
+            self._take(database, limit, count)
+
+    def _take(self, database, limit, cost):
+        wait = self.buckets.take(
+            limit.index, cost, limit.rate, limit.capacity)
+        if wait:
+            raise RateLimitedError(database, max(1, math.ceil(wait)))
+
+
+def create_shared_limiter(config):
+    """Creates the limiter that processes forked from now on will share."""
+    global _shared
+    _shared = RateLimiter.from_config(config)
+    return _shared
+
+
+def get_limiter(config):
+    """Returns the shared limiter, or one for this process only."""
+    if _shared is not None:
+        return _shared
+    return RateLimiter.from_config(config)
@@ -0,0 +1,76 @@
+import logging
+import os
+
+from influxproxy import configuration
+from influxproxy.provisioning import provision
+
+
+DEFAULT_RELOAD_INTERVAL = 5
+
+
+logger = logging.getLogger('influxproxy.reloading')
+
+
+class ConfigReloader:
+    """Swaps in the configuration when its file changes, or when asked to.
+
+    The file's modification time is checked every ``interval`` seconds, and
+    a configuration that fails validation is logged and ignored until the
+    file changes again. Databases that are new in a reloaded configuration
+    are created in the backend without holding up requests.
+    """
+
+    def __init__(self, loop, path=configuration.SETTINGS_PATH,
+                 interval=DEFAULT_RELOAD_INTERVAL):
+        self.loop = loop
+        self.path = path
+        self.interval = interval
+        self.seen_mtime = configuration.settings.mtime
+        self.creating = None
+        self._handle = None
+
+    def start(self):
+        if self.interval:
+            self._handle = self.loop.call_later(self.interval, self._check)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _check(self):
+        self.check()
+        self._handle = self.loop.call_later(self.interval, self._check)
+
+    def check(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return False
+        if mtime == self.seen_mtime:
+            return False
+        return self.reload()
+
+    def reload(self):
+        """Reloads the configuration, returning whether it was swapped in."""
+        previous = configuration.settings
+        try:
+            current = configuration.reload_settings(self.path)
+        except Exception:
+            self.seen_mtime = self._stat()
+            logger.exception(
+                'Keeping the current configuration, %s is invalid', self.path)
+            return False
+        self.seen_mtime = current.mtime
+        added = current.databases - previous.databases
+        logger.info(
+            'Reloaded %s, with %d new databases', self.path, len(added))
+        if added:
+            self.creating = provision(self.loop, sorted(added))
+        return True
+
+    def _stat(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
@@ -0,0 +1,244 @@
+import re
+
+
+MAX_CACHED_SERIES = 10000
+FIELD_TYPES = {
+    'float': float,
+    'integer': int,
+    'string': str,
+    'boolean': bool,
+}
+TYPE_NAMES = {kind: name for name, kind in FIELD_TYPES.items()}
+LINE_BOOLEANS = frozenset([
+    b't', b'T', b'true', b'True', b'TRUE',
+    b'f', b'F', b'false', b'False', b'FALSE',
+])
+QUOTE = ord('"')
+LINE_INTEGER_SUFFIXES = frozenset([ord('i'), ord('u')])
+
+_KEY = rb'[^,= \\]*(?:\\.[^,= \\]*)*'
+SERIES = re.compile(rb'[^ \\]*(?:\\.[^ \\]*)*')
+MEASUREMENT = re.compile(rb'[^, \\]*(?:\\.[^, \\]*)*')
+TAG = re.compile(rb',(' + _KEY + rb')=(' + _KEY + rb')')
+FIELD = re.compile(
+    rb'[ ,](' + _KEY + rb')=("[^"\\]*(?:\\.[^"\\]*)*"|[^, ]+)')
+ESCAPED = re.compile(rb'\\(.)')
+
+
+class SchemaError(ValueError):
+    """Raised when a point doesn't match its database schema."""
+
+
+class InvalidSchemaError(ValueError):
+    """Raised when a schema in the configuration can't be compiled."""
+
+
+def _unescape(token):
+    if b'\\' in token:
+        return ESCAPED.sub(rb'\1', token)
+    return token
+
+
+def _line_kind(value):
+    if value[0] == QUOTE:
+        return str
+    if value[-1] in LINE_INTEGER_SUFFIXES:
+        return int
+    if value in LINE_BOOLEANS:
+        return bool
+    return float
+
+
+class MeasurementSchema:
+    """The tags and fields allowed in one measurement.
+
+    Lookups are kept both by name, for JSON points, and by UTF-8 encoded
+    name, for line protocol, so neither has to be converted to check it.
+    """
+
+    __slots__ = ('name', 'tags', 'fields', 'line_tags', 'line_fields')
+
+    def __init__(self, name, tags, fields):
+        self.name = name
+        self.tags = None if tags is None else frozenset(tags)
+        self.fields = dict(fields)
+        self.line_tags = None if tags is None else frozenset(
+            tag.encode('utf-8') for tag in tags)
+        self.line_fields = {
+            key.encode('utf-8'): kind for key, kind in fields.items()}
+
+    @classmethod
+    def compile(cls, name, definition):
+        if not isinstance(definition, dict):
+            raise InvalidSchemaError(
+                'Measurement {!r} should be a mapping'.format(name))
+        tags = definition.get('tags')
+        if tags is not None and not isinstance(tags, list):
+            raise InvalidSchemaError(
+                'Tags of {!r} should be a list'.format(name))
+        fields = {}
+        for key, type_name in (definition.get('fields') or {}).items():
+            try:
+                fields[str(key)] = FIELD_TYPES[type_name]
+            except (KeyError, TypeError):
+                raise InvalidSchemaError(
+                    'Unknown type {!r} for field {!r} of {!r}'.format(
+                        type_name, key, name))
+        if not fields:
+            raise InvalidSchemaError(
+                'Measurement {!r} has no fields'.format(name))
+        return cls(
+            str(name), None if tags is None else [str(tag) for tag in tags],
+            fields)
+
+
+class Schema:
+    """A compiled database schema.
+
+    Built once from the configuration, so that checking a point only takes
+    dict lookups and type checks.
+    """
+
+    __slots__ = (
+        'measurements', 'line_measurements', 'max_string_length',
+        'max_cached_series', '_series')
+
+    def __init__(self, measurements, max_string_length=None,
+                 max_cached_series=MAX_CACHED_SERIES):
+        self.measurements = {m.name: m for m in measurements}
+        self.line_measurements = {
+            m.name.encode('utf-8'): m for m in measurements}
+        self.max_string_length = max_string_length
+        self.max_cached_series = max_cached_series
+        self._series = {}
+
+    @classmethod
+    def compile(cls, definition):
+        if not isinstance(definition, dict):
+            raise InvalidSchemaError('Schema should be a mapping')
+        measurements = definition.get('measurements')
+        if not isinstance(measurements, dict) or not measurements:
+            raise InvalidSchemaError('Schema has no measurements')
+        max_string_length = definition.get('max_string_length')
+        if max_string_length is not None and (
+                type(max_string_length) is not int or max_string_length < 0):
+            raise InvalidSchemaError('Invalid max_string_length: {!r}'.format(
+                max_string_length))
+        return cls(
+            [MeasurementSchema.compile(name, measurement)
+             for name, measurement in measurements.items()],
+            max_string_length)
+
+    def validate_points(self, points):
+        """Checks points that already have the mandatory keys.
+
+        Integer values of float fields are converted to floats, so that they
+        don't conflict with the field type in the backend.
+        """
+        for point in points:
+            self.validate_point(point)
+
+    def validate_point(self, point):
+        try:
+            measurement = self.measurements[point['measurement']]
+        except (KeyError, TypeError):
+            raise SchemaError('Unknown measurement: {!r}'.format(
+                point['measurement']))
+        tags = point.get('tags')
+        if tags:
+            self._validate_tags(measurement, tags)
+        fields = point['fields']
+        if not isinstance(fields, dict):
+            raise SchemaError('Invalid fields: {!r}'.format(fields))
+        for key, value in fields.items():
+            kind = measurement.fields.get(key)
+            if kind is None:
+                raise SchemaError('Unknown field {!r} in {!r}'.format(
+                    key, measurement.name))
+            value_type = type(value)
+            if value_type is kind:
+                if kind is str:
+                    self._validate_length(value, key)
+            elif kind is float and value_type is int:
+                fields[key] = float(value)
+            elif value is not None:
+                raise SchemaError('Field {!r} should be {}'.format(
+                    key, TYPE_NAMES[kind]))
+
+    def _validate_tags(self, measurement, tags):
+        if not isinstance(tags, dict):
+            raise SchemaError('Invalid tags: {!r}'.format(tags))
+        allowed = measurement.tags
+        for key, value in tags.items():
+            if allowed is not None and key not in allowed:
+                raise SchemaError('Unknown tag {!r} in {!r}'.format(
+                    key, measurement.name))
+            if type(value) is str:
+                self._validate_length(value, key)
+
+    def _validate_length(self, value, key):
+        limit = self.max_string_length
+        if limit is not None and len(value) > limit:
+            raise SchemaError('Value of {!r} is longer than {}'.format(
+                key, limit))
+
+    def validate_line(self, data, start, end):
+        """Checks a structurally valid line protocol line in place.
+
+        Series prefixes that passed are remembered, so that only the fields
+        of lines from known series are looked at.
+        """
+        match = SERIES.match(data, start, end)
+        series = match.group()
+        measurement = self._series.get(series)
+        if measurement is None:
+            measurement = self._validate_series(series)
+        line_fields = measurement.line_fields
+        for key, value in FIELD.findall(data, match.end(), end):
+            kind = line_fields.get(key) or line_fields.get(_unescape(key))
+            if kind is None:
+                raise SchemaError('Unknown field {!r} in {!r}'.format(
+                    key, measurement.name))
+            if _line_kind(value) is not kind:
+                raise SchemaError('Field {!r} should be {}'.format(
+                    key, TYPE_NAMES[kind]))
+            if kind is str:
+                self._validate_line_length(value[1:-1], key)
+
+    def _validate_series(self, series):
+        match = MEASUREMENT.match(series)
+        name = _unescape(match.group())
+        measurement = self.line_measurements.get(name)
+        if measurement is None:
+            raise SchemaError('Unknown measurement: {!r}'.format(name))
+        allowed = measurement.line_tags
+        for key, value in TAG.findall(series, match.end()):
+            if allowed is not None and _unescape(key) not in allowed:
+                raise SchemaError('Unknown tag {!r} in {!r}'.format(
+                    key, measurement.name))
+            self._validate_line_length(value, key)
+        if len(self._series) >= self.max_cached_series:
+            self._series.clear()
+        self._series[series] = measurement
+        return measurement
+
+    def _validate_line_length(self, value, key):
+        limit = self.max_string_length
+        if limit is not None and len(value) > limit:
+            value = _unescape(value).decode('utf-8', 'replace')
+            self._validate_length(value, key)
+
+
+def compile_schemas(databases):
+    """Compiles the schemas of the databases that have one."""
+    schemas = {}
+    for database, db_config in databases.items():
+        definition = db_config.get('schema')
+        if definition is None:
+            continue
+        try:
+            schemas[database] = Schema.compile(definition)
+        except InvalidSchemaError as e:
+            raise InvalidSchemaError('Invalid schema for {!r}: {}'.format(
+                database, e))
+    return schemas
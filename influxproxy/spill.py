@@ -0,0 +1,274 @@
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import zlib
+from collections import deque
+
+
+DEFAULT_SPILL_BYTES = 1024 * 1024 * 1024
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+DEFAULT_REPLAY_RATE = 1024 * 1024
+DEFAULT_REPLAY_RETRY = 5
+SEGMENT_SUFFIX = '.spill'
+CURSOR_NAME = 'cursor'
+# Each record is the length and CRC-32 of its body, then the body: the
+# number of points, the length of their precision, the precision itself
+# and finally the lines.
+HEADER = struct.Struct('>II')
+BODY_HEADER = struct.Struct('>IB')
+CURSOR = struct.Struct('>QQ')
+
+
+logger = logging.getLogger('influxproxy.spill')
+
+
+def encode_record(data, count, precision=None):
+    precision = (precision or '').encode('ascii')
+    body = BODY_HEADER.pack(count, len(precision)) + precision + data
+    return HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_record(buffer, offset):
+    """Returns the record at ``offset`` and where the next one starts.
+
+    Returns None for the record when it's cut short or fails its CRC, as
+    the last one written before a crash may be.
+    """
+    end = offset + HEADER.size
+    if end > len(buffer):
+        return None, end
+    length, crc = HEADER.unpack_from(buffer, offset)
+    body = buffer[end:end + length]
+    if len(body) != length or zlib.crc32(body) != crc:
+        return None, end + length
+    count, precision_length = BODY_HEADER.unpack_from(body)
+    data_start = BODY_HEADER.size + precision_length
+    precision = body[BODY_HEADER.size:data_start].decode('ascii') or None
+    return (body[data_start:], count, precision), end + length
+
+
+class SpillQueue:
+    """Batches of a database kept on disk until they can be written.
+
+    Batches are appended as CRC-checked records to append-only segment
+    files, a new one being started once the last holds ``segment_bytes``
+    bytes, or is about to be read. Segments are only read once closed,
+    through mmap, and deleted once read. When the segments hold more than
+    ``max_bytes`` bytes, the oldest ones are deleted to make room.
+
+    Where reading got to is kept in a cursor file, so that after a crash
+    reading resumes from the first record not written yet; a record cut
+    short by the crash fails its CRC, and the rest of its segment is
+    skipped. Files are written without syncing them, so they survive the
+    process crashing, not the host.
+    """
+
+    def __init__(self, directory, database, max_bytes=DEFAULT_SPILL_BYTES,
+                 segment_bytes=DEFAULT_SEGMENT_BYTES, metrics=None):
+        self.directory = directory
+        self.database = database
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.metrics = metrics
+        self.spilled_bytes = 0
+        self.replayed_bytes = 0
+        self.evicted_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        self.segments = deque()
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(SEGMENT_SUFFIX):
+                sequence = int(name[:-len(SEGMENT_SUFFIX)])
+                size = os.stat(self._path(sequence)).st_size
+                self.segments.append([sequence, size])
+        self.size = sum(size for _, size in self.segments)
+        self._file = None
+        self._next_sequence = (
+            self.segments[-1][0] + 1 if self.segments else 0)
+        self._reading = None
+        self._offset = 0
+        self._peeked = None
+        self._cursor = os.open(
+            os.path.join(directory, CURSOR_NAME), os.O_RDWR | os.O_CREAT)
+        cursor = os.read(self._cursor, CURSOR.size)
+        if len(cursor) == CURSOR.size and self.segments:
+            sequence, offset = CURSOR.unpack(cursor)
+            if sequence == self.segments[0][0]:
+                self._offset = offset
+
+    def _path(self, sequence):
+        return os.path.join(
+            self.directory, '{:016d}{}'.format(sequence, SEGMENT_SUFFIX))
+
+    def __bool__(self):
+        return bool(self.segments)
+
+    def append(self, data, count, precision=None):
+        """Spills a batch, returning whether it fit within the disk cap."""
+        record = encode_record(data, count, precision)
+        if len(record) > self.max_bytes:
+            return False
+        while self.size + len(record) > self.max_bytes:
+            self._evict_oldest()
+        if self._file is None:
+            sequence = self._next_sequence
+            self._next_sequence += 1
+            self._file = open(self._path(sequence), 'ab', buffering=0)
+            self.segments.append([sequence, 0])
+        self._file.write(record)
+        self.segments[-1][1] += len(record)
+        self.size += len(record)
+        self._count('spilled', len(data))
+        if self.segments[-1][1] >= self.segment_bytes:
+            self._close_segment()
+        return True
+
+    def _evict_oldest(self):
+        unread = self.segments[0][1] - self._offset
+        if len(self.segments) == 1 and self._file is not None:
+            self._close_segment()
+        self._remove_oldest()
+        self._offset = 0
+        self._count('evicted', unread)
+        logger.warning(
+            'Evicted %d spilled bytes of %s', unread, self.database)
+
+    def _close_segment(self):
+        self._file.close()
+        self._file = None
+
+    def _remove_oldest(self):
+        sequence, size = self.segments.popleft()
+        self.size -= size
+        if self._reading is not None:
+            self._reading.close()
+            self._reading = None
+        os.unlink(self._path(sequence))
+
+    def peek(self):
+        """Returns the oldest ``(data, count, precision)`` batch, or None.
+
+        The batch stays spilled until ``commit`` is called.
+        """
+        while self.segments:
+            if self._reading is None:
+                if len(self.segments) == 1 and self._file is not None:
+                    self._close_segment()
+                sequence, size = self.segments[0]
+                if self._offset >= size:
+                    self._finish_segment()
+                    continue
+                with open(self._path(sequence), 'rb') as segment:
+                    self._reading = mmap.mmap(
+                        segment.fileno(), 0, access=mmap.ACCESS_READ)
+            record, next_offset = decode_record(self._reading, self._offset)
+            if record is not None:
+                self._peeked = (
+                    self.segments[0][0], self._offset, next_offset,
+                    len(record[0]))
+                return record
+            logger.warning(
+                'Skipped %d corrupt spilled bytes of %s',
+                len(self._reading) - self._offset, self.database)
+            self._finish_segment()
+        return None
+
+    def commit(self):
+        """Marks the batch last returned by ``peek`` as written.
+
+        The batch may have been evicted while it was being written, in
+        which case there's nothing left to mark.
+        """
+        sequence, offset, next_offset, size = self._peeked
+        self._peeked = None
+        self._count('replayed', size)
+        if (not self.segments or self.segments[0][0] != sequence or
+                self._offset != offset):
+            return
+        self._offset = next_offset
+        if self._offset >= len(self._reading):
+            self._finish_segment()
+        else:
+            self._save_cursor()
+
+    def _finish_segment(self):
+        self._remove_oldest()
+        self._offset = 0
+        self._save_cursor()
+
+    def _save_cursor(self):
+        sequence = self.segments[0][0] if self.segments else 0
+        os.pwrite(self._cursor, CURSOR.pack(sequence, self._offset), 0)
+
+    def _count(self, outcome, size):
+        setattr(self, outcome + '_bytes',
+                getattr(self, outcome + '_bytes') + size)
+        if self.metrics is not None:
+            self.metrics.count_spill(self.database, outcome, size)
+
+    def close(self):
+        if self._file is not None:
+            self._close_segment()
+        if self._reading is not None:
+            self._reading.close()
+            self._reading = None
+        if self._cursor is not None:
+            os.close(self._cursor)
+            self._cursor = None
+
+
+class Replayer:
+    """Writes the batches of a ``SpillQueue`` back, oldest first.
+
+    Batches are written at up to ``rate`` bytes per second, so that a
+    backend coming back up isn't flooded with everything it missed; when a
+    write fails, the backend is given ``retry_after`` seconds before the
+    batch is tried again. Replaying stops once the queue is empty, until
+    it's started again.
+    """
+
+    def __init__(self, spill, driver, loop, rate=DEFAULT_REPLAY_RATE,
+                 retry_after=DEFAULT_REPLAY_RETRY):
+        self.spill = spill
+        self.driver = driver
+        self.loop = loop
+        self.rate = rate
+        self.retry_after = retry_after
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self, delay=0):
+        if not self.running:
+            self._task = asyncio.ensure_future(
+                self._replay(delay), loop=self.loop)
+
+    async def _replay(self, delay):
+        await asyncio.sleep(delay, loop=self.loop)
+        database = self.spill.database
+        record = self.spill.peek()
+        while record is not None:
+            data, count, precision = record
+            try:
+                if precision is None:
+                    await self.driver.write_lines(database, [data])
+                else:
+                    await self.driver.write_lines(
+                        database, [data], precision)
+            except Exception as e:
+                logger.warning(
+                    'Failed to replay %d points to %s, retrying in %ss: %s',
+                    count, database, self.retry_after, e)
+                await asyncio.sleep(self.retry_after, loop=self.loop)
+            else:
+                self.spill.commit()
+                await asyncio.sleep(len(data) / self.rate, loop=self.loop)
+            record = self.spill.peek()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+
+
+DEFAULT_PAYLOAD_SIZE = 1400
+
+
+logger = logging.getLogger('influxproxy.udp')
+
+
+class UDPStats:
+    """Counters for what was sent to a UDP destination."""
+
+    def __init__(self):
+        self.datagrams = 0
+        self.bytes = 0
+        self.dropped_lines = 0
+        self.stalls = 0
+
+
+def pack_datagrams(chunks, max_size, stats):
+    """Groups line protocol chunks into datagram payloads.
+
+    Yields lists of buffers whose total size is at most ``max_size``, without
+    ever splitting a line. Chunks are sliced through memoryviews, so no data
+    is copied; lines longer than ``max_size`` are dropped and counted in
+    ``stats``.
+    """
+    datagram, size = [], 0
+    for chunk in chunks:
+        view = memoryview(chunk)
+        start, end = 0, len(chunk)
+        while start < end:
+            room = max_size - size
+            if end - start <= room:
+                datagram.append(view[start:end])
+                size += end - start
+                break
+            cut = chunk.rfind(b'\n', start, start + room)
+            if cut >= 0:
+                datagram.append(view[start:cut + 1])
+                start = cut + 1
+            elif not size:
+                cut = chunk.find(b'\n', start)
+                start = end if cut < 0 else cut + 1
+                stats.dropped_lines += 1
+                continue
+            yield datagram
+            datagram, size = [], 0
+    if datagram:
+        yield datagram
+
+
+class UDPEndpoint(asyncio.DatagramProtocol):
+    """A non-blocking datagram transport to one destination.
+
+    Datagrams the kernel can't take right away are buffered by the transport;
+    once that buffer goes past its high-water mark the endpoint is congested
+    until it drains, and writers wait for it instead of piling up more data.
+    """
+
+    def __init__(self, address, loop):
+        self.address = address
+        self.loop = loop
+        self.transport = None
+        self._writable = None
+
+    @classmethod
+    async def create(cls, address, loop):
+        _, endpoint = await loop.create_datagram_endpoint(
+            lambda: cls(address, loop), remote_addr=address)
+        return endpoint
+
+    @property
+    def backlog(self):
+        return self.transport.get_write_buffer_size()
+
+    @property
+    def congested(self):
+        return self._writable is not None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.resume_writing()
+
+    def error_received(self, exc):
+        logger.debug('Error sending to %s:%s: %s', *self.address, exc)
+
+    def pause_writing(self):
+        if self._writable is None:
+            self._writable = self.loop.create_future()
+
+    def resume_writing(self):
+        if self._writable is not None:
+            self._writable.set_result(None)
+            self._writable = None
+
+    async def drain(self):
+        if self._writable is not None:
+            await self._writable
+
+    def send(self, data):
+        self.transport.sendto(data)
+
+    def close(self):
+        self.transport.close()
+
+
+class UDPWriter:
+    """Writes line protocol to an endpoint, packed into datagrams."""
+
+    def __init__(self, endpoint, payload_size=DEFAULT_PAYLOAD_SIZE):
+        self.endpoint = endpoint
+        self.payload_size = payload_size
+        self.stats = UDPStats()
+
+    async def write(self, database, chunks):
+        stats = self.stats
+        dropped = stats.dropped_lines
+        for datagram in pack_datagrams(chunks, self.payload_size, stats):
+            if self.endpoint.congested:
+                stats.stalls += 1
+                await self.endpoint.drain()
+            data = b''.join(datagram)
+            self.endpoint.send(data)
+            stats.bytes += len(data)
+            stats.datagrams += 1
+        if stats.dropped_lines > dropped:
+            logger.warning(
+                'Dropped %d lines larger than %d bytes for %s:%s',
+                stats.dropped_lines - dropped, self.payload_size,
+                *self.endpoint.address)
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import os
+import resource
+import signal
+import sys
+
+from aiohttp.worker import GunicornWebWorker
+
+from influxproxy.configuration import config
+
+
+RSS_CHECK_INTERVAL = 10
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+MEGABYTE = 1024 * 1024
+
+
+logger = logging.getLogger('influxproxy.worker')
+
+
+def current_rss():
+    """Returns the resident memory of this process, in bytes."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        # Without procfs, the peak is the closest we have; it comes in
+        # bytes on macOS and in kilobytes everywhere else.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class ProxyWorker(GunicornWebWorker):
+    """A long-lived worker for a preloaded application.
+
+    The application module only exposes a factory, so that the work done
+    when importing it is shared by all workers, while each of them builds
+    its application on its own event loop. Workers are recycled once their
+    resident memory goes past ``max_worker_rss`` megabytes, if configured,
+    and drain their buffers after their last request is handled. SIGHUP
+    reloads the configuration in place.
+    """
+
+    def init_signals(self):
+        super().init_signals()
+        self.loop.add_signal_handler(signal.SIGHUP, self.reload_config)
+
+    def reload_config(self):
+        self.wsgi['reloader'].reload()
+
+    def load_wsgi(self):
+        factory = self.app.wsgi()
+        self.wsgi = factory(self.loop)
+        max_rss = config.get('max_worker_rss')
+        self.max_rss = None if max_rss is None else max_rss * MEGABYTE
+        if self.max_rss is not None:
+            self.loop.call_later(RSS_CHECK_INTERVAL, self.check_rss)
+
+    def check_rss(self):
+        rss = current_rss()
+        if rss > self.max_rss:
+            logger.info(
+                'Recycling worker %s, using %d MB', self.pid, rss // MEGABYTE)
+            self.alive = False
+        else:
+            self.loop.call_later(RSS_CHECK_INTERVAL, self.check_rss)
+
+    async def close(self):
+        if not self.servers:
+            return
+        servers, self.servers = self.servers, None
+        for server in servers:
+            server.close()
+        timeout = self.cfg.graceful_timeout / 100 * 95
+        await asyncio.wait([
+            handler.finish_connections(timeout=timeout)
+            for handler in servers.values()], loop=self.loop)
+        # Only drained once no request can add to the buffers anymore.
+        await self.wsgi.shutdown()
+        await self.wsgi.finish()
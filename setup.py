@@ -14,13 +14,14 @@ setup(name='influxproxy',
       author_email='diogo.baeder@yougov.com',
       url='',
       license='MIT License',
-      packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
+      packages=find_packages(
+          exclude=['ez_setup', 'examples', 'tests', 'benchmarks']),
       include_package_data=True,
       zip_safe=True,
       install_requires=[
           'aiohttp>=0.22.5,<1',
           'aiohttp_jinja2>=0.8.0,<0.15',
-          'influxdb>=3.0.0,<4',
+          'python-dateutil>=2.0.0',
           'PyYAML>=3.11',
           # 'uvloop>=0.5.2',  # Breaks static file serving. Will try later.
           'cchardet>=1.0.0',
@@ -31,6 +32,8 @@ setup(name='influxproxy',
               'nose',
               'coverage',
               'flake8',
+              # To compare the encoder with, in its tests and benchmark.
+              'influxdb>=3.0.0,<4',
               'xtraceback',
           ],
       },
@@ -1,6 +1,13 @@
 from functools import wraps
+from unittest import TestCase
+from unittest.mock import MagicMock
 
-from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+from aiohttp.test_utils import (
+    AioHTTPTestCase,
+    setup_test_loop,
+    teardown_test_loop,
+    unittest_run_loop,
+)
 from nose.tools import istest
 
 from influxproxy.app import create_app
@@ -10,12 +17,29 @@ class AppTestCase(AioHTTPTestCase):
     def get_app(self, loop):
         return create_app(loop)
 
+    def tearDown(self):
+        self.loop.run_until_complete(self.app.shutdown())
+        super().tearDown()
+
     def assert_control(self, response, access_control, expected):
         self.assertEqual(
             response.headers['Access-Control-{}'.format(access_control)],
             expected)
 
 
+class LoopTestCase(TestCase):
+    def setUp(self):
+        self.loop = setup_test_loop()
+
+    def tearDown(self):
+        teardown_test_loop(self.loop)
+
+
+class AsyncMock(MagicMock):
+    async def __call__(self, *args, **kwargs):
+        return super().__call__(*args, **kwargs)
+
+
 def asynctest(f):
     return wraps(f)(
         istest(
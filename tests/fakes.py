@@ -0,0 +1,104 @@
+import asyncio
+import gzip
+import re
+
+from aiohttp import web
+
+
+class FakeInfluxHTTP:
+    """A stand-in for InfluxDB's HTTP API that records what it receives.
+
+    Responds to writes with the queued ``statuses`` first, and with 204 once
+    they run out. Each response is held back for ``delay`` seconds, to play
+    a slow backend. Queries can list and create ``databases``, and pings
+    are answered while ``up``.
+    """
+
+    def __init__(self, loop, statuses=(), delay=0, databases=()):
+        self.loop = loop
+        self.statuses = list(statuses)
+        self.delay = delay
+        self.requests = []
+        self.lines = []
+        self.databases = set(databases)
+        self.queries = []
+        self.up = True
+        self.app = web.Application(loop=loop)
+        self.app.router.add_route('POST', '/write', self.write)
+        self.app.router.add_route('*', '/query', self.query)
+        self.app.router.add_route('GET', '/ping', self.ping)
+        self.handler = None
+        self.server = None
+        self.port = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/write'.format(self.port)
+
+    async def start(self):
+        self.handler = self.app.make_handler()
+        self.server = await self.loop.create_server(
+            self.handler, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.handler.finish_connections()
+
+    async def write(self, request):
+        body = await request.read()
+        if request.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        self.requests.append((request, body))
+        if self.delay:
+            await asyncio.sleep(self.delay, loop=self.loop)
+        status = self.statuses.pop(0) if self.statuses else 204
+        if status == 204:
+            self.lines.extend(body.splitlines())
+            return web.Response(status=204)
+        return web.Response(status=status, text='{"error": "oops"}')
+
+    async def ping(self, request):
+        return web.Response(status=204 if self.up else 503)
+
+    async def query(self, request):
+        query = request.GET['q']
+        self.queries.append((request.method, query))
+        if self.delay:
+            await asyncio.sleep(self.delay, loop=self.loop)
+        status = self.statuses.pop(0) if self.statuses else 200
+        if status != 200:
+            return web.Response(status=status, text='{"error": "oops"}')
+        result = {'statement_id': 0}
+        if query == 'SHOW DATABASES' and self.databases:
+            result['series'] = [{
+                'name': 'databases',
+                'columns': ['name'],
+                'values': [[name] for name in sorted(self.databases)],
+            }]
+        created = re.match(r'CREATE DATABASE "(.+)"$', query)
+        if created:
+            self.databases.add(created.group(1))
+        return web.json_response({'results': [result]})
+
+
+class FakeInfluxUDP(asyncio.DatagramProtocol):
+    """A stand-in for InfluxDB's UDP listener, keeping the lines it gets."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.lines = []
+        self.transport = None
+        self.port = None
+
+    async def start(self):
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: self, local_addr=('127.0.0.1', 0))
+        self.port = self.transport.get_extra_info('sockname')[1]
+
+    def stop(self):
+        self.transport.close()
+
+    def datagram_received(self, data, address):
+        self.lines.extend(data.splitlines())
@@ -0,0 +1,147 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from nose.tools import istest
+
+from influxproxy.access import (
+    DatabaseAccess,
+    OriginMatcher,
+    build_preflight_headers,
+    compile_access,
+)
+from influxproxy.configuration import access, config, schemas
+
+
+class OriginMatcherTest(TestCase):
+    @istest
+    def allows_everything_to_wildcard(self):
+        matcher = OriginMatcher('*')
+
+        self.assertEqual(matcher.allowed_to('http://any.com'), '*')
+
+    @istest
+    def allows_wildcard_within_list(self):
+        matcher = OriginMatcher(['http://a.com', '*'])
+
+        self.assertEqual(matcher.allowed_to('http://any.com'), '*')
+
+    @istest
+    def allows_listed_origins(self):
+        matcher = OriginMatcher(['http://a.com', 'http://b.com'])
+
+        self.assertEqual(matcher.origins, {'http://a.com', 'http://b.com'})
+        self.assertEqual(matcher.allowed_to('http://b.com'), 'http://b.com')
+        self.assertIsNone(matcher.allowed_to('http://c.com'))
+
+    @istest
+    def takes_single_origin_as_is(self):
+        matcher = OriginMatcher('http://a.com')
+
+        self.assertEqual(matcher.allowed_to('http://a.com'), 'http://a.com')
+        self.assertIsNone(matcher.allowed_to('a.com'))
+
+    @istest
+    def allows_origins_matching_patterns(self):
+        matcher = OriginMatcher(['https://*.a.com', '*.b.org'])
+
+        for origin in ['https://x.a.com', 'https://x.y.a.com',
+                       'http://x.b.org']:
+            self.assertEqual(matcher.allowed_to(origin), origin)
+        for origin in ['http://x.a.com', 'https://x.a.com.evil',
+                       'https://xa.com', 'http://b.org']:
+            self.assertIsNone(matcher.allowed_to(origin))
+
+    @istest
+    def escapes_patterns(self):
+        matcher = OriginMatcher(['https://*.a.com'])
+
+        self.assertIsNone(matcher.allowed_to('https://x.aXcom'))
+
+    @istest
+    def allows_nothing_if_empty(self):
+        matcher = OriginMatcher(None)
+
+        self.assertIsNone(matcher.allowed_to('http://a.com'))
+
+
+class DatabaseAccessTest(TestCase):
+    def compile(self, allow_from):
+        return DatabaseAccess.compile('my_db', {
+            'public_key': 'secret',
+            'allow_from': allow_from,
+        }, 600)
+
+    @istest
+    def checks_public_key(self):
+        access = self.compile('*')
+
+        self.assertTrue(access.check_key('secret'))
+        self.assertFalse(access.check_key('secreT'))
+        self.assertFalse(access.check_key('sécret'))
+
+    @istest
+    def is_immutable(self):
+        access = self.compile('*')
+
+        with self.assertRaises(AttributeError):
+            access.public_key = b'other'
+
+    @istest
+    def prebuilds_wildcard_preflight(self):
+        access = self.compile('*')
+
+        headers = access.preflight_headers('*')
+
+        self.assertEqual(headers, build_preflight_headers('*', 600))
+        self.assertIs(access.preflight_headers('*'), headers)
+        self.assertEqual(list(access.preflights), ['*'])
+
+    @istest
+    def prebuilds_preflight_per_origin(self):
+        access = self.compile(['http://a.com', 'http://b.com'])
+
+        self.assertEqual(
+            sorted(access.preflights), ['http://a.com', 'http://b.com'])
+        headers = access.preflight_headers('http://b.com')
+        self.assertEqual(
+            headers['Access-Control-Allow-Origin'], 'http://b.com')
+        self.assertEqual(headers['Access-Control-Max-Age'], '600')
+
+    @istest
+    def builds_pattern_preflights_on_first_use(self):
+        access = self.compile(['http://a.com', 'http://*.b.com'])
+
+        headers = access.preflight_headers('http://x.b.com')
+
+        self.assertIs(access.preflight_headers('http://x.b.com'), headers)
+        self.assertEqual(
+            headers['Access-Control-Allow-Origin'], 'http://x.b.com')
+
+    @istest
+    def forgets_pattern_preflights_when_full(self):
+        access = self.compile(['http://a.com', 'http://*.b.com'])
+
+        with patch('influxproxy.access.MAX_CACHED_PREFLIGHTS', 2):
+            access.preflight_headers('http://x.b.com')
+            access.preflight_headers('http://y.b.com')
+
+        self.assertEqual(
+            sorted(access.preflights), ['http://a.com', 'http://y.b.com'])
+
+
+class CompileAccessTest(TestCase):
+    @istest
+    def compiles_every_database(self):
+        self.assertEqual(sorted(access), sorted(config['databases']))
+        self.assertIs(access['testing'].config, config['databases']['testing'])
+        self.assertIs(access['strict'].schema, schemas['strict'])
+        self.assertIsNone(access['testing'].schema)
+
+    @istest
+    def uses_preflight_expiration(self):
+        compiled = compile_access({
+            'preflight_expiration': 30,
+            'databases': {'a': {'public_key': 'k', 'allow_from': '*'}},
+        }, {})
+
+        self.assertEqual(compiled['a'].max_age, 30)
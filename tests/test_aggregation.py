@@ -0,0 +1,318 @@
+from unittest import TestCase
+from unittest.mock import ANY, MagicMock, patch
+
+from nose.tools import istest
+
+from .base import LoopTestCase, asynctest
+from influxproxy.aggregation import (
+    DEFAULT_MAX_SERIES,
+    DEFAULT_WINDOW,
+    AggregationWindow,
+    Aggregator,
+    FieldStats,
+    parse_number,
+)
+from influxproxy.batching import QueueFullError
+
+
+class ParseNumberTest(TestCase):
+    @istest
+    def parses_integers_and_floats(self):
+        self.assertEqual(parse_number(b'-12i'), -12)
+        self.assertIs(type(parse_number(b'-12i')), int)
+        self.assertEqual(parse_number(b'1.5e3'), 1500.0)
+
+    @istest
+    def ignores_other_values(self):
+        for value in (b'12u', b'"12"', b'true', b'F'):
+            self.assertIsNone(parse_number(value))
+
+
+class FieldStatsTest(TestCase):
+    @istest
+    def reduces_integers(self):
+        stats = FieldStats(b'3i', 3)
+        stats.add(b'1i', 1)
+        stats.add(b'2i', 2)
+
+        self.assertEqual(
+            stats.encode(b'value'),
+            b'value_count=3i,value_sum=6i,value_min=1i,value_max=3i,'
+            b'value_last=2i')
+
+    @istest
+    def reduces_floats(self):
+        stats = FieldStats(b'0.5', 0.5)
+        stats.add(b'1', 1.0)
+
+        self.assertEqual(
+            stats.encode(b'value'),
+            b'value_count=2i,value_sum=1.5,value_min=0.5,value_max=1.0,'
+            b'value_last=1')
+
+    @istest
+    def counts_and_keeps_last_of_other_values(self):
+        stats = FieldStats(b'1i', 1)
+        stats.add(b'"x"', None)
+        stats.add(b'2i', 2)
+
+        self.assertEqual(
+            stats.encode(b'value'), b'value_count=3i,value_last=2i')
+
+    @istest
+    def leaves_out_overflowing_floats(self):
+        stats = FieldStats(b'1e308', 1e308)
+        stats.add(b'1e308', 1e308)
+
+        self.assertEqual(
+            stats.encode(b'value'),
+            b'value_count=2i,value_min=1e+308,value_max=1e+308,'
+            b'value_last=1e308')
+
+
+class AggregationWindowTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.batcher = MagicMock()
+        self.driver = MagicMock()
+        self.metrics = MagicMock()
+        self.window = AggregationWindow(
+            'my_db', self.batcher, self.loop, window=60,
+            tag=(b'worker', b'1'), metrics=self.metrics)
+
+    def aggregate(self, data, count, db_config=None):
+        lines, remaining = self.window.split([(data, count)])
+        self.window.add(self.driver, lines, db_config or {})
+        return remaining
+
+    def written(self):
+        database, driver, data, count, db_config = (
+            self.batcher.add.call_args[0])
+        self.assertEqual(database, 'my_db')
+        self.assertIs(driver, self.driver)
+        return [line.rsplit(b' ', 1) for line in data.splitlines()]
+
+    @istest
+    def builds_from_database_config(self):
+        window = AggregationWindow.from_config(
+            'my_db', self.batcher, self.loop, {'aggregate': {
+                'window': 5,
+                'measurements': ['clicks', 'scroll depth'],
+                'max_series': 10,
+                'worker_tag': 'proxy',
+            }}, worker=3)
+
+        self.assertEqual(window.window, 5)
+        self.assertEqual(window.measurements, {b'clicks', b'scroll\\ depth'})
+        self.assertEqual(window.max_series, 10)
+        self.assertEqual(window.tag, (b'proxy', b'3'))
+
+    @istest
+    def builds_with_defaults(self):
+        window = AggregationWindow.from_config(
+            'my_db', self.batcher, self.loop, {'aggregate': {}})
+
+        self.assertEqual(window.window, DEFAULT_WINDOW)
+        self.assertIsNone(window.measurements)
+        self.assertEqual(window.max_series, DEFAULT_MAX_SERIES)
+        self.assertIsNone(window.tag)
+
+    @istest
+    def aggregates_points_per_series(self):
+        with patch('influxproxy.aggregation.time.time', return_value=130.5):
+            remaining = self.aggregate(
+                b'clicks,page=a value=1i 1\n'
+                b'clicks,page=b value=5i 2\r\n'
+                b'# comment\n'
+                b'\n'
+                b'clicks,page=a value=2i,x=0.5 3\n', 3)
+
+        self.window.flush()
+
+        self.assertEqual(remaining, [])
+        self.assertEqual(self.written(), [
+            [b'clicks,page=a,worker=1 value_count=2i,value_sum=3i,'
+             b'value_min=1i,value_max=2i,value_last=2i,x_count=1i,'
+             b'x_sum=0.5,x_min=0.5,x_max=0.5,x_last=0.5', b'120000000000'],
+            [b'clicks,page=b,worker=1 value_count=1i,value_sum=5i,'
+             b'value_min=5i,value_max=5i,value_last=5i', b'120000000000'],
+        ])
+        self.assertEqual(self.batcher.add.call_args[0][3], 2)
+        self.metrics.count_points.assert_called_once_with(
+            'my_db', 'aggregated', 3)
+
+    @istest
+    def puts_worker_tag_in_order(self):
+        self.aggregate(b'clicks,a=1,zone=x value=1i\n', 1)
+
+        self.window.flush()
+
+        self.assertEqual(
+            self.written()[0][0].split(b' ')[0],
+            b'clicks,a=1,worker=1,zone=x')
+
+    @istest
+    def leaves_series_untagged_without_worker(self):
+        self.window.tag = None
+        self.aggregate(b'clicks,page=a value=1i\n', 1)
+
+        self.window.flush()
+
+        self.assertEqual(
+            self.written()[0][0].split(b' ')[0], b'clicks,page=a')
+
+    @istest
+    def replaces_tag_with_worker_tag_key(self):
+        self.aggregate(
+            b'clicks,page=a,worker=9 value=1i\n'
+            b'clicks,page=a value=2i\n', 2)
+
+        self.window.flush()
+
+        self.assertEqual(self.written(), [
+            [b'clicks,page=a,worker=1 value_count=2i,value_sum=3i,'
+             b'value_min=1i,value_max=2i,value_last=2i', ANY],
+        ])
+        self.assertEqual(self.batcher.add.call_args[0][3], 1)
+
+    @istest
+    def times_aggregates_in_database_precision(self):
+        with patch('influxproxy.aggregation.time.time', return_value=130.5):
+            self.aggregate(b'clicks value=1i\n', 1, {'precision': 's'})
+
+        self.window.flush()
+
+        self.assertEqual(self.written()[0][1], b'120')
+
+    @istest
+    def flushes_at_end_of_window(self):
+        with patch('influxproxy.aggregation.time.time', return_value=130.5), \
+                patch.object(self.loop, 'call_later') as call_later:
+            self.aggregate(b'clicks value=1i\n', 1)
+            self.aggregate(b'clicks value=1i\n', 1)
+
+        call_later.assert_called_once_with(49.5, self.window.flush)
+
+    @asynctest
+    async def starts_new_window_after_flush(self):
+        self.aggregate(b'clicks value=1i\n', 1)
+        timer = self.window._timer
+
+        self.window.flush()
+        self.window.flush()
+        self.aggregate(b'clicks value=2i\n', 1)
+
+        self.assertTrue(timer._cancelled)
+        self.assertEqual(self.batcher.add.call_count, 1)
+        self.assertEqual(list(self.window.series), [b'clicks'])
+
+    @istest
+    def passes_other_measurements_through(self):
+        self.window.measurements = {b'clicks'}
+        data = b'views value=1i\nviews value=2i\n'
+
+        remaining = self.aggregate(data, 2)
+
+        self.assertEqual(remaining, [(data, 2)])
+        self.assertEqual(self.window.series, {})
+        self.assertFalse(self.metrics.count_points.called)
+
+    @istest
+    def keeps_lines_left_out_of_chunk(self):
+        self.window.measurements = {b'clicks'}
+
+        remaining = self.aggregate(
+            b'views value=1i\nclicks value=1i\r\nviews value=2i\n', 3)
+
+        self.assertEqual(
+            remaining, [(b'views value=1i\nviews value=2i\n', 2)])
+
+    @istest
+    def passes_series_over_limit_through(self):
+        self.window.max_series = 1
+        self.aggregate(b'clicks,page=a value=1i\n', 1)
+
+        remaining = self.aggregate(
+            b'clicks,page=b value=1i\nclicks,page=a value=2i\n', 2)
+
+        self.assertEqual(remaining, [(b'clicks,page=b value=1i\n', 1)])
+        self.assertEqual(list(self.window.series), [b'clicks,page=a'])
+
+    @istest
+    def drops_aggregates_when_queue_is_full(self):
+        self.batcher.add.side_effect = QueueFullError('my_db', 1)
+        self.aggregate(b'clicks value=1i\n', 1)
+
+        with patch('influxproxy.aggregation.logger') as logger:
+            self.window.flush()
+
+        self.metrics.count_points.assert_called_with('my_db', 'dropped', 1)
+        self.assertTrue(logger.warning.called)
+        self.assertEqual(self.window.series, {})
+
+
+class AggregatorTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.batcher = MagicMock()
+        self.driver = MagicMock()
+        self.aggregator = Aggregator(self.loop, self.batcher, worker=2)
+        self.db_config = {'aggregate': {'window': 60}}
+
+    @istest
+    def leaves_other_databases_alone(self):
+        chunks = [(b'clicks value=1i\n', 1)]
+
+        lines, remaining = self.aggregator.split('my_db', chunks, {})
+        self.aggregator.add('my_db', self.driver, lines, {})
+
+        self.assertEqual(lines, [])
+        self.assertIs(remaining, chunks)
+        self.assertEqual(self.aggregator.windows, {})
+
+    @istest
+    def aggregates_in_a_window_per_database(self):
+        chunks = [(b'clicks value=1i\n', 1)]
+
+        lines, remaining = self.aggregator.split(
+            'my_db', chunks, self.db_config)
+        self.aggregator.add('my_db', self.driver, lines, self.db_config)
+        self.aggregator.flush()
+
+        window = self.aggregator.windows['my_db']
+        self.assertEqual(window.tag, (b'worker', b'2'))
+        self.assertEqual(remaining, [])
+        data = self.batcher.add.call_args[0][2]
+        self.assertTrue(data.startswith(b'clicks,worker=2 value_count=1i'))
+
+    @istest
+    def replaces_window_when_reload_changes_its_settings(self):
+        lines, _ = self.aggregator.split(
+            'my_db', [(b'clicks value=1i\n', 1)], self.db_config)
+        self.aggregator.add('my_db', self.driver, lines, self.db_config)
+        window = self.aggregator.windows['my_db']
+
+        self.aggregator.split('my_db', [], {'aggregate': {'window': 60}})
+        self.assertIs(self.aggregator.windows['my_db'], window)
+        self.assertFalse(self.batcher.add.called)
+        lines, remaining = self.aggregator.split(
+            'my_db', [(b'clicks value=2i\n', 1)],
+            {'aggregate': {'window': 10, 'measurements': ['other']}})
+
+        self.assertEqual(lines, [])
+        self.assertEqual(len(remaining), 1)
+        self.assertEqual(self.aggregator.windows['my_db'].window, 10)
+        data = self.batcher.add.call_args[0][2]
+        self.assertTrue(data.startswith(b'clicks,worker=2 value_count=1i'))
+
+    @istest
+    def drops_aggregates_without_metrics(self):
+        self.batcher.add.side_effect = QueueFullError('my_db', 1)
+        lines, _ = self.aggregator.split(
+            'my_db', [(b'clicks value=1i\n', 1)], self.db_config)
+        self.aggregator.add('my_db', self.driver, lines, self.db_config)
+
+        with patch('influxproxy.aggregation.logger') as logger:
+            self.aggregator.flush()
+
+        self.assertTrue(logger.warning.called)
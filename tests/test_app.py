@@ -1,13 +1,27 @@
+import asyncio
+import copy
+import gzip
 import json
+import logging
+import os
+import zlib
 from unittest.mock import patch
 
-from .base import AppTestCase, asynctest
-from influxproxy.configuration import config
-from influxproxy.drivers import MalformedDataError
+from .base import AppTestCase, AsyncMock, LoopTestCase, asynctest
+from .fakes import FakeInfluxHTTP
+import influxproxy.app
+from influxproxy import configuration, metrics
+from influxproxy.app import create_app
+from influxproxy.configuration import Settings, config
+from influxproxy.drivers import InfluxDriver
+from influxproxy.metrics import Layout, MetricsTable
+from influxproxy.ratelimit import RateLimiter
+from influxproxy.udp import DEFAULT_PAYLOAD_SIZE
 
 
 DB_USER = 'testing'
 DB_CONF = config['databases'][DB_USER]
+STRICT_CONF = config['databases']['strict']
 
 
 class PingTest(AppTestCase):
@@ -46,7 +60,7 @@ class PreflightTest(AppTestCase):
         self.assert_control(response, 'Allow-Origin', DB_CONF['allow_from'][0])
         self.assert_control(response, 'Allow-Methods', 'POST')
         self.assert_control(
-            response, 'Allow-Headers', 'Content-Type')
+            response, 'Allow-Headers', 'Content-Type, Content-Encoding')
         self.assert_control(
             response, 'Max-Age', str(config['preflight_expiration']))
 
@@ -62,7 +76,17 @@ class PreflightTest(AppTestCase):
         self.assert_control(response, 'Allow-Origin', '*')
         self.assert_control(response, 'Allow-Methods', 'POST')
         self.assert_control(
-            response, 'Allow-Headers', 'Content-Type')
+            response, 'Allow-Headers', 'Content-Type, Content-Encoding')
+        self.assert_control(
+            response, 'Max-Age', str(config['preflight_expiration']))
+
+    @asynctest
+    async def sends_a_metric_preflight_to_origin_pattern(self):
+        origin = 'https://app.example.com'
+        response = await self.do_preflight(headers={'Origin': origin})
+
+        self.assertEqual(response.status, 200)
+        self.assert_control(response, 'Allow-Origin', origin)
         self.assert_control(
             response, 'Max-Age', str(config['preflight_expiration']))
 
@@ -120,13 +144,28 @@ class MetricPostTest(AppTestCase):
         super().setUp()
 
         self.origin = DB_CONF['allow_from'][0]
-        self.points = ['point1', 'point2']
+        self.points = [
+            {
+                'measurement': 'my_metrics',
+                'time': '2016-09-01T12:00:00Z',
+                'fields': {'value': 1234},
+            },
+            {
+                'measurement': 'my_metrics',
+                'time': '2016-09-01T12:00:01Z',
+                'fields': {'value': 2345},
+            },
+        ]
         self.data = json.dumps(self.points).encode('utf-8')
+        self.lines = (
+            b'my_metrics value=1234i 1472731200000000000\n'
+            b'my_metrics value=2345i 1472731201000000000\n')
         self.headers = {
             'Content-Type': 'application/json',
             'Origin': self.origin,
         }
         self.set_auth(DB_USER, DB_CONF['public_key'])
+        self.query = ''
 
     def set_auth(self, user, public_key):
         self.user = user
@@ -137,92 +176,910 @@ class MetricPostTest(AppTestCase):
         self.headers['Origin'] = origin
 
     async def send_metric(self, headers=None):
-        url = '/metric/{}/{}'.format(self.user, self.public_key)
+        url = '/metric/{}/{}{}'.format(self.user, self.public_key, self.query)
 
         return await self.client.post(
             url, data=self.data, headers=self.headers)
 
+    async def assert_counted(self, *lines):
+        with patch.dict(config, {'admin_token': 'secret'}):
+            response = await self.client.get(
+                '/metrics', headers={'Authorization': 'Bearer secret'})
+        rendered = (await response.text()).splitlines()
+        for line in lines:
+            self.assertIn(line, rendered)
+
+    def patch_backend(self):
+        return patch.object(
+            InfluxDriver, 'write_lines', new_callable=AsyncMock)
+
+    def backend_address(self, database):
+        udp_port = config['databases'][database]['udp_port']
+        return (
+            'udp', config['backend']['host'], udp_port, DEFAULT_PAYLOAD_SIZE,
+            None)
+
     @asynctest
     async def sends_metric_to_driver(self):
-        with patch('influxproxy.app.InfluxDriver') as MockDriver:
-            driver = MockDriver.return_value
-
+        with self.patch_backend() as write_lines:
             response = await self.send_metric()
+            await self.app['batcher'].drain()
 
             self.assertEqual(response.status, 204)
             self.assert_control(response, 'Allow-Origin', self.origin)
-            MockDriver.assert_called_once_with(udp_port=DB_CONF['udp_port'])
-            driver.write.assert_called_once_with(DB_USER, self.points)
+            self.assertEqual(
+                list(self.app['drivers'].drivers),
+                [self.backend_address(DB_USER)])
+            write_lines.assert_called_once_with(DB_USER, [self.lines])
+
+    @asynctest
+    async def sends_metric_to_database_added_by_reload(self):
+        reloaded = copy.deepcopy(config)
+        reloaded['databases']['added'] = dict(DB_CONF, public_key='new-key')
+        self.set_auth('added', 'new-key')
+
+        with self.patch_backend() as write_lines, patch.object(
+                configuration, 'settings', Settings.compile(reloaded)):
+            response = await self.send_metric()
+            await self.app['batcher'].drain()
+
+        self.assertEqual(response.status, 204)
+        write_lines.assert_called_once_with('added', [self.lines])
+
+    @asynctest
+    async def sends_metric_to_backend_set_by_reload(self):
+        backends = [FakeInfluxHTTP(self.loop), FakeInfluxHTTP(self.loop)]
+        for backend in backends:
+            await backend.start()
+
+        for backend, batch_size in zip(backends, [10, 1]):
+            reloaded = copy.deepcopy(config)
+            reloaded['backend']['port'] = backend.port
+            reloaded['databases'][DB_USER].update(
+                transport='http', batch_size=batch_size)
+            with patch.object(
+                    configuration, 'settings', Settings.compile(reloaded)):
+                response = await self.send_metric()
+                self.assertEqual(response.status, 204)
+        await self.app['batcher'].drain()
+        for backend in backends:
+            await backend.stop()
+
+        for backend in backends:
+            self.assertEqual(backend.lines, [
+                b'my_metrics value=1234i 1472731200',
+                b'my_metrics value=2345i 1472731201'])
+        self.assertEqual(self.app['batcher'].buffers[DB_USER].max_points, 1)
 
     @asynctest
     async def sends_metric_to_generic_database(self):
-        with patch('influxproxy.app.InfluxDriver') as MockDriver:
+        with self.patch_backend() as write_lines:
             self.user = 'udp'
             self.public_key = config['databases']['udp']['public_key']
             origin = 'http://some-unregistered-website.com'
             self.headers['Origin'] = origin
-            driver = MockDriver.return_value
 
             response = await self.send_metric()
+            await self.app['batcher'].drain()
 
             self.assertEqual(response.status, 204)
             self.assert_control(response, 'Allow-Origin', '*')
-            MockDriver.assert_called_once_with(
-                udp_port=config['databases']['udp']['udp_port'])
-            driver.write.assert_called_once_with(self.user, self.points)
+            self.assertEqual(
+                list(self.app['drivers'].drivers),
+                [self.backend_address('udp')])
+            write_lines.assert_called_once_with(self.user, [self.lines])
+
+    @asynctest
+    async def sends_single_point(self):
+        with self.patch_backend() as write_lines:
+            self.data = json.dumps(self.points[0]).encode('utf-8')
+
+            response = await self.send_metric()
+            await self.app['batcher'].drain()
+
+            self.assertEqual(response.status, 204)
+            write_lines.assert_called_once_with(
+                DB_USER, [self.lines.split(b'\n')[0] + b'\n'])
+
+    @asynctest
+    async def responds_before_points_are_written(self):
+        with self.patch_backend() as write_lines:
+            response = await self.send_metric()
+
+            self.assertEqual(response.status, 204)
+            self.assertFalse(write_lines.called)
+
+    @asynctest
+    async def reuses_driver_between_requests(self):
+        with self.patch_backend() as write_lines:
+            await self.send_metric()
+            driver = self.app['drivers'].drivers[self.backend_address(DB_USER)]
+            response = await self.send_metric()
+            await self.app['batcher'].drain()
+
+            self.assertEqual(response.status, 204)
+            self.assertEqual(len(self.app['drivers'].drivers), 1)
+            self.assertIs(
+                self.app['drivers'].drivers[self.backend_address(DB_USER)],
+                driver)
+            write_lines.assert_called_once_with(
+                DB_USER, [self.lines, self.lines])
+
+    @asynctest
+    async def drains_batches_and_closes_drivers_on_shutdown(self):
+        with self.patch_backend() as write_lines:
+            await self.send_metric()
+            endpoint = self.app['drivers'].drivers[
+                self.backend_address(DB_USER)].writer.endpoint
+
+            await self.app.shutdown()
+
+            write_lines.assert_called_once_with(DB_USER, [self.lines])
+            self.assertTrue(endpoint.transport.is_closing())
+            self.assertEqual(self.app['drivers'].drivers, {})
+
+    @asynctest
+    async def merges_duplicate_points_of_opted_in_database(self):
+        with self.patch_backend() as write_lines, \
+                patch.dict(DB_CONF, {'dedup': True}):
+            await self.send_metric()
+            await self.send_metric()
+            await self.app['batcher'].drain()
+
+        write_lines.assert_called_once_with(DB_USER, [self.lines])
+        await self.assert_counted(
+            'influxproxy_points_total{database="testing",'
+            'outcome="deduplicated"} 2')
+
+    @asynctest
+    async def aggregates_points_of_opted_in_database(self):
+        with self.patch_backend() as write_lines, \
+                patch.dict(DB_CONF, {'aggregate': {'window': 60}}):
+            response = await self.send_metric()
+            await self.app.shutdown()
+
+        self.assertEqual(response.status, 204)
+        (database, [data]), _ = write_lines.call_args
+        self.assertTrue(data.startswith(
+            b'my_metrics,worker=0 value_count=2i,value_sum=3579i,'
+            b'value_min=1234i,value_max=2345i,value_last=2345i '))
+        await self.assert_counted(
+            'influxproxy_points_total{database="testing",'
+            'outcome="aggregated"} 2')
+
+    @asynctest
+    async def guards_cardinality_of_opted_in_database(self):
+        self.headers['Content-Type'] = 'text/plain'
+        self.data = b'page,url=/a load=1i\npage,url=/b load=1i\n'
+
+        with self.patch_backend() as write_lines, \
+                patch.dict(DB_CONF, {'cardinality': {
+                    'max_tag_values': 1, 'precision': 16}}):
+            response = await self.send_metric()
+            await self.app['batcher'].drain()
+
+        self.assertEqual(response.status, 204)
+        write_lines.assert_called_once_with(
+            DB_USER, [b'page,url=/a load=1i\n'])
+        await self.assert_counted(
+            'influxproxy_points_total{database="testing",'
+            'outcome="accepted"} 1',
+            'influxproxy_points_total{database="testing",'
+            'outcome="over_cardinality"} 1')
+
+    @asynctest
+    async def aggregates_nothing_from_refused_request(self):
+        self.data = self.lines + b'other value=1i\n'
+        self.headers['Content-Type'] = 'text/plain'
+
+        with self.patch_backend(), \
+                patch.dict(DB_CONF, {'aggregate': {
+                    'measurements': ['my_metrics']}}), \
+                patch.object(self.app['batcher'], 'max_pending_bytes', 0):
+            response = await self.send_metric()
+
+        self.assertEqual(response.status, 503)
+        self.assertEqual(self.app['aggregator'].windows['testing'].series, {})
+
+    @asynctest
+    async def gives_up_draining_after_timeout(self):
+        async def write_lines(*args):
+            await asyncio.sleep(1, loop=self.loop)
+
+        with patch.object(InfluxDriver, 'write_lines', write_lines), \
+                patch.dict(config, {'drain_timeout': 0.01}), \
+                patch('influxproxy.app.logger') as logger:
+            await self.send_metric()
+
+            await self.app.shutdown()
+
+            self.assertTrue(logger.warning.called)
+
+    @asynctest
+    async def sends_metric_through_http(self):
+        backend = FakeInfluxHTTP(self.loop)
+        await backend.start()
+        http_conf = {'transport': 'http', 'precision': 's', 'gzip': True}
+
+        with patch.dict(config['backend'], {'port': backend.port}), \
+                patch.dict(DB_CONF, http_conf):
+            response = await self.send_metric()
+            await self.app['batcher'].drain()
+        await backend.stop()
+
+        self.assertEqual(response.status, 204)
+        self.assertEqual(backend.lines, [
+            b'my_metrics value=1234i 1472731200',
+            b'my_metrics value=2345i 1472731201',
+        ])
+
+    @asynctest
+    async def sends_through_http_in_coarsest_precision(self):
+        backend = FakeInfluxHTTP(self.loop)
+        await backend.start()
+
+        with patch.dict(config['backend'], {'port': backend.port}), \
+                patch.dict(DB_CONF, {'transport': 'http'}):
+            await self.send_metric()
+            self.query = '?precision=ms'
+            self.headers['Content-Type'] = 'text/plain'
+            self.data = b'my_metrics value=1i 1472731202000\n'
+            await self.send_metric()
+            await self.app['batcher'].drain()
+        await backend.stop()
+
+        self.assertEqual(
+            [request.GET['precision'] for request, _ in backend.requests],
+            ['s', 'ms'])
+        self.assertEqual(backend.lines, [
+            b'my_metrics value=1234i 1472731200',
+            b'my_metrics value=2345i 1472731201',
+            b'my_metrics value=1i 1472731202000',
+        ])
+
+    @asynctest
+    async def sends_line_protocol_as_is(self):
+        with self.patch_backend() as write_lines:
+            self.headers['Content-Type'] = 'text/plain; charset=utf-8'
+            self.data = self.lines
+
+            response = await self.send_metric()
+            await self.app['batcher'].drain()
+
+            self.assertEqual(response.status, 204)
+            write_lines.assert_called_once_with(DB_USER, [self.lines])
+
+    @asynctest
+    async def terminates_last_line_protocol_line(self):
+        with self.patch_backend() as write_lines:
+            self.headers['Content-Type'] = 'text/plain'
+            self.data = self.lines.rstrip(b'\n')
+
+            response = await self.send_metric()
+            await self.app['batcher'].drain()
+
+            self.assertEqual(response.status, 204)
+            write_lines.assert_called_once_with(DB_USER, [self.lines])
+
+    @asynctest
+    async def sends_crlf_line_protocol_without_carriage_returns(self):
+        with self.patch_backend() as write_lines:
+            self.headers['Content-Type'] = 'text/plain'
+            self.data = self.lines.replace(b'\n', b'\r\n')
+
+            response = await self.send_metric()
+            await self.app['batcher'].drain()
+
+            self.assertEqual(response.status, 204)
+            write_lines.assert_called_once_with(DB_USER, [self.lines])
+
+    @asynctest
+    async def ignores_empty_line_protocol(self):
+        with self.patch_backend() as write_lines:
+            self.headers['Content-Type'] = 'text/plain'
+            self.data = b'# nothing to see\n'
+
+            response = await self.send_metric()
+            await self.app['batcher'].drain()
+
+            self.assertEqual(response.status, 204)
+            self.assertFalse(write_lines.called)
+
+    @asynctest
+    async def cant_send_invalid_line_protocol(self):
+        with self.patch_backend() as write_lines:
+            self.headers['Content-Type'] = 'text/plain'
+            self.data = b'my_metrics value=\n'
+
+            response = await self.send_metric()
+            await self.app['batcher'].drain()
+
+            self.assertEqual(response.status, 400)
+            self.assertFalse(write_lines.called)
+
+    @asynctest
+    async def reads_integer_times_in_given_precision(self):
+        self.query = '?precision=ms'
+        times = (1472731200000, 1472731201000)
+        for point, timestamp in zip(self.points, times):
+            point['time'] = timestamp
+        self.data = json.dumps(self.points).encode('utf-8')
+
+        with self.patch_backend() as write_lines:
+            response = await self.send_metric()
+            await self.app['batcher'].drain()
+
+        self.assertEqual(response.status, 204)
+        write_lines.assert_called_once_with(DB_USER, [self.lines])
+
+    @asynctest
+    async def cant_send_unknown_precision(self):
+        self.query = '?precision=h'
+
+        with self.patch_backend() as write_lines:
+            response = await self.send_metric()
+
+        self.assertEqual(response.status, 400)
+        self.assertFalse(write_lines.called)
+
+    @asynctest
+    async def stamps_points_without_time_with_server_time(self):
+        for point in self.points:
+            del point['time']
+        self.data = json.dumps(self.points).encode('utf-8')
+
+        with self.patch_backend() as write_lines, \
+                patch.dict(DB_CONF, {'stamp_time': True}), \
+                patch('influxproxy.app.time.time', return_value=1472731200.0):
+            response = await self.send_metric()
+            await self.app['batcher'].drain()
+
+        self.assertEqual(response.status, 204)
+        write_lines.assert_called_once_with(DB_USER, [
+            b'my_metrics value=1234i 1472731200000000000\n'
+            b'my_metrics value=2345i 1472731200000000000\n'])
+
+    @asynctest
+    async def rescales_line_protocol_times_to_database_precision(self):
+        self.query = '?precision=s'
+        self.headers['Content-Type'] = 'text/plain'
+        self.data = (
+            b'my_metrics value=1234i 1472731200\n'
+            b'my_metrics value=2345i 1472731201\n')
+
+        with self.patch_backend() as write_lines:
+            response = await self.send_metric()
+            await self.app['batcher'].drain()
+
+        self.assertEqual(response.status, 204)
+        write_lines.assert_called_once_with(DB_USER, [self.lines])
+
+    @asynctest
+    async def keeps_line_protocol_in_database_precision(self):
+        self.query = '?precision=s'
+        self.headers['Content-Type'] = 'text/plain'
+        self.data = b'my_metrics value=1234i 1472731200\n'
+
+        with self.patch_backend() as write_lines, \
+                patch.dict(DB_CONF, {'precision': 's'}):
+            await self.send_metric()
+            await self.app['batcher'].drain()
+
+        write_lines.assert_called_once_with(DB_USER, [self.data])
+
+    @asynctest
+    async def sends_ndjson_in_given_precision(self):
+        self.query = '?precision=s'
+        self.headers['Content-Type'] = 'application/x-ndjson'
+        self.data = (
+            b'{"measurement": "my_metrics", "time": 1472731200, '
+            b'"fields": {"value": 1234}}\n')
+
+        with self.patch_backend() as write_lines:
+            await self.send_metric()
+            await self.app['batcher'].drain()
+
+        write_lines.assert_called_once_with(
+            DB_USER, [self.lines.split(b'\n')[0] + b'\n'])
+
+    @asynctest
+    async def sends_ndjson(self):
+        with self.patch_backend() as write_lines:
+            self.headers['Content-Type'] = 'application/x-ndjson'
+            self.data = b''.join(
+                json.dumps(point).encode('utf-8') + b'\n'
+                for point in self.points)
+
+            response = await self.send_metric()
+            await self.app['batcher'].drain()
+
+            self.assertEqual(response.status, 204)
+            write_lines.assert_called_once_with(DB_USER, [self.lines])
+
+    @asynctest
+    async def sends_gzipped_json(self):
+        self.headers['Content-Encoding'] = 'gzip'
+        self.data = gzip.compress(self.data)
+
+        with self.patch_backend() as write_lines:
+            response = await self.send_metric()
+            await self.app['batcher'].drain()
+
+        self.assertEqual(response.status, 204)
+        write_lines.assert_called_once_with(DB_USER, [self.lines])
+
+    @asynctest
+    async def sends_deflated_ndjson(self):
+        self.headers['Content-Type'] = 'application/x-ndjson'
+        self.headers['Content-Encoding'] = 'deflate'
+        self.data = zlib.compress(b''.join(
+            json.dumps(point).encode('utf-8') + b'\n'
+            for point in self.points))
+
+        with self.patch_backend() as write_lines:
+            response = await self.send_metric()
+            await self.app['batcher'].drain()
+
+        self.assertEqual(response.status, 204)
+        write_lines.assert_called_once_with(DB_USER, [self.lines])
+
+    @asynctest
+    async def cant_send_body_inflating_past_database_limit(self):
+        self.headers['Content-Encoding'] = 'gzip'
+        self.data = gzip.compress(b' ' * 100000 + self.data)
+
+        with self.patch_backend() as write_lines, \
+                patch.dict(DB_CONF, {'max_body_size': 1000}):
+            response = await self.send_metric()
+
+        self.assertEqual(response.status, 413)
+        self.assertFalse(write_lines.called)
+        await self.assert_counted(
+            'influxproxy_rejected_requests_total'
+            '{database="testing",reason="too_large"} 1')
+
+    @asynctest
+    async def cant_send_invalid_ndjson(self):
+        with self.patch_backend() as write_lines:
+            self.headers['Content-Type'] = 'application/x-ndjson'
+            self.data = b'{"measurement": \n'
+
+            response = await self.send_metric()
+            await self.app['batcher'].drain()
+
+            self.assertEqual(response.status, 400)
+            self.assertFalse(write_lines.called)
+
+    @asynctest
+    async def cant_send_invalid_json(self):
+        with self.patch_backend() as write_lines:
+            self.data = b'{"measurement": '
+
+            response = await self.send_metric()
+
+            self.assertEqual(response.status, 400)
+            self.assertFalse(write_lines.called)
+
+    @asynctest
+    async def checks_points_against_database_schema(self):
+        with self.patch_backend() as write_lines:
+            self.set_auth('strict', STRICT_CONF['public_key'])
+            self.data = json.dumps({
+                'measurement': 'page_load',
+                'time': 1,
+                'fields': {'duration': 12},
+            }).encode('utf-8')
+
+            response = await self.send_metric()
+            await self.app['batcher'].drain()
+
+            self.assertEqual(response.status, 204)
+            write_lines.assert_called_once_with(
+                'strict', [b'page_load duration=12.0 1\n'])
+
+    @asynctest
+    async def cant_send_points_outside_database_schema(self):
+        with self.patch_backend() as write_lines:
+            self.set_auth('strict', STRICT_CONF['public_key'])
+
+            response = await self.send_metric()
+
+            self.assertEqual(response.status, 400)
+            self.assertFalse(write_lines.called)
+
+    @asynctest
+    async def cant_send_lines_outside_database_schema(self):
+        with self.patch_backend() as write_lines:
+            self.set_auth('strict', STRICT_CONF['public_key'])
+            self.headers['Content-Type'] = 'text/plain'
+            self.data = b'page_load duration=1i\n'
+
+            response = await self.send_metric()
+
+            self.assertEqual(response.status, 400)
+            self.assertFalse(write_lines.called)
+
+    @asynctest
+    async def sheds_load_when_backend_is_slow(self):
+        backend = FakeInfluxHTTP(self.loop, delay=0.2)
+        await backend.start()
+        slow_conf = {
+            'transport': 'http',
+            'batch_size': 2,
+            'max_writes': 1,
+            'queue_points': 4,
+            'retry_after': 2,
+        }
+
+        with patch.dict(config['backend'], {'port': backend.port}), \
+                patch.dict(DB_CONF, slow_conf):
+            responses = [await self.send_metric() for _ in range(3)]
+            await self.app['batcher'].drain()
+        await backend.stop()
+
+        self.assertEqual(
+            [response.status for response in responses], [204, 204, 429])
+        self.assertEqual(responses[2].headers['Retry-After'], '2')
+        self.assert_control(responses[2], 'Allow-Origin', self.origin)
+        self.assertEqual(len(backend.lines), 4)
+        await self.assert_counted(
+            'influxproxy_points_total'
+            '{database="testing",outcome="accepted"} 4',
+            'influxproxy_points_total'
+            '{database="testing",outcome="queue_full"} 2',
+            'influxproxy_rejected_requests_total'
+            '{database="testing",reason="queue_full"} 1',
+            'influxproxy_backend_write_duration_seconds_count'
+            '{database="testing"} 2',
+        )
+
+    @asynctest
+    async def sheds_load_when_proxy_is_overloaded(self):
+        with self.patch_backend() as write_lines:
+            self.app['batcher'].max_pending_bytes = 10
+
+            response = await self.send_metric()
+
+            self.assertEqual(response.status, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+            self.assertFalse(write_lines.called)
+            await self.assert_counted(
+                'influxproxy_points_total'
+                '{database="testing",outcome="overloaded"} 2')
+
+    @asynctest
+    async def limits_request_rate(self):
+        with self.patch_backend():
+            self.app['rate_limiter'] = RateLimiter(
+                [(DB_USER, 'requests', 1, 1)])
+
+            responses = [await self.send_metric() for _ in range(2)]
+
+            self.assertEqual(
+                [response.status for response in responses], [204, 429])
+            self.assertEqual(responses[1].headers['Retry-After'], '1')
+            await self.assert_counted(
+                'influxproxy_rejected_requests_total'
+                '{database="testing",reason="rate_limited"} 1',
+                'influxproxy_points_total'
+                '{database="testing",outcome="rate_limited"} 0')
+
+    @asynctest
+    async def limits_point_rate(self):
+        with self.patch_backend():
+            self.app['rate_limiter'] = RateLimiter(
+                [(DB_USER, 'points', 3, 1)])
+
+            responses = [await self.send_metric() for _ in range(2)]
+
+            self.assertEqual(
+                [response.status for response in responses], [204, 429])
+            self.assert_control(responses[1], 'Allow-Origin', self.origin)
+            await self.assert_counted(
+                'influxproxy_points_total'
+                '{database="testing",outcome="rate_limited"} 2')
 
     @asynctest
     async def cant_send_metric_if_wrong_public_key(self):
-        with patch('influxproxy.app.InfluxDriver') as MockDriver:
+        with self.patch_backend() as write_lines:
             self.set_auth(DB_USER, 'bogus-key')
-            driver = MockDriver.return_value
 
             response = await self.send_metric()
 
             self.assertEqual(response.status, 401)
-            self.assertFalse(driver.write.called)
+            self.assertFalse(write_lines.called)
+            await self.assert_counted(
+                'influxproxy_rejected_requests_total'
+                '{database="testing",reason="unauthorized"} 1')
+
+    @asynctest
+    async def sends_metric_from_origin_pattern(self):
+        with self.patch_backend():
+            self.set_origin('https://app.example.com')
+
+            response = await self.send_metric()
+
+            self.assertEqual(response.status, 204)
+            self.assert_control(response, 'Allow-Origin', self.origin)
 
     @asynctest
     async def cant_send_metric_if_wrong_origin(self):
-        with patch('influxproxy.app.InfluxDriver') as MockDriver:
+        with self.patch_backend() as write_lines:
             self.set_origin('bogus-origin')
-            driver = MockDriver.return_value
 
             response = await self.send_metric()
 
             self.assertEqual(response.status, 403)
-            self.assertFalse(driver.write.called)
+            self.assertFalse(write_lines.called)
+            await self.assert_counted(
+                'influxproxy_rejected_requests_total'
+                '{database="testing",reason="forbidden"} 1')
 
     @asynctest
     async def cant_send_metric_if_database_not_found(self):
-        with patch('influxproxy.app.InfluxDriver') as MockDriver:
+        with self.patch_backend() as write_lines:
             self.set_auth('bogus-db', DB_CONF['public_key'])
-            driver = MockDriver.return_value
 
             response = await self.send_metric()
 
             self.assertEqual(response.status, 401)
-            self.assertFalse(driver.write.called)
+            self.assertFalse(write_lines.called)
+            await self.assert_counted(
+                'influxproxy_rejected_requests_total'
+                '{database="other",reason="unauthorized"} 1')
 
     @asynctest
     async def cant_send_metric_if_bad_metric_format(self):
-        with patch('influxproxy.app.InfluxDriver') as MockDriver:
-            driver = MockDriver.return_value
-            driver.write.side_effect = MalformedDataError('oops...')
+        with self.patch_backend() as write_lines:
+            del self.points[1]['measurement']
+            self.data = json.dumps(self.points).encode('utf-8')
+
+            response = await self.send_metric()
+            await self.app['batcher'].drain()
+
+            self.assertEqual(response.status, 400)
+            self.assertFalse(write_lines.called)
+            await self.assert_counted(
+                'influxproxy_rejected_requests_total'
+                '{database="testing",reason="malformed"} 1')
+
+    @asynctest
+    async def cant_send_metric_if_field_cant_be_encoded(self):
+        with self.patch_backend() as write_lines:
+            self.points[1]['fields']['value'] = [1, 2]
+            self.data = json.dumps(self.points).encode('utf-8')
 
             response = await self.send_metric()
+            await self.app['batcher'].drain()
 
             self.assertEqual(response.status, 400)
+            self.assertFalse(write_lines.called)
 
     @asynctest
     async def cant_send_metric_if_backend_fails(self):
-        with patch('influxproxy.app.InfluxDriver') as MockDriver:
-            driver = MockDriver.return_value
-            driver.write.side_effect = RuntimeError('oops...')
+        with patch.object(self.app['drivers'], 'get') as get:
+            get.side_effect = RuntimeError('oops...')
 
             response = await self.send_metric()
 
             self.assertEqual(response.status, 500)
+            await self.assert_counted(
+                'influxproxy_rejected_requests_total'
+                '{database="testing",reason="error"} 1')
+
+
+class LogRequestsTest(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        for patcher in (
+                patch('influxproxy.app.logger'),
+                patch.object(
+                    InfluxDriver, 'write_lines', new_callable=AsyncMock)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.logger = influxproxy.app.logger
+
+    def sample(self, **rates):
+        return patch.dict(config, {'logging': {'sample_rates': rates}})
+
+    async def send_metric(self):
+        return await self.client.post(
+            '/metric/{}/{}'.format(DB_USER, DB_CONF['public_key']),
+            data=b'[{"measurement": "cpu", "time": "2016-09-01T12:00:00Z", '
+                 b'"fields": {"value": 1}}]',
+            headers={
+                'Content-Type': 'application/json',
+                'Origin': DB_CONF['allow_from'][0],
+            })
+
+    @asynctest
+    async def logs_requests_with_their_id_and_database(self):
+        response = await self.send_metric()
+
+        self.assertEqual(response.status, 204)
+        level, message, method, route, status = self.logger.log.call_args[0]
+        extra = self.logger.log.call_args[1]['extra']
+        self.assertEqual(
+            (level, method, route, status),
+            (logging.INFO, 'POST', 'send_metric', 204))
+        self.assertEqual(len(extra['request_id']), 32)
+        self.assertEqual(extra['database'], DB_USER)
+        self.assertEqual(extra['route'], 'send_metric')
+        self.assertEqual(extra['status'], 204)
+
+    @asynctest
+    async def logs_unnamed_routes_by_path(self):
+        response = await self.client.get('/nowhere')
+
+        self.assertEqual(response.status, 404)
+        self.assertEqual(
+            self.logger.log.call_args[0][1:],
+            ('%s %s %d', 'GET', '/nowhere', 404))
+        self.assertEqual(self.logger.log.call_args[0][0], logging.WARNING)
+
+    @asynctest
+    async def leaves_out_requests_sampled_out(self):
+        with self.sample(send_metric=0):
+            response = await self.send_metric()
+
+        self.assertEqual(response.status, 204)
+        self.assertFalse(self.logger.log.called)
+
+    @asynctest
+    async def logs_failures_whatever_the_rate(self):
+        with self.sample(send_metric=0), \
+                patch.object(self.app['drivers'], 'get') as get:
+            get.side_effect = RuntimeError('oops...')
+
+            response = await self.send_metric()
+
+        self.assertEqual(response.status, 500)
+        request_id = self.logger.log.call_args[1]['extra']['request_id']
+        self.assertEqual(self.logger.log.call_args[0][0], logging.ERROR)
+        self.assertEqual(
+            self.logger.exception.call_args[1]['extra'],
+            {'request_id': request_id, 'database': DB_USER})
+        self.assertIn(request_id, response.reason)
+
+
+class SpillDirectoryTest(LoopTestCase):
+    @asynctest
+    async def spills_in_a_directory_per_worker(self):
+        with patch.dict(config, {'spill_directory': '/var/spill'}):
+            app = create_app(self.loop)
+        await app.shutdown()
+
+        self.assertEqual(
+            app['batcher'].spill_directory,
+            os.path.join('/var/spill', str(app['metrics'].slot)))
+
+    @asynctest
+    async def doesnt_spill_without_a_metrics_slot(self):
+        shared = MetricsTable(Layout(config['databases']), 1)
+        with patch.dict(config, {'spill_directory': '/var/spill'}), \
+                patch.object(metrics, '_table', shared), \
+                patch('influxproxy.app.logger') as logger:
+            app = create_app(self.loop)
+        await app.shutdown()
+
+        self.assertIsNone(app['batcher'].spill_directory)
+        logger.warning.assert_called_once_with(
+            'No free metrics slot, not spilling to disk')
+
+
+class MetricsTest(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = patch.dict(config, {'admin_token': 'secret'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @asynctest
+    async def exposes_metrics_in_prometheus_format(self):
+        preflight = await self.client.options(
+            '/metric/{}/{}'.format(DB_USER, DB_CONF['public_key']),
+            headers={
+                'Origin': 'bogus-origin',
+                'Access-Control-Request-Method': 'POST',
+            })
+        self.assertEqual(preflight.status, 403)
+
+        response = await self.client.get(
+            '/metrics', headers={'Authorization': 'Bearer secret'})
+        content = await response.text()
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(
+            response.headers['Content-Type'],
+            'text/plain; version=0.0.4; charset=utf-8')
+        self.assertIn('# TYPE influxproxy_points_total counter', content)
+        self.assertIn(
+            'influxproxy_rejected_requests_total'
+            '{database="testing",reason="forbidden"} 1', content)
+        self.assertIn(
+            'influxproxy_request_duration_seconds_count'
+            '{route="preflight_metric",database="testing"} 1', content)
+        self.assertIn(
+            'influxproxy_request_duration_seconds_count'
+            '{route="send_metric",database="testing"} 0', content)
+
+    @asynctest
+    async def cannot_show_metrics_without_admin_token(self):
+        for headers in [{}, {'Authorization': 'Bearer wrong'}]:
+            response = await self.client.get('/metrics', headers=headers)
+
+            self.assertEqual(response.status, 401)
+            self.assertEqual(response.headers['WWW-Authenticate'], 'Bearer')
+
+    @asynctest
+    async def cannot_show_metrics_unless_admin_token_configured(self):
+        with patch.dict(config, {'admin_token': None}):
+            response = await self.client.get(
+                '/metrics', headers={'Authorization': 'Bearer None'})
+
+        self.assertEqual(response.status, 404)
+
+
+class CardinalityTest(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app['cardinality'].check(
+            DB_USER, [(b'page,url=/a load=1i\n', 1)],
+            {'cardinality': {'max_series': 10}})
+        patcher = patch.dict(config, {'admin_token': 'secret'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.headers = {'Authorization': 'Bearer secret'}
+
+    @asynctest
+    async def lists_estimates_of_every_guarded_database(self):
+        response = await self.client.get(
+            '/admin/cardinality', headers=self.headers)
+        content = await response.json()
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(list(content), [DB_USER])
+        self.assertEqual(content[DB_USER]['max_series'], 10)
+        self.assertEqual(content[DB_USER]['measurements'], {
+            'page': {
+                'series': 1,
+                'tags': {'url': {'values': 1, 'limited': False}},
+            },
+        })
+
+    @asynctest
+    async def shows_estimates_of_one_database(self):
+        response = await self.client.get(
+            '/admin/cardinality/{}'.format(DB_USER), headers=self.headers)
+        content = await response.json()
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(content['action'], 'reject')
+
+    @asynctest
+    async def cannot_show_estimates_of_unguarded_database(self):
+        response = await self.client.get(
+            '/admin/cardinality/strict', headers=self.headers)
+
+        self.assertEqual(response.status, 404)
+
+    @asynctest
+    async def cannot_show_estimates_without_admin_token(self):
+        for headers in ({}, {'Authorization': 'Bearer wrong'}):
+            response = await self.client.get(
+                '/admin/cardinality', headers=headers)
+
+            self.assertEqual(response.status, 401)
+            self.assertEqual(response.headers['WWW-Authenticate'], 'Bearer')
+
+    @asynctest
+    async def cannot_show_estimates_unless_admin_token_configured(self):
+        del config['admin_token']
+
+        response = await self.client.get(
+            '/admin/cardinality', headers=self.headers)
+
+        self.assertEqual(response.status, 404)
 
 
 class ManualTest(AppTestCase):
@@ -0,0 +1,684 @@
+import asyncio
+import os
+from unittest.mock import MagicMock, call, patch
+
+from nose.tools import istest
+
+from .base import AsyncMock, LoopTestCase, asynctest
+from influxproxy.batching import (
+    DEFAULT_BATCH_BYTES,
+    DEFAULT_BATCH_LINGER,
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_MAX_WRITES,
+    DEFAULT_QUEUE_BYTES,
+    DEFAULT_QUEUE_POINTS,
+    DEFAULT_RETRY_AFTER,
+    DROP_OLDEST,
+    REJECT_NEWEST,
+    BatchBuffer,
+    Batcher,
+    QueueFullError,
+    ShardedBuffer,
+)
+from influxproxy.cluster import ClusterDriver
+from influxproxy.dedup import Deduplicator
+from influxproxy.spill import (
+    DEFAULT_REPLAY_RATE,
+    DEFAULT_REPLAY_RETRY,
+    DEFAULT_SEGMENT_BYTES,
+    DEFAULT_SPILL_BYTES,
+    SpillQueue,
+)
+from .test_spill import temporary_directory
+
+
+class BatchBufferTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.driver = AsyncMock()
+        self.buffer = BatchBuffer(
+            'my_db', self.driver, self.loop,
+            max_points=3, max_bytes=100, linger=0.01)
+
+    @istest
+    def builds_from_database_config(self):
+        buffer = BatchBuffer.from_config('my_db', self.driver, self.loop, {
+            'batch_size': 10,
+            'batch_bytes': 20,
+            'batch_linger': 30,
+            'queue_points': 40,
+            'queue_bytes': 50,
+            'queue_policy': 'drop_oldest',
+            'max_writes': 2,
+            'retry_after': 5,
+            'dedup': True,
+            'dedup_keys': 60,
+        })
+
+        self.assertEqual(buffer.max_points, 10)
+        self.assertEqual(buffer.max_bytes, 20)
+        self.assertEqual(buffer.linger, 30)
+        self.assertEqual(buffer.queue_points, 40)
+        self.assertEqual(buffer.queue_bytes, 50)
+        self.assertEqual(buffer.policy, DROP_OLDEST)
+        self.assertEqual(buffer.max_writes, 2)
+        self.assertEqual(buffer.retry_after, 5)
+        self.assertEqual(buffer.dedup.max_keys, 60)
+
+    @istest
+    def builds_with_defaults(self):
+        buffer = BatchBuffer.from_config('my_db', self.driver, self.loop, {})
+
+        self.assertEqual(buffer.max_points, DEFAULT_BATCH_SIZE)
+        self.assertEqual(buffer.max_bytes, DEFAULT_BATCH_BYTES)
+        self.assertEqual(buffer.linger, DEFAULT_BATCH_LINGER)
+        self.assertEqual(buffer.queue_points, DEFAULT_QUEUE_POINTS)
+        self.assertEqual(buffer.queue_bytes, DEFAULT_QUEUE_BYTES)
+        self.assertEqual(buffer.policy, REJECT_NEWEST)
+        self.assertEqual(buffer.max_writes, DEFAULT_MAX_WRITES)
+        self.assertEqual(buffer.retry_after, DEFAULT_RETRY_AFTER)
+        self.assertIsNone(buffer.dedup)
+
+    @istest
+    def refuses_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            BatchBuffer.from_config(
+                'my_db', self.driver, self.loop, {'queue_policy': 'pray'})
+
+    @asynctest
+    async def merges_duplicate_points_before_writing(self):
+        self.buffer.dedup = Deduplicator()
+        self.buffer.metrics = MagicMock()
+        self.buffer.add(b'cpu value=1i 10\n', 1)
+        self.buffer.add(b'cpu value=2i 10\n', 1)
+        await self.buffer.drain()
+
+        self.driver.write_lines.assert_called_once_with(
+            'my_db', [b'cpu value=2i 10\n'])
+        self.assertEqual(self.buffer.deduplicated_points, 1)
+        self.buffer.metrics.count_points.assert_called_once_with(
+            'my_db', 'deduplicated', 1)
+        self.assertEqual(self.buffer.pending_points, 0)
+
+    @asynctest
+    async def merges_duplicate_points_without_metrics(self):
+        self.buffer.dedup = Deduplicator()
+        self.buffer.add(b'cpu value=1i 10\ncpu value=2i 10\n', 2)
+        await self.buffer.drain()
+
+        self.assertEqual(self.buffer.deduplicated_points, 1)
+
+    @asynctest
+    async def writes_batches_without_duplicates_as_they_are(self):
+        self.buffer.dedup = Deduplicator()
+        self.buffer.add(b'cpu value=1i 10\n', 1)
+        self.buffer.add(b'cpu value=2i 11\n', 1)
+        await self.buffer.drain()
+
+        self.driver.write_lines.assert_called_once_with(
+            'my_db', [b'cpu value=1i 10\n', b'cpu value=2i 11\n'])
+        self.assertEqual(self.buffer.deduplicated_points, 0)
+
+    @asynctest
+    async def writes_batches_in_their_precision(self):
+        self.buffer.add(b'a 1 1\n', 1, 's')
+        self.buffer.add(b'b 1 2\n', 1, 's')
+        self.buffer.add(b'c 1 3\n', 1)
+        await self.buffer.drain()
+
+        self.assertEqual(self.driver.write_lines.mock_calls, [
+            call('my_db', [b'a 1 1\n', b'b 1 2\n'], 's'),
+            call('my_db', [b'c 1 3\n']),
+        ])
+
+    @asynctest
+    async def flushes_when_max_points_reached(self):
+        self.buffer.add(b'p1\np2\n', 2)
+        self.buffer.add(b'p3\n', 1)
+        await self.buffer.drain()
+
+        self.driver.write_lines.assert_called_once_with(
+            'my_db', [b'p1\np2\n', b'p3\n'])
+
+    @asynctest
+    async def flushes_when_max_bytes_reached(self):
+        self.buffer.add(b'a' * 60, 1)
+        self.buffer.add(b'b' * 60, 1)
+        self.assertEqual(self.buffer.chunks, [])
+        self.assertEqual(self.buffer.size, 0)
+        await asyncio.sleep(0, loop=self.loop)
+
+        self.driver.write_lines.assert_called_once_with(
+            'my_db', [b'a' * 60, b'b' * 60])
+
+    @asynctest
+    async def flushes_after_lingering(self):
+        self.buffer.add(b'p1\n', 1)
+        self.buffer.add(b'p2\n', 1)
+        await asyncio.sleep(0, loop=self.loop)
+        self.assertFalse(self.driver.write_lines.called)
+
+        await asyncio.sleep(0.05, loop=self.loop)
+
+        self.driver.write_lines.assert_called_once_with(
+            'my_db', [b'p1\n', b'p2\n'])
+
+    @asynctest
+    async def starts_a_new_batch_after_flushing(self):
+        self.buffer.add(b'p1\np2\np3\n', 3)
+        self.buffer.add(b'p4\n', 1)
+        await self.buffer.drain()
+
+        self.assertEqual(self.driver.write_lines.mock_calls, [
+            call('my_db', [b'p1\np2\np3\n']),
+            call('my_db', [b'p4\n']),
+        ])
+        self.assertEqual(self.buffer.count, 0)
+
+    @asynctest
+    async def doesnt_write_empty_batches(self):
+        await self.buffer.drain()
+
+        self.assertFalse(self.driver.write_lines.called)
+
+    @asynctest
+    async def logs_failed_writes(self):
+        self.driver.write_lines.side_effect = RuntimeError('oops')
+
+        with patch('influxproxy.batching.logger') as logger:
+            self.buffer.add(b'p1\n', 1)
+            await self.buffer.drain()
+
+        self.assertTrue(logger.exception.called)
+        self.assertEqual(self.buffer.pending_points, 0)
+        self.assertEqual(self.buffer.pending_bytes, 0)
+
+    @asynctest
+    async def records_write_durations(self):
+        self.buffer.metrics = MagicMock()
+        self.driver.write_lines.side_effect = [None, RuntimeError('oops')]
+
+        with patch('influxproxy.batching.logger'):
+            for data in [b'p1\n', b'p2\n']:
+                self.buffer.add(data, 1)
+                self.buffer.flush()
+                await self.buffer.drain()
+
+        self.assertEqual(
+            [args[0::2] for args, _ in
+             self.buffer.metrics.observe_write.call_args_list],
+            [('my_db', False), ('my_db', True)])
+
+
+class SlowWrites:
+    """Write calls that only finish when released."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.calls = []
+        self.started = []
+
+    async def write_lines(self, database, chunks):
+        self.calls.append(chunks)
+        released = self.loop.create_future()
+        self.started.append(released)
+        await released
+
+    def release(self):
+        for released in self.started:
+            if not released.done():
+                released.set_result(None)
+
+
+class AdmissionTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.driver = SlowWrites(self.loop)
+        self.buffer = self.create_buffer()
+
+    def create_buffer(self, **kwargs):
+        options = dict(
+            max_points=2, max_bytes=1000, linger=10, queue_points=6,
+            queue_bytes=1000, max_writes=1, retry_after=3)
+        options.update(kwargs)
+        return BatchBuffer('my_db', self.driver, self.loop, **options)
+
+    def add(self, data, count=1):
+        self.buffer.admit(len(data), count)
+        self.buffer.add(data, count)
+
+    async def settle(self):
+        for _ in range(3):
+            await asyncio.sleep(0, loop=self.loop)
+
+    @asynctest
+    async def limits_concurrent_writes(self):
+        for i in range(4):
+            self.add('p{}\n'.format(i).encode())
+        await asyncio.sleep(0, loop=self.loop)
+
+        self.assertEqual(self.driver.calls, [[b'p0\n', b'p1\n']])
+        self.assertEqual(len(self.buffer.queue), 1)
+
+        self.driver.release()
+        await self.settle()
+
+        self.assertEqual(self.driver.calls[1], [b'p2\n', b'p3\n'])
+        self.assertEqual(len(self.buffer.queue), 0)
+
+    @asynctest
+    async def tracks_pending_points_and_bytes(self):
+        self.add(b'p0\n')
+        self.add(b'p1\n')
+        self.add(b'p2\n')
+        await asyncio.sleep(0, loop=self.loop)
+
+        self.assertEqual(self.buffer.pending_points, 3)
+        self.assertEqual(self.buffer.pending_bytes, 9)
+
+        self.driver.release()
+        await self.settle()
+
+        self.assertEqual(self.buffer.pending_points, 1)
+        self.assertEqual(self.buffer.pending_bytes, 3)
+
+    @asynctest
+    async def rejects_newest_points_when_full(self):
+        for i in range(6):
+            self.add(b'p\n')
+
+        with self.assertRaises(QueueFullError) as context:
+            self.add(b'p\n')
+
+        self.assertEqual(context.exception.retry_after, 3)
+        self.assertFalse(context.exception.overloaded)
+        self.assertEqual(self.buffer.pending_points, 6)
+
+    @asynctest
+    async def rejects_when_out_of_bytes(self):
+        self.buffer = self.create_buffer(queue_bytes=10)
+        self.add(b'p' * 8)
+
+        with self.assertRaises(QueueFullError):
+            self.add(b'p' * 3)
+
+    @asynctest
+    async def drops_oldest_queued_points_to_make_room(self):
+        self.buffer = self.create_buffer(
+            policy=DROP_OLDEST, metrics=MagicMock())
+        for i in range(6):
+            self.add('p{}\n'.format(i).encode())
+        await asyncio.sleep(0, loop=self.loop)
+
+        with patch('influxproxy.batching.logger') as logger:
+            self.add(b'p6\n')
+
+        self.assertTrue(logger.warning.called)
+        self.assertEqual(self.buffer.dropped_points, 2)
+        self.buffer.metrics.count_points.assert_called_once_with(
+            'my_db', 'dropped', 2)
+        self.assertEqual(self.buffer.pending_points, 5)
+        self.driver.release()
+        await self.drain()
+        self.assertEqual(self.driver.calls, [
+            [b'p0\n', b'p1\n'],
+            [b'p4\n', b'p5\n'],
+            [b'p6\n'],
+        ])
+
+    @asynctest
+    async def drops_oldest_buffered_points_to_make_room(self):
+        self.buffer = self.create_buffer(
+            policy=DROP_OLDEST, max_points=10, queue_points=3)
+        self.add(b'p0\n')
+        self.add(b'p1\n')
+        self.add(b'p2\n')
+
+        self.add(b'p3\n')
+
+        self.assertEqual(self.buffer.chunks, [b'p1\n', b'p2\n', b'p3\n'])
+        self.assertEqual(self.buffer.count, 3)
+        self.assertEqual(self.buffer.size, 9)
+        self.assertEqual(self.buffer.dropped_points, 1)
+
+    @asynctest
+    async def cant_drop_points_being_written(self):
+        self.buffer = self.create_buffer(policy=DROP_OLDEST, queue_points=2)
+        self.add(b'p0\n')
+        self.add(b'p1\n')
+        await asyncio.sleep(0, loop=self.loop)
+
+        with self.assertRaises(QueueFullError):
+            self.add(b'p2\n')
+
+        self.assertEqual(self.buffer.dropped_points, 0)
+        self.driver.release()
+
+    @asynctest
+    async def doesnt_drop_points_if_room_cant_be_made(self):
+        self.buffer = self.create_buffer(
+            policy=DROP_OLDEST, max_points=10, queue_points=3)
+        self.add(b'p0\n')
+        self.add(b'p1\n')
+
+        with self.assertRaises(QueueFullError):
+            self.add(b'p2\np3\np4\np5\n', 4)
+
+        self.assertEqual(self.buffer.chunks, [b'p0\n', b'p1\n'])
+        self.assertEqual(self.buffer.dropped_points, 0)
+
+    async def drain(self):
+        task = asyncio.ensure_future(self.buffer.drain(), loop=self.loop)
+        while not task.done():
+            self.driver.release()
+            await asyncio.sleep(0, loop=self.loop)
+
+
+class BatcherTest(LoopTestCase):
+    @asynctest
+    async def keeps_one_buffer_per_database(self):
+        batcher = Batcher(self.loop)
+        driver1, driver2 = AsyncMock(), AsyncMock()
+
+        batcher.add('db1', driver1, b'p1\n', 1, {})
+        batcher.add('db2', driver2, b'p2\n', 1, {'batch_size': 1})
+        batcher.add('db1', driver1, b'p3\n', 1, {})
+        await batcher.drain()
+
+        driver1.write_lines.assert_called_once_with('db1', [b'p1\n', b'p3\n'])
+        driver2.write_lines.assert_called_once_with('db2', [b'p2\n'])
+        self.assertEqual(batcher.buffers['db2'].max_points, 1)
+
+    @asynctest
+    async def adds_all_chunks_or_none(self):
+        batcher = Batcher(self.loop)
+        driver = AsyncMock()
+        db_config = {'queue_points': 3}
+
+        batcher.add_all('db', driver, [(b'p1\n', 1), (b'p2\n', 1)], db_config)
+        with self.assertRaises(QueueFullError):
+            batcher.add_all(
+                'db', driver, [(b'p3\n', 1), (b'p4\n', 1)], db_config)
+        await batcher.drain()
+
+        driver.write_lines.assert_called_once_with('db', [b'p1\n', b'p2\n'])
+
+    @asynctest
+    async def adds_to_every_node_or_none(self):
+        batcher = Batcher(self.loop)
+        node1, node2 = MagicMock(), MagicMock()
+        node1.write_lines, node2.write_lines = AsyncMock(), AsyncMock()
+        driver = MagicMock(spec=ClusterDriver)
+        driver.route.side_effect = [
+            [(node1, [(b'a1\na2\n', 2)]), (node2, [(b'b1\n', 1)])],
+            [(node1, [(b'a3\n', 1)]), (node2, [(b'b2\nb3\nb4\n', 3)])],
+        ]
+        db_config = {'queue_points': 2, 'queue_policy': DROP_OLDEST}
+
+        batcher.add_all('db', driver, [], db_config)
+        with self.assertRaises(QueueFullError):
+            batcher.add_all('db', driver, [], db_config)
+
+        buffer = batcher.buffers['db'].buffers[node1]
+        self.assertEqual(buffer.chunks, [b'a1\na2\n'])
+        self.assertEqual(buffer.dropped_points, 0)
+        await batcher.drain()
+        node1.write_lines.assert_called_once_with('db', [b'a1\na2\n'])
+        node2.write_lines.assert_called_once_with('db', [b'b1\n'])
+
+    @asynctest
+    async def adds_chunks_in_their_precision(self):
+        batcher = Batcher(self.loop)
+        driver = AsyncMock()
+
+        batcher.add_all('db', driver, [(b'p1 1\n', 1)], {}, 'ms')
+        await batcher.drain()
+
+        driver.write_lines.assert_called_once_with('db', [b'p1 1\n'], 'ms')
+
+    @asynctest
+    async def refuses_points_when_overloaded(self):
+        batcher = Batcher(self.loop, max_pending_bytes=5, retry_after=7)
+        driver = AsyncMock()
+
+        batcher.add('db1', driver, b'p1\n', 1, {})
+        with self.assertRaises(QueueFullError) as context:
+            batcher.add('db2', driver, b'p2\n', 1, {})
+
+        self.assertTrue(context.exception.overloaded)
+        self.assertEqual(context.exception.retry_after, 7)
+        self.assertEqual(batcher.pending_bytes, 3)
+        await batcher.drain()
+        self.assertEqual(batcher.pending_bytes, 0)
+
+    @asynctest
+    async def replaces_buffer_when_driver_changes(self):
+        batcher = Batcher(self.loop)
+        driver1, driver2 = AsyncMock(), AsyncMock()
+        db_config = {}
+        batcher.add('db', driver1, b'p1\n', 1, db_config)
+        old_buffer = batcher.buffers['db']
+
+        batcher.add('db', driver2, b'p2\n', 1, db_config)
+
+        self.assertIsNot(batcher.buffers['db'], old_buffer)
+        self.assertEqual(batcher.pending_bytes, 6)
+        await batcher.drain()
+        driver1.write_lines.assert_called_once_with('db', [b'p1\n'])
+        driver2.write_lines.assert_called_once_with('db', [b'p2\n'])
+        self.assertEqual(batcher.retired, {})
+
+    @asynctest
+    async def replaces_buffer_when_settings_change(self):
+        batcher = Batcher(self.loop)
+        driver = AsyncMock()
+        batcher.add('db', driver, b'p1\n', 1, {'batch_size': 10})
+        buffer = batcher.buffers['db']
+        reloaded = {'batch_size': 10}
+
+        batcher.add('db', driver, b'p2\n', 1, reloaded)
+        self.assertIs(batcher.buffers['db'], buffer)
+        self.assertIs(batcher.configs['db'][1], reloaded)
+        batcher.add('db', driver, b'p3\n', 1, {'batch_size': 1})
+
+        self.assertEqual(batcher.buffers['db'].max_points, 1)
+        await batcher.drain()
+        self.assertEqual(driver.write_lines.call_args_list, [
+            call('db', [b'p3\n']), call('db', [b'p1\n', b'p2\n'])])
+
+
+class SpillTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = temporary_directory(self)
+        self.driver = AsyncMock()
+        self.metrics = MagicMock()
+        self.db_config = {
+            'spill': True, 'queue_points': 2, 'replay_retry': 0.01}
+        self.closing = []
+
+    def tearDown(self):
+        for buffer in self.closing:
+            buffer.close()
+        super().tearDown()
+
+    def create_buffer(self, **settings):
+        buffer = BatchBuffer.from_config(
+            'my_db', self.driver, self.loop, dict(self.db_config, **settings),
+            self.metrics, self.directory)
+        self.closing.append(buffer)
+        return buffer
+
+    def spilled(self, buffer):
+        batches = []
+        while buffer.spill.peek() is not None:
+            batches.append(buffer.spill.peek())
+            buffer.spill.commit()
+        return batches
+
+    @istest
+    def builds_from_database_config(self):
+        buffer = self.create_buffer(
+            spill_bytes=10, spill_segment_bytes=20, replay_rate=30,
+            replay_retry=40)
+
+        self.assertIsInstance(buffer.spill, SpillQueue)
+        self.assertEqual(buffer.spill.directory, self.directory)
+        self.assertEqual(buffer.spill.max_bytes, 10)
+        self.assertEqual(buffer.spill.segment_bytes, 20)
+        self.assertEqual(buffer.replayer.rate, 30)
+        self.assertEqual(buffer.replayer.retry_after, 40)
+
+    @istest
+    def builds_with_defaults(self):
+        self.db_config = {'spill': True}
+        buffer = self.create_buffer()
+
+        self.assertEqual(buffer.spill.max_bytes, DEFAULT_SPILL_BYTES)
+        self.assertEqual(buffer.spill.segment_bytes, DEFAULT_SEGMENT_BYTES)
+        self.assertEqual(buffer.replayer.rate, DEFAULT_REPLAY_RATE)
+        self.assertEqual(buffer.replayer.retry_after, DEFAULT_REPLAY_RETRY)
+
+    @istest
+    def spills_only_when_configured_to(self):
+        self.assertIsNone(self.create_buffer(spill=False).spill)
+        self.assertIsNone(BatchBuffer.from_config(
+            'my_db', self.driver, self.loop, self.db_config).spill)
+
+    @asynctest
+    async def replays_batches_that_failed_once_backend_is_back(self):
+        buffer = self.create_buffer()
+        self.driver.write_lines.side_effect = [OSError('down'), None]
+
+        with patch('influxproxy.batching.logger'):
+            buffer.add(b'p1 1\n', 1, 'ms')
+            await buffer.drain()
+
+        self.assertEqual(buffer.spilled_points, 1)
+        self.metrics.count_points.assert_called_once_with(
+            'my_db', 'spilled', 1)
+        self.assertTrue(buffer.spill)
+        await asyncio.wait_for(buffer.replayer._task, 1, loop=self.loop)
+        self.assertEqual(self.driver.write_lines.call_args_list, [
+            call('my_db', [b'p1 1\n'], 'ms'),
+            call('my_db', [b'p1 1\n'], 'ms'),
+        ])
+        self.assertFalse(buffer.spill)
+
+    @asynctest
+    async def spills_newest_points_when_full(self):
+        batcher = Batcher(self.loop, spill_directory=self.directory)
+        self.closing.append(batcher)
+        batcher.add_all(
+            'my_db', self.driver, [(b'p1\n', 1), (b'p2\n', 1)],
+            self.db_config)
+
+        batcher.add_all(
+            'my_db', self.driver, [(b'p3\n', 1), (b'p4\n', 1)],
+            self.db_config, 'ms')
+
+        buffer = batcher.buffers['my_db']
+        self.assertEqual(
+            buffer.spill.directory, os.path.join(self.directory, 'my_db'))
+        self.assertEqual(buffer.pending_points, 2)
+        self.assertEqual(buffer.spilled_points, 2)
+        buffer.replayer.stop()
+        self.assertEqual(self.spilled(buffer), [(b'p3\np4\n', 2, 'ms')])
+
+    @asynctest
+    async def spills_oldest_points_to_make_room(self):
+        buffer = self.create_buffer(
+            queue_policy=DROP_OLDEST, batch_size=2, max_writes=0)
+        buffer.add(b'p1\n', 1)
+        buffer.add(b'p2\n', 1)
+
+        buffer.admit(3, 1)
+        buffer.add(b'p3\n', 1)
+        buffer.admit(6, 2)
+
+        self.assertEqual(buffer.spilled_points, 3)
+        self.assertEqual(buffer.dropped_points, 0)
+        buffer.replayer.stop()
+        self.assertEqual(self.spilled(buffer), [
+            (b'p1\np2\n', 2, None), (b'p3\n', 1, None)])
+
+    @asynctest
+    async def drops_points_too_many_to_spill(self):
+        buffer = self.create_buffer(spill_bytes=10)
+
+        with patch('influxproxy.batching.logger') as logger:
+            buffer.spill_all([(b'p1\n', 1), (b'p2\n', 1)])
+
+        self.assertTrue(logger.warning.called)
+        self.assertEqual(buffer.dropped_points, 2)
+        self.metrics.count_points.assert_called_once_with(
+            'my_db', 'dropped', 2)
+
+    @asynctest
+    async def replays_what_an_earlier_process_left(self):
+        spill = SpillQueue(self.directory, 'my_db')
+        spill.append(b'p1\n', 1)
+        spill.close()
+
+        buffer = self.create_buffer()
+
+        self.assertTrue(buffer.replayer.running)
+        await asyncio.wait_for(buffer.replayer._task, 1, loop=self.loop)
+        self.driver.write_lines.assert_called_once_with('my_db', [b'p1\n'])
+
+    @asynctest
+    async def stops_replaying_when_closed(self):
+        batcher = Batcher(self.loop, spill_directory=self.directory)
+        batcher.add('my_db', self.driver, b'p1\n', 1, self.db_config)
+        buffer = batcher.buffers['my_db']
+        buffer.spill_all([(b'p2\n', 1)])
+
+        batcher.close()
+
+        self.assertFalse(buffer.replayer.running)
+        batcher.close()
+
+    @asynctest
+    async def shares_spill_with_the_buffer_it_replaces(self):
+        batcher = Batcher(self.loop, spill_directory=self.directory)
+        self.closing.append(batcher)
+        batcher.add('my_db', self.driver, b'p1\n', 1, self.db_config)
+        old_buffer = batcher.buffers['my_db']
+        driver = AsyncMock()
+
+        batcher.add('my_db', driver, b'p2\n', 1, dict(
+            self.db_config, spill_bytes=10, spill_segment_bytes=20,
+            replay_rate=30, replay_retry=40))
+
+        buffer = batcher.buffers['my_db']
+        self.assertIs(buffer.spill, old_buffer.spill)
+        self.assertIs(buffer.replayer, old_buffer.replayer)
+        self.assertIs(buffer.replayer.driver, driver)
+        self.assertEqual(buffer.spill.max_bytes, 10)
+        self.assertEqual(buffer.spill.segment_bytes, 20)
+        self.assertEqual(buffer.replayer.rate, 30)
+        self.assertEqual(buffer.replayer.retry_after, 40)
+        buffer.spill_all([(b'p3\n', 1)])
+        batcher.close()
+        self.assertFalse(buffer.replayer.running)
+        self.assertIsNone(buffer.spill._cursor)
+
+    @asynctest
+    async def spills_each_node_apart(self):
+        node_driver = MagicMock()
+        node_driver.node.name = 'influx-1:8086'
+        node_driver.write_lines = AsyncMock()
+        cluster_driver = MagicMock()
+        cluster_driver.route.return_value = [(node_driver, [(b'p1\n', 1)])]
+        buffer = ShardedBuffer(
+            'my_db', self.loop, self.db_config,
+            spill_directory=self.directory)
+        self.closing.append(buffer)
+
+        [(node_buffer, _)] = buffer.route(cluster_driver, [(b'p1\n', 1)])
+
+        self.assertEqual(
+            node_buffer.spill.directory,
+            os.path.join(self.directory, 'influx-1-8086'))
+        buffer.close()
+        self.assertFalse(node_buffer.replayer.running)
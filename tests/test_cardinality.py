@@ -0,0 +1,308 @@
+import zlib
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from nose.tools import istest
+
+from influxproxy.cardinality import (
+    DEFAULT_BUCKETS,
+    DEFAULT_MAX_SKETCHES,
+    DEFAULT_PRECISION,
+    DEFAULT_WINDOW,
+    REJECT,
+    CardinalityGuard,
+    CardinalityGuards,
+    HyperLogLog,
+    WindowedSketch,
+)
+
+
+def lines(template, count, start=0):
+    return [template.format(index).encode() for index in range(start, count)]
+
+
+def chunk(lines):
+    return (b''.join(line + b'\n' for line in lines), len(lines))
+
+
+class HyperLogLogTest(TestCase):
+    def add(self, sketch, values):
+        for value in values:
+            sketch.add(hash(value) & ((1 << 64) - 1))
+
+    @istest
+    def estimates_large_cardinalities(self):
+        sketch = HyperLogLog()
+        self.add(sketch, ['value-{}'.format(i) for i in range(50000)])
+
+        self.assertAlmostEqual(sketch.estimate() / 50000, 1, delta=0.15)
+
+    @istest
+    def counts_small_cardinalities_closely(self):
+        sketch = HyperLogLog()
+        self.add(sketch, ['value-{}'.format(i) for i in range(10)] * 3)
+
+        self.assertAlmostEqual(sketch.estimate(), 10, delta=1)
+        self.assertFalse(sketch.empty)
+
+    @istest
+    def starts_empty(self):
+        sketch = HyperLogLog(4)
+
+        self.assertTrue(sketch.empty)
+        self.assertEqual(sketch.estimate(), 0)
+        self.assertEqual(len(sketch.registers), 16)
+
+    @istest
+    def works_with_small_precisions(self):
+        for precision in (4, 5, 6):
+            sketch = HyperLogLog(precision)
+            self.add(sketch, ['value-{}'.format(i) for i in range(10000)])
+
+            self.assertAlmostEqual(sketch.estimate() / 10000, 1, delta=0.8)
+
+    @istest
+    def refuses_unsupported_precisions(self):
+        with self.assertRaises(ValueError):
+            HyperLogLog(3)
+        with self.assertRaises(ValueError):
+            HyperLogLog(17)
+
+
+class WindowedSketchTest(TestCase):
+    @istest
+    def remembers_the_previous_window(self):
+        sketch = WindowedSketch()
+        for value in lines('a{}', 10):
+            sketch.add(value)
+
+        self.assertTrue(sketch.rotate())
+        for value in lines('b{}', 10):
+            sketch.add(value)
+
+        self.assertAlmostEqual(sketch.estimate(), 20, delta=1)
+        self.assertTrue(sketch.rotate())
+        self.assertAlmostEqual(sketch.estimate(), 10, delta=1)
+        self.assertFalse(sketch.rotate())
+        self.assertEqual(sketch.estimate(), 0)
+
+
+class CardinalityGuardTest(TestCase):
+    def setUp(self):
+        self.loop = MagicMock()
+        self.loop.time.return_value = 100
+        self.metrics = MagicMock()
+
+    def create_guard(self, **kwargs):
+        # The highest precision keeps values from sharing registers, so
+        # that estimates of a few values are exact.
+        kwargs.setdefault('precision', 16)
+        return CardinalityGuard(
+            'my_db', self.loop, window=60, metrics=self.metrics, **kwargs)
+
+    def check(self, guard, *chunks):
+        with patch('influxproxy.cardinality.logger') as self.logger:
+            return guard.check(list(chunks))
+
+    @istest
+    def builds_from_database_config(self):
+        guard = CardinalityGuard.from_config('my_db', self.loop, {
+            'cardinality': {
+                'window': 10,
+                'max_series': 20,
+                'max_tag_values': 30,
+                'action': 'bucket',
+                'buckets': 40,
+                'precision': 12,
+                'max_sketches': 50,
+            },
+        })
+
+        self.assertEqual(guard.window, 10)
+        self.assertEqual(guard.rotate_at, 110)
+        self.assertEqual(guard.max_series, 20)
+        self.assertEqual(guard.max_tag_values, 30)
+        self.assertEqual(guard.action, 'bucket')
+        self.assertEqual(guard.buckets, 40)
+        self.assertEqual(guard.precision, 12)
+        self.assertEqual(guard.max_sketches, 50)
+
+    @istest
+    def builds_with_defaults(self):
+        guard = CardinalityGuard.from_config(
+            'my_db', self.loop, {'cardinality': {'max_series': 1}})
+
+        self.assertEqual(guard.window, DEFAULT_WINDOW)
+        self.assertIsNone(guard.max_tag_values)
+        self.assertEqual(guard.action, REJECT)
+        self.assertEqual(guard.buckets, DEFAULT_BUCKETS)
+        self.assertEqual(guard.precision, DEFAULT_PRECISION)
+        self.assertEqual(guard.max_sketches, DEFAULT_MAX_SKETCHES)
+
+    @istest
+    def refuses_unknown_action(self):
+        with self.assertRaises(ValueError):
+            self.create_guard(action='panic')
+
+    @istest
+    def leaves_points_under_limits_alone(self):
+        guard = self.create_guard(max_series=100, max_tag_values=100)
+        chunks = [
+            chunk(lines('cpu,host=h{} value=1i', 10)),
+            (b'# comment\n\nmem value=1i\n', 1),
+        ]
+
+        self.assertEqual(guard.check(chunks), (chunks, 0))
+        self.assertFalse(self.metrics.count_points.called)
+
+    @istest
+    def rejects_points_with_a_tag_over_its_limit(self):
+        guard = self.create_guard(max_tag_values=5)
+
+        chunks, rejected = self.check(
+            guard, chunk(lines('page,url=/p{},b=x load=1i', 20)),
+            chunk([b'other value=1i']))
+
+        self.assertEqual(rejected, 15)
+        self.assertEqual(chunks, [
+            chunk(lines('page,url=/p{},b=x load=1i', 5)),
+            chunk([b'other value=1i'])])
+        self.metrics.count_points.assert_called_once_with(
+            'my_db', 'over_cardinality', 15)
+        self.logger.warning.assert_called_once_with(
+            'Cardinality of %s is too high, applying %s to its %s tag',
+            'page', 'reject', 'url')
+
+    @istest
+    def drops_tags_over_their_limit(self):
+        guard = self.create_guard(max_tag_values=5, action='drop_tag')
+
+        chunks, rejected = self.check(
+            guard, chunk(lines('page,url=/p{0},b=x load=1i {0}', 7)))
+
+        self.assertEqual(rejected, 0)
+        self.assertEqual(
+            chunks[0][0].split(b'\n')[-3:],
+            [b'page,b=x load=1i 5', b'page,b=x load=1i 6', b''])
+        self.metrics.count_points.assert_called_once_with(
+            'my_db', 'retagged', 2)
+
+    @istest
+    def buckets_values_of_tags_over_their_limit(self):
+        guard = self.create_guard(
+            max_tag_values=5, action='bucket', buckets=7)
+
+        chunks, _ = self.check(
+            guard, chunk(lines('page,url=/p{},b=x load=1i\r', 7)))
+
+        self.assertEqual(
+            chunks[0][0].split(b'\n')[-2],
+            b'page,url=bucket-%d,b=x load=1i\r' % (zlib.crc32(b'/p6') % 7))
+
+    @istest
+    def blames_series_over_limit_on_tag_with_most_values(self):
+        guard = self.create_guard(max_series=10, action='drop_tag')
+        points = [
+            'page,a=a{},b=b{} load=1i'.format(i % 4, i).encode()
+            for i in range(20)]
+
+        chunks, _ = self.check(guard, chunk(points))
+
+        self.assertEqual(
+            chunks[0][0].split(b'\n')[-2], b'page,a=a3 load=1i')
+
+    @istest
+    def starts_over_after_the_window(self):
+        guard = self.create_guard(max_tag_values=5)
+        self.check(guard, chunk(lines('page,url=/p{} load=1i', 20)))
+        self.check(guard, chunk([b'mem value=1i']))
+
+        self.loop.time.return_value = 160
+        chunks, rejected = self.check(guard, chunk([b'mem value=1i']))
+        self.assertEqual(rejected, 0)
+        self.assertEqual(guard.rotate_at, 220)
+        self.assertEqual(guard.limited, set())
+
+        self.loop.time.return_value = 220
+        _, rejected = self.check(
+            guard, chunk(lines('page,url=/p{} load=1i', 5)))
+
+        self.assertEqual(rejected, 0)
+        self.assertEqual(sorted(guard.series), [b'mem', b'page'])
+        self.assertEqual(list(guard.tag_values), [(b'page', b'url')])
+
+    @istest
+    def leaves_series_past_its_sketches_alone(self):
+        guard = self.create_guard(max_tag_values=5, max_sketches=2)
+        self.check(guard, chunk([b'cpu,host=a value=1i']))
+
+        chunks, rejected = self.check(
+            guard, chunk(lines('mem,host=h{} value=1i', 20)),
+            chunk(lines('cpu,host=a,url=/p{} value=1i', 20)))
+
+        self.assertEqual(rejected, 0)
+        self.assertEqual(guard.sketches, 2)
+
+    @istest
+    def reports_estimates(self):
+        guard = self.create_guard(max_tag_values=5)
+        self.check(guard, chunk(lines('page,url=/p{},b=x load=1i', 20)))
+
+        estimates = guard.estimates()
+
+        self.assertEqual(
+            {key: estimates[key] for key in (
+                'window', 'max_series', 'max_tag_values', 'action')},
+            {'window': 60, 'max_series': None, 'max_tag_values': 5,
+             'action': 'reject'})
+        page = estimates['measurements']['page']
+        self.assertAlmostEqual(page['series'], 20, delta=1)
+        self.assertAlmostEqual(page['tags']['url']['values'], 20, delta=1)
+        self.assertTrue(page['tags']['url']['limited'])
+        self.assertEqual(page['tags']['b'], {'values': 1, 'limited': False})
+
+
+class CardinalityGuardsTest(TestCase):
+    def setUp(self):
+        self.loop = MagicMock()
+        self.loop.time.return_value = 0
+        self.guards = CardinalityGuards(self.loop)
+
+    @istest
+    def leaves_databases_without_guard_alone(self):
+        chunks = [chunk([b'cpu value=1i'])]
+
+        self.assertEqual(self.guards.check('my_db', chunks, {}), (chunks, 0))
+        self.assertEqual(self.guards.estimates(), {})
+        self.assertIsNone(self.guards.estimates('my_db'))
+
+    @istest
+    def keeps_one_guard_per_database(self):
+        db_config = {'cardinality': {'max_tag_values': 1}}
+        self.guards.check('db1', [chunk([b'cpu,a=1 v=1i'])], db_config)
+
+        _, rejected = self.guards.check(
+            'db1', [chunk([b'cpu,a=2 v=1i'])], db_config)
+        self.guards.check('db2', [chunk([b'cpu,a=3 v=1i'])], db_config)
+
+        self.assertEqual(rejected, 1)
+        self.assertEqual(sorted(self.guards.estimates()), ['db1', 'db2'])
+        self.assertEqual(
+            self.guards.estimates('db2')['measurements']['cpu']['series'], 1)
+
+    @istest
+    def rebuilds_guard_when_reload_changes_its_settings(self):
+        self.guards.check(
+            'db', [chunk([b'cpu,a=1 v=1i'])],
+            {'cardinality': {'max_tag_values': 1}})
+        guard = self.guards.guards['db']
+
+        self.guards.check(
+            'db', [], {'cardinality': {'max_tag_values': 1}})
+        self.assertIs(self.guards.guards['db'], guard)
+        _, rejected = self.guards.check(
+            'db', [chunk([b'cpu,a=2 v=1i'])],
+            {'cardinality': {'max_tag_values': 2}})
+
+        self.assertEqual(rejected, 0)
+        self.assertEqual(self.guards.estimates('db')['max_tag_values'], 2)
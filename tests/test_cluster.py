@@ -0,0 +1,502 @@
+import asyncio
+import copy
+from collections import Counter
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+import aiohttp
+from nose.tools import istest
+
+from .base import AsyncMock, LoopTestCase, asynctest
+from .fakes import FakeInfluxHTTP, FakeInfluxUDP
+from influxproxy import configuration
+from influxproxy.batching import Batcher, ShardedBuffer
+from influxproxy.cluster import (
+    DEFAULT_CHECK_INTERVAL,
+    DEFAULT_REPLICATION,
+    Cluster,
+    ClusterDriver,
+    ClusterNode,
+    HashRing,
+    NodeDriver,
+    node_configs,
+    series_key,
+)
+from influxproxy.configuration import Settings, config
+from influxproxy.drivers import DriverRegistry
+
+
+KEYS = [b'cpu,host=server-%d' % index for index in range(10000)]
+
+
+def make_nodes(count, loop=None, **kwargs):
+    return [
+        ClusterNode('influx-{}'.format(index), 8086, loop or MagicMock(),
+                    **kwargs)
+        for index in range(count)]
+
+
+class SeriesKeyTest(TestCase):
+    @istest
+    def sorts_tags(self):
+        self.assertEqual(
+            series_key(b'cpu,zone=b,host=a,dc=x value=1i 10'),
+            b'cpu,dc=x,host=a,zone=b')
+
+    @istest
+    def keeps_measurement_without_tags(self):
+        self.assertEqual(series_key(b'cpu value=1i'), b'cpu')
+        self.assertEqual(series_key(b'cpu,host=a value=1i'), b'cpu,host=a')
+
+    @istest
+    def keeps_escaped_characters(self):
+        self.assertEqual(
+            series_key(b'my\\ cpu,b=x\\,y,a=1\\ 2 value=1i'),
+            b'my\\ cpu,a=1\\ 2,b=x\\,y')
+
+
+class NodeConfigsTest(TestCase):
+    @istest
+    def takes_backend_as_single_node(self):
+        backend_conf = {'host': 'influx', 'port': 8086}
+
+        self.assertEqual(node_configs(backend_conf), [backend_conf])
+
+    @istest
+    def takes_node_settings_over_backend_ones(self):
+        backend_conf = {
+            'host': 'influx', 'port': 8086, 'udp_port': 8089,
+            'cluster': {'nodes': [
+                {'host': 'influx-1'},
+                {'host': 'influx-2', 'port': 8087},
+            ]},
+        }
+
+        self.assertEqual(node_configs(backend_conf), [
+            {'host': 'influx-1', 'port': 8086, 'udp_port': 8089},
+            {'host': 'influx-2', 'port': 8087, 'udp_port': 8089},
+        ])
+
+
+class ClusterNodeTest(TestCase):
+    def setUp(self):
+        self.loop = MagicMock()
+        self.loop.time.return_value = 100
+        self.node = ClusterNode(
+            'influx', 8086, self.loop, max_failures=2, down_for=10)
+
+    @istest
+    def is_named_after_its_address(self):
+        self.assertEqual(self.node.name, 'influx:8086')
+        self.assertEqual(self.node.ping_url, 'http://influx:8086/ping')
+
+    @istest
+    def goes_down_after_failures_in_a_row(self):
+        self.node.failed()
+        self.assertTrue(self.node.up)
+
+        with patch('influxproxy.cluster.logger') as logger:
+            self.node.failed()
+
+        self.assertFalse(self.node.up)
+        self.assertTrue(logger.warning.called)
+
+    @istest
+    def forgets_failures_on_success(self):
+        self.node.failed()
+        self.node.succeeded()
+        self.node.failed()
+
+        self.assertTrue(self.node.up)
+
+    @istest
+    def is_tried_again_after_a_while(self):
+        self.node.failed()
+        self.node.failed()
+        self.node.failed()
+
+        self.loop.time.return_value = 110
+        self.assertTrue(self.node.up)
+        self.node.failed()
+        self.assertFalse(self.node.up)
+        self.assertEqual(self.node.down_until, 120)
+
+    @istest
+    def comes_back_up_on_success(self):
+        self.node.failed()
+        self.node.failed()
+
+        with patch('influxproxy.cluster.logger') as logger:
+            self.node.succeeded()
+
+        self.assertTrue(self.node.up)
+        self.assertTrue(logger.info.called)
+
+
+class HashRingTest(TestCase):
+    def owners(self, ring):
+        return {key: ring.preference(key)[0] for key in KEYS}
+
+    @istest
+    def spreads_keys_evenly(self):
+        ring = HashRing(['a', 'b', 'c', 'd'])
+
+        shares = Counter(self.owners(ring).values())
+
+        for name in 'abcd':
+            self.assertGreater(shares[name], 0.2 * len(KEYS))
+            self.assertLess(shares[name], 0.3 * len(KEYS))
+
+    @istest
+    def prefers_every_node_once(self):
+        ring = HashRing(['a', 'b', 'c'])
+
+        for key in KEYS[:100]:
+            self.assertEqual(sorted(ring.preference(key)), ['a', 'b', 'c'])
+
+    @istest
+    def moves_only_keys_taken_by_added_node(self):
+        before = self.owners(HashRing(['a', 'b', 'c', 'd']))
+
+        after = self.owners(HashRing(['a', 'b', 'c', 'd', 'e']))
+
+        moved = [key for key in KEYS if after[key] != before[key]]
+        self.assertEqual({after[key] for key in moved}, {'e'})
+        self.assertLess(len(moved), 0.25 * len(KEYS))
+
+    @istest
+    def moves_only_keys_of_removed_node(self):
+        before = self.owners(HashRing(['a', 'b', 'c', 'd']))
+
+        after = self.owners(HashRing(['a', 'b', 'c']))
+
+        moved = [key for key in KEYS if after[key] != before[key]]
+        self.assertEqual({before[key] for key in moved}, {'d'})
+
+
+class ClusterTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.nodes = make_nodes(3, self.loop, max_failures=1)
+        self.cluster = Cluster(self.nodes, self.loop, replication=2)
+
+    def tearDown(self):
+        self.cluster.close()
+        super().tearDown()
+
+    @istest
+    def builds_from_backend_config(self):
+        cluster = Cluster.from_config({
+            'host': 'influx', 'port': 8086,
+            'cluster': {
+                'nodes': [{'host': 'influx-1'}, {'host': 'influx-2'}],
+                'virtual_nodes': 10,
+                'replication': 3,
+                'max_failures': 5,
+                'down_for': 30,
+                'check_interval': 1,
+            },
+        }, self.loop)
+
+        self.assertEqual(
+            [node.name for node in cluster.nodes],
+            ['influx-1:8086', 'influx-2:8086'])
+        self.assertEqual(len(cluster.ring.hashes), 20)
+        self.assertEqual(cluster.replication, 2)
+        self.assertEqual(cluster.nodes[0].max_failures, 5)
+        self.assertEqual(cluster.nodes[0].down_for, 30)
+        self.assertEqual(cluster.check_interval, 1)
+
+    @istest
+    def builds_with_defaults(self):
+        cluster = Cluster.from_config({
+            'host': 'influx', 'port': 8086,
+            'cluster': {'nodes': [{'host': 'influx-1'}]},
+        }, self.loop)
+
+        self.assertEqual(cluster.replication, DEFAULT_REPLICATION)
+        self.assertEqual(cluster.check_interval, DEFAULT_CHECK_INTERVAL)
+
+    @istest
+    def writes_series_to_replicated_nodes(self):
+        nodes = self.cluster.nodes_for(b'cpu,host=a')
+
+        self.assertEqual(len(set(nodes)), 2)
+        self.assertEqual(self.cluster.nodes_for(b'cpu,host=a'), nodes)
+
+    @istest
+    def fails_over_to_next_nodes_when_down(self):
+        first, second = self.cluster.nodes_for(b'cpu,host=a')
+        others = {
+            key: self.cluster.nodes_for(key) for key in KEYS[:100]
+            if first not in self.cluster.nodes_for(key)}
+
+        first.failed()
+
+        nodes = self.cluster.nodes_for(b'cpu,host=a')
+        self.assertEqual(nodes[0], second)
+        self.assertNotIn(first, nodes)
+        for key, nodes in others.items():
+            self.assertEqual(self.cluster.nodes_for(key), nodes)
+
+    @istest
+    def writes_to_preferred_nodes_when_all_are_down(self):
+        nodes = self.cluster.nodes_for(b'cpu,host=a')
+        for node in self.nodes:
+            node.failed()
+
+        self.assertEqual(self.cluster.nodes_for(b'cpu,host=a'), nodes)
+
+    @istest
+    def forgets_series_past_cache_limit(self):
+        with patch('influxproxy.cluster.MAX_CACHED_SERIES', 2):
+            for key in KEYS[:5]:
+                self.cluster.nodes_for(key)
+
+        self.assertEqual(len(self.cluster._preferences), 1)
+
+    @asynctest
+    async def checks_nodes_through_ping(self):
+        backends = [FakeInfluxHTTP(self.loop) for _ in range(3)]
+        for backend in backends:
+            await backend.start()
+        for node, backend in zip(self.nodes, backends):
+            node.host, node.port = '127.0.0.1', backend.port
+        backends[1].up = False
+        await backends[2].stop()
+        session = aiohttp.ClientSession(loop=self.loop)
+
+        try:
+            await self.cluster.check(session)
+        finally:
+            session.close()
+            for backend in backends[:2]:
+                await backend.stop()
+
+        self.assertEqual(
+            [node.up for node in self.nodes], [True, False, False])
+
+    @asynctest
+    async def checks_nodes_periodically_until_closed(self):
+        self.cluster.check_interval = 0.01
+        session = object()
+
+        with patch.object(self.cluster, 'check', AsyncMock()) as check:
+            self.cluster.start_checks(session)
+            self.cluster.start_checks(session)
+            await asyncio.sleep(0.05, loop=self.loop)
+            checker = self.cluster._checker
+            self.cluster.close()
+            await asyncio.sleep(0, loop=self.loop)
+
+        check.assert_called_with(session)
+        self.assertTrue(checker.cancelled())
+        self.assertIsNone(self.cluster._checker)
+
+
+class NodeDriverTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.node = MagicMock()
+        self.driver = MagicMock()
+        self.driver.write_lines = AsyncMock()
+
+    @asynctest
+    async def tells_node_of_failed_writes(self):
+        self.driver.write_lines.side_effect = OSError('oops')
+        node_driver = NodeDriver(self.node, self.driver)
+
+        with self.assertRaises(OSError):
+            await node_driver.write_lines('db', [b'cpu value=1i\n'], 's')
+
+        self.driver.write_lines.assert_called_once_with(
+            'db', [b'cpu value=1i\n'], 's')
+        self.node.failed.assert_called_once_with()
+
+    @asynctest
+    async def tells_node_of_acknowledged_writes(self):
+        await NodeDriver(self.node, self.driver, acknowledged=True) \
+            .write_lines('db', [b'cpu value=1i\n'])
+
+        self.node.succeeded.assert_called_once_with()
+
+    @asynctest
+    async def tells_nothing_of_unacknowledged_writes(self):
+        await NodeDriver(self.node, self.driver).write_lines(
+            'db', [b'cpu value=1i\n'])
+
+        self.assertFalse(self.node.succeeded.called)
+
+
+class ClusterDriverTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.nodes = make_nodes(3, self.loop)
+        self.cluster = Cluster(self.nodes, self.loop, replication=2)
+        self.drivers = [
+            MagicMock(precision='s', adaptive_precision=False)
+            for _ in self.nodes]
+        self.driver = ClusterDriver(self.cluster, self.drivers, True)
+
+    @istest
+    def encodes_as_first_node_driver(self):
+        encoded = self.driver.encode(['point'], 'ms')
+
+        self.assertEqual(self.driver.precision, 's')
+        self.assertFalse(self.driver.adaptive_precision)
+        self.assertIs(encoded, self.drivers[0].encode.return_value)
+        self.drivers[0].encode.assert_called_once_with(['point'], 'ms')
+
+    @istest
+    def routes_lines_to_nodes_of_their_series(self):
+        lines = [
+            b'cpu,host=server-%d value=%di' % (index % 10, index)
+            for index in range(50)]
+        data = b'# comment\n\n' + b'\n'.join(lines) + b'\n'
+
+        routed = self.driver.route([(data, 50)])
+
+        received = {}
+        for node_driver, chunks in routed:
+            self.assertIsInstance(node_driver, NodeDriver)
+            self.assertTrue(node_driver.acknowledged)
+            [(node_data, count)] = chunks
+            node_lines = node_data.splitlines()
+            self.assertEqual(count, len(node_lines))
+            for line in node_lines:
+                received.setdefault(line, []).append(node_driver.node)
+        self.assertEqual(set(received), set(lines))
+        for line, nodes in received.items():
+            self.assertEqual(
+                set(nodes), set(self.cluster.nodes_for(series_key(line))))
+
+
+class ClusterWritesTest(LoopTestCase):
+    """Writes through a cluster of local stand-ins for InfluxDB."""
+
+    def setUp(self):
+        super().setUp()
+        self.http = [FakeInfluxHTTP(self.loop) for _ in range(3)]
+        self.udp = [FakeInfluxUDP(self.loop) for _ in range(3)]
+        for backend in self.http + self.udp:
+            self.loop.run_until_complete(backend.start())
+        self.use_cluster(range(3))
+        self.registry = DriverRegistry(self.loop)
+        self.batcher = Batcher(self.loop)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.batcher.drain())
+        self.registry.close()
+        for backend in self.udp:
+            backend.stop()
+        for backend in self.http:
+            self.loop.run_until_complete(backend.stop())
+        super().tearDown()
+
+    def use_cluster(self, indexes, **settings):
+        reloaded = copy.deepcopy(config)
+        reloaded['backend']['cluster'] = dict(settings, nodes=[
+            {
+                'host': '127.0.0.1',
+                'port': self.http[index].port,
+                'udp_port': self.udp[index].port,
+            }
+            for index in indexes])
+        patcher = patch.object(
+            configuration, 'settings', Settings.compile(reloaded))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def write(self, lines, db_config=None):
+        db_config = db_config or {'udp_payload_size': 512}
+        driver = await self.registry.get(db_config)
+        data = b''.join(line + b'\n' for line in lines)
+        self.batcher.add('testing', driver, data, len(lines), db_config)
+        await self.batcher.drain()
+        await asyncio.sleep(0.01, loop=self.loop)
+        return driver
+
+    def received(self, backends):
+        return [set(backend.lines) for backend in backends]
+
+    @asynctest
+    async def spreads_series_evenly_over_udp(self):
+        lines = [
+            b'cpu,host=server-%d value=1i' % index for index in range(600)]
+
+        driver = await self.write(lines)
+
+        self.assertIsInstance(driver, ClusterDriver)
+        self.assertIsInstance(self.batcher.buffers['testing'], ShardedBuffer)
+        received = self.received(self.udp)
+        self.assertEqual(set.union(*received), set(lines))
+        self.assertEqual(sum(map(len, received)), len(lines))
+        for node_lines in received:
+            self.assertGreater(len(node_lines), 150)
+            self.assertLess(len(node_lines), 250)
+
+    @asynctest
+    async def replicates_series_over_http(self):
+        self.use_cluster(range(3), replication=2)
+        lines = [
+            b'cpu,host=server-%d value=1i' % index for index in range(60)]
+
+        await self.write(lines, {'transport': 'http'})
+
+        received = self.received(self.http)
+        for line in lines:
+            self.assertEqual(
+                sum(line in node_lines for node_lines in received), 2)
+        self.assertEqual(self.batcher.buffers['testing'].pending_points, 0)
+        self.assertEqual(self.batcher.buffers['testing'].pending_bytes, 0)
+
+    @asynctest
+    async def keeps_series_in_place_when_node_is_removed(self):
+        lines = [
+            b'cpu,host=server-%d value=1i' % index for index in range(300)]
+        await self.write(lines)
+        before = self.received(self.udp)
+        for backend in self.udp:
+            backend.lines.clear()
+
+        self.use_cluster([0, 1])
+        await self.write(lines)
+
+        after = self.received(self.udp)
+        self.assertTrue(before[0] <= after[0])
+        self.assertTrue(before[1] <= after[1])
+        self.assertEqual(after[2], set())
+
+    @asynctest
+    async def keeps_series_in_place_when_node_is_added(self):
+        self.use_cluster([0, 1])
+        lines = [
+            b'cpu,host=server-%d value=1i' % index for index in range(300)]
+        await self.write(lines)
+        before = self.received(self.udp)
+        for backend in self.udp:
+            backend.lines.clear()
+
+        self.use_cluster(range(3))
+        await self.write(lines)
+
+        after = self.received(self.udp)
+        self.assertTrue(after[0] <= before[0])
+        self.assertTrue(after[1] <= before[1])
+        self.assertEqual(after[2], set(lines) - after[0] - after[1])
+
+    @asynctest
+    async def fails_over_from_node_failing_writes(self):
+        self.use_cluster(range(3), max_failures=1)
+        db_config = {'transport': 'http', 'retries': 0}
+        self.http[2].statuses = [500]
+        lines = [
+            b'cpu,host=server-%d value=1i' % index for index in range(60)]
+
+        with patch('influxproxy.batching.logger'):
+            await self.write(lines, db_config)
+            await self.write(lines, db_config)
+
+        self.assertEqual(set(self.http[2].lines), set())
+        received = self.received(self.http[:2])
+        self.assertEqual(received[0] | received[1], set(lines))
@@ -0,0 +1,164 @@
+import copy
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import yaml
+from nose.tools import istest
+
+from influxproxy import configuration
+from influxproxy.configuration import (
+    InvalidConfigError,
+    Settings,
+    config,
+    reload_settings,
+    validate_config,
+)
+from influxproxy.schemas import InvalidSchemaError
+
+
+def write_config(config):
+    settings_file = tempfile.NamedTemporaryFile(
+        'w', suffix='.yaml', delete=False)
+    with settings_file:
+        yaml.safe_dump(config, settings_file)
+    return settings_file.name
+
+
+class ValidateConfigTest(TestCase):
+    def setUp(self):
+        self.config = copy.deepcopy(config)
+
+    def assert_invalid(self):
+        with self.assertRaises(InvalidConfigError):
+            validate_config(self.config)
+
+    @istest
+    def accepts_current_config(self):
+        validate_config(self.config)
+
+    @istest
+    def refuses_non_mappings(self):
+        self.config = ['databases']
+
+        self.assert_invalid()
+
+    @istest
+    def refuses_missing_sections(self):
+        del self.config['databases']
+
+        self.assert_invalid()
+
+    @istest
+    def refuses_backend_without_host(self):
+        del self.config['backend']['host']
+
+        self.assert_invalid()
+
+    @istest
+    def refuses_databases_list(self):
+        self.config['databases'] = ['udp']
+
+        self.assert_invalid()
+
+    @istest
+    def refuses_database_without_public_key(self):
+        del self.config['databases']['udp']['public_key']
+
+        self.assert_invalid()
+
+    @istest
+    def refuses_database_without_origins(self):
+        del self.config['databases']['udp']['allow_from']
+
+        self.assert_invalid()
+
+    @istest
+    def refuses_database_without_settings(self):
+        self.config['databases']['udp'] = None
+
+        self.assert_invalid()
+
+    @istest
+    def refuses_admin_token_other_than_string(self):
+        self.config['admin_token'] = 1234
+
+        self.assert_invalid()
+
+    @istest
+    def refuses_unknown_logging_handler(self):
+        self.config['logging'] = {'handler': 'syslog'}
+
+        self.assert_invalid()
+
+    @istest
+    def refuses_unknown_logging_format(self):
+        self.config['logging'] = {'format': 'xml'}
+
+        self.assert_invalid()
+
+
+class SettingsTest(TestCase):
+    def setUp(self):
+        self.config = copy.deepcopy(config)
+
+    @istest
+    def compiles_access_and_schemas(self):
+        settings = Settings.compile(self.config)
+
+        self.assertIs(settings.config, self.config)
+        self.assertEqual(
+            settings.databases, {'udp', 'testing', 'strict'})
+        self.assertIs(settings.access['strict'].schema,
+                      settings.schemas['strict'])
+
+    @istest
+    def refuses_invalid_schemas(self):
+        self.config['databases']['strict']['schema']['measurements'][
+            'page_load']['fields']['duration'] = 'complex'
+
+        with self.assertRaises(InvalidSchemaError):
+            Settings.compile(self.config)
+
+    @istest
+    def loads_file_with_its_mtime(self):
+        path = write_config(self.config)
+        self.addCleanup(os.unlink, path)
+
+        settings = Settings.load(path)
+
+        self.assertEqual(settings.config, self.config)
+        self.assertEqual(settings.mtime, os.stat(path).st_mtime)
+
+
+class ReloadSettingsTest(TestCase):
+    def setUp(self):
+        patcher = patch.object(configuration, 'settings')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.config = copy.deepcopy(config)
+
+    @istest
+    def swaps_in_new_settings(self):
+        self.config['databases']['new'] = {
+            'public_key': 'new-key', 'allow_from': '*'}
+        path = write_config(self.config)
+        self.addCleanup(os.unlink, path)
+
+        settings = reload_settings(path)
+
+        self.assertIs(configuration.settings, settings)
+        self.assertIn('new', settings.access)
+
+    @istest
+    def keeps_current_settings_if_invalid(self):
+        current = configuration.settings
+        del self.config['backend']
+        path = write_config(self.config)
+        self.addCleanup(os.unlink, path)
+
+        with self.assertRaises(InvalidConfigError):
+            reload_settings(path)
+
+        self.assertIs(configuration.settings, current)
@@ -0,0 +1,64 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from nose.tools import istest
+
+from influxproxy.dedup import Deduplicator, merge_lines
+
+
+class MergeLinesTest(TestCase):
+    @istest
+    def merges_fields_newest_winning(self):
+        merged = merge_lines(
+            b'cpu,host=a value=1i,idle=0.5 10',
+            b'cpu,host=a value=2i,label="x y" 10')
+
+        self.assertEqual(
+            merged, b'cpu,host=a value=2i,idle=0.5,label="x y" 10')
+
+
+class DeduplicatorTest(TestCase):
+    def setUp(self):
+        self.dedup = Deduplicator(max_keys=10)
+
+    @istest
+    def collapses_points_with_same_series_and_time(self):
+        chunks, saved = self.dedup.collapse([
+            b'cpu,host=a value=1i 10\ncpu,host=b value=1i 10\n',
+            b'# comment\n\ncpu,host=a value=2i 10\r\ncpu,host=a value=3i 11\n',
+        ])
+
+        self.assertEqual(saved, 1)
+        self.assertEqual(chunks, [
+            b'cpu,host=a value=2i 10\n'
+            b'cpu,host=b value=1i 10\n'
+            b'cpu,host=a value=3i 11\n'])
+
+    @istest
+    def leaves_chunks_without_duplicates_alone(self):
+        chunks = [b'cpu value=1i 10\n', b'cpu value=1i 11\n']
+
+        self.assertEqual(self.dedup.collapse(chunks), (chunks, 0))
+
+    @istest
+    def leaves_points_without_time_alone(self):
+        chunks = [b'cpu value=1i\ncpu value=1i\ncpu label="a 10"\n']
+
+        self.assertEqual(self.dedup.collapse(chunks), (chunks, 0))
+
+    @istest
+    def forgets_least_recently_seen_points(self):
+        self.dedup.max_keys = 2
+
+        chunks, saved = self.dedup.collapse([
+            b'a v=1i 1\nb v=1i 1\na v=2i 1\nc v=1i 1\na v=3i 1\nb v=2i 1\n'])
+
+        self.assertEqual(saved, 2)
+        self.assertEqual(chunks, [b'a v=3i 1\nb v=1i 1\nc v=1i 1\nb v=2i 1\n'])
+
+    @istest
+    def tells_points_with_same_hash_apart(self):
+        chunks = [b'a v=1i 1\nb v=1i 1\n']
+
+        with patch('influxproxy.dedup.hash', return_value=0, create=True):
+            self.assertEqual(self.dedup.collapse(chunks), (chunks, 0))
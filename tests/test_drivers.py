@@ -1,32 +1,46 @@
-import socket
+import asyncio
+import copy
 from datetime import datetime
-from unittest import TestCase
-from unittest.mock import MagicMock, call, patch
+from unittest.mock import ANY, MagicMock, patch
 
-from influxdb.client import InfluxDBClient
 from nose.tools import istest
 
-from influxproxy.configuration import config
-from influxproxy.drivers import InfluxDriver, MalformedDataError
+from .base import AsyncMock, LoopTestCase, asynctest
+from influxproxy import configuration
+from influxproxy.configuration import Settings, config
+from influxproxy.drivers import (
+    DriverRegistry,
+    HostResolver,
+    InfluxDriver,
+    MalformedDataError,
+    validate_points,
+)
+from influxproxy.http import (
+    DEFAULT_POOL_SIZE,
+    DEFAULT_RETRIES,
+    DEFAULT_WRITE_TIMEOUT,
+    HTTPWriter,
+)
+from influxproxy.udp import DEFAULT_PAYLOAD_SIZE, UDPEndpoint
 
 
-class InfluxDriverTest(TestCase):
+class InfluxDriverTest(LoopTestCase):
     def setUp(self):
-        self.driver = InfluxDriver()
-        self.driver.client = MagicMock()
+        super().setUp()
+        self.driver = InfluxDriver(writer=AsyncMock())
 
     def create_points(self):
         points = [
             {
                 'measurement': 'my_metrics',
-                'time': datetime.utcnow().isoformat(),
+                'time': datetime(2016, 9, 1, 12).isoformat(),
                 'fields': {
                     'value': 1234,
                 }
             },
             {
                 'measurement': 'my_metrics_2',
-                'time': datetime.utcnow().isoformat(),
+                'time': datetime(2016, 9, 1, 12, 0, 1).isoformat(),
                 'fields': {
                     'value': 2345,
                 }
@@ -36,58 +50,393 @@ class InfluxDriverTest(TestCase):
         return points
 
     @istest
-    def starts_with_influx_client(self):
-        backend_conf = config['backend']
-
+    def starts_with_backend_udp_port(self):
         driver = InfluxDriver()
 
-        host = socket.gethostbyname(backend_conf['host'])
-        self.assertIsInstance(driver.client, InfluxDBClient)
-        self.assertEqual(driver.client._host, host)
-        self.assertEqual(driver.client._port, backend_conf['port'])
-        self.assertEqual(driver.client.udp_port, backend_conf['udp_port'])
-        self.assertEqual(driver.client._username, backend_conf['username'])
-        self.assertEqual(driver.client._password, backend_conf['password'])
+        self.assertEqual(driver.udp_port, config['backend']['udp_port'])
 
-    @istest
-    def starts_with_alternative_udp_port(self):
-        driver = InfluxDriver(udp_port=1234)
+    def assert_sent(self, data):
+        self.driver.writer.write.assert_called_once_with(
+            'my_database', [data])
 
-        self.assertEqual(driver.client.udp_port, 1234)
+    @asynctest
+    async def writes_encoded_lines_to_backend(self):
+        await self.driver.write_lines(
+            'my_database', [b'my_metrics value=1i\n'])
 
-    @istest
-    def creates_databases(self):
-        with patch.dict(
-                config['databases'], {'db1': 'foo', 'db2': 'bar'}, clear=True):
-            self.driver.create_databases()
+        self.assert_sent(b'my_metrics value=1i\n')
 
-        self.assertEqual(self.driver.client.create_database.mock_calls, [
-            call('db1'),
-            call('db2'),
-        ])
+    @asynctest
+    async def writes_lines_in_given_precision(self):
+        await self.driver.write_lines(
+            'my_database', [b'my_metrics value=1i 1\n'], 's')
 
-    @istest
-    def writes_points_to_backend(self):
-        points = self.create_points()
+        self.driver.writer.write.assert_called_once_with(
+            'my_database', [b'my_metrics value=1i 1\n'], 's')
 
-        self.driver.write('my_database', points)
+    @istest
+    def encodes_points(self):
+        data = self.driver.encode(self.create_points()[:1])
 
-        self.driver.client.write_points.assert_called_once_with(
-            points, database='my_database')
+        self.assertEqual(
+            data, b'my_metrics value=1234i 1472731200000000000\n')
 
     @istest
-    def writes_single_point_to_backend(self):
-        points = self.create_points()[0]
-
-        self.driver.write('my_database', points)
+    def cant_encode_unsupported_values(self):
+        points = self.create_points()
+        points[0]['fields']['value'] = {'nested': 'dict'}
 
-        self.driver.client.write_points.assert_called_once_with(
-            [points], database='my_database')
+        with self.assertRaises(MalformedDataError):
+            self.driver.encode(points)
 
     @istest
-    def cant_write_if_measurement_missing(self):
+    def cant_validate_if_measurement_missing(self):
         points = self.create_points()
         del points[1]['measurement']
 
         with self.assertRaises(MalformedDataError):
-            self.driver.write('my_database', points)
+            validate_points(points)
+
+    @istest
+    def validates_single_point(self):
+        point = self.create_points()[0]
+
+        self.assertEqual(validate_points(point), [point])
+
+
+class HostResolverTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.resolver = HostResolver('localhost', self.loop, ttl=10)
+
+    def tearDown(self):
+        self.resolver.close()
+        super().tearDown()
+
+    @asynctest
+    async def resolves_host_asynchronously(self):
+        address = await self.resolver.resolve()
+
+        self.assertEqual(address, '127.0.0.1')
+
+    @asynctest
+    async def caches_address_until_it_expires(self):
+        await self.resolver.resolve()
+
+        with patch.object(self.resolver, 'refresh') as refresh:
+            await self.resolver.resolve()
+            self.assertFalse(refresh.called)
+
+            self.resolver.expires_at = 0
+            future = asyncio.Future(loop=self.loop)
+            future.set_result(None)
+            refresh.return_value = future
+            await self.resolver.resolve()
+            refresh.assert_called_once_with()
+
+    @asynctest
+    async def refreshes_in_the_background(self):
+        self.resolver.ttl = 0.01
+        await self.resolver.resolve()
+        self.resolver.address = 'stale'
+
+        await asyncio.sleep(0.05, loop=self.loop)
+
+        self.assertEqual(self.resolver.address, '127.0.0.1')
+
+    @asynctest
+    async def keeps_address_if_refresh_fails(self):
+        self.resolver.ttl = 0.01
+        await self.resolver.resolve()
+        self.resolver.host = 'bogus.invalid'
+
+        with patch.object(self.loop, 'getaddrinfo',
+                          side_effect=OSError('oops')):
+            await asyncio.sleep(0.05, loop=self.loop)
+
+        self.assertEqual(self.resolver.address, '127.0.0.1')
+
+    @asynctest
+    async def keeps_address_if_lookup_fails_after_it_expires(self):
+        await self.resolver.resolve()
+        self.resolver.close()
+        self.resolver.expires_at = self.loop.time()
+
+        with patch.object(self.loop, 'getaddrinfo',
+                          side_effect=OSError('oops')), \
+                patch('influxproxy.drivers.logger') as logger:
+            address = await self.resolver.resolve()
+
+        self.assertEqual(address, '127.0.0.1')
+        self.assertGreater(self.resolver.expires_at, self.loop.time() + 9)
+        logger.warning.assert_called_once_with(
+            'Could not resolve %s, keeping %s: %s',
+            'localhost', '127.0.0.1', ANY)
+
+    @asynctest
+    async def cant_resolve_if_first_lookup_fails(self):
+        with patch.object(self.loop, 'getaddrinfo',
+                          side_effect=OSError('oops')):
+            with self.assertRaises(OSError):
+                await self.resolver.resolve()
+
+        self.assertIsNone(self.resolver.address)
+
+    @asynctest
+    async def stops_refreshing_when_closed(self):
+        await self.resolver.resolve()
+        refresher = self.resolver._refresher
+
+        self.resolver.close()
+        await asyncio.sleep(0, loop=self.loop)
+
+        self.assertTrue(refresher.cancelled())
+        self.assertIsNone(self.resolver._refresher)
+
+
+class DriverRegistryTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.registry = DriverRegistry(self.loop)
+        self.host = config['backend']['host']
+
+    def tearDown(self):
+        self.registry.close()
+        super().tearDown()
+
+    @asynctest
+    async def creates_driver_for_backend_udp_port(self):
+        driver = await self.registry.get({})
+
+        udp_port = config['backend']['udp_port']
+        self.assertEqual(driver.udp_port, udp_port)
+        self.assertEqual(driver.host, '127.0.0.1')
+        self.assertEqual(driver.writer.payload_size, DEFAULT_PAYLOAD_SIZE)
+        self.assertEqual(
+            driver.writer.endpoint.address, ('127.0.0.1', udp_port))
+
+    @asynctest
+    async def creates_driver_for_database_config(self):
+        driver = await self.registry.get({
+            'udp_port': 1234,
+            'udp_payload_size': 512,
+        })
+
+        self.assertEqual(driver.udp_port, 1234)
+        self.assertEqual(driver.writer.payload_size, 512)
+
+    @asynctest
+    async def reuses_driver_for_same_udp_port(self):
+        driver1 = await self.registry.get({'udp_port': 1234})
+        driver2 = await self.registry.get({'udp_port': 1234})
+        driver3 = await self.registry.get({'udp_port': 2345})
+
+        self.assertIs(driver1, driver2)
+        self.assertIsNot(driver1, driver3)
+
+    @asynctest
+    async def shares_endpoint_between_drivers_of_a_destination(self):
+        driver1 = await self.registry.get({'udp_port': 1234})
+        driver2 = await self.registry.get({
+            'udp_port': 1234,
+            'udp_payload_size': 512,
+        })
+
+        self.assertIsNot(driver1, driver2)
+        self.assertIs(driver1.writer.endpoint, driver2.writer.endpoint)
+
+    @asynctest
+    async def creates_endpoint_once_for_concurrent_requests(self):
+        drivers = await asyncio.gather(
+            self.registry.get({'udp_port': 1234}),
+            self.registry.get({'udp_port': 1234, 'udp_payload_size': 512}),
+            loop=self.loop)
+
+        self.assertIs(drivers[0].writer.endpoint, drivers[1].writer.endpoint)
+
+    @asynctest
+    async def follows_backend_of_reloaded_config(self):
+        driver = await self.registry.get({})
+        resolver = self.registry.resolver
+        reloaded = copy.deepcopy(config)
+        reloaded['backend']['udp_port'] = 1234
+
+        with patch.object(
+                configuration, 'settings', Settings.compile(reloaded)):
+            same_host = await self.registry.get({})
+            self.assertIs(self.registry.resolver, resolver)
+            reloaded = copy.deepcopy(reloaded)
+            reloaded['backend']['host'] = '127.0.0.2'
+            with patch.object(configuration, 'settings',
+                              Settings.compile(reloaded)):
+                new_host = await self.registry.get({})
+
+        self.assertEqual(same_host.udp_port, 1234)
+        self.assertIsNot(same_host, driver)
+        self.assertEqual(new_host.writer.endpoint.address,
+                         ('127.0.0.2', 1234))
+        self.assertIsNone(resolver._refresher)
+
+    @asynctest
+    async def replaces_endpoint_when_address_changes(self):
+        driver = await self.registry.get({'udp_port': 1234})
+        old_endpoint = driver.writer.endpoint
+        self.registry.resolver.address = '10.0.0.1'
+        self.registry.resolver.expires_at = self.loop.time() + 10
+
+        driver = await self.registry.get({'udp_port': 1234})
+
+        self.assertEqual(driver.writer.endpoint.address, ('10.0.0.1', 1234))
+        self.assertTrue(old_endpoint.transport.is_closing())
+
+    @asynctest
+    async def replaces_endpoint_only_once_when_address_changes(self):
+        driver = await self.registry.get({'udp_port': 1234})
+        self.registry.resolver.address = '10.0.0.1'
+        self.registry.resolver.expires_at = self.loop.time() + 10
+
+        drivers = await asyncio.gather(
+            self.registry.get({'udp_port': 1234}),
+            self.registry.get({'udp_port': 1234, 'udp_payload_size': 512}),
+            loop=self.loop)
+
+        self.assertIs(driver, drivers[0])
+        self.assertIs(drivers[0].writer.endpoint, drivers[1].writer.endpoint)
+        self.assertFalse(drivers[0].writer.endpoint.transport.is_closing())
+
+    @asynctest
+    async def replaces_stale_endpoint_once_when_awaited_concurrently(self):
+        await self.registry.resolver.resolve()
+        creating = asyncio.Future(loop=self.loop)
+        self.registry.endpoints[self.host, 1234] = creating
+        gathering = asyncio.gather(
+            self.registry.get({'udp_port': 1234}),
+            self.registry.get({'udp_port': 1234, 'udp_payload_size': 512}),
+            loop=self.loop)
+        await asyncio.sleep(0, loop=self.loop)
+        stale = MagicMock(address=('10.0.0.1', 1234))
+
+        creating.set_result(stale)
+        drivers = await gathering
+
+        stale.close.assert_called_once_with()
+        self.assertIs(drivers[0].writer.endpoint, drivers[1].writer.endpoint)
+        self.assertEqual(
+            drivers[0].writer.endpoint.address, ('127.0.0.1', 1234))
+
+    @asynctest
+    async def fails_all_requests_waiting_for_failed_endpoint(self):
+        await self.registry.resolver.resolve()
+        creating = asyncio.Future(loop=self.loop)
+        self.registry.endpoints[self.host, 1234] = creating
+        gathering = asyncio.gather(
+            self.registry.get({'udp_port': 1234}),
+            self.registry.get({'udp_port': 1234, 'udp_payload_size': 512}),
+            loop=self.loop, return_exceptions=True)
+        await asyncio.sleep(0, loop=self.loop)
+
+        creating.set_exception(OSError('oops'))
+        results = await gathering
+
+        self.assertIsInstance(results[0], OSError)
+        self.assertIsInstance(results[1], OSError)
+        self.assertEqual(self.registry.endpoints, {})
+
+    @asynctest
+    async def retries_endpoint_creation_after_failures(self):
+        with patch.object(UDPEndpoint, 'create', new_callable=AsyncMock) \
+                as create:
+            create.side_effect = OSError('oops')
+            with self.assertRaises(OSError):
+                await self.registry.get({'udp_port': 1234})
+
+        driver = await self.registry.get({'udp_port': 1234})
+
+        self.assertEqual(driver.writer.endpoint.address, ('127.0.0.1', 1234))
+
+    @asynctest
+    async def encodes_in_database_precision(self):
+        driver = await self.registry.get({'udp_port': 1234, 'precision': 's'})
+
+        self.assertEqual(driver.encoder.precision, 's')
+        self.assertFalse(driver.adaptive_precision)
+
+    @asynctest
+    async def creates_http_driver(self):
+        driver = await self.registry.get({
+            'transport': 'http',
+            'precision': 'ms',
+            'gzip': True,
+            'retries': 5,
+            'write_timeout': 3,
+        })
+
+        backend_conf = config['backend']
+        writer = driver.writer
+        self.assertIsInstance(writer, HTTPWriter)
+        self.assertEqual(writer.url, 'http://127.0.0.1:{}/write'.format(
+            backend_conf['port']))
+        self.assertEqual(writer.precision, 'ms')
+        self.assertTrue(writer.gzip)
+        self.assertEqual(writer.retries, 5)
+        self.assertEqual(writer.write_timeout, 3)
+        self.assertEqual(writer.auth.login, backend_conf['username'])
+        self.assertEqual(writer.auth.password, backend_conf['password'])
+        self.assertEqual(driver.encoder.precision, 'ms')
+        self.assertFalse(driver.adaptive_precision)
+
+    @asynctest
+    async def creates_http_driver_with_defaults(self):
+        driver = await self.registry.get({'transport': 'http'})
+
+        self.assertIsNone(driver.writer.precision)
+        self.assertTrue(driver.adaptive_precision)
+        self.assertFalse(driver.writer.gzip)
+        self.assertEqual(driver.writer.retries, DEFAULT_RETRIES)
+        self.assertEqual(driver.writer.write_timeout, DEFAULT_WRITE_TIMEOUT)
+
+    @asynctest
+    async def shares_http_session_between_drivers(self):
+        driver1 = await self.registry.get({'transport': 'http'})
+        driver2 = await self.registry.get({'transport': 'http'})
+        driver3 = await self.registry.get({'transport': 'http', 'gzip': True})
+
+        self.assertIs(driver1, driver2)
+        self.assertIsNot(driver1, driver3)
+        self.assertIs(driver1.writer.session, driver3.writer.session)
+        self.assertEqual(
+            driver1.writer.session.connector.limit, DEFAULT_POOL_SIZE)
+
+    @asynctest
+    async def updates_http_url_when_address_changes(self):
+        driver = await self.registry.get({'transport': 'http'})
+        self.registry.resolver.address = '10.0.0.1'
+        self.registry.resolver.expires_at = self.loop.time() + 10
+
+        driver = await self.registry.get({'transport': 'http'})
+
+        self.assertEqual(driver.writer.url, 'http://10.0.0.1:{}/write'.format(
+            config['backend']['port']))
+
+    @asynctest
+    async def closes_http_session(self):
+        driver = await self.registry.get({'transport': 'http'})
+
+        self.registry.close()
+
+        self.assertTrue(driver.writer.session.closed)
+        self.assertIsNone(self.registry.session)
+
+    @asynctest
+    async def closes_all_endpoints(self):
+        driver = await self.registry.get({'udp_port': 1234})
+        creating = asyncio.Future(loop=self.loop)
+        self.registry.endpoints[self.host, 2345] = creating
+
+        self.registry.close()
+
+        self.assertTrue(driver.writer.endpoint.transport.is_closing())
+        self.assertTrue(creating.cancelled())
+        self.assertEqual(self.registry.endpoints, {})
+        self.assertEqual(self.registry.drivers, {})
+        self.assertIsNone(self.registry.resolver._refresher)
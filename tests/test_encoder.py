@@ -0,0 +1,345 @@
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase
+
+from influxdb.line_protocol import make_lines
+from nose.tools import istest
+
+from influxproxy.encoder import (
+    EncodingError,
+    LineEncoder,
+    encode_value,
+    normalize_times,
+    to_nanoseconds,
+)
+
+
+class LineEncoderTest(TestCase):
+    def setUp(self):
+        self.encoder = LineEncoder()
+
+    def create_points(self):
+        return [
+            {
+                'measurement': 'page load',
+                'time': '2016-09-01T12:00:00Z',
+                'tags': {
+                    'page': '/home,index',
+                    'browser': 'chrome=53',
+                    'empty': '',
+                    'missing': None,
+                    'version': 2,
+                },
+                'fields': {
+                    'duration': 123.5,
+                    'count': 3,
+                    'name': 'a "quoted"\nvalue',
+                    'ok': True,
+                    'failed': False,
+                    'blank': '',
+                    'nothing': None,
+                },
+            },
+            {
+                'measurement': 'clicks',
+                'time': '2016-09-01T12:00:01',
+                'fields': {'value': 1},
+            },
+            {
+                'measurement': 'clicks',
+                'time': 1472731201000000000,
+                'tags': {},
+                'fields': {'value with space': -2},
+            },
+            {
+                'measurement': 'offsets',
+                'time': '2016-09-01T14:30:00+02:30',
+                'fields': {'value': 0.1},
+            },
+        ]
+
+    @istest
+    def has_parity_with_influxdb_client(self):
+        points = self.create_points()
+
+        data = self.encoder.encode(points)
+
+        expected = make_lines({'points': points}).encode('utf-8')
+        self.assertEqual(data, expected)
+
+    @istest
+    def has_parity_when_series_are_repeated(self):
+        points = self.create_points() * 3
+
+        self.encoder.encode(points)
+        data = self.encoder.encode(points)
+
+        expected = make_lines({'points': points}).encode('utf-8')
+        self.assertEqual(data, expected)
+
+    @istest
+    def keeps_nanosecond_precision(self):
+        data = self.encoder.encode([{
+            'measurement': 'm',
+            'time': '2016-09-01T12:00:00.123456789Z',
+            'fields': {'value': 1},
+        }])
+
+        self.assertEqual(data, b'm value=1i 1472731200123456789\n')
+
+    @istest
+    def writes_time_in_precision(self):
+        encoder = LineEncoder(precision='ms')
+
+        data = encoder.encode([{
+            'measurement': 'm',
+            'time': '2016-09-01T12:00:00.123456789Z',
+            'fields': {'value': 1},
+        }])
+
+        self.assertEqual(data, b'm value=1i 1472731200123\n')
+
+    @istest
+    def writes_time_in_given_precision(self):
+        data = self.encoder.encode([{
+            'measurement': 'm',
+            'time': 1472731200123000000,
+            'fields': {'value': 1},
+        }], 'ms')
+
+        self.assertEqual(data, b'm value=1i 1472731200123\n')
+
+    @istest
+    def escapes_backslashes_in_strings(self):
+        data = self.encoder.encode([{
+            'measurement': 'm',
+            'time': 1,
+            'fields': {'path': 'C:\\'},
+        }])
+
+        self.assertEqual(data, b'm path="C:\\\\" 1\n')
+
+    @istest
+    def encodes_points_without_time(self):
+        line = self.encoder.encode_line({
+            'measurement': 'm',
+            'fields': {'value': 1},
+        })
+
+        self.assertEqual(line, 'm value=1i')
+
+    @istest
+    def encodes_unicode(self):
+        data = self.encoder.encode([{
+            'measurement': 'm',
+            'time': 1,
+            'tags': {'city': 'São Paulo'},
+            'fields': {'value': 'ç'},
+        }])
+
+        self.assertEqual(data, 'm,city=São\\ Paulo value="ç" 1\n'.encode())
+
+    @istest
+    def caches_series_prefixes(self):
+        points = self.create_points()
+
+        self.encoder.encode(points)
+
+        self.assertIn(('clicks', ()), self.encoder._prefixes)
+
+    @istest
+    def clears_cache_when_full(self):
+        encoder = LineEncoder(max_cached_prefixes=1)
+
+        encoder.encode(self.create_points())
+
+        self.assertEqual(len(encoder._prefixes), 1)
+        self.assertEqual(len(encoder._field_keys), 1)
+
+    @istest
+    def caches_equal_tag_values_of_other_types_apart(self):
+        lines = [
+            self.encoder.encode_line({
+                'measurement': 'm',
+                'tags': {'a': value},
+                'fields': {'value': 1},
+            })
+            for value in [True, 1, 1.0, True]]
+
+        self.assertEqual(lines, [
+            'm,a=True value=1i', 'm,a=1 value=1i', 'm,a=1.0 value=1i',
+            'm,a=True value=1i'])
+
+    @istest
+    def encodes_unhashable_tags_without_caching(self):
+        line = self.encoder.encode_line({
+            'measurement': 'm',
+            'tags': {'values': [1, 2]},
+            'fields': {'value': 1},
+        })
+
+        self.assertEqual(line, 'm,values=[1\\,\\ 2] value=1i')
+        self.assertEqual(self.encoder._prefixes, {})
+
+    @istest
+    def cant_encode_invalid_measurement(self):
+        for measurement in ['', 1, None, ['m']]:
+            with self.assertRaises(EncodingError):
+                self.encoder.encode_line({
+                    'measurement': measurement,
+                    'fields': {'value': 1},
+                })
+
+    @istest
+    def cant_encode_invalid_tags(self):
+        with self.assertRaises(EncodingError):
+            self.encoder.encode_line({
+                'measurement': 'm',
+                'tags': ['a', 'b'],
+                'fields': {'value': 1},
+            })
+
+    @istest
+    def cant_encode_line_breaks(self):
+        points = [
+            {'measurement': 'm\nevil', 'fields': {'value': 1}},
+            {'measurement': 'm', 'tags': {'a\rb': 'c'},
+             'fields': {'value': 1}},
+            {'measurement': 'm', 'tags': {'browser': 'x\nevil'},
+             'fields': {'value': 1}},
+            {'measurement': 'm', 'fields': {'value\nevil': 1}},
+        ]
+        for point in points:
+            with self.assertRaises(EncodingError):
+                self.encoder.encode_line(point)
+
+    @istest
+    def cant_encode_invalid_fields(self):
+        for fields in [{}, {'value': None}, {'': 1}, ['value']]:
+            with self.assertRaises(EncodingError):
+                self.encoder.encode_line({
+                    'measurement': 'm',
+                    'fields': fields,
+                })
+
+    @istest
+    def recovers_buffer_after_failures(self):
+        with self.assertRaises(EncodingError):
+            self.encoder.encode([
+                {'measurement': 'm', 'fields': {'value': 1}},
+                {'measurement': 'm', 'fields': {}},
+            ])
+
+        data = self.encoder.encode([
+            {'measurement': 'm', 'fields': {'value': 2}},
+        ])
+
+        self.assertEqual(data, b'm value=2i\n')
+
+
+class EncodeValueTest(TestCase):
+    @istest
+    def encodes_supported_values(self):
+        self.assertEqual(encode_value(1.5), '1.5')
+        self.assertEqual(encode_value(1), '1i')
+        self.assertEqual(encode_value('a'), '"a"')
+        self.assertEqual(encode_value(True), 'True')
+        self.assertEqual(encode_value(False), 'False')
+        self.assertIsNone(encode_value(''))
+        self.assertIsNone(encode_value(None))
+
+    @istest
+    def cant_encode_unsupported_values(self):
+        for value in [float('nan'), float('inf'), [1], {'a': 1}]:
+            with self.assertRaises(EncodingError):
+                encode_value(value)
+
+
+class ToNanosecondsTest(TestCase):
+    @istest
+    def keeps_integers(self):
+        self.assertEqual(to_nanoseconds(123), 123)
+
+    @istest
+    def converts_iso_strings(self):
+        self.assertEqual(
+            to_nanoseconds('2016-09-01T12:00:00.5Z'), 1472731200500000000)
+        self.assertEqual(
+            to_nanoseconds('2016-09-01 12:00:00'), 1472731200000000000)
+        self.assertEqual(
+            to_nanoseconds('2016-09-01T09:00:00-0300'), 1472731200000000000)
+
+    @istest
+    def converts_other_date_formats(self):
+        self.assertEqual(to_nanoseconds('2016-09-01'), 1472688000000000000)
+
+    @istest
+    def converts_datetimes(self):
+        self.assertEqual(
+            to_nanoseconds(datetime(2016, 9, 1, 12, 0, 0, 1)),
+            1472731200000001000)
+        tz = timezone(timedelta(hours=-3))
+        self.assertEqual(
+            to_nanoseconds(datetime(2016, 9, 1, 9, tzinfo=tz)),
+            1472731200000000000)
+
+    @istest
+    def cant_convert_invalid_times(self):
+        for timestamp in ['2016-13-01T12:00:00Z', 'yesterday', 1.5, True]:
+            with self.assertRaises(EncodingError):
+                to_nanoseconds(timestamp)
+
+
+class NormalizeTimesTest(TestCase):
+    def points(self, *times):
+        return [
+            {'measurement': 'm', 'fields': {'value': 1}, 'time': timestamp}
+            for timestamp in times]
+
+    def times(self, points):
+        return [point['time'] for point in points]
+
+    @istest
+    def converts_times_to_nanoseconds(self):
+        points = self.points(
+            1472731200123456789, '2016-09-01T12:00:00.5Z',
+            datetime(2016, 9, 1, 12, 0, 0, 1))
+
+        self.assertEqual(normalize_times(points), 'n')
+        self.assertEqual(self.times(points), [
+            1472731200123456789, 1472731200500000000, 1472731200000001000])
+
+    @istest
+    def reads_integers_in_precision(self):
+        points = self.points(1472731200123, '2016-09-01T12:00:01Z')
+
+        self.assertEqual(normalize_times(points, 'ms'), 'ms')
+        self.assertEqual(self.times(points), [
+            1472731200123000000, 1472731201000000000])
+
+    @istest
+    def finds_coarsest_precision(self):
+        cases = [
+            ((1472731200, 1472731260), 's', 's'),
+            ((1472731200000, 1472731200500), 'ms', 'ms'),
+            ((1472731200000001,), 'u', 'u'),
+            ((1472731200000000001,), None, 'n'),
+            ((), None, 's'),
+        ]
+        for times, precision, coarsest in cases:
+            self.assertEqual(
+                normalize_times(self.points(*times), precision), coarsest)
+
+    @istest
+    def stamps_points_without_time(self):
+        points = self.points(None, 1)
+        del points[0]['time']
+
+        normalize_times(points, 's', now=1472731200000000000)
+
+        self.assertEqual(self.times(points), [1472731200000000000, 10 ** 9])
+
+    @istest
+    def cant_normalize_invalid_times(self):
+        for points in (self.points('yesterday'), self.points(None)):
+            with self.assertRaises(EncodingError):
+                normalize_times(points)
@@ -0,0 +1,183 @@
+import asyncio
+import gzip
+import socket
+from unittest import TestCase
+from unittest.mock import patch
+
+import aiohttp
+from nose.tools import istest
+
+from .base import LoopTestCase, asynctest
+from .fakes import FakeInfluxHTTP
+from influxproxy.http import (
+    MAX_RETRY_DELAY,
+    BackendError,
+    HTTPWriter,
+    create_session,
+    gzip_chunks,
+)
+
+
+class GzipChunksTest(TestCase):
+    @istest
+    def compresses_chunks_as_a_single_gzip_stream(self):
+        data = gzip_chunks([b'a 1\n', b'b 2\n'])
+
+        self.assertEqual(gzip.decompress(data), b'a 1\nb 2\n')
+
+
+class CreateSessionTest(LoopTestCase):
+    @istest
+    def limits_connection_pool(self):
+        session = create_session(self.loop, pool_size=3)
+
+        self.assertEqual(session.connector.limit, 3)
+        self.assertFalse(session.connector.force_close)
+        session.close()
+
+
+class HTTPWriterTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backend = FakeInfluxHTTP(self.loop)
+        self.loop.run_until_complete(self.backend.start())
+        self.session = create_session(self.loop)
+        self.writer = HTTPWriter(
+            self.session, self.backend.url, self.loop,
+            auth=aiohttp.BasicAuth('root', 'secret'), retry_delay=0.001)
+
+    def tearDown(self):
+        self.session.close()
+        self.loop.run_until_complete(self.backend.stop())
+        super().tearDown()
+
+    @asynctest
+    async def writes_lines_to_backend(self):
+        await self.writer.write('my_db', [b'a 1\n', b'b 2\n'])
+
+        request, body = self.backend.requests[0]
+        self.assertEqual(body, b'a 1\nb 2\n')
+        self.assertEqual(request.GET['db'], 'my_db')
+        self.assertNotIn('precision', request.GET)
+        self.assertNotIn('Content-Encoding', request.headers)
+        self.assertEqual(
+            request.headers['Authorization'],
+            aiohttp.BasicAuth('root', 'secret').encode())
+
+    @asynctest
+    async def writes_with_precision(self):
+        self.writer.precision = 's'
+
+        await self.writer.write('my_db', [b'a 1 1\n'])
+
+        request, _ = self.backend.requests[0]
+        self.assertEqual(request.GET['precision'], 's')
+
+    @asynctest
+    async def writes_with_precision_of_batch(self):
+        self.writer.precision = 's'
+
+        await self.writer.write('my_db', [b'a 1 1000\n'], 'ms')
+
+        request, _ = self.backend.requests[0]
+        self.assertEqual(request.GET['precision'], 'ms')
+
+    @asynctest
+    async def compresses_body(self):
+        self.writer.gzip = True
+
+        await self.writer.write('my_db', [b'a 1\n', b'b 2\n'])
+
+        request, body = self.backend.requests[0]
+        self.assertEqual(request.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(self.backend.lines, [b'a 1', b'b 2'])
+
+    @asynctest
+    async def reuses_connections(self):
+        await self.writer.write('my_db', [b'a 1\n'])
+        await self.writer.write('my_db', [b'b 2\n'])
+
+        self.assertEqual(len(self.backend.handler.connections), 1)
+
+    @asynctest
+    async def retries_when_backend_fails(self):
+        self.backend.statuses = [500, 503]
+
+        with patch('influxproxy.http.logger'):
+            await self.writer.write('my_db', [b'a 1\n'])
+
+        self.assertEqual(len(self.backend.requests), 3)
+        self.assertEqual(self.backend.lines, [b'a 1'])
+
+    @asynctest
+    async def gives_up_after_retries(self):
+        self.backend.statuses = [500] * 4
+
+        with patch('influxproxy.http.logger'):
+            with self.assertRaises(aiohttp.ClientResponseError):
+                await self.writer.write('my_db', [b'a 1\n'])
+
+        self.assertEqual(len(self.backend.requests), 4)
+
+    @asynctest
+    async def doesnt_retry_refused_writes(self):
+        self.backend.statuses = [400]
+
+        with self.assertRaises(BackendError):
+            await self.writer.write('my_db', [b'a 1\n'])
+
+        self.assertEqual(len(self.backend.requests), 1)
+
+    @asynctest
+    async def retries_when_backend_hangs(self):
+        self.backend.delay = 0.2
+        self.writer.write_timeout = 0.05
+        self.writer.retries = 1
+
+        with patch('influxproxy.http.logger') as logger:
+            with self.assertRaises(asyncio.TimeoutError):
+                await self.writer.write('my_db', [b'a 1\n'])
+
+        self.assertEqual(logger.warning.call_count, 1)
+        self.assertEqual(len(self.backend.requests), 2)
+
+    @asynctest
+    async def retries_when_backend_is_unreachable(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.writer.url = 'http://127.0.0.1:{}/write'.format(
+            sock.getsockname()[1])
+        self.writer.retries = 1
+        sock.close()
+
+        with patch('influxproxy.http.logger') as logger:
+            with self.assertRaises(aiohttp.ClientOSError):
+                await self.writer.write('my_db', [b'a 1\n'])
+
+        self.assertEqual(logger.warning.call_count, 1)
+
+    @istest
+    def backs_off_exponentially_with_jitter(self):
+        self.writer.retry_delay = 1
+
+        with patch('influxproxy.http.random.uniform') as uniform:
+            self.writer.backoff(0)
+            self.writer.backoff(2)
+            self.writer.backoff(10)
+
+        self.assertEqual(
+            [c[0] for c in uniform.call_args_list],
+            [(0, 1), (0, 4), (0, MAX_RETRY_DELAY)])
+
+
+class FakeInfluxHTTPTest(LoopTestCase):
+    @asynctest
+    async def stops_serving(self):
+        backend = FakeInfluxHTTP(self.loop)
+        await backend.start()
+
+        await backend.stop()
+
+        with self.assertRaises(OSError):
+            await asyncio.open_connection(
+                '127.0.0.1', backend.port, loop=self.loop)
@@ -0,0 +1,403 @@
+import gzip
+import time
+import zlib
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+
+from aiohttp.streams import StreamReader
+from multidict import CIMultiDict
+from nose.tools import istest
+
+from .base import LoopTestCase, asynctest
+from influxproxy.drivers import MalformedDataError
+from influxproxy.encoder import LineEncoder
+from influxproxy.ingestion import (
+    BodyTooLargeError,
+    RequestBody,
+    decode_record,
+    encode_points,
+    parse_line,
+    parse_precision,
+    read_line_protocol,
+    read_ndjson,
+    rescale_times,
+    validate_lines,
+)
+
+
+class ValidateLinesTest(TestCase):
+    def assert_invalid(self, data):
+        with self.assertRaises(MalformedDataError):
+            validate_lines(data)
+
+    @istest
+    def counts_points(self):
+        data = (
+            b'cpu value=1\n'
+            b'cpu,host=a,region=b value=1i,ok=t 1472731200000000000\n'
+            b'mem free=-1.5e3,used=10u,name="a \\"b\\"" -10\n')
+
+        self.assertEqual(validate_lines(data), 3)
+
+    @istest
+    def accepts_missing_trailing_newline(self):
+        self.assertEqual(validate_lines(b'cpu value=1\ncpu value=2'), 2)
+
+    @istest
+    def accepts_escaped_keys(self):
+        data = b'my\\ cpu,host\\=x=a\\,b field\\ 1=1\n'
+
+        self.assertEqual(validate_lines(data), 1)
+
+    @istest
+    def skips_blank_lines_and_comments(self):
+        data = b'\n# a comment\r\ncpu value=1\r\n\r\n'
+
+        self.assertEqual(validate_lines(data), 1)
+
+    @istest
+    def accepts_empty_data(self):
+        self.assertEqual(validate_lines(b''), 0)
+
+    @istest
+    def rejects_line_without_fields(self):
+        self.assert_invalid(b'cpu\n')
+
+    @istest
+    def rejects_tag_without_value(self):
+        self.assert_invalid(b'cpu,host value=1\n')
+
+    @istest
+    def rejects_invalid_field_value(self):
+        self.assert_invalid(b'cpu value=abc\n')
+
+    @istest
+    def rejects_long_invalid_numbers_in_linear_time(self):
+        started = time.monotonic()
+
+        self.assert_invalid(b'cpu value=' + b'1' * 100000 + b'x\n')
+        self.assert_invalid(b'cpu value=1.' + b'1' * 100000 + b'x\n')
+
+        self.assertLess(time.monotonic() - started, 1)
+
+    @istest
+    def rejects_unterminated_string(self):
+        self.assert_invalid(b'cpu value="abc\n')
+
+    @istest
+    def rejects_invalid_timestamp(self):
+        self.assert_invalid(b'cpu value=1 2016-09-01\n')
+
+    @istest
+    def reports_invalid_line_number(self):
+        with self.assertRaises(MalformedDataError) as context:
+            validate_lines(b'cpu value=1\n\ncpu value\n')
+
+        self.assertIn('line 3', str(context.exception))
+
+
+class ParseLineTest(TestCase):
+    @istest
+    def parses_series_and_fields(self):
+        key, fields = parse_line(
+            b'clicks,page=home value=1i,label="a b,c" 1472731200')
+
+        self.assertEqual(key, b'clicks,page=home')
+        self.assertEqual(
+            fields, [(b'value', b'1i'), (b'label', b'"a b,c"')])
+
+    @istest
+    def parses_escaped_keys(self):
+        key, fields = parse_line(b'my\\ clicks,a\\ b=c\\,d x\\=y=1.5')
+
+        self.assertEqual(key, b'my\\ clicks,a\\ b=c\\,d')
+        self.assertEqual(fields, [(b'x\\=y', b'1.5')])
+
+
+class ParsePrecisionTest(TestCase):
+    @istest
+    def maps_query_to_line_protocol_precision(self):
+        for query, precision in [('s', 's'), ('ms', 'ms'), ('us', 'u'),
+                                 ('ns', 'n')]:
+            request = SimpleNamespace(GET={'precision': query})
+            self.assertEqual(parse_precision(request), precision)
+
+    @istest
+    def defaults_to_none(self):
+        self.assertIsNone(parse_precision(SimpleNamespace(GET={})))
+
+    @istest
+    def refuses_unknown_precision(self):
+        with self.assertRaises(MalformedDataError):
+            parse_precision(SimpleNamespace(GET={'precision': 'h'}))
+
+
+class RescaleTimesTest(TestCase):
+    @istest
+    def rewrites_times_in_target_precision(self):
+        data = (
+            b'cpu value=1 1472731200123\n'
+            b'cpu value=1\n'
+            b'cpu name="a 12" -1000\r\n')
+
+        self.assertEqual(rescale_times(data, 'ms', 'u'), (
+            b'cpu value=1 1472731200123000\n'
+            b'cpu value=1\n'
+            b'cpu name="a 12" -1000000\r\n'))
+        self.assertEqual(
+            rescale_times(b'cpu value=1 1472731200123\n', 'ms', 's'),
+            b'cpu value=1 1472731200\n')
+
+
+class EncodePointsTest(TestCase):
+    def setUp(self):
+        self.driver = LineEncoder()
+        self.points = [
+            {'measurement': 'm', 'time': 1472731200, 'fields': {'v': 1}},
+            {'measurement': 'm', 'fields': {'v': 2}},
+        ]
+
+    @istest
+    def requires_times_by_default(self):
+        with self.assertRaises(MalformedDataError):
+            encode_points(self.points, self.driver)
+
+    @istest
+    def stamps_points_without_time(self):
+        data, count, precision = encode_points(
+            self.points, self.driver, precision='s',
+            now=1472731201000000000)
+
+        self.assertEqual(data, (
+            b'm v=1i 1472731200000000000\n'
+            b'm v=2i 1472731201000000000\n'))
+        self.assertEqual(count, 2)
+        self.assertIsNone(precision)
+
+    @istest
+    def writes_in_coarsest_precision(self):
+        data, _, precision = encode_points(
+            self.points[:1], self.driver, precision='s', adapt=True)
+
+        self.assertEqual(data, b'm v=1i 1472731200\n')
+        self.assertEqual(precision, 's')
+
+    @istest
+    def refuses_invalid_times(self):
+        self.points[0]['time'] = 'yesterday'
+
+        with self.assertRaises(MalformedDataError):
+            encode_points(self.points[:1], self.driver, precision='s')
+
+
+class DecodeRecordTest(TestCase):
+    @istest
+    def decodes_point(self):
+        point = decode_record(b'{"measurement": "cpu"}\n', 1)
+
+        self.assertEqual(point, {'measurement': 'cpu'})
+
+    @istest
+    def skips_blank_line(self):
+        self.assertIsNone(decode_record(b'  \n', 1))
+
+    @istest
+    def rejects_invalid_json(self):
+        with self.assertRaises(MalformedDataError) as context:
+            decode_record(b'{"measurement"\n', 2)
+
+        self.assertIn('line 2', str(context.exception))
+
+    @istest
+    def rejects_non_object(self):
+        with self.assertRaises(MalformedDataError):
+            decode_record(b'[1, 2]\n', 1)
+
+
+class FakeRequest:
+    def __init__(self, data, loop, headers=None, content_length=None):
+        self.content = StreamReader(loop=loop)
+        self.content.feed_data(data)
+        self.content.feed_eof()
+        self.headers = CIMultiDict(headers or {})
+        self.content_length = content_length
+
+
+class RequestBodyTest(LoopTestCase):
+    def body(self, data, encoding=None, max_size=1000, **kwargs):
+        headers = {}
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        request = FakeRequest(data, self.loop, headers, **kwargs)
+        return RequestBody(request, max_size)
+
+    @asynctest
+    async def reads_plain_body(self):
+        body = self.body(b'cpu value=1i\n')
+
+        self.assertEqual(await body.read(), b'cpu value=1i\n')
+
+    @asynctest
+    async def inflates_gzip_body(self):
+        body = self.body(gzip.compress(b'cpu value=1i\n'), 'GZip')
+
+        self.assertEqual(await body.read(), b'cpu value=1i\n')
+
+    @asynctest
+    async def inflates_body_read_in_small_pieces(self):
+        body = self.body(gzip.compress(b'cpu value=1i\n'), 'gzip')
+
+        with patch('influxproxy.ingestion.READ_SIZE', 5):
+            self.assertEqual(await body.read(), b'cpu value=1i\n')
+
+    @asynctest
+    async def inflates_deflate_body(self):
+        body = self.body(zlib.compress(b'cpu value=1i\n'), 'deflate')
+
+        self.assertEqual(await body.read(), b'cpu value=1i\n')
+
+    @asynctest
+    async def inflates_in_bounded_chunks(self):
+        data = b'x' * 100
+        body = self.body(gzip.compress(data), 'gzip')
+
+        with patch('influxproxy.ingestion.DECOMPRESSED_CHUNK_SIZE', 30):
+            chunks = [await body.read_chunk() for _ in range(5)]
+
+        self.assertEqual([len(chunk) for chunk in chunks], [30, 30, 30, 10, 0])
+
+    @istest
+    def refuses_unknown_encoding(self):
+        with self.assertRaises(MalformedDataError):
+            self.body(b'', 'br')
+
+    @istest
+    def refuses_declared_length_over_limit(self):
+        with self.assertRaises(BodyTooLargeError):
+            self.body(b'', content_length=1001)
+
+    @asynctest
+    async def refuses_plain_body_over_limit(self):
+        body = self.body(b'x' * 1001)
+
+        with self.assertRaises(BodyTooLargeError):
+            await body.read()
+
+    @asynctest
+    async def refuses_body_inflating_over_limit(self):
+        body = self.body(gzip.compress(b'\0' * 10000000), 'gzip')
+
+        with self.assertRaises(BodyTooLargeError):
+            await body.read()
+
+        self.assertEqual(body.size, 1001)
+
+    @asynctest
+    async def refuses_invalid_compressed_body(self):
+        body = self.body(b'not gzip', 'gzip')
+
+        with self.assertRaises(MalformedDataError):
+            await body.read()
+
+    @asynctest
+    async def refuses_truncated_compressed_body(self):
+        body = self.body(gzip.compress(b'cpu value=1i\n')[:-4], 'gzip')
+
+        with self.assertRaises(MalformedDataError):
+            await body.read()
+
+    @asynctest
+    async def refuses_data_after_compressed_body(self):
+        body = self.body(gzip.compress(b'cpu value=1i\n') + b'junk', 'gzip')
+
+        with self.assertRaises(MalformedDataError):
+            await body.read()
+
+    @asynctest
+    async def reads_lines_across_chunks(self):
+        body = self.body(gzip.compress(b'a\nbc\n\nd'), 'gzip')
+        lines = []
+
+        with patch('influxproxy.ingestion.DECOMPRESSED_CHUNK_SIZE', 3):
+            line = await body.read_line()
+            while line is not None:
+                lines.append(line)
+                line = await body.read_line()
+
+        self.assertEqual(lines, [b'a', b'bc', b'', b'd'])
+
+
+class ReadLineProtocolTest(LoopTestCase):
+    def read(self, body, chunk_size=15):
+        return read_line_protocol(body, chunk_size=chunk_size)
+
+    def body(self, data, headers=None):
+        return RequestBody(
+            FakeRequest(data, self.loop, headers), max_size=10000000)
+
+    @asynctest
+    async def gathers_lines_in_chunks(self):
+        data = b'# comment\ncpu v=1i\n\nmem v=2i\ndisk v=3i'
+
+        chunks = await self.read(self.body(data))
+
+        self.assertEqual(chunks, [
+            (b'cpu v=1i\nmem v=2i\n', 2),
+            (b'disk v=3i\n', 1),
+        ])
+
+    @asynctest
+    async def ends_lines_without_carriage_returns(self):
+        chunks = await self.read(self.body(b'cpu v=1i 1\r\nmem v=2i\r\n'))
+
+        self.assertEqual(chunks, [(b'cpu v=1i 1\nmem v=2i\n', 2)])
+
+    @asynctest
+    async def reads_body_without_points(self):
+        chunks = await self.read(self.body(b'# comment\n\n'))
+
+        self.assertEqual(chunks, [])
+
+    @asynctest
+    async def stops_reading_at_invalid_line(self):
+        data = b'cpu v=1i\nbogus\n' + b'cpu v=1i\n' * 100000
+        body = self.body(
+            gzip.compress(data), headers={'Content-Encoding': 'gzip'})
+
+        with self.assertRaises(MalformedDataError) as context:
+            await self.read(body)
+
+        self.assertIn('Invalid line 2', str(context.exception))
+        self.assertLess(body.size, len(data))
+
+
+class ReadNDJSONTest(LoopTestCase):
+    def read(self, data, chunk_size=2):
+        body = RequestBody(FakeRequest(data, self.loop))
+        return read_ndjson(body, LineEncoder(), chunk_size=chunk_size)
+
+    @asynctest
+    async def encodes_records_in_chunks(self):
+        data = b''.join(
+            '{{"measurement": "m", "time": 1, "fields": {{"v": {}}}}}\n'
+            .format(i).encode('utf-8')
+            for i in range(3))
+
+        chunks = await self.read(data)
+
+        self.assertEqual(chunks, [
+            (b'm v=0i 1\nm v=1i 1\n', 2),
+            (b'm v=2i 1\n', 1),
+        ])
+
+    @asynctest
+    async def reads_empty_body(self):
+        chunks = await self.read(b'\n')
+
+        self.assertEqual(chunks, [])
+
+    @asynctest
+    async def rejects_invalid_point(self):
+        with self.assertRaises(MalformedDataError):
+            await self.read(b'{"measurement": "m"}\n')
@@ -0,0 +1,175 @@
+import io
+import json
+import logging
+import queue
+import sys
+from unittest import TestCase
+from unittest.mock import patch
+
+from nose.tools import istest
+
+from influxproxy import logs
+from influxproxy.configuration import config
+from influxproxy.logs import (
+    DroppingQueueHandler,
+    JsonFormatter,
+    restart_logging,
+    setup_logging,
+    should_log,
+    stop_logging,
+)
+
+
+def make_record(msg='Wrote %d points', args=(3,), exc_info=None, **extra):
+    record = logging.LogRecord(
+        'influxproxy.tests', logging.INFO, __file__, 1, msg, args, exc_info)
+    record.__dict__.update(extra)
+    return record
+
+
+def failure():
+    try:
+        raise RuntimeError('oops')
+    except RuntimeError:
+        return make_record('Failed', (), sys.exc_info())
+
+
+class JsonFormatterTest(TestCase):
+    @istest
+    def formats_records_as_json_lines(self):
+        record = make_record(
+            request_id='abc', database='testing', status=204, route=None)
+        record.created = 0
+        record.msecs = 5
+
+        line = JsonFormatter().format(record)
+
+        self.assertEqual(json.loads(line), {
+            'time': '1970-01-01T00:00:00.005Z',
+            'level': 'INFO',
+            'logger': 'influxproxy.tests',
+            'message': 'Wrote 3 points',
+            'request_id': 'abc',
+            'database': 'testing',
+            'status': 204,
+        })
+
+    @istest
+    def includes_tracebacks_on_the_same_line(self):
+        line = JsonFormatter().format(failure())
+
+        self.assertNotIn('\n', line)
+        self.assertIn('RuntimeError: oops', json.loads(line)['exception'])
+
+
+class DroppingQueueHandlerTest(TestCase):
+    def setUp(self):
+        self.handler = DroppingQueueHandler(queue.Queue(1))
+
+    @istest
+    def queues_records_with_their_message_and_traceback(self):
+        self.handler.handle(failure())
+
+        record = self.handler.queue.get_nowait()
+        self.assertEqual(record.getMessage(), 'Failed')
+        self.assertIsNone(record.exc_info)
+        self.assertIn('RuntimeError: oops', record.exc_text)
+
+    @istest
+    def drops_records_when_queue_is_full(self):
+        self.handler.handle(make_record())
+        self.handler.handle(make_record())
+
+        self.assertEqual(self.handler.queue.qsize(), 1)
+        self.assertEqual(self.handler.dropped, 1)
+
+
+class SetupLoggingTest(TestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.logger = logging.getLogger('influxproxy.tests')
+        self.addCleanup(setup_logging, config.get('logging', {}))
+
+    @istest
+    def writes_json_from_a_thread(self):
+        handler = setup_logging({}, self.stream)
+        self.logger.info('Wrote %d points', 3, extra={'database': 'udp'})
+        stop_logging()
+
+        self.assertIsInstance(handler, DroppingQueueHandler)
+        self.assertIn(handler, logging.getLogger().handlers)
+        entry = json.loads(self.stream.getvalue())
+        self.assertEqual(entry['message'], 'Wrote 3 points')
+        self.assertEqual(entry['database'], 'udp')
+
+    @istest
+    def writes_text_as_it_comes(self):
+        handler = setup_logging(
+            {'handler': 'stream', 'format': 'text', 'level': 'WARNING'},
+            self.stream)
+        self.logger.info('Hidden')
+        self.logger.warning('Wrote %d points', 3)
+
+        self.assertIsInstance(handler, logging.StreamHandler)
+        self.assertEqual(
+            self.stream.getvalue(),
+            'WARNING:influxproxy.tests:Wrote 3 points\n')
+
+    @istest
+    def replaces_its_previous_handler(self):
+        first = setup_logging({}, self.stream)
+        second = setup_logging({'handler': 'stream'}, self.stream)
+
+        root_handlers = logging.getLogger().handlers
+        self.assertNotIn(first, root_handlers)
+        self.assertIn(second, root_handlers)
+
+    @istest
+    def restarts_thread_with_a_new_queue(self):
+        handler = setup_logging({'max_queued_records': 5}, self.stream)
+        old_queue = handler.queue
+
+        restart_logging()
+        self.logger.info('Restarted')
+        stop_logging()
+
+        self.assertIsNot(handler.queue, old_queue)
+        self.assertEqual(handler.queue.maxsize, 5)
+        self.assertIn('Restarted', self.stream.getvalue())
+
+    @istest
+    def restarts_nothing_without_thread(self):
+        setup_logging({'handler': 'stream'}, self.stream)
+
+        restart_logging()
+
+        self.assertIsNone(logs._listener)
+
+
+class ShouldLogTest(TestCase):
+    @istest
+    def logs_all_requests_by_default(self):
+        self.assertTrue(should_log('send_metric', 204, {}))
+
+    @istest
+    def logs_failures_whatever_the_rate(self):
+        rates = {'send_metric': 0}
+
+        self.assertTrue(should_log('send_metric', 400, rates))
+        self.assertTrue(should_log('send_metric', 500, rates))
+
+    @istest
+    def samples_shed_load_like_successes(self):
+        rates = {'send_metric': 0}
+
+        self.assertFalse(should_log('send_metric', 204, rates))
+        self.assertFalse(should_log('send_metric', 429, rates))
+        self.assertFalse(should_log('send_metric', 503, rates))
+
+    @istest
+    def samples_requests_at_their_route_rate(self):
+        rates = {'send_metric': 0.25}
+
+        with patch('influxproxy.logs.random.random', side_effect=[0.2, 0.3]):
+            self.assertTrue(should_log('send_metric', 204, rates))
+            self.assertFalse(should_log('send_metric', 204, rates))
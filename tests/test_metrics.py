@@ -0,0 +1,355 @@
+import multiprocessing
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from nose.tools import istest
+
+from .base import AsyncMock, LoopTestCase, asynctest
+from influxproxy import metrics
+from influxproxy.metrics import (
+    COLLECT_INTERVAL,
+    DEFAULT_BUCKETS,
+    DEFAULT_EMIT_INTERVAL,
+    Layout,
+    MetricsTable,
+    Recorder,
+    StatsReporter,
+    claim_slot,
+    create_shared_metrics,
+    get_recorder,
+    use_slot,
+)
+from influxproxy.udp import UDPStats
+
+
+def create_recorder(slots=1, slot=0):
+    return Recorder(MetricsTable(Layout(['db1', 'db2']), slots), slot)
+
+
+class LayoutTest(TestCase):
+    @istest
+    def places_every_label_combination(self):
+        layout = Layout(['db1', 'db2'])
+        requests = layout.by_name['influxproxy_request_duration_seconds']
+        points = layout.by_name['influxproxy_points_total']
+
+        self.assertEqual(len(requests.offsets), 2 * 3)
+        self.assertEqual(requests.width, len(DEFAULT_BUCKETS) + 2)
+        self.assertIn(('send_metric', 'other'), requests.offsets)
+        self.assertIn(('db2', 'dropped'), points.offsets)
+        offsets = sorted(
+            offset for family in layout.families
+            for offset in family.offsets.values())
+        self.assertEqual(len(set(offsets)), len(offsets))
+        self.assertLess(offsets[-1], layout.size)
+
+    @istest
+    def counts_unknown_databases_as_other(self):
+        layout = Layout(['db1'])
+
+        self.assertEqual(layout.database('db1'), 'db1')
+        self.assertEqual(layout.database('bogus'), 'other')
+        self.assertEqual(layout.database(None), 'other')
+
+
+class RecorderTest(TestCase):
+    def setUp(self):
+        self.recorder = create_recorder()
+
+    def assert_rendered(self, *lines):
+        rendered = self.recorder.render().splitlines()
+        for line in lines:
+            self.assertIn(line, rendered)
+
+    @istest
+    def renders_help_and_type(self):
+        self.assert_rendered(
+            '# HELP influxproxy_points_total '
+            'Points received, by what became of them.',
+            '# TYPE influxproxy_points_total counter',
+            '# TYPE influxproxy_queue_points gauge',
+            '# TYPE influxproxy_request_duration_seconds histogram',
+        )
+
+    @istest
+    def counts_points_and_rejections(self):
+        self.recorder.count_points('db1', 'accepted', 10)
+        self.recorder.count_points('db1', 'accepted', 5)
+        self.recorder.count_points('bogus', 'queue_full', 3)
+        self.recorder.reject_request('db2', 'forbidden')
+
+        self.assert_rendered(
+            'influxproxy_points_total{database="db1",outcome="accepted"} 15',
+            'influxproxy_points_total{database="other",outcome="queue_full"}'
+            ' 3',
+            'influxproxy_rejected_requests_total'
+            '{database="db2",reason="forbidden"} 1',
+            'influxproxy_rejected_requests_total'
+            '{database="db1",reason="forbidden"} 0',
+        )
+
+    @istest
+    def observes_durations_in_cumulative_buckets(self):
+        self.recorder.observe_request('send_metric', 'db1', 0.003)
+        self.recorder.observe_request('send_metric', 'db1', 0.005)
+        self.recorder.observe_request('send_metric', 'db1', 20)
+
+        name = 'influxproxy_request_duration_seconds'
+        labels = 'route="send_metric",database="db1"'
+        self.assert_rendered(
+            '{}_bucket{{{},le="0.0025"}} 0'.format(name, labels),
+            '{}_bucket{{{},le="0.005"}} 2'.format(name, labels),
+            '{}_bucket{{{},le="10"}} 2'.format(name, labels),
+            '{}_bucket{{{},le="+Inf"}} 3'.format(name, labels),
+            '{}_sum{{{}}} 20.008'.format(name, labels),
+            '{}_count{{{}}} 3'.format(name, labels),
+        )
+
+    @istest
+    def counts_failed_writes(self):
+        self.recorder.observe_write('db1', 0.5)
+        self.recorder.observe_write('db1', 1.5, failed=True)
+
+        self.assert_rendered(
+            'influxproxy_backend_write_duration_seconds_count'
+            '{database="db1"} 2',
+            'influxproxy_backend_write_errors_total{database="db1"} 1',
+        )
+
+    @istest
+    def counts_spilled_bytes(self):
+        self.recorder.count_spill('db1', 'spilled', 100)
+        self.recorder.count_spill('db1', 'replayed', 60)
+
+        self.assert_rendered(
+            'influxproxy_spill_bytes_total'
+            '{database="db1",outcome="spilled"} 100',
+            'influxproxy_spill_bytes_total'
+            '{database="db1",outcome="replayed"} 60',
+            'influxproxy_spill_bytes_total'
+            '{database="db1",outcome="evicted"} 0',
+        )
+
+    @istest
+    def sets_queue_gauges(self):
+        self.recorder.set_queue('db1', 10, 100)
+        self.recorder.set_queue('db1', 4, 40)
+        self.recorder.add_udp(100, 2)
+        self.recorder.add_udp(50, 1)
+
+        self.assert_rendered(
+            'influxproxy_queue_points{database="db1"} 4',
+            'influxproxy_queue_bytes{database="db1"} 40',
+            'influxproxy_udp_bytes_total 150',
+            'influxproxy_udp_datagrams_total 3',
+        )
+
+    @istest
+    def escapes_label_values(self):
+        recorder = Recorder(MetricsTable(Layout(['a"b\\c\n']), 1), 0)
+
+        self.assertIn('database="a\\"b\\\\c\\n"', recorder.render())
+
+    @istest
+    def adds_up_all_workers(self):
+        table = MetricsTable(Layout(['db1']), 3)
+        Recorder(table, 0).count_points('db1', 'accepted', 2)
+        Recorder(table, 2).count_points('db1', 'accepted', 3)
+
+        self.assertIn(
+            'influxproxy_points_total{database="db1",outcome="accepted"} 5',
+            Recorder(table, 1).render())
+
+    @istest
+    def shares_values_with_forked_processes(self):
+        table = MetricsTable(Layout(['db1']), 2)
+        context = multiprocessing.get_context('fork')
+        process = context.Process(
+            target=Recorder(table, 1).count_points,
+            args=('db1', 'accepted', 7))
+        process.start()
+        process.join()
+
+        self.assertIn(
+            'influxproxy_points_total{database="db1",outcome="accepted"} 7',
+            Recorder(table, 0).render())
+
+    @istest
+    def converts_nonzero_metrics_to_points(self):
+        self.recorder.count_points('db1', 'accepted', 3)
+        self.recorder.observe_write('db2', 0.25)
+
+        points = self.recorder.as_points({'host': 'web1'}, 1000)
+
+        by_name = {}
+        for point in points:
+            by_name.setdefault(point['measurement'], []).append(point)
+        self.assertEqual(by_name['influxproxy_points_total'], [{
+            'measurement': 'influxproxy_points_total',
+            'time': 1000,
+            'tags': {'host': 'web1', 'database': 'db1', 'outcome': 'accepted'},
+            'fields': {'value': 3},
+        }])
+        self.assertEqual(
+            by_name['influxproxy_backend_write_duration_seconds'][0]['fields'],
+            {'count': 1, 'sum': 0.25})
+        self.assertEqual(len(by_name['influxproxy_queue_points']), 3)
+        self.assertNotIn('influxproxy_request_duration_seconds', by_name)
+        self.assertNotIn('influxproxy_udp_bytes_total', by_name)
+
+
+class SharedMetricsTest(TestCase):
+    def tearDown(self):
+        metrics._table = None
+        use_slot(None)
+
+    @istest
+    def records_per_process_by_default(self):
+        recorder = get_recorder(['db1'])
+
+        self.assertIsNot(recorder.table, get_recorder(['db1']).table)
+        self.assertIsNone(claim_slot([]))
+        self.assertTrue(recorder.owner)
+
+    @istest
+    def claims_free_slots(self):
+        create_shared_metrics(['db1'], 3)
+
+        self.assertEqual(claim_slot([]), 0)
+        self.assertEqual(claim_slot([0, None, 2]), 1)
+        self.assertIsNone(claim_slot([0, 1, 2]))
+
+    @istest
+    def records_in_claimed_slot(self):
+        table = create_shared_metrics(['db1'], 3)
+        use_slot(2)
+
+        recorder = get_recorder(['db1'])
+
+        self.assertIs(recorder.table, table)
+        self.assertEqual(recorder.slot, 2)
+        self.assertTrue(recorder.owner)
+
+    @istest
+    def records_apart_without_a_slot(self):
+        table = create_shared_metrics(['db1'], 1)
+
+        recorder = get_recorder(['db1'])
+
+        self.assertIsNot(recorder.table, table)
+        self.assertEqual(recorder.slot, 0)
+        self.assertFalse(recorder.owner)
+
+
+class StatsReporterTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.recorder = create_recorder()
+        self.batcher = MagicMock()
+        self.batcher.buffers = {}
+        self.drivers = MagicMock()
+        self.drivers.drivers = {}
+        self.driver = MagicMock()
+        self.driver.encode.return_value = b'encoded'
+        self.drivers.get = AsyncMock(return_value=self.driver)
+        self.influxdb = {'database': 'stats', 'udp_port': 8089}
+
+    def create_reporter(self, influxdb=None):
+        return StatsReporter(
+            self.recorder, self.batcher, self.drivers, self.loop, influxdb)
+
+    @istest
+    def collects_queues_and_udp_stats(self):
+        reporter = self.create_reporter()
+        self.batcher.buffers['db1'] = MagicMock(
+            pending_points=5, pending_bytes=50)
+        stats = UDPStats()
+        self.drivers.drivers['udp'] = MagicMock()
+        self.drivers.drivers['udp'].writer.stats = stats
+        self.drivers.drivers['http'] = MagicMock()
+        self.drivers.drivers['http'].writer = object()
+
+        stats.bytes, stats.datagrams = 100, 2
+        reporter.collect()
+        stats.bytes, stats.datagrams = 150, 3
+        reporter.collect()
+
+        rendered = self.recorder.render()
+        self.assertIn('influxproxy_queue_points{database="db1"} 5', rendered)
+        self.assertIn('influxproxy_udp_bytes_total 150', rendered)
+        self.assertIn('influxproxy_udp_datagrams_total 3', rendered)
+
+    @istest
+    def schedules_collection_only_by_default(self):
+        reporter = self.create_reporter()
+
+        with patch.object(self.loop, 'call_later') as call_later:
+            reporter.start()
+
+        self.assertEqual(call_later.call_count, 1)
+        self.assertEqual(call_later.call_args[0][0], COLLECT_INTERVAL)
+
+    @istest
+    def schedules_emission_if_configured(self):
+        reporter = self.create_reporter(self.influxdb)
+
+        with patch.object(self.loop, 'call_later') as call_later:
+            reporter.start()
+
+        intervals = [args[0] for args, _ in call_later.call_args_list]
+        self.assertEqual(intervals, [COLLECT_INTERVAL, DEFAULT_EMIT_INTERVAL])
+
+    @asynctest
+    async def keeps_collecting_until_stopped(self):
+        reporter = self.create_reporter()
+        reporter.collect = MagicMock()
+
+        with patch('influxproxy.metrics.COLLECT_INTERVAL', 0.001):
+            reporter.start()
+            for _ in range(20):
+                await metrics.asyncio.sleep(0.001, loop=self.loop)
+            reporter.stop()
+        calls = reporter.collect.call_count
+        await metrics.asyncio.sleep(0.01, loop=self.loop)
+
+        self.assertGreater(calls, 1)
+        self.assertEqual(reporter.collect.call_count, calls)
+
+    @asynctest
+    async def emits_points_through_the_batcher(self):
+        reporter = self.create_reporter(self.influxdb)
+        self.recorder.count_points('db1', 'accepted', 3)
+
+        await reporter.emit()
+
+        self.drivers.get.assert_called_once_with(self.influxdb)
+        points = self.driver.encode.call_args[0][0]
+        self.assertTrue(points)
+        self.assertTrue(all(p['tags']['worker'] == 0 for p in points))
+        self.batcher.add.assert_called_once_with(
+            'stats', self.driver, b'encoded', len(points), self.influxdb)
+
+    @asynctest
+    async def logs_failed_emissions(self):
+        reporter = self.create_reporter(self.influxdb)
+        self.batcher.add.side_effect = RuntimeError('full')
+
+        with patch('influxproxy.metrics.logger') as logger:
+            await reporter.emit()
+
+        self.assertTrue(logger.exception.called)
+
+    @asynctest
+    async def doesnt_emit_overlapping(self):
+        reporter = self.create_reporter(self.influxdb)
+        reporter.emit = AsyncMock()
+
+        reporter._emit()
+        emitting = reporter._emitting
+        reporter._emit()
+        self.assertIs(reporter._emitting, emitting)
+        await emitting
+        reporter._emit()
+
+        self.assertIsNot(reporter._emitting, emitting)
+        await reporter._emitting
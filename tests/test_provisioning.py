@@ -0,0 +1,292 @@
+import asyncio
+import copy
+import fcntl
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from aiohttp import web
+from nose.tools import istest
+
+from .base import AsyncMock, LoopTestCase, asynctest
+from .fakes import FakeInfluxHTTP
+from influxproxy import configuration
+from influxproxy.configuration import Settings
+from influxproxy.provisioning import (
+    DEFAULT_CONCURRENCY,
+    DEFAULT_MARKER,
+    DEPLOYMENT_ENV,
+    DatabaseProvisioner,
+    configured_databases,
+    deployment_id,
+    provision,
+    start_provisioning,
+    stop_provisioning,
+)
+
+
+DATABASES = {'udp', 'testing', 'strict'}
+
+
+class ConfiguredDatabasesTest(TestCase):
+    @istest
+    def lists_configured_databases(self):
+        config = {'databases': {'db1': {}, 'db2': {}}}
+
+        self.assertEqual(configured_databases(config), {'db1', 'db2'})
+
+    @istest
+    def includes_stats_database(self):
+        config = {
+            'databases': {'db1': {}},
+            'metrics': {'influxdb': {'database': 'stats'}},
+        }
+
+        self.assertEqual(configured_databases(config), {'db1', 'stats'})
+
+
+class DeploymentIdTest(TestCase):
+    @istest
+    def comes_from_environment(self):
+        with patch.dict(os.environ, {DEPLOYMENT_ENV: 'deploy-1'}):
+            self.assertEqual(deployment_id(), 'deploy-1')
+
+    @istest
+    def defaults_to_process_id(self):
+        with patch.dict(os.environ, clear=True):
+            self.assertEqual(deployment_id(), str(os.getpid()))
+
+
+class DatabaseProvisionerTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backend = FakeInfluxHTTP(self.loop, databases={'udp'})
+        self.loop.run_until_complete(self.backend.start())
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.marker = os.path.join(self.directory, 'databases.json')
+        patcher = patch.dict(os.environ, {DEPLOYMENT_ENV: 'deploy-1'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.provisioner = self.create_provisioner()
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.backend.stop())
+        super().tearDown()
+
+    def create_provisioner(self, **kwargs):
+        backend_conf = {
+            'host': '127.0.0.1',
+            'port': self.backend.port,
+            'username': 'root',
+            'password': 'root',
+        }
+        return DatabaseProvisioner(
+            self.loop, backend_conf, self.marker, **kwargs)
+
+    def assert_queried(self, *queries):
+        self.assertEqual(self.backend.queries, list(queries))
+
+    @istest
+    def starts_from_config(self):
+        config = {
+            'backend': {
+                'host': 'influx', 'port': 8086,
+                'username': 'root', 'password': 'root',
+            },
+            'provisioning': {'concurrency': 2, 'marker': self.marker},
+        }
+
+        provisioner = DatabaseProvisioner.from_config(self.loop, config)
+
+        self.assertEqual(provisioner.url, 'http://influx:8086/query')
+        self.assertEqual(provisioner.concurrency, 2)
+        self.assertEqual(provisioner.marker, self.marker)
+        node = dict(config['backend'], host='influx-2')
+        provisioner = DatabaseProvisioner.from_config(self.loop, config, node)
+        self.assertEqual(provisioner.url, 'http://influx-2:8086/query')
+        self.assertEqual(provisioner.marker, self.marker + '.influx-2-8086')
+        del config['provisioning']
+        provisioner = DatabaseProvisioner.from_config(self.loop, config)
+        self.assertEqual(provisioner.concurrency, DEFAULT_CONCURRENCY)
+        self.assertEqual(provisioner.marker, DEFAULT_MARKER)
+
+    @asynctest
+    async def creates_only_missing_databases(self):
+        created = await self.provisioner.provision(DATABASES)
+
+        self.assertEqual(created, ['strict', 'testing'])
+        self.assertEqual(self.backend.databases, DATABASES)
+        self.assertEqual(self.backend.queries[0], ('GET', 'SHOW DATABASES'))
+        self.assertEqual(sorted(self.backend.queries[1:]), [
+            ('POST', 'CREATE DATABASE "strict"'),
+            ('POST', 'CREATE DATABASE "testing"'),
+        ])
+
+    @asynctest
+    async def provisions_once_per_deployment(self):
+        await self.provisioner.provision(DATABASES)
+        self.backend.queries.clear()
+
+        created = await self.create_provisioner().provision(DATABASES)
+
+        self.assertEqual(created, [])
+        self.assert_queried()
+
+    @asynctest
+    async def provisions_only_databases_new_to_deployment(self):
+        await self.provisioner.provision(DATABASES)
+        self.backend.queries.clear()
+
+        created = await self.provisioner.provision(DATABASES | {'new'})
+
+        self.assertEqual(created, ['new'])
+        self.assert_queried(
+            ('GET', 'SHOW DATABASES'), ('POST', 'CREATE DATABASE "new"'))
+
+    @asynctest
+    async def lists_existing_databases_once_on_restart(self):
+        await self.provisioner.provision(DATABASES)
+        self.backend.queries.clear()
+
+        with patch.dict(os.environ, {DEPLOYMENT_ENV: 'deploy-2'}):
+            created = await self.provisioner.provision(DATABASES)
+
+        self.assertEqual(created, [])
+        self.assert_queried(('GET', 'SHOW DATABASES'))
+
+    @asynctest
+    async def provisions_again_for_another_backend(self):
+        await self.provisioner.provision(DATABASES)
+        self.backend.queries.clear()
+        self.provisioner.url += '?'
+
+        await self.provisioner.provision(DATABASES)
+
+        self.assert_queried(('GET', 'SHOW DATABASES'))
+
+    @asynctest
+    async def ignores_unreadable_marker(self):
+        with open(self.marker, 'w') as marker:
+            marker.write('{')
+
+        created = await self.provisioner.provision(DATABASES)
+
+        self.assertEqual(created, ['strict', 'testing'])
+
+    @asynctest
+    async def bounds_concurrent_creations(self):
+        provisioner = self.create_provisioner(concurrency=2)
+        query = provisioner._query
+        in_flight = []
+        most = []
+
+        async def counting_query(*args):
+            in_flight.append(args)
+            most.append(len(in_flight))
+            try:
+                return await query(*args)
+            finally:
+                in_flight.pop()
+
+        provisioner._query = counting_query
+        databases = {'db{}'.format(i) for i in range(6)}
+
+        created = await provisioner.provision(databases)
+
+        self.assertEqual(created, sorted(databases))
+        self.assertEqual(max(most), 2)
+
+    @asynctest
+    async def retries_databases_that_failed(self):
+        self.backend.statuses = [200, 500]
+
+        with patch('influxproxy.provisioning.logger') as logger:
+            first = await self.provisioner.provision(DATABASES)
+
+        self.assertEqual(len(first), 1)
+        self.assertTrue(logger.error.called)
+        second = await self.provisioner.provision(DATABASES)
+        self.assertEqual(sorted(first + second), ['strict', 'testing'])
+
+    @asynctest
+    async def logs_failure_to_list_databases(self):
+        self.backend.statuses = [500]
+
+        with patch('influxproxy.provisioning.logger') as logger:
+            created = await self.provisioner.provision(DATABASES)
+
+        self.assertEqual(created, [])
+        self.assertTrue(logger.exception.called)
+        self.assertFalse(os.path.exists(self.marker))
+
+    @asynctest
+    async def gives_up_on_slow_backend(self):
+        self.backend.delay = 1
+        provisioner = self.create_provisioner(timeout=0.01)
+
+        with patch('influxproxy.provisioning.logger') as logger:
+            created = await provisioner.provision(DATABASES)
+
+        self.assertEqual(created, [])
+        self.assertTrue(logger.exception.called)
+
+    @asynctest
+    async def waits_for_other_workers(self):
+        with open(self.marker + '.lock', 'a') as lock_file, \
+                patch('influxproxy.provisioning.LOCK_POLL_INTERVAL', 0.001):
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            task = asyncio.ensure_future(
+                self.provisioner.provision(DATABASES), loop=self.loop)
+            await asyncio.sleep(0.02, loop=self.loop)
+            self.assert_queried()
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+            created = await task
+
+        self.assertEqual(created, ['strict', 'testing'])
+
+
+class StartProvisioningTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = patch.object(DatabaseProvisioner, 'provision', AsyncMock())
+        self.provision = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @asynctest
+    async def provisions_configured_databases(self):
+        await provision(self.loop)
+
+        self.provision.assert_called_once_with(DATABASES)
+
+    @asynctest
+    async def provisions_given_databases(self):
+        await provision(self.loop, ['new'])
+
+        self.provision.assert_called_once_with(['new'])
+
+    @asynctest
+    async def provisions_every_node_of_a_cluster(self):
+        reloaded = copy.deepcopy(configuration.settings.config)
+        reloaded['backend']['cluster'] = {
+            'nodes': [{'host': 'influx-1'}, {'host': 'influx-2'}]}
+
+        with patch.object(
+                configuration, 'settings', Settings.compile(reloaded)):
+            await provision(self.loop, ['new'])
+
+        self.assertEqual(self.provision.call_count, 2)
+
+    @asynctest
+    async def runs_in_background_until_shutdown(self):
+        app = web.Application(loop=self.loop)
+
+        start_provisioning(app)
+
+        self.assertIn(stop_provisioning, app.on_shutdown)
+        await app.shutdown()
+        with self.assertRaises(asyncio.CancelledError):
+            await app['provisioning']
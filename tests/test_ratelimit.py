@@ -0,0 +1,270 @@
+import multiprocessing
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from nose.tools import istest
+
+from influxproxy import ratelimit
+from influxproxy.ratelimit import (
+    HOLDER,
+    LOCKS,
+    RateLimitedError,
+    RateLimiter,
+    TokenBuckets,
+    create_shared_limiter,
+    get_limiter,
+    is_alive,
+)
+
+
+def dead_pid():
+    process = multiprocessing.get_context('fork').Process(target=int)
+    process.start()
+    process.join()
+    return process.pid
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketsTest(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = patch('influxproxy.ratelimit.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.buckets = TokenBuckets(2)
+        self.buckets.reset(0, 10)
+        self.buckets.reset(1, 10)
+
+    def take(self, cost, index=0):
+        return self.buckets.take(index, cost, rate=5, capacity=10)
+
+    @istest
+    def takes_tokens_until_empty(self):
+        self.assertEqual(self.take(6), 0)
+        self.assertEqual(self.take(4), 0)
+
+        self.assertEqual(self.take(1), 0.2)
+
+    @istest
+    def keeps_buckets_apart(self):
+        self.take(10)
+
+        self.assertEqual(self.take(10, index=1), 0)
+
+    @istest
+    def refills_over_time(self):
+        self.take(10)
+        self.clock.now += 1
+
+        self.assertEqual(self.take(5), 0)
+        self.assertEqual(self.take(1), 0.2)
+
+    @istest
+    def refills_up_to_capacity(self):
+        self.take(1)
+        self.clock.now += 100
+
+        self.assertEqual(self.take(10), 0)
+        self.assertGreater(self.take(1), 0)
+
+    @istest
+    def goes_into_debt_for_large_costs(self):
+        self.assertEqual(self.take(15), 0)
+
+        self.assertEqual(self.take(1), 1.2)
+
+    def hold_lock(self, pid, lock=0):
+        self.buckets.locks[lock].acquire()
+        HOLDER.pack_into(self.buckets.memory, 0, lock, pid)
+
+    def hold_lock_in_child(self, held, done):
+        lock = self.buckets._acquire()
+        held.set()
+        done.wait()
+        HOLDER.pack_into(self.buckets.memory, 0, lock, 0)
+        self.buckets.locks[lock].release()
+
+    @istest
+    def skips_limit_if_lock_is_busy(self):
+        self.take(10)
+        self.hold_lock(os.getpid())
+
+        with patch('influxproxy.ratelimit.logger') as logger:
+            self.assertEqual(self.take(1), 0)
+
+        logger.error.assert_called_once_with(
+            'Rate limits are not enforced, their lock is busy')
+
+    @istest
+    def replaces_lock_of_dead_worker(self):
+        self.take(10)
+        context = multiprocessing.get_context('fork')
+        process = context.Process(target=self.buckets._acquire)
+        process.start()
+        process.join()
+
+        with patch('influxproxy.ratelimit.logger') as logger:
+            self.assertGreater(self.take(1), 0)
+            self.assertGreater(self.take(1), 0)
+
+        logger.error.assert_called_once_with(
+            'Replaced the rate limit lock process %d died holding',
+            process.pid)
+        self.assertEqual(HOLDER.unpack_from(self.buckets.memory, 0), (1, 0))
+
+    @istest
+    def waits_out_a_slow_live_holder(self):
+        self.take(10)
+        context = multiprocessing.get_context('fork')
+        held, done = context.Event(), context.Event()
+        process = context.Process(
+            target=self.hold_lock_in_child, args=(held, done))
+        process.start()
+        held.wait()
+        self.clock.now += 1000
+
+        with patch('influxproxy.ratelimit.logger') as logger:
+            self.assertEqual(self.take(20), 0)
+        done.set()
+        process.join()
+
+        logger.error.assert_called_once_with(
+            'Rate limits are not enforced, their lock is busy')
+        self.assertEqual(self.take(10), 0)
+        self.assertGreater(self.take(1), 0)
+        self.assertEqual(HOLDER.unpack_from(self.buckets.memory, 0), (0, 0))
+        self.assertTrue(self.buckets.locks[0].acquire(False))
+        self.assertFalse(self.buckets.locks[0].acquire(False))
+
+    @istest
+    def skips_limit_while_another_worker_replaces_lock(self):
+        self.take(10)
+        self.hold_lock(dead_pid())
+        self.buckets.recovery_lock.acquire()
+
+        with patch('influxproxy.ratelimit.logger') as logger:
+            self.assertEqual(self.take(1), 0)
+
+        logger.error.assert_called_once_with(
+            'Rate limits are not enforced, their lock is busy')
+
+    @istest
+    def skips_limit_once_out_of_locks(self):
+        self.take(10)
+        pid = dead_pid()
+        self.hold_lock(pid, lock=LOCKS - 1)
+
+        with patch('influxproxy.ratelimit.logger') as logger:
+            self.assertEqual(self.take(1), 0)
+
+        logger.error.assert_any_call(
+            'No rate limit lock left to replace the one process %d '
+            'died holding', pid)
+
+    @istest
+    def counts_processes_it_cant_signal_as_alive(self):
+        with patch('influxproxy.ratelimit.os.kill',
+                   side_effect=PermissionError):
+            self.assertTrue(is_alive(1))
+
+        self.assertFalse(is_alive(dead_pid()))
+
+    @istest
+    def shares_buckets_with_forked_processes(self):
+        context = multiprocessing.get_context('fork')
+        process = context.Process(target=self.take, args=(10,))
+        process.start()
+        process.join()
+
+        self.assertGreater(self.take(1), 0)
+
+
+class RateLimiterTest(TestCase):
+    def setUp(self):
+        self.limiter = RateLimiter.from_config({'databases': {
+            'limited': {'rate_limit': {
+                'requests_per_second': 2,
+                'points_per_second': 100,
+                'burst': 2,
+            }},
+            'requests_only': {'rate_limit': {'requests_per_second': 1}},
+            'free': {},
+        }})
+
+    @istest
+    def builds_limits_from_config(self):
+        self.assertEqual(
+            sorted(self.limiter.requests), ['limited', 'requests_only'])
+        self.assertEqual(list(self.limiter.points), ['limited'])
+        self.assertEqual(self.limiter.requests['limited'].capacity, 4)
+        self.assertEqual(self.limiter.points['limited'].capacity, 200)
+        self.assertEqual(self.limiter.buckets.count, 3)
+
+    @istest
+    def refuses_invalid_limits(self):
+        for rate_limit in [{'requests_per_second': 0},
+                           {'points_per_second': 1, 'burst': 0}]:
+            with self.assertRaises(ValueError):
+                RateLimiter.from_config({'databases': {
+                    'db': {'rate_limit': rate_limit}}})
+
+    @istest
+    def limits_requests(self):
+        self.limiter.check_request('requests_only')
+
+        with self.assertRaises(RateLimitedError) as context:
+            self.limiter.check_request('requests_only')
+
+        self.assertEqual(context.exception.database, 'requests_only')
+        self.assertEqual(context.exception.retry_after, 1)
+
+    @istest
+    def limits_points(self):
+        self.limiter.check_points('limited', 150)
+        self.limiter.check_points('requests_only', 1000)
+
+        with self.assertRaises(RateLimitedError):
+            self.limiter.check_points('limited', 100)
+
+    @istest
+    def rounds_retry_after_up(self):
+        self.limiter.check_points('limited', 600)
+
+        with self.assertRaises(RateLimitedError) as context:
+            self.limiter.check_points('limited', 1)
+
+        self.assertEqual(context.exception.retry_after, 5)
+
+    @istest
+    def doesnt_limit_unknown_databases(self):
+        for _ in range(10):
+            self.limiter.check_request('free')
+            self.limiter.check_request('bogus')
+            self.limiter.check_points('free', 1000)
+
+
+class SharedLimiterTest(TestCase):
+    def tearDown(self):
+        ratelimit._shared = None
+
+    @istest
+    def creates_limiter_per_process_by_default(self):
+        config = {'databases': {}}
+
+        self.assertIsNot(get_limiter(config), get_limiter(config))
+
+    @istest
+    def returns_shared_limiter(self):
+        config = {'databases': {}}
+
+        limiter = create_shared_limiter(config)
+
+        self.assertIs(get_limiter(config), limiter)
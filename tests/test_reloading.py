@@ -0,0 +1,121 @@
+import asyncio
+import copy
+import os
+from unittest.mock import MagicMock, patch
+
+import yaml
+from nose.tools import istest
+
+from .base import LoopTestCase, asynctest
+from .test_configuration import write_config
+from influxproxy import configuration
+from influxproxy.configuration import config
+from influxproxy.reloading import ConfigReloader
+
+
+NEW_DATABASE = {'public_key': 'key', 'allow_from': '*'}
+
+
+class ConfigReloaderTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = patch.object(configuration, 'settings')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.config = copy.deepcopy(config)
+        self.path = write_config(self.config)
+        self.addCleanup(os.unlink, self.path)
+        configuration.settings = configuration.Settings.load(self.path)
+        self.reloader = ConfigReloader(self.loop, self.path, interval=10)
+
+    def rewrite(self):
+        with open(self.path, 'w') as settings_file:
+            yaml.safe_dump(self.config, settings_file)
+        mtime = configuration.settings.mtime + 1
+        os.utime(self.path, (mtime, mtime))
+
+    @istest
+    def does_nothing_while_file_is_unchanged(self):
+        settings = configuration.settings
+
+        self.assertFalse(self.reloader.check())
+
+        self.assertIs(configuration.settings, settings)
+
+    @istest
+    def does_nothing_if_file_is_gone(self):
+        self.reloader.path = self.path + '.gone'
+
+        self.assertFalse(self.reloader.check())
+
+    @asynctest
+    async def reloads_changed_file(self):
+        self.config['databases']['testing']['public_key'] = 'rotated'
+        self.rewrite()
+
+        self.assertTrue(self.reloader.check())
+
+        access = configuration.settings.access['testing']
+        self.assertTrue(access.check_key('rotated'))
+        self.assertIsNone(self.reloader.creating)
+        self.assertFalse(self.reloader.check())
+
+    @asynctest
+    async def provisions_new_databases(self):
+        self.config['databases']['new2'] = NEW_DATABASE
+        self.config['databases']['new1'] = NEW_DATABASE
+        self.rewrite()
+
+        with patch('influxproxy.reloading.provision') as provision:
+            self.assertTrue(self.reloader.reload())
+
+        provision.assert_called_once_with(self.loop, ['new1', 'new2'])
+        self.assertIs(self.reloader.creating, provision.return_value)
+
+    @istest
+    def keeps_settings_if_file_is_invalid(self):
+        settings = configuration.settings
+        del self.config['databases']
+        self.rewrite()
+
+        with patch('influxproxy.reloading.logger') as logger:
+            self.assertFalse(self.reloader.check())
+            self.assertFalse(self.reloader.check())
+
+        self.assertIs(configuration.settings, settings)
+        self.assertEqual(logger.exception.call_count, 1)
+
+    @istest
+    def keeps_settings_if_file_cant_be_read(self):
+        settings = configuration.settings
+        self.reloader.path = self.path + '.gone'
+
+        with patch('influxproxy.reloading.logger'):
+            self.assertFalse(self.reloader.reload())
+
+        self.assertIs(configuration.settings, settings)
+        self.assertIsNone(self.reloader.seen_mtime)
+
+    @asynctest
+    async def checks_periodically_until_stopped(self):
+        self.reloader.interval = 0.001
+        self.reloader.check = MagicMock()
+
+        self.reloader.start()
+        await asyncio.sleep(0.02, loop=self.loop)
+        self.reloader.stop()
+        self.reloader.stop()
+        calls = self.reloader.check.call_count
+        await asyncio.sleep(0.01, loop=self.loop)
+
+        self.assertGreater(calls, 1)
+        self.assertEqual(self.reloader.check.call_count, calls)
+
+    @istest
+    def doesnt_check_without_interval(self):
+        self.reloader.interval = 0
+
+        with patch.object(self.loop, 'call_later') as call_later:
+            self.reloader.start()
+
+        self.assertFalse(call_later.called)
@@ -0,0 +1,276 @@
+from unittest import TestCase
+
+from nose.tools import istest
+
+from influxproxy.configuration import config, schemas
+from influxproxy.schemas import (
+    InvalidSchemaError,
+    Schema,
+    SchemaError,
+    compile_schemas,
+)
+
+
+DEFINITION = {
+    'max_string_length': 5,
+    'measurements': {
+        'page_load': {
+            'tags': ['browser'],
+            'fields': {
+                'duration': 'float',
+                'resources': 'integer',
+                'connection': 'string',
+                'cached': 'boolean',
+            },
+        },
+        'click': {
+            'fields': {'count': 'integer'},
+        },
+    },
+}
+
+
+class CompileSchemasTest(TestCase):
+    @istest
+    def compiles_configured_schemas(self):
+        self.assertEqual(list(schemas), ['strict'])
+        self.assertIsInstance(schemas['strict'], Schema)
+
+    @istest
+    def compiles_only_databases_with_schema(self):
+        compiled = compile_schemas({
+            'a': {'schema': DEFINITION},
+            'b': {},
+        })
+
+        self.assertEqual(list(compiled), ['a'])
+        measurement = compiled['a'].measurements['page_load']
+        self.assertEqual(measurement.tags, frozenset(['browser']))
+        self.assertEqual(measurement.fields['duration'], float)
+        self.assertEqual(measurement.line_fields[b'cached'], bool)
+        self.assertIsNone(compiled['a'].measurements['click'].tags)
+
+    @istest
+    def names_database_with_invalid_schema(self):
+        with self.assertRaises(InvalidSchemaError) as context:
+            compile_schemas({'a': {'schema': {}}})
+
+        self.assertIn("'a'", str(context.exception))
+
+    @istest
+    def rejects_invalid_definitions(self):
+        invalid = [
+            [],
+            {'measurements': []},
+            {'measurements': {'m': []}},
+            {'measurements': {'m': {'fields': {}}}},
+            {'measurements': {'m': {'fields': {'v': 'decimal'}}}},
+            {'measurements': {'m': {'fields': {'v': ['float']}}}},
+            {'measurements': {'m': {'tags': 'a', 'fields': {'v': 'float'}}}},
+            {'max_string_length': -1,
+             'measurements': {'m': {'fields': {'v': 'float'}}}},
+        ]
+        for definition in invalid:
+            with self.assertRaises(InvalidSchemaError):
+                Schema.compile(definition)
+
+
+class ValidatePointTest(TestCase):
+    def setUp(self):
+        self.schema = Schema.compile(DEFINITION)
+        self.point = {
+            'measurement': 'page_load',
+            'time': 1,
+            'tags': {'browser': 'ff'},
+            'fields': {
+                'duration': 1.5,
+                'resources': 3,
+                'connection': '4g',
+                'cached': False,
+            },
+        }
+
+    def assert_invalid(self):
+        with self.assertRaises(SchemaError):
+            self.schema.validate_points([self.point])
+
+    @istest
+    def accepts_valid_point(self):
+        self.schema.validate_points([self.point])
+
+    @istest
+    def accepts_any_tags_if_not_restricted(self):
+        self.schema.validate_point({
+            'measurement': 'click',
+            'tags': {'anything': 'goes'},
+            'fields': {'count': 1},
+        })
+
+    @istest
+    def converts_integers_of_float_fields(self):
+        self.point['fields']['duration'] = 2
+
+        self.schema.validate_point(self.point)
+
+        self.assertIs(type(self.point['fields']['duration']), float)
+
+    @istest
+    def accepts_missing_values(self):
+        self.point['fields']['connection'] = None
+
+        self.schema.validate_point(self.point)
+
+    @istest
+    def rejects_unknown_measurement(self):
+        self.point['measurement'] = 'other'
+
+        self.assert_invalid()
+
+    @istest
+    def rejects_unhashable_measurement(self):
+        self.point['measurement'] = ['page_load']
+
+        self.assert_invalid()
+
+    @istest
+    def rejects_unknown_tag(self):
+        self.point['tags']['os'] = 'linux'
+
+        self.assert_invalid()
+
+    @istest
+    def rejects_invalid_tags(self):
+        self.point['tags'] = ['browser']
+
+        self.assert_invalid()
+
+    @istest
+    def accepts_non_string_tag_values(self):
+        self.point['tags']['browser'] = 1234567
+
+        self.schema.validate_point(self.point)
+
+    @istest
+    def rejects_long_tag_value(self):
+        self.point['tags']['browser'] = 'firefox'
+
+        self.assert_invalid()
+
+    @istest
+    def rejects_unknown_field(self):
+        self.point['fields']['size'] = 1
+
+        self.assert_invalid()
+
+    @istest
+    def rejects_invalid_fields(self):
+        self.point['fields'] = [1]
+
+        self.assert_invalid()
+
+    @istest
+    def rejects_wrong_field_type(self):
+        for key, value in [('resources', 1.5), ('cached', 1),
+                           ('duration', True), ('connection', 1)]:
+            point = dict(self.point, fields={key: value})
+            with self.assertRaises(SchemaError):
+                self.schema.validate_point(point)
+
+    @istest
+    def rejects_long_string_value(self):
+        self.point['fields']['connection'] = 'broadband'
+
+        self.assert_invalid()
+
+
+class ValidateLineTest(TestCase):
+    def setUp(self):
+        self.schema = Schema.compile(DEFINITION)
+
+    def validate(self, line):
+        self.schema.validate_line(line, 0, len(line))
+
+    def assert_invalid(self, line):
+        with self.assertRaises(SchemaError):
+            self.validate(line)
+
+    @istest
+    def accepts_valid_line(self):
+        self.validate(
+            b'page_load,browser=ff duration=1.5,resources=3i,'
+            b'connection="4g",cached=t 1')
+
+    @istest
+    def checks_line_inside_data(self):
+        data = b'junk\npage_load duration=1\njunk'
+
+        self.schema.validate_line(data, 5, 25)
+
+    @istest
+    def accepts_escaped_names(self):
+        schema = Schema.compile({'measurements': {
+            'my metric': {'tags': ['a,b'], 'fields': {'x y': 'string'}},
+        }})
+        line = b'my\\ metric,a\\,b=1 x\\ y="a \\"b\\""'
+
+        schema.validate_line(line, 0, len(line))
+
+    @istest
+    def accepts_any_tags_if_not_restricted(self):
+        self.validate(b'click,anything=goes count=1i')
+
+    @istest
+    def remembers_valid_series(self):
+        self.validate(b'page_load,browser=ff duration=1')
+        self.validate(b'page_load,browser=ff duration=2')
+
+        self.assertEqual(list(self.schema._series), [b'page_load,browser=ff'])
+        self.assert_invalid(b'page_load,browser=ff size=1i')
+
+    @istest
+    def forgets_series_when_full(self):
+        self.schema.max_cached_series = 1
+
+        self.validate(b'page_load,browser=ff duration=1')
+        self.validate(b'page_load,browser=ie duration=1')
+
+        self.assertEqual(list(self.schema._series), [b'page_load,browser=ie'])
+
+    @istest
+    def rejects_unknown_measurement(self):
+        self.assert_invalid(b'other duration=1')
+
+    @istest
+    def rejects_unknown_tag(self):
+        self.assert_invalid(b'page_load,os=linux duration=1')
+
+    @istest
+    def rejects_long_tag_value(self):
+        self.assert_invalid(b'page_load,browser=firefox duration=1')
+
+    @istest
+    def accepts_escapes_within_length(self):
+        self.validate(b'page_load,browser=a\\ b\\ c duration=1')
+
+    @istest
+    def rejects_unknown_field(self):
+        self.assert_invalid(b'page_load size=1i')
+
+    @istest
+    def rejects_wrong_field_type(self):
+        for line in [b'page_load duration=1i', b'page_load resources=1',
+                     b'page_load cached="t"', b'page_load connection=t',
+                     b'page_load resources=1u,cached=1']:
+            self.assert_invalid(line)
+
+    @istest
+    def rejects_long_string_value(self):
+        self.assert_invalid(b'page_load connection="broadband"')
+
+    @istest
+    def uses_configured_schema(self):
+        schema = schemas['strict']
+
+        self.assertEqual(
+            schema.max_string_length,
+            config['databases']['strict']['schema']['max_string_length'])
@@ -0,0 +1,298 @@
+import asyncio
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from nose.tools import istest
+
+from .base import AsyncMock, LoopTestCase, asynctest
+from influxproxy.spill import (
+    CURSOR_NAME,
+    HEADER,
+    Replayer,
+    SpillQueue,
+    decode_record,
+    encode_record,
+)
+
+
+def temporary_directory(test):
+    directory = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, directory)
+    return os.path.join(directory, 'spill')
+
+
+class RecordTest(TestCase):
+    @istest
+    def decodes_what_it_encodes(self):
+        record = encode_record(b'cpu value=1i 1\n', 1, 'ms')
+
+        self.assertEqual(
+            decode_record(record, 0),
+            ((b'cpu value=1i 1\n', 1, 'ms'), len(record)))
+
+    @istest
+    def decodes_records_without_precision(self):
+        record = encode_record(b'cpu value=1i\n', 2)
+
+        self.assertEqual(
+            decode_record(record, 0)[0], (b'cpu value=1i\n', 2, None))
+
+    @istest
+    def refuses_corrupt_records(self):
+        record = bytearray(encode_record(b'cpu value=1i\n', 1))
+        record[-2] = ord('2')
+
+        self.assertEqual(decode_record(record, 0), (None, len(record)))
+
+    @istest
+    def refuses_records_cut_short(self):
+        record = encode_record(b'cpu value=1i\n', 1)
+
+        self.assertIsNone(decode_record(record[:-1], 0)[0])
+        self.assertIsNone(decode_record(record[:HEADER.size - 1], 0)[0])
+
+
+class SpillQueueTest(TestCase):
+    def setUp(self):
+        self.directory = temporary_directory(self)
+        self.metrics = MagicMock()
+        self.spill = self.open()
+
+    def open(self, **kwargs):
+        options = dict(
+            max_bytes=1000, segment_bytes=100, metrics=self.metrics)
+        options.update(kwargs)
+        spill = SpillQueue(self.directory, 'my_db', **options)
+        self.addCleanup(spill.close)
+        return spill
+
+    def reopen(self, **kwargs):
+        self.spill.close()
+        self.spill = self.open(**kwargs)
+
+    def replay(self, limit=None):
+        batches = []
+        record = self.spill.peek()
+        while record is not None and len(batches) != limit:
+            batches.append(record)
+            self.spill.commit()
+            record = self.spill.peek()
+        return batches
+
+    def segment_files(self):
+        return sorted(
+            name for name in os.listdir(self.directory)
+            if name != CURSOR_NAME)
+
+    @istest
+    def replays_batches_in_order(self):
+        self.spill.append(b'p1\n', 1)
+        self.spill.append(b'p2 1\n', 2, 'ms')
+
+        self.assertTrue(self.spill)
+        self.assertEqual(
+            self.replay(), [(b'p1\n', 1, None), (b'p2 1\n', 2, 'ms')])
+        self.assertFalse(self.spill)
+        self.assertIsNone(self.spill.peek())
+        self.assertEqual(self.spill.size, 0)
+        self.assertEqual(self.segment_files(), [])
+
+    @istest
+    def counts_spilled_and_replayed_bytes(self):
+        self.spill.append(b'p1\n', 1)
+        self.replay()
+
+        self.assertEqual(self.spill.spilled_bytes, 3)
+        self.assertEqual(self.spill.replayed_bytes, 3)
+        self.metrics.count_spill.assert_any_call('my_db', 'spilled', 3)
+        self.metrics.count_spill.assert_any_call('my_db', 'replayed', 3)
+
+    @istest
+    def rolls_segments_once_full(self):
+        for i in range(5):
+            self.spill.append(b'p' * 40, 1)
+
+        self.assertEqual(len(self.segment_files()), 3)
+        self.assertEqual(len(self.replay()), 5)
+
+    @istest
+    def keeps_appending_while_replaying(self):
+        self.spill.append(b'p1\n', 1)
+        self.assertEqual(self.spill.peek(), (b'p1\n', 1, None))
+
+        self.spill.append(b'p2\n', 1)
+        self.spill.commit()
+
+        self.assertEqual(self.replay(), [(b'p2\n', 1, None)])
+
+    @istest
+    def evicts_oldest_segments_past_the_cap(self):
+        self.reopen(max_bytes=150, segment_bytes=50)
+        for i in range(4):
+            self.spill.append('p{}'.format(i).encode() * 20, 1)
+
+        with patch('influxproxy.spill.logger') as logger:
+            self.spill.append(b'p4' * 20, 1)
+
+        self.assertTrue(logger.warning.called)
+        self.assertLessEqual(self.spill.size, 150)
+        self.assertEqual(
+            [data[:2] for data, _, _ in self.replay()], [b'p3', b'p4'])
+        size = len(encode_record(b'p0' * 20, 1))
+        self.assertEqual(self.spill.evicted_bytes, 3 * size)
+        self.metrics.count_spill.assert_any_call('my_db', 'evicted', size)
+
+    @istest
+    def evicts_segment_being_written(self):
+        self.reopen(max_bytes=60, segment_bytes=1000)
+        self.spill.append(b'p' * 30, 1)
+
+        self.spill.append(b'q' * 30, 1)
+
+        self.assertEqual(self.replay(), [(b'q' * 30, 1, None)])
+
+    @istest
+    def refuses_batches_bigger_than_the_cap(self):
+        self.reopen(max_bytes=20)
+
+        self.assertFalse(self.spill.append(b'p' * 20, 1))
+        self.assertFalse(self.spill)
+
+    @istest
+    def forgets_batches_evicted_while_replayed(self):
+        self.reopen(max_bytes=60, segment_bytes=10)
+        self.spill.append(b'p' * 30, 1)
+        self.spill.peek()
+        self.spill.append(b'q' * 30, 1)
+
+        self.spill.commit()
+
+        self.assertEqual(self.replay(), [(b'q' * 30, 1, None)])
+
+    @istest
+    def resumes_replay_after_a_restart(self):
+        for i in range(4):
+            self.spill.append('p{}'.format(i).encode() * 20, 1)
+        self.replay(limit=1)
+
+        self.reopen()
+
+        self.assertEqual(self.spill.size, self.spill.segments[0][1] + sum(
+            size for _, size in list(self.spill.segments)[1:]))
+        self.assertEqual(
+            [data[:2] for data, _, _ in self.replay()],
+            [b'p1', b'p2', b'p3'])
+
+    @istest
+    def reads_from_the_start_once_cursor_segment_is_gone(self):
+        for i in range(4):
+            self.spill.append('p{}'.format(i).encode() * 20, 1)
+        self.replay(limit=1)
+        self.spill.close()
+        os.unlink(os.path.join(self.directory, self.segment_files()[0]))
+
+        self.spill = self.open()
+
+        self.assertEqual(
+            [data[:2] for data, _, _ in self.replay()], [b'p2', b'p3'])
+
+    @istest
+    def appends_to_new_segments_after_a_restart(self):
+        self.spill.append(b'p1\n', 1)
+        self.reopen()
+
+        self.spill.append(b'p2\n', 1)
+
+        self.assertEqual(len(self.segment_files()), 2)
+        self.assertEqual(len(self.replay()), 2)
+
+    @istest
+    def skips_the_rest_of_a_torn_segment(self):
+        self.spill.append(b'p1\n', 1)
+        self.spill.append(b'p2\n', 1)
+        path = os.path.join(self.directory, self.segment_files()[0])
+        self.spill.close()
+        with open(path, 'r+b') as segment:
+            segment.truncate(os.stat(path).st_size - 1)
+        self.spill = self.open()
+        self.spill.append(b'p3\n', 1)
+
+        with patch('influxproxy.spill.logger') as logger:
+            batches = self.replay()
+
+        self.assertTrue(logger.warning.called)
+        self.assertEqual(batches, [(b'p1\n', 1, None), (b'p3\n', 1, None)])
+
+    @istest
+    def skips_empty_segments(self):
+        self.spill.close()
+        empty = os.path.join(self.directory, '0000000000000007.spill')
+        open(empty, 'w').close()
+        self.spill = self.open()
+        self.spill.append(b'p1\n', 1)
+
+        self.assertEqual(self.replay(), [(b'p1\n', 1, None)])
+
+
+class ReplayerTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.spill = SpillQueue(temporary_directory(self), 'my_db')
+        self.addCleanup(self.spill.close)
+        self.driver = AsyncMock()
+        self.replayer = Replayer(
+            self.spill, self.driver, self.loop, rate=1000, retry_after=10)
+
+    @asynctest
+    async def replays_batches_at_a_limited_rate(self):
+        self.spill.append(b'p' * 100, 1)
+        self.spill.append(b'q' * 100, 1, 'ms')
+
+        with patch('influxproxy.spill.asyncio.sleep',
+                   new_callable=AsyncMock) as sleep:
+            self.replayer.start(3)
+            await self.replayer._task
+
+        self.assertEqual(
+            [args[0] for args, _ in sleep.call_args_list], [3, 0.1, 0.1])
+        self.assertEqual(self.driver.write_lines.call_args_list, [
+            (('my_db', [b'p' * 100]),),
+            (('my_db', [b'q' * 100], 'ms'),),
+        ])
+        self.assertFalse(self.spill)
+        self.assertFalse(self.replayer.running)
+
+    @asynctest
+    async def retries_batches_that_fail(self):
+        self.spill.append(b'p1\n', 1)
+        self.driver.write_lines.side_effect = [OSError('down'), None]
+
+        with patch('influxproxy.spill.asyncio.sleep',
+                   new_callable=AsyncMock) as sleep, \
+                patch('influxproxy.spill.logger') as logger:
+            self.replayer.start()
+            await self.replayer._task
+
+        self.assertTrue(logger.warning.called)
+        self.assertEqual(sleep.call_args_list[1][0], (10,))
+        self.assertEqual(self.driver.write_lines.call_count, 2)
+        self.assertFalse(self.spill)
+
+    @asynctest
+    async def runs_once_at_a_time(self):
+        self.spill.append(b'p1\n', 1)
+        self.replayer.start(10)
+        task = self.replayer._task
+
+        self.replayer.start()
+
+        self.assertIs(self.replayer._task, task)
+        self.assertTrue(self.replayer.running)
+        self.replayer.stop()
+        self.replayer.stop()
+        await asyncio.sleep(0, loop=self.loop)
+        self.assertTrue(task.cancelled())
+        self.assertFalse(self.replayer.running)
@@ -0,0 +1,161 @@
+import asyncio
+import socket
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from nose.tools import istest
+
+from .base import AsyncMock, LoopTestCase, asynctest
+from influxproxy.udp import UDPEndpoint, UDPStats, UDPWriter, pack_datagrams
+
+
+class PackDatagramsTest(TestCase):
+    def setUp(self):
+        self.stats = UDPStats()
+
+    def pack(self, chunks, max_size):
+        return [
+            b''.join(datagram)
+            for datagram in pack_datagrams(chunks, max_size, self.stats)
+        ]
+
+    @istest
+    def packs_small_chunks_together(self):
+        datagrams = self.pack([b'a 1\n', b'b 2\n', b'c 3\n'], 8)
+
+        self.assertEqual(datagrams, [b'a 1\nb 2\n', b'c 3\n'])
+
+    @istest
+    def splits_chunks_between_lines(self):
+        datagrams = self.pack([b'aa 1\nbb 2\ncc 3\n'], 11)
+
+        self.assertEqual(datagrams, [b'aa 1\nbb 2\n', b'cc 3\n'])
+
+    @istest
+    def fills_datagrams_across_chunks(self):
+        datagrams = self.pack([b'aa 1\n', b'bb 2\ncc 3\n'], 11)
+
+        self.assertEqual(datagrams, [b'aa 1\nbb 2\n', b'cc 3\n'])
+
+    @istest
+    def drops_lines_larger_than_a_datagram(self):
+        datagrams = self.pack([b'a 1\nlooooong 2\nb 3\n', b'huge line'], 8)
+
+        self.assertEqual(datagrams, [b'a 1\n', b'b 3\n'])
+        self.assertEqual(self.stats.dropped_lines, 2)
+
+    @istest
+    def doesnt_copy_chunks(self):
+        chunk = b'a 1\nb 2\n'
+
+        datagram, = pack_datagrams([chunk], 100, self.stats)
+
+        self.assertIs(datagram[0].obj, chunk)
+
+    @istest
+    def packs_nothing_from_no_chunks(self):
+        self.assertEqual(self.pack([], 10), [])
+
+
+class UDPEndpointTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(('127.0.0.1', 0))
+        self.receiver.settimeout(1)
+        self.endpoint = self.loop.run_until_complete(
+            UDPEndpoint.create(self.receiver.getsockname(), self.loop))
+
+    def tearDown(self):
+        self.endpoint.close()
+        self.receiver.close()
+        super().tearDown()
+
+    @asynctest
+    async def sends_datagrams_without_blocking(self):
+        self.endpoint.send(b'a 1\n')
+
+        self.assertEqual(self.receiver.recv(100), b'a 1\n')
+        self.assertEqual(self.endpoint.backlog, 0)
+        self.assertFalse(self.endpoint.congested)
+
+    @asynctest
+    async def reports_congestion_until_resumed(self):
+        self.endpoint.pause_writing()
+        self.endpoint.pause_writing()
+        self.assertTrue(self.endpoint.congested)
+        drain = asyncio.ensure_future(self.endpoint.drain(), loop=self.loop)
+        await asyncio.sleep(0, loop=self.loop)
+        self.assertFalse(drain.done())
+
+        self.endpoint.resume_writing()
+        await drain
+
+        self.assertFalse(self.endpoint.congested)
+
+    @asynctest
+    async def drains_immediately_when_not_congested(self):
+        await self.endpoint.drain()
+
+    @asynctest
+    async def stops_congestion_when_connection_is_lost(self):
+        self.endpoint.pause_writing()
+
+        self.endpoint.close()
+        await asyncio.sleep(0, loop=self.loop)
+
+        self.assertFalse(self.endpoint.congested)
+
+    @asynctest
+    async def logs_send_errors(self):
+        with patch('influxproxy.udp.logger') as logger:
+            self.endpoint.error_received(ConnectionRefusedError())
+
+        self.assertTrue(logger.debug.called)
+
+
+class UDPWriterTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.endpoint = MagicMock(address=('127.0.0.1', 1234))
+        self.endpoint.congested = False
+        self.endpoint.drain = AsyncMock()
+        self.writer = UDPWriter(self.endpoint, payload_size=10)
+
+    def sent(self):
+        return [c[0][0] for c in self.endpoint.send.call_args_list]
+
+    @asynctest
+    async def sends_packed_datagrams(self):
+        await self.writer.write('my_db', [b'a 1\n', b'b 2\nc 3\n'])
+
+        self.assertEqual(self.sent(), [b'a 1\nb 2\n', b'c 3\n'])
+        self.assertEqual(self.writer.stats.datagrams, 2)
+        self.assertEqual(self.writer.stats.bytes, 12)
+        self.assertFalse(self.endpoint.drain.called)
+
+    @asynctest
+    async def waits_for_congested_endpoint(self):
+        self.endpoint.congested = True
+
+        await self.writer.write('my_db', [b'a 1\n'])
+
+        self.endpoint.drain.assert_called_once_with()
+        self.assertEqual(self.sent(), [b'a 1\n'])
+        self.assertEqual(self.writer.stats.stalls, 1)
+
+    @asynctest
+    async def logs_dropped_lines(self):
+        with patch('influxproxy.udp.logger') as logger:
+            await self.writer.write('my_db', [b'a very long line\nb 2\n'])
+
+        self.assertEqual(self.sent(), [b'b 2\n'])
+        self.assertEqual(self.writer.stats.dropped_lines, 1)
+        self.assertTrue(logger.warning.called)
+
+    @asynctest
+    async def doesnt_log_when_nothing_dropped(self):
+        with patch('influxproxy.udp.logger') as logger:
+            await self.writer.write('my_db', [b'a 1\n'])
+
+        self.assertFalse(logger.warning.called)
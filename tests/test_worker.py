@@ -0,0 +1,122 @@
+import signal
+from unittest import TestCase
+from unittest.mock import MagicMock, call, patch
+
+from nose.tools import istest
+
+from .base import AsyncMock, LoopTestCase, asynctest
+from influxproxy.worker import (
+    MEGABYTE,
+    RSS_CHECK_INTERVAL,
+    ProxyWorker,
+    current_rss,
+)
+
+
+class CurrentRSSTest(TestCase):
+    @istest
+    def reads_rss_from_procfs(self):
+        self.assertGreater(current_rss(), MEGABYTE)
+
+    @istest
+    def falls_back_to_peak_rss(self):
+        with patch('influxproxy.worker.open', side_effect=OSError,
+                   create=True), \
+                patch('influxproxy.worker.resource') as resource, \
+                patch('influxproxy.worker.sys') as sys:
+            resource.getrusage.return_value.ru_maxrss = 2048
+            sys.platform = 'linux'
+            self.assertEqual(current_rss(), 2048 * 1024)
+            sys.platform = 'darwin'
+            self.assertEqual(current_rss(), 2048)
+
+
+class ProxyWorkerTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.worker = ProxyWorker.__new__(ProxyWorker)
+        self.worker.loop = MagicMock(wraps=self.loop)
+        self.worker.pid = 1234
+        self.worker.alive = True
+        self.worker.app = MagicMock()
+        self.worker.cfg = MagicMock(graceful_timeout=10)
+
+    @istest
+    def builds_application_on_its_loop(self):
+        factory = self.worker.app.wsgi.return_value
+
+        with patch.dict('influxproxy.worker.config', {}, clear=True):
+            self.worker.load_wsgi()
+
+        factory.assert_called_once_with(self.worker.loop)
+        self.assertIs(self.worker.wsgi, factory.return_value)
+        self.assertIsNone(self.worker.max_rss)
+        self.assertFalse(self.worker.loop.call_later.called)
+
+    @istest
+    def watches_memory_if_configured(self):
+        with patch.dict('influxproxy.worker.config', {'max_worker_rss': 5}):
+            self.worker.load_wsgi()
+
+        self.assertEqual(self.worker.max_rss, 5 * MEGABYTE)
+        self.worker.loop.call_later.assert_called_once_with(
+            RSS_CHECK_INTERVAL, self.worker.check_rss)
+
+    @istest
+    def keeps_running_below_max_rss(self):
+        self.worker.max_rss = 10 * MEGABYTE
+
+        with patch('influxproxy.worker.current_rss', return_value=MEGABYTE):
+            self.worker.check_rss()
+
+        self.assertTrue(self.worker.alive)
+        self.worker.loop.call_later.assert_called_once_with(
+            RSS_CHECK_INTERVAL, self.worker.check_rss)
+
+    @istest
+    def stops_past_max_rss(self):
+        self.worker.max_rss = MEGABYTE
+
+        with patch('influxproxy.worker.current_rss',
+                   return_value=2 * MEGABYTE):
+            self.worker.check_rss()
+
+        self.assertFalse(self.worker.alive)
+        self.assertFalse(self.worker.loop.call_later.called)
+
+    @istest
+    def reloads_config_on_sighup(self):
+        self.worker.wsgi = MagicMock()
+        self.worker.cfg = MagicMock()
+
+        with patch.object(self.loop, 'add_signal_handler') as add_handler:
+            self.worker.init_signals()
+
+        add_handler.assert_any_call(
+            signal.SIGHUP, self.worker.reload_config)
+        self.worker.reload_config()
+        self.worker.wsgi['reloader'].reload.assert_called_once_with()
+
+    @asynctest
+    async def drains_application_after_connections(self):
+        events = MagicMock()
+        server = MagicMock()
+        server.close = events.close_server
+        handler = MagicMock()
+        handler.finish_connections = AsyncMock(
+            side_effect=events.finish_connections)
+        self.worker.servers = {server: handler}
+        self.worker.wsgi = MagicMock()
+        self.worker.wsgi.shutdown = AsyncMock(side_effect=events.shutdown)
+        self.worker.wsgi.finish = AsyncMock(side_effect=events.finish)
+
+        await self.worker.close()
+        await self.worker.close()
+
+        self.assertEqual(events.mock_calls, [
+            call.close_server(),
+            call.finish_connections(timeout=9.5),
+            call.shutdown(),
+            call.finish(),
+        ])
+        self.assertIsNone(self.worker.servers)